@@ -3,16 +3,21 @@ import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge, NullTrigger, Timer
 from cocotb.result import TestFailure, TestSuccess, ReturnValue
+from cocotb.utils import get_sim_time
 
 from valentyusb.usbcore.utils.packet import *
 from valentyusb.usbcore.endpoint import *
 from valentyusb.usbcore.pid import *
 from valentyusb.usbcore.utils.pprint import pp_packet
+from valentyusb.usbcore.utils.pcap import PcapWriter
+from valentyusb.usbcore.test import scenario
 
 from wishbone import WishboneMaster, WBOp
 
+import atexit
 import logging
 import csv
+import os
 
 def grouper_tofit(n, iterable):
     from itertools import zip_longest
@@ -34,6 +39,10 @@ def grouper_tofit(n, iterable):
     return fixed
 
 class UsbTest:
+    # Every test runs in the same simulation, so they share one capture
+    # which lines up with dump.vcd.
+    pcap = None
+
     def __init__(self, dut):
         self.dut = dut
         self.csrs = dict()
@@ -108,6 +117,13 @@ class UsbTest:
             EndpointType.epdir(epaddr).name,
             msg) % args)
 
+    def capture_packet(self, value, timestamp):
+        """Add a J/K encoded packet to the pcap file, timestamp in ns."""
+        if UsbTest.pcap is None:
+            UsbTest.pcap = PcapWriter(os.environ.get("PCAP", "usb.pcap"))
+            atexit.register(UsbTest.pcap.close)
+        UsbTest.pcap.write_jk(value, timestamp * 1e-9)
+
     # Host->Device
     @cocotb.coroutine
     def _host_send_packet(self, packet):
@@ -118,6 +134,7 @@ class UsbTest:
         packet = 'JJJJJJJJ' + wrap_packet(packet)
         self.assertEqual('J', packet[-1], "Packet didn't end in J: "+packet)
 
+        self.capture_packet(packet, get_sim_time('ns'))
         for v in packet:
             if v == '0' or v == '_':
                 # SE0 - both lines pulled low
@@ -223,6 +240,7 @@ class UsbTest:
             self.dut._log.info("Response came after {} bit times".format(bit_times / 4.0))
 
         # Read in the transmission data
+        start = get_sim_time('ns')
         result = ""
         for i in range(0, 1024):
             result += current()
@@ -233,6 +251,7 @@ class UsbTest:
             raise TestFailure("Packet didn't finish, " + msg)
         self.dut.usb_d_p = 1
         self.dut.usb_d_n = 0
+        self.capture_packet(result, start)
 
         # Check the packet received matches
         expected = pp_packet(wrap_packet(packet))
@@ -397,6 +416,37 @@ class UsbTest:
         for b in data:
             yield self.write(self.csrs['usb_epin_data'], b)
 
+    @cocotb.coroutine
+    def run_scenario(self, steps):
+        """Run a list of `scenario` steps against the cocotb test bench."""
+        for step in steps:
+            if isinstance(step, scenario.Token):
+                epdir = EndpointType.IN if step.pid == PID.IN else EndpointType.OUT
+                yield self.host_send_token_packet(step.pid, step.addr, EndpointType.epaddr(step.epnum, epdir))
+            elif isinstance(step, scenario.Data):
+                yield self.host_send_data_packet(step.pid, step.data)
+            elif isinstance(step, scenario.Handshake):
+                yield self._host_send_packet(handshake_packet(step.pid))
+            elif isinstance(step, scenario.ExpectData):
+                yield self.host_expect_data_packet(step.pid, step.data)
+            elif isinstance(step, scenario.ExpectHandshake):
+                yield self.host_expect_packet(handshake_packet(step.pid), "Expected {} packet.".format(step.pid.name))
+            elif isinstance(step, scenario.SetResponse):
+                yield self.set_response(step.epaddr, step.response)
+            elif isinstance(step, scenario.LoadData):
+                yield self.set_data(step.epaddr, step.data)
+            elif isinstance(step, scenario.ExpectSetup):
+                yield self.expect_setup(step.epaddr, step.data)
+            elif isinstance(step, scenario.ExpectReceived):
+                yield self.expect_data(step.epaddr, step.data, PID.ACK)
+            elif isinstance(step, scenario.ClearPending):
+                yield self.clear_pending(step.epaddr)
+            elif isinstance(step, scenario.ExpectPending):
+                pending = yield self.pending(step.epaddr)
+                self.assertEqual(bool(pending), step.pending, "Expected pending to be {}".format(step.pending))
+            else:
+                raise TestFailure("Unknown scenario step: {!r}".format(step))
+
     @cocotb.coroutine
     def transaction_status_in(self, addr, ep):
         epnum = EndpointType.epnum(ep)
@@ -3,16 +3,20 @@ import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge, NullTrigger, Timer
 from cocotb.result import TestFailure, TestSuccess, ReturnValue
+from cocotb.utils import get_sim_time
 
 from valentyusb.usbcore.utils.packet import *
 from valentyusb.usbcore.endpoint import *
 from valentyusb.usbcore.pid import *
 from valentyusb.usbcore.utils.pprint import pp_packet
+from valentyusb.usbcore.utils.pcap import PcapWriter
 
 from wishbone import WishboneMaster, WBOp
 
+import atexit
 import logging
 import csv
+import os
 
 def grouper_tofit(n, iterable):
     from itertools import zip_longest
@@ -34,6 +38,10 @@ def grouper_tofit(n, iterable):
     return fixed
 
 class UsbTest:
+    # Every test runs in the same simulation, so they share one capture
+    # which lines up with dump.vcd.
+    pcap = None
+
     def __init__(self, dut):
         self.dut = dut
         self.csrs = dict()
@@ -110,6 +118,13 @@ class UsbTest:
             EndpointType.epdir(epaddr).name,
             msg) % args)
 
+    def capture_packet(self, value, timestamp):
+        """Add a J/K encoded packet to the pcap file, timestamp in ns."""
+        if UsbTest.pcap is None:
+            UsbTest.pcap = PcapWriter(os.environ.get("PCAP", "usb.pcap"))
+            atexit.register(UsbTest.pcap.close)
+        UsbTest.pcap.write_jk(value, timestamp * 1e-9)
+
     # Host->Device
     @cocotb.coroutine
     def _host_send_packet(self, packet):
@@ -120,6 +135,7 @@ class UsbTest:
         packet = 'JJJJJJJJ' + wrap_packet(packet)
         self.assertEqual('J', packet[-1], "Packet didn't end in J: "+packet)
 
+        self.capture_packet(packet, get_sim_time('ns'))
         for v in packet:
             if v == '0' or v == '_':
                 # SE0 - both lines pulled low
@@ -225,6 +241,7 @@ class UsbTest:
             self.dut._log.info("Response came after {} bit times".format(bit_times / 4.0))
 
         # Read in the transmission data
+        start = get_sim_time('ns')
         result = ""
         for i in range(0, 1024):
             result += current()
@@ -235,6 +252,7 @@ class UsbTest:
             raise TestFailure("Packet didn't finish, " + msg)
         self.dut.usb_d_p = 1
         self.dut.usb_d_n = 0
+        self.capture_packet(result, start)
 
         # Check the packet received matches
         expected = pp_packet(wrap_packet(packet))
@@ -3,16 +3,21 @@ import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge, NullTrigger, Timer
 from cocotb.result import TestFailure, TestSuccess, ReturnValue
+from cocotb.utils import get_sim_time
 
 from valentyusb.usbcore.utils.packet import *
 from valentyusb.usbcore.endpoint import *
 from valentyusb.usbcore.pid import *
 from valentyusb.usbcore.utils.pprint import pp_packet
+from valentyusb.usbcore.utils.pcap import PcapWriter
+from valentyusb.usbcore.test import scenario
 
 from wishbone import WishboneMaster, WBOp
 
+import atexit
 import logging
 import csv
+import os
 
 def grouper_tofit(n, iterable):
     from itertools import zip_longest
@@ -34,6 +39,10 @@ def grouper_tofit(n, iterable):
     return fixed
 
 class UsbTest:
+    # Every test runs in the same simulation, so they share one capture
+    # which lines up with dump.vcd.
+    pcap = None
+
     def __init__(self, dut):
         self.dut = dut
         self.csrs = dict()
@@ -120,6 +129,13 @@ class UsbTest:
             EndpointType.epdir(epaddr).name,
             msg) % args)
 
+    def capture_packet(self, value, timestamp):
+        """Add a J/K encoded packet to the pcap file, timestamp in ns."""
+        if UsbTest.pcap is None:
+            UsbTest.pcap = PcapWriter(os.environ.get("PCAP", "usb.pcap"))
+            atexit.register(UsbTest.pcap.close)
+        UsbTest.pcap.write_jk(value, timestamp * 1e-9)
+
     # Host->Device
     @cocotb.coroutine
     def _host_send_packet(self, packet):
@@ -130,6 +146,7 @@ class UsbTest:
         packet = 'JJJJJJJJ' + wrap_packet(packet)
         self.assertEqual('J', packet[-1], "Packet didn't end in J: "+packet)
 
+        self.capture_packet(packet, get_sim_time('ns'))
         for v in packet:
             if v == '0' or v == '_':
                 # SE0 - both lines pulled low
@@ -235,6 +252,7 @@ class UsbTest:
             self.dut._log.info("Response came after {} bit times".format(bit_times / 4.0))
 
         # Read in the transmission data
+        start = get_sim_time('ns')
         result = ""
         for i in range(0, 4096):
             result += current()
@@ -245,6 +263,7 @@ class UsbTest:
             raise TestFailure("Packet didn't finish, " + msg)
         self.dut.usb_d_p = 1
         self.dut.usb_d_n = 0
+        self.capture_packet(result, start)
 
         # Check the packet received matches
         expected = pp_packet(wrap_packet(packet))
@@ -444,6 +463,37 @@ class UsbTest:
         for b in data:
             yield self.write(self.csrs['usb_in_data'], b)
 
+    @cocotb.coroutine
+    def run_scenario(self, steps):
+        """Run a list of `scenario` steps against the cocotb test bench."""
+        for step in steps:
+            if isinstance(step, scenario.Token):
+                epdir = EndpointType.IN if step.pid == PID.IN else EndpointType.OUT
+                yield self.host_send_token_packet(step.pid, step.addr, EndpointType.epaddr(step.epnum, epdir))
+            elif isinstance(step, scenario.Data):
+                yield self.host_send_data_packet(step.pid, step.data)
+            elif isinstance(step, scenario.Handshake):
+                yield self._host_send_packet(handshake_packet(step.pid))
+            elif isinstance(step, scenario.ExpectData):
+                yield self.host_expect_data_packet(step.pid, step.data)
+            elif isinstance(step, scenario.ExpectHandshake):
+                yield self.host_expect_packet(handshake_packet(step.pid), "Expected {} packet.".format(step.pid.name))
+            elif isinstance(step, scenario.SetResponse):
+                yield self.set_response(step.epaddr, step.response)
+            elif isinstance(step, scenario.LoadData):
+                yield self.set_data(step.epaddr, step.data)
+            elif isinstance(step, scenario.ExpectSetup):
+                yield self.expect_setup(step.epaddr, step.data)
+            elif isinstance(step, scenario.ExpectReceived):
+                yield self.expect_data(step.epaddr, step.data, PID.ACK)
+            elif isinstance(step, scenario.ClearPending):
+                yield self.clear_pending(step.epaddr)
+            elif isinstance(step, scenario.ExpectPending):
+                pending = yield self.pending(step.epaddr)
+                self.assertEqual(bool(pending), step.pending, "Expected pending to be {}".format(step.pending))
+            else:
+                raise TestFailure("Unknown scenario step: {!r}".format(step))
+
     @cocotb.coroutine
     def transaction_status_in(self, addr, ep):
         epnum = EndpointType.epnum(ep)
@@ -612,6 +662,38 @@ def test_control_transfer_in(dut):
             0x08, 0x09, 0x0A, 0x0B],
     )
 
+@cocotb.test()
+def test_scenario_control_transfer_in(dut):
+    harness = UsbTest(dut)
+    yield harness.reset()
+    yield harness.connect()
+
+    yield harness.write(harness.csrs['usb_address'], 20)
+    yield harness.run_scenario(scenario.control_in(
+        20,
+        # Get descriptor, Index 0, Type 03, LangId 0000, wLength 12
+        [0x80, 0x06, 0x00, 0x03, 0x00, 0x00, 0x0C, 0x00],
+        # 12 byte descriptor, max packet size 8 bytes
+        [0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07,
+            0x08, 0x09, 0x0A, 0x0B],
+        max_packet_size=8,
+    ))
+
+@cocotb.test()
+def test_scenario_control_transfer_out(dut):
+    harness = UsbTest(dut)
+    yield harness.reset()
+    yield harness.connect()
+
+    yield harness.write(harness.csrs['usb_address'], 20)
+    yield harness.run_scenario(scenario.control_out(
+        20,
+        # Set descriptor, wLength 10
+        [0x00, 0x07, 0x00, 0x03, 0x00, 0x00, 0x0A, 0x00],
+        [0x30, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39],
+        max_packet_size=8,
+    ))
+
 @cocotb.test()
 def test_control_transfer_in_data_out(dut):
     harness = UsbTest(dut)
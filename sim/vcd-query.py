@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# Query USB packets in dump.vcd without loading the whole file, e.g.:
+#
+#   ./vcd-query.py dump.vcd --list-tests
+#   ./vcd-query.py dump.vcd --test test_control_setup
+#   ./vcd-query.py dump.vcd --start 1000000 --end 2000000
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from valentyusb.usbcore.utils.vcdindex import main
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+
+from migen import *
+from migen.genlib import fifo
+from migen.genlib.cdc import MultiReg
+
+
+PoolCapacity = namedtuple("PoolCapacity", ["blocks", "packets", "endpoints"])
+
+
+def pool_capacity(size, block_size=16, max_packet_size=64, packets_per_endpoint=2):
+    """Work out what fits in a :obj:`PacketPool` of `size` bytes.
+
+    `packets` is the number of full packets the pool holds at once, counting
+    the CRC16 that OUT packets bring with them.  `endpoints` is the number of
+    endpoint directions that can each have `packets_per_endpoint` of them
+    queued at the same time.
+
+    >>> pool_capacity(4096)
+    PoolCapacity(blocks=256, packets=51, endpoints=25)
+    >>> pool_capacity(1024, block_size=8, max_packet_size=8, packets_per_endpoint=1)
+    PoolCapacity(blocks=128, packets=64, endpoints=64)
+    """
+    blocks = size // block_size
+    blocks_per_packet = -(-(max_packet_size + 2) // block_size)
+    packets = blocks // blocks_per_packet
+    return PoolCapacity(blocks, packets, packets // packets_per_endpoint)
+
+
+class PoolQueue(Module):
+    """One queue of a :obj:`PacketPool`.
+
+    It has the same signals as a ``migen`` FIFO, but ``readable`` is set while
+    there is anything in the queue.  ``dout`` holds the next byte once
+    ``valid`` is set, which is a couple of cycles after ``re``.
+    """
+    def __init__(self, size, blk_bits, off_bits):
+        self.din = Signal(8)
+        self.we = Signal()
+        self.writable = Signal()
+
+        self.dout = Signal(8)
+        self.readable = Signal()
+        self.re = Signal()
+        self.valid = Signal()
+
+        # Descriptor
+        self.hblk = Signal(blk_bits)
+        self.hoff = Signal(off_bits)
+        self.tblk = Signal(blk_bits)
+        self.toff = Signal(off_bits + 1)
+        self.count = Signal(max=size + 1)
+        self.has_blk = Signal()
+
+        self.in_valid = Signal()
+        self.in_data = Signal(8)
+        self.out_data = Signal(8)
+        self.fetching = Signal()
+
+        self.comb += [
+            self.readable.eq(self.valid | (self.count != 0) | self.in_valid | self.fetching),
+        ]
+
+
+class PacketPool(Module):
+    """A number of byte queues sharing one block of memory.
+
+    The memory is split into blocks of `block_size` bytes.  Blocks are taken
+    from a free list as a queue is written to, chained together, and given
+    back once they have been read, so a queue only holds memory while it has
+    data in it.  Each queue is a :obj:`PoolQueue`.
+
+    One queue write or read is handled per cycle, so this is meant for
+    traffic at USB rates rather than at the speed of the clock.
+
+    Parameters
+    ----------
+
+    queues : int
+        The number of queues.
+
+    size : int
+        The size of the memory in bytes.
+
+    block_size : int, optional
+        The unit that memory is handed out in.  Must be a power of two.
+
+    Attributes
+    ----------
+
+    queues : list of :obj:`PoolQueue`
+
+    free : Signal
+        The number of blocks that are not in use.
+    """
+    def __init__(self, queues, size=4096, block_size=16):
+        if block_size < 2 or block_size & (block_size - 1):
+            raise ValueError("block_size must be a power of two")
+        if size < 2 * block_size or size % block_size:
+            raise ValueError("size must be a multiple of block_size, and hold at least two blocks")
+
+        nblocks = size // block_size
+        blk_bits = bits_for(nblocks - 1)
+        off_bits = log2_int(block_size)
+
+        self.queues = [PoolQueue(size, blk_bits, off_bits) for _ in range(queues)]
+        self.submodules += self.queues
+        self.free = Signal(max=nblocks + 2)
+
+        self.specials.mem = Memory(8, size)
+        self.specials.wr = wr = self.mem.get_port(write_capable=True)
+        self.specials.rd = rd = self.mem.get_port()
+
+        # The next block of each block in use
+        self.specials.link = Memory(blk_bits, nblocks)
+        self.specials.link_wr = link_wr = self.link.get_port(write_capable=True)
+        self.specials.link_rd = link_rd = self.link.get_port()
+
+        self.submodules.free_list = free_list = fifo.SyncFIFOBuffered(width=blk_bits, depth=nblocks)
+        self.comb += self.free.eq(free_list.level)
+
+        # Every block starts out on the free list
+        init = Signal(max=nblocks + 1)
+        ready = Signal()
+        self.comb += ready.eq(init == nblocks)
+        self.sync += If(~ready, init.eq(init + 1))
+
+        # Pick a queue to write and a queue to read, writes first.  Moving
+        # on to the next block of a queue being read takes an extra cycle.
+        want_push = Signal()
+        want_pop = Signal()
+        push_sel = Signal(max=max(queues, 2))
+        pop_sel = Signal(max=max(queues, 2))
+        push = Signal()
+        pop = Signal()
+        link_pending = Signal()
+        link_sel = Signal(max=max(queues, 2))
+
+        pick_push = None
+        pick_pop = None
+        for i, q in enumerate(self.queues):
+            step_push = [push_sel.eq(i), want_push.eq(1)]
+            step_pop = [pop_sel.eq(i), want_pop.eq(1)]
+            can_pop = ~q.valid & ~q.fetching & (q.count != 0)
+            if pick_push is None:
+                pick_push = If(q.in_valid, *step_push)
+                pick_pop = If(can_pop, *step_pop)
+            else:
+                pick_push = pick_push.Elif(q.in_valid, *step_push)
+                pick_pop = pick_pop.Elif(can_pop, *step_pop)
+        self.comb += [
+            pick_push,
+            pick_pop,
+            push.eq(ready & ~link_pending & want_push),
+            pop.eq(ready & ~link_pending & ~want_push & want_pop),
+            If(~ready,
+                free_list.din.eq(init),
+                free_list.we.eq(1),
+            ),
+        ]
+        self.sync += link_pending.eq(0)
+
+        for i, q in enumerate(self.queues):
+            is_push = Signal()
+            is_pop = Signal()
+            # An empty queue takes the byte straight into `dout`
+            bypass = Signal()
+            room = Signal()
+            last = Signal()
+            end_of_blk = Signal()
+            self.comb += [
+                is_push.eq(push & (push_sel == i)),
+                is_pop.eq(pop & (pop_sel == i)),
+                bypass.eq((q.count == 0) & ~q.valid & ~q.fetching),
+                room.eq(q.has_blk & (q.toff != block_size)),
+                last.eq(q.count == 1),
+                end_of_blk.eq(q.hoff == block_size - 1),
+                q.writable.eq(~q.in_valid & (bypass | room | free_list.readable)),
+                q.dout.eq(q.out_data),
+
+                If(is_push,
+                    If(bypass,
+                    ).Elif(room,
+                        wr.adr.eq(Cat(q.toff[:off_bits], q.tblk)),
+                        wr.dat_w.eq(q.in_data),
+                        wr.we.eq(1),
+                    ).Elif(free_list.readable,
+                        wr.adr.eq(Cat(C(0, off_bits), free_list.dout)),
+                        wr.dat_w.eq(q.in_data),
+                        wr.we.eq(1),
+                        free_list.re.eq(1),
+                        link_wr.adr.eq(q.tblk),
+                        link_wr.dat_w.eq(free_list.dout),
+                        link_wr.we.eq(q.has_blk),
+                    ),
+                ),
+                If(is_pop,
+                    rd.adr.eq(Cat(q.hoff, q.hblk)),
+                    link_rd.adr.eq(q.hblk),
+                    If(last | end_of_blk,
+                        free_list.din.eq(q.hblk),
+                        free_list.we.eq(1),
+                    ),
+                ),
+            ]
+
+            self.sync += [
+                If(q.we,
+                    q.in_valid.eq(1),
+                    q.in_data.eq(q.din),
+                ).Elif(is_push,
+                    q.in_valid.eq(0),
+                    If(bypass,
+                        q.out_data.eq(q.in_data),
+                        q.valid.eq(1),
+                    ),
+                ),
+                If(is_push & ~bypass,
+                    If(room,
+                        q.toff.eq(q.toff + 1),
+                        q.count.eq(q.count + 1),
+                    ).Elif(free_list.readable,
+                        If(~q.has_blk,
+                            q.hblk.eq(free_list.dout),
+                            q.hoff.eq(0),
+                        ),
+                        q.has_blk.eq(1),
+                        q.tblk.eq(free_list.dout),
+                        q.toff.eq(1),
+                        q.count.eq(q.count + 1),
+                    ),
+                ),
+
+                If(is_pop,
+                    q.fetching.eq(1),
+                    q.count.eq(q.count - 1),
+                    If(last,
+                        q.has_blk.eq(0),
+                    ).Elif(end_of_blk,
+                        q.hoff.eq(0),
+                        link_pending.eq(1),
+                        link_sel.eq(i),
+                    ).Else(
+                        q.hoff.eq(q.hoff + 1),
+                    ),
+                ),
+                If(link_pending & (link_sel == i),
+                    q.hblk.eq(link_rd.dat_r),
+                ),
+                If(q.fetching,
+                    q.fetching.eq(0),
+                    q.out_data.eq(rd.dat_r),
+                    q.valid.eq(1),
+                ).Elif(q.re & q.valid,
+                    q.valid.eq(0),
+                ),
+            ]
+
+
+class PooledFifo(Module):
+    """A FIFO that keeps its bytes in a :obj:`PoolQueue`.
+
+    It has the interface of a ``migen`` ``AsyncFIFO``, with ``write`` and
+    ``read`` clock domains.  The pool is on the `pool` side, either
+    ``"write"`` or ``"read"``, and bytes cross to the other side through a
+    four byte ``AsyncFIFO``, which is too small to need a block RAM.
+
+    With the pool on the ``write`` side, ``readable`` is set while ``dout``
+    holds a byte, and ``pending`` is set while anything is left in the pool as
+    well.  With the pool on the ``read`` side, ``readable`` is set while there
+    is anything left in the pool, and ``pending`` is set while anything is on
+    its way to it.
+    """
+    def __init__(self, queue, pool):
+        self.din = Signal(8)
+        self.we = Signal()
+        self.writable = Signal()
+
+        self.dout = Signal(8)
+        self.readable = Signal()
+        self.re = Signal()
+        self.pending = Signal()
+
+        self.submodules.cross = cross = fifo.AsyncFIFO(width=8, depth=4)
+
+        if pool == "write":
+            more = Signal()
+            self.specials += MultiReg(queue.readable, more, odomain="read")
+            self.comb += [
+                queue.din.eq(self.din),
+                queue.we.eq(self.we),
+                self.writable.eq(queue.writable),
+
+                cross.din.eq(queue.dout),
+                cross.we.eq(queue.valid & cross.writable),
+                queue.re.eq(queue.valid & cross.writable),
+
+                self.dout.eq(cross.dout),
+                self.readable.eq(cross.readable),
+                self.pending.eq(cross.readable | more),
+                cross.re.eq(self.re),
+            ]
+        elif pool == "read":
+            self.comb += [
+                cross.din.eq(self.din),
+                cross.we.eq(self.we),
+                self.writable.eq(cross.writable),
+
+                queue.din.eq(cross.dout),
+                queue.we.eq(cross.readable & queue.writable),
+                cross.re.eq(cross.readable & queue.writable),
+
+                self.dout.eq(queue.dout),
+                self.readable.eq(queue.readable),
+                self.pending.eq(queue.readable | cross.readable),
+                queue.re.eq(self.re),
+            ]
+        else:
+            raise ValueError("pool must be \"write\" or \"read\", not {}".format(pool))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
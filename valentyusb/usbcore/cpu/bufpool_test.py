@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest import TestCase
+
+from migen import *
+
+from .bufpool import PacketPool, PooledFifo, pool_capacity
+
+
+class TestPacketPool(TestCase):
+    def wait_ready(self, dut):
+        for _ in range(dut.mem.depth):
+            yield
+        yield
+
+    def push(self, q, data):
+        for b in data:
+            self.assertTrue((yield q.writable))
+            yield q.din.eq(b)
+            yield q.we.eq(1)
+            yield
+            yield q.we.eq(0)
+            yield
+            yield
+
+    def pop(self, q, count):
+        data = []
+        for _ in range(count):
+            for _ in range(10):
+                if (yield q.valid):
+                    break
+                yield
+            else:
+                self.fail("queue never became valid")
+            data.append((yield q.dout))
+            yield q.re.eq(1)
+            yield
+            yield q.re.eq(0)
+            yield
+        return data
+
+    def test_one_queue(self):
+        dut = PacketPool(1, size=32, block_size=4)
+        q = dut.queues[0]
+        def stim():
+            yield from self.wait_ready(dut)
+            self.assertEqual((yield dut.free), 8)
+            self.assertFalse((yield q.readable))
+            data = list(range(1, 14))
+            yield from self.push(q, data)
+            self.assertTrue((yield q.readable))
+            # The first byte never goes into the memory
+            self.assertEqual((yield dut.free), 5)
+            self.assertEqual((yield from self.pop(q, len(data))), data)
+            yield
+            self.assertFalse((yield q.readable))
+            self.assertEqual((yield dut.free), 8)
+        run_simulation(dut, stim())
+
+    def test_interleaved(self):
+        dut = PacketPool(3, size=64, block_size=4)
+        def stim():
+            yield from self.wait_ready(dut)
+            expected = [[], [], []]
+            for i in range(30):
+                n = i % 3
+                expected[n].append(i)
+                yield from self.push(dut.queues[n], [i])
+            # Read some out, and write some more
+            got = []
+            for n in range(3):
+                got.append((yield from self.pop(dut.queues[n], 5)))
+            for i in range(30, 45):
+                n = i % 3
+                expected[n].append(i)
+                yield from self.push(dut.queues[n], [i])
+            for n in range(3):
+                got[n] += yield from self.pop(dut.queues[n], len(expected[n]) - 5)
+            self.assertEqual(got, expected)
+            yield
+            self.assertEqual((yield dut.free), 16)
+        run_simulation(dut, stim())
+
+    def test_full(self):
+        dut = PacketPool(2, size=8, block_size=4)
+        a, b = dut.queues
+        def stim():
+            yield from self.wait_ready(dut)
+            # One byte is held outside of the memory
+            yield from self.push(a, range(9))
+            self.assertFalse((yield a.writable))
+            self.assertTrue((yield b.writable))
+            yield from self.push(b, [0xaa])
+            self.assertFalse((yield b.writable))
+            self.assertEqual((yield from self.pop(a, 9)), list(range(9)))
+            yield from self.push(b, [0xbb, 0xcc])
+            self.assertEqual((yield from self.pop(b, 3)), [0xaa, 0xbb, 0xcc])
+        run_simulation(dut, stim())
+
+    def test_sizes(self):
+        with self.assertRaises(ValueError):
+            PacketPool(2, size=64, block_size=12)
+        with self.assertRaises(ValueError):
+            PacketPool(2, size=100, block_size=16)
+        with self.assertRaises(ValueError):
+            PacketPool(2, size=16, block_size=16)
+
+    def test_capacity(self):
+        cap = pool_capacity(4096)
+        self.assertEqual(cap.blocks, 256)
+        self.assertEqual(cap.packets, 51)
+        self.assertEqual(cap.endpoints, 25)
+
+
+class PooledFifoTestBench(Module):
+    def __init__(self, pool):
+        self.submodules.pool = ClockDomainsRenamer("usb_12")(PacketPool(1, size=64, block_size=8))
+        self.submodules.fifo = ClockDomainsRenamer({
+            "write": "usb_12" if pool == "write" else "sys",
+            "read": "sys" if pool == "write" else "usb_12",
+        })(PooledFifo(self.pool.queues[0], pool))
+
+
+class TestPooledFifo(TestCase):
+    def transfer(self, pool, data, byte_time=1):
+        """Move `data` through the FIFO, reading a byte at most every `byte_time` cycles."""
+        dut = PooledFifoTestBench(pool)
+        write_domain = "usb_12" if pool == "write" else "sys"
+        read_domain = "sys" if pool == "write" else "usb_12"
+        received = []
+
+        def writer():
+            for _ in range(80):
+                yield
+            for b in data:
+                while not (yield dut.fifo.writable):
+                    yield
+                yield dut.fifo.din.eq(b)
+                yield dut.fifo.we.eq(1)
+                yield
+                yield dut.fifo.we.eq(0)
+                yield
+
+        def reader():
+            for _ in range(120):
+                yield
+            self.assertTrue((yield dut.fifo.pending))
+            for _ in range(2000):
+                if len(received) == len(data):
+                    break
+                if (yield dut.fifo.readable):
+                    received.append((yield dut.fifo.dout))
+                    yield dut.fifo.re.eq(1)
+                    yield
+                    yield dut.fifo.re.eq(0)
+                    for _ in range(byte_time - 1):
+                        yield
+                yield
+            for _ in range(10):
+                yield
+            self.assertFalse((yield dut.fifo.readable))
+            self.assertFalse((yield dut.fifo.pending))
+
+        run_simulation(dut, {write_domain: writer(), read_domain: reader()},
+            clocks={"sys": 10, "usb_12": 14})
+        self.assertEqual(received, data)
+
+    def test_out(self):
+        self.transfer("write", list(range(40)))
+
+    def test_in(self):
+        # The USB core takes a byte every eight bit times
+        self.transfer("read", list(range(100, 140)), byte_time=8)
+
+    def test_bad_side(self):
+        dut = PacketPool(1, size=32, block_size=4)
+        with self.assertRaises(ValueError):
+            PooledFifo(dut.queues[0], "both")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+from migen import *
+
+from migen.genlib.fifo import AsyncFIFOBuffered, SyncFIFOBuffered
+
+from litex.soc.interconnect import stream
+from litex.soc.integration.doc import ModuleDoc, AutoDoc
+
+from ..pid import PID
+
+
+class BulkStream(Module, AutoDoc):
+    """A pair of bulk endpoints, as LiteX streams
+
+    Parameters
+    ----------
+
+    usb_core : :obj:`sm.transfer.UsbTransfer`
+        The USB core to listen to.
+
+    endpoint : int, optional
+        The endpoint number to use, in both directions.
+
+    depth : int, optional
+        The number of bytes buffered on the USB side, in each direction.
+        It must hold at least two packets.
+
+    Attributes
+    ----------
+
+    sink : :obj:`stream.Endpoint`
+        Bytes for the host to read from the ``IN`` endpoint, in the ``sys`` domain.
+
+    source : :obj:`stream.Endpoint`
+        Bytes the host wrote to the ``OUT`` endpoint, in the ``sys`` domain.
+
+    selected : Signal
+        Set while the current transaction is to one of these endpoints.  While
+        it is, the wrapping module should drive the USB core from ``arm``,
+        ``dtb``, ``data_send_have`` and ``data_send_payload``.
+
+    reset_toggles : Signal
+        Put both endpoints back to ``DATA0``, as ``SET_CONFIGURATION`` does.
+    """
+
+    def __init__(self, usb_core, endpoint=2, depth=128):
+        if depth < 128 or depth & (depth - 1):
+            raise ValueError("depth must be a power of two of at least 128")
+
+        self.sink = stream.Endpoint([("data", 8)])
+        self.source = stream.Endpoint([("data", 8)])
+
+        self.about = ModuleDoc(title="USB Bulk Stream", body="""
+            Moves bytes between the host and the fabric over a bulk ``OUT`` and a bulk ``IN``
+            endpoint, with no CPU involved.
+
+            Bytes written to ``sink`` go out in 64 byte packets.  A byte with ``last`` set ends
+            the transfer: the packet it is in goes out even if it is short, and if it is full,
+            a zero length packet follows it.  Until then, the ``IN`` endpoint NAKs.
+
+            Bytes the host writes come out of ``source``.  The last byte of a transfer, which is
+            the last byte before a short or zero length packet, has ``last`` set.  The ``OUT``
+            endpoint NAKs unless there is room for a whole packet, and a packet the host sends
+            again because it missed the ACK is dropped.""")
+
+        # # #
+
+        self.selected = Signal()
+        self.arm = Signal()
+        self.dtb = Signal()
+        self.data_send_have = Signal()
+        self.data_send_payload = Signal(8)
+        self.reset_toggles = Signal()
+
+        is_out = Signal()
+        is_in = Signal()
+        acked = Signal()
+        self.comb += [
+            is_out.eq((usb_core.tok == PID.OUT) & (usb_core.endp == endpoint)),
+            is_in.eq((usb_core.tok == PID.IN) & (usb_core.endp == endpoint)),
+            self.selected.eq(is_out | is_in),
+            acked.eq(usb_core.commit & ~usb_core.retry),
+        ]
+
+        # ---------------------
+        # OUT endpoint
+        # ---------------------
+        self.submodules.out_queue = out_queue = ClockDomainsRenamer("usb_12")(
+            SyncFIFOBuffered(width=9, depth=depth))
+        self.submodules.out_fifo = out_fifo = ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(
+            AsyncFIFOBuffered(width=9, depth=16))
+        self.comb += [
+            out_fifo.din.eq(out_queue.dout),
+            out_fifo.we.eq(out_queue.readable & out_fifo.writable),
+            out_queue.re.eq(out_queue.readable & out_fifo.writable),
+            self.source.valid.eq(out_fifo.readable),
+            self.source.data.eq(out_fifo.dout[:8]),
+            self.source.last.eq(out_fifo.dout[8]),
+            out_fifo.re.eq(self.source.valid & self.source.ready),
+        ]
+
+        # A packet the host sends again has the same toggle as the last one
+        out_toggle = Signal()
+        repeated = Signal()
+        self.comb += repeated.eq(usb_core.data_recv_pid[3] != out_toggle)
+
+        # The last two bytes of each packet are its CRC16, so bytes are
+        # held back two at a time and only counted once the next arrives.
+        last = [Signal(8) for _ in range(2)]
+        held = Signal(2)
+        parse = Signal()
+        count = Signal(7)
+        self.comb += parse.eq(is_out & usb_core.data_recv_put & ~repeated & (held == 2))
+        self.sync.usb_12 += [
+            If(usb_core.start,
+                held.eq(0),
+                count.eq(0),
+            ).Elif(is_out & usb_core.data_recv_put,
+                last[0].eq(last[1]),
+                last[1].eq(usb_core.data_recv_payload),
+                If(held != 2,
+                    held.eq(held + 1),
+                ),
+            ),
+            If(parse,
+                count.eq(count + 1),
+            ),
+        ]
+
+        # Whether a byte ends the transfer isn't known until the packet after
+        # it, if it's the last of a full one, so the last byte is kept back.
+        hold = Signal(8)
+        hold_valid = Signal()
+        out_done = Signal()
+        self.comb += [
+            out_done.eq(is_out & acked & ~repeated),
+            If(parse,
+                out_queue.din.eq(Cat(hold, 0)),
+                out_queue.we.eq(hold_valid),
+            ).Elif(out_done & (count != 64),
+                out_queue.din.eq(Cat(hold, 1)),
+                out_queue.we.eq(hold_valid),
+            ),
+        ]
+        self.sync.usb_12 += [
+            If(parse,
+                hold.eq(last[0]),
+                hold_valid.eq(1),
+            ).Elif(out_done & (count != 64),
+                hold_valid.eq(0),
+            ),
+            If(out_done,
+                out_toggle.eq(~out_toggle),
+            ),
+            If(usb_core.usb_reset | self.reset_toggles,
+                out_toggle.eq(0),
+            ),
+        ]
+
+        # ---------------------
+        # IN endpoint
+        # ---------------------
+        self.submodules.in_fifo = in_fifo = ClockDomainsRenamer({"write": "sys", "read": "usb_12"})(
+            AsyncFIFOBuffered(width=9, depth=16))
+        self.comb += [
+            in_fifo.din.eq(Cat(self.sink.data, self.sink.last)),
+            in_fifo.we.eq(self.sink.valid),
+            self.sink.ready.eq(in_fifo.writable),
+        ]
+
+        # Bytes are kept until the host has ACKed the packet they went out
+        # in, so that they can be sent again.  The ends of transfers are
+        # queued up alongside, as the pointer just past their last byte.
+        self.specials.in_buffer = in_buffer = Memory(8, depth)
+        self.specials.in_wr = in_wr = in_buffer.get_port(write_capable=True, clock_domain="usb_12")
+        self.specials.in_rd = in_rd = in_buffer.get_port(clock_domain="usb_12")
+        ptr_bits = log2_int(depth) + 1
+        self.submodules.in_ends = in_ends = ClockDomainsRenamer("usb_12")(
+            SyncFIFOBuffered(width=ptr_bits, depth=4))
+        head = Signal(ptr_bits)     # The next byte from the fabric goes here
+        tail = Signal(ptr_bits)     # The oldest byte not ACKed yet
+        rd = Signal(ptr_bits)       # The next byte to send
+        level = Signal(ptr_bits)
+        self.comb += [
+            level.eq(head - tail),
+            in_wr.adr.eq(head[:-1]),
+            in_wr.dat_w.eq(in_fifo.dout[:8]),
+            in_wr.we.eq(in_fifo.readable & (level != depth) & (~in_fifo.dout[8] | in_ends.writable)),
+            in_fifo.re.eq(in_wr.we),
+            in_ends.din.eq(head + 1),
+            in_ends.we.eq(in_wr.we & in_fifo.dout[8]),
+        ]
+        self.sync.usb_12 += If(in_wr.we, head.eq(head + 1))
+
+        # The next packet runs up to the end of the transfer, or is a full
+        # one.  A transfer that ends on a full packet is followed by an
+        # empty one, before its end is dropped.
+        in_dtb = Signal()
+        to_end = Signal(ptr_bits)
+        next_len = Signal(7)
+        next_ends = Signal()
+        packet_len = Signal(7)
+        packet_ends = Signal()
+        sent = Signal(7)
+        self.comb += [
+            to_end.eq(in_ends.dout - tail),
+            If(in_ends.readable & (to_end < 64),
+                next_len.eq(to_end),
+                next_ends.eq(1),
+            ).Else(
+                next_len.eq(64),
+            ),
+            in_rd.adr.eq(Mux(is_in & usb_core.data_send_get, rd + 1, rd)[:-1]),
+            self.data_send_payload.eq(in_rd.dat_r),
+            self.data_send_have.eq(sent != packet_len),
+            self.dtb.eq(in_dtb),
+            self.arm.eq(Mux(is_in,
+                in_ends.readable | (level >= 64),
+                out_queue.level <= depth - 64)),
+            in_ends.re.eq(is_in & acked & packet_ends),
+        ]
+        self.sync.usb_12 += [
+            If(usb_core.poll | usb_core.retry,
+                rd.eq(tail),
+                sent.eq(0),
+            ).Elif(is_in & usb_core.data_send_get,
+                rd.eq(rd + 1),
+                sent.eq(sent + 1),
+            ),
+            If(usb_core.poll,
+                packet_len.eq(next_len),
+                packet_ends.eq(next_ends),
+            ),
+            If(is_in & acked,
+                tail.eq(tail + packet_len),
+                in_dtb.eq(~in_dtb),
+            ),
+            If(usb_core.usb_reset | self.reset_toggles,
+                in_dtb.eq(0),
+            ),
+        ]
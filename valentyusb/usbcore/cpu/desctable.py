@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+from collections import namedtuple
+
+from migen import *
+from migen.genlib.fsm import FSM, NextState
+
+
+DescriptorCost = namedtuple("DescriptorCost", ["rom_bytes", "brams", "table_luts", "case_luts"])
+
+
+class DescriptorTable:
+    """Responses to control requests, packed into one ROM along with a table to find them.
+
+    Responses are added under the first four bytes of the ``SETUP`` packet,
+    as :obj:`DummyUsb` collects them: ``wRequestAndType << 16 | wValue``,
+    where ``wValue`` has its bytes in the order they arrive.
+
+    The ROM starts with the table, which has an entry for each response in
+    order of key: the key, most significant byte first, then the offset of
+    the response as two bytes, most significant first, and its length.  The
+    responses come after it.  A response that is already in the ROM, or that
+    starts with the bytes the ROM ends with, shares them.
+
+    >>> table = DescriptorTable()
+    >>> table.add(0x8006, 0x0003, [0x04, 0x03, 0x09, 0x04])
+    >>> table.add(0x8000, 0x0000, [0x09, 0x04])
+    >>> table.add(0x8006, 0x0103, [0x04, 0x06, 0x00])
+    >>> table.add(0x0009, 0x0100, [])
+    >>> [(hex(key), offset, length) for key, offset, length in table.entries]
+    [('0x90100', 0, 0), ('0x80000000', 30, 2), ('0x80060003', 28, 4), ('0x80060103', 31, 3)]
+    >>> table.contents[28:]
+    [4, 3, 9, 4, 6, 0]
+    """
+
+    ENTRY_SIZE = 7
+
+    def __init__(self):
+        self.responses = {}
+
+    def add(self, wRequestAndType, wValue, mem):
+        self.responses[wRequestAndType << 16 | wValue] = list(mem)
+        self._build()
+
+    def _build(self):
+        # Longest first, so that the short ones have the most to be found in
+        data = []
+        offsets = {}
+        for key, mem in sorted(self.responses.items(), key=lambda kv: -len(kv[1])):
+            if not mem:
+                offsets[key] = 0
+                continue
+            pos = bytes(data).find(bytes(mem))
+            if pos < 0:
+                overlap = len(mem) - 1
+                while overlap and data[len(data) - overlap:] != mem[:overlap]:
+                    overlap -= 1
+                pos = len(data) - overlap
+                data += mem[overlap:]
+            offsets[key] = pos
+
+        base = self.ENTRY_SIZE * len(self.responses)
+        assert base + len(data) <= 0x10000, "descriptors are too big"
+        table = []
+        self.entries = []
+        for key in sorted(self.responses):
+            length = len(self.responses[key])
+            offset = base + offsets[key] if length else 0
+            assert length < 256, "response to {:#x} is too long".format(key)
+            self.entries.append((key, offset, length))
+            table += list(key.to_bytes(4, "big")) + [offset >> 8, offset & 0xff, length]
+        self.contents = table + data
+
+    def estimate(self, lut_inputs=4, bram_bits=4096):
+        """Roughly how much of an FPGA this takes.
+
+        ``case_luts`` is what comparing the key against each response in turn
+        would take instead of ``table_luts``, the cost of :obj:`DescriptorLookup`.
+        The defaults are for the iCE40, with 4-input LUTs and 4 kbit block RAMs.
+
+        >>> table = DescriptorTable()
+        >>> for i in range(16):
+        ...     table.add(0x8006, i << 8 | 0x03, [0x04, 0x03, i, 0x00])
+        >>> table.estimate()
+        DescriptorCost(rom_bytes=176, brams=1, table_luts=66, case_luts=416)
+        """
+        rom_bytes = len(self.contents)
+        addr_bits = max(rom_bytes - 1, 1).bit_length()
+        brams = -(-rom_bytes * 8 // bram_bits)
+
+        def tree(inputs):
+            # LUTs to reduce `inputs` signals to one
+            luts = 0
+            while inputs > 1:
+                inputs, rest = divmod(inputs, lut_inputs)
+                luts += inputs
+                inputs += rest
+            return luts
+
+        # An 8-bit magnitude comparator, a four way mux for each bit of the
+        # key byte, an adder for the address, and the offset and length.
+        table_luts = 2 * tree(16) + 2 * 8 + 2 * addr_bits + 16 + 8
+        # A 32-bit comparator for each response, then a mux for the offset and
+        # length, which is an OR of each bit across all of the responses.
+        n = len(self.responses)
+        case_luts = n * tree(64) + (addr_bits + 8) * tree(n)
+        return DescriptorCost(rom_bytes, brams, table_luts, case_luts)
+
+
+class DescriptorLookup(Module):
+    """Find a response in a :obj:`DescriptorTable` by reading through its table.
+
+    Pulse ``start`` with ``key`` set, and ``busy`` is held while the table is
+    read through ``adr``, from a ROM read port whose data is given as
+    `dat_r`.  Once ``busy`` drops, ``offset`` and ``length`` give the
+    response, and ``length`` is 0 if there was none.  The table is in order,
+    so the search stops at the first entry past the key.
+    """
+    def __init__(self, table, dat_r):
+        self.key = Signal(32)
+        self.start = Signal()
+        self.busy = Signal()
+        self.adr = Signal(max=max(len(table.contents), 2))
+        self.offset = Signal(16)
+        self.length = Signal(8)
+
+        # # #
+
+        last = table.ENTRY_SIZE * (len(table.entries) - 1)
+        base = Signal.like(self.adr)
+        index = Signal(3)
+        want = Signal(8)
+        self.comb += [
+            self.adr.eq(base + index),
+            Case(index, {i: want.eq(self.key[24 - 8*i:32 - 8*i]) for i in range(4)}),
+        ]
+
+        next_entry = [
+            NextValue(base, base + table.ENTRY_SIZE),
+            NextValue(index, 0),
+            If(base == last,
+                NextState("IDLE"),
+            ),
+        ]
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            If(self.start,
+                NextValue(base, 0),
+                NextValue(index, 0),
+                NextValue(self.length, 0),
+                NextValue(self.offset, 0),
+                NextState("FETCH" if table.entries else "IDLE"),
+            )
+        )
+        # The read port has a cycle of latency
+        fsm.act("FETCH",
+            self.busy.eq(1),
+            NextState("CHECK"),
+        )
+        fsm.act("CHECK",
+            self.busy.eq(1),
+            NextValue(index, index + 1),
+            NextState("FETCH"),
+            Case(index, {
+                4: NextValue(self.offset[8:], dat_r),
+                5: NextValue(self.offset[:8], dat_r),
+                6: [
+                    NextValue(self.length, dat_r),
+                    NextState("IDLE"),
+                ],
+                "default": [
+                    If(dat_r < want,
+                        *next_entry
+                    ).Elif(dat_r > want,
+                        NextState("IDLE"),
+                    ),
+                ],
+            }),
+        )
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
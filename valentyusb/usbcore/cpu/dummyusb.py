@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 from enum import IntEnum
+from functools import reduce
+from operator import or_
 
 from migen import *
 from migen.genlib import fsm
@@ -10,8 +12,11 @@ from litex.soc.integration.doc import AutoDoc, ModuleDoc
 from ..endpoint import EndpointType, EndpointResponse
 from ..pid import PID, PIDTypes
 from ..sm.transfer import UsbTransfer
+from .desctable import DescriptorTable, DescriptorLookup
 from .usbwishbonebridge import USBWishboneBridge
 from .usbwishboneburstbridge import USBWishboneBurstBridge
+from .usbwishbonebulkbridge import USBWishboneBulkBridge
+from .bulkstream import BulkStream
 
 class DummyUsb(Module, AutoDoc, ModuleDoc):
     """DummyUSB Self-Enumerating USB Controller
@@ -31,6 +36,12 @@ class DummyUsb(Module, AutoDoc, ModuleDoc):
         Adding a debug bridge generates a Wishbone Master, which can take
         a large number of resources.  In exchange, it offers transparent debug.
 
+    bulk (bool, optional): Carry the debug bridge over bulk endpoint 1 with
+        :obj:`USBWishboneBulkBridge`, instead of over control transfers.
+
+    stream (bool, optional): Add a pair of bulk endpoints on endpoint 2, which
+        move data to and from the fabric through :obj:`BulkStream`.
+
     cdc (bool, optional): By default, ``eptri`` assumes that the CSR bus is in
         the same 12 MHz clock domain as the USB stack.  If ``cdc`` is set to
         True, then additional buffers will be placed on the ``.we`` and ``.re``
@@ -56,12 +67,20 @@ class DummyUsb(Module, AutoDoc, ModuleDoc):
     Attributes
     ----------
 
+    descriptors (:obj:`DescriptorTable`): The responses to control requests,
+        as laid out in the ROM.  ``descriptors.estimate()`` gives a rough
+        idea of what they cost.
+
     debug_bridge (:obj:`wishbone.Interface`): The wishbone interface master for debug
         If `debug=True`, this attribute will contain the Wishbone Interface
         master for you to connect to your desired Wishbone bus.
+
+    source, sink (:obj:`stream.Endpoint`): If `stream=True`, the data the host
+        writes to endpoint 2, and the data for the host to read from it, in
+        the ``sys`` domain.
     """
 
-    def __init__(self, iobuf, debug=False, burst=False, vid=0x1209, pid=0x5bf0,
+    def __init__(self, iobuf, debug=False, burst=False, bulk=False, stream=False, vid=0x1209, pid=0x5bf0,
         product="Fomu Bridge",
         manufacturer="Foosn",
         cdc=False,
@@ -108,15 +127,23 @@ class DummyUsb(Module, AutoDoc, ModuleDoc):
             usbstr.extend(bytes(s, 'utf_16_le'))
             return list(usbstr)
 
+        # Bulk endpoints, in pairs of OUT and IN
+        endpoints = []
+        if debug and bulk:
+            endpoints += [1, 0x81]
+        if stream:
+            endpoints += [2, 0x82]
+        config_length = 18 + 7 * len(endpoints)
+
         # Start with 0x8006
         descriptors = {
             # Config descriptor
             # 80 06 00 02
             0x0002: [
-                0x09, 0x02, 0x12, 0x00, 0x01, 0x01, 0x01, 0x80,
-                0x32, 0x09, 0x04, 0x00, 0x00, 0x00, 0xfe, 0x00,
-                0x00, 0x02,
-            ],
+                0x09, 0x02, config_length, 0x00, 0x01, 0x01, 0x01, 0x80,
+                0x32, 0x09, 0x04, 0x00, 0x00, len(endpoints),
+                0xff if endpoints else 0xfe, 0x00, 0x00, 0x02,
+            ] + sum(([0x07, 0x05, ep, 0x02, 0x40, 0x00, 0x00] for ep in endpoints), []),
 
             # Device descriptor
             # 80 06 00 01
@@ -163,18 +190,7 @@ class DummyUsb(Module, AutoDoc, ModuleDoc):
             0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
         ]
 
-        class MemoryContents:
-            def __init__(self):
-                self.contents = [0x00]
-                self.offsets = {}
-                self.lengths = {}
-
-            def add(self, wRequestAndType, wValue, mem):
-                self.offsets[wRequestAndType << 16 | wValue] = len(self.contents)
-                self.lengths[wRequestAndType << 16 | wValue] = len(mem)
-                self.contents = self.contents + mem
-
-        mem = MemoryContents()
+        mem = self.descriptors = DescriptorTable()
         for key, value in descriptors.items():
             mem.add(0x8006, key, value)
 
@@ -185,26 +201,30 @@ class DummyUsb(Module, AutoDoc, ModuleDoc):
         out_buffer = self.specials.out_buffer = Memory(8, len(mem.contents), init=mem.contents)
         self.specials.out_buffer_rd = out_buffer_rd = out_buffer.get_port(write_capable=False, clock_domain="usb_12")
 
+        # Requests are looked up in the table at the start of the ROM.
+        # The host is NAKed until that's done.
+        self.submodules.lookup = lookup = ClockDomainsRenamer("usb_12")(
+            DescriptorLookup(mem, out_buffer_rd.dat_r))
+        lookup_done = Signal()
+        last_busy = Signal()
+
         last_start = Signal()
 
         # Set to 1 if we have a response that matches the requested descriptor
         have_response = self.have_response = Signal()
 
         # Needs to be able to index Memory
-        response_addr = Signal(9)
-        response_len = Signal(6)
         response_ack = Signal()
         bytes_remaining = Signal(6)
-        bytes_addr = Signal(9)
+        bytes_addr = Signal.like(lookup.adr)
 
         # Respond to various descriptor requests
-        cases = {}
-        for key in mem.offsets:
-            cases[key] = [
-                response_len.eq(mem.lengths[key]),
-                response_addr.eq(mem.offsets[key]),
-            ]
-        self.comb += Case(usbPacket, cases)
+        self.comb += [
+            lookup.key.eq(usbPacket),
+            lookup.start.eq(usb_core.setup),
+            lookup_done.eq(last_busy & ~lookup.busy),
+        ]
+        self.sync.usb_12 += last_busy.eq(lookup.busy)
 
         # Used to respond to Transaction stage
         transaction_queued = Signal()
@@ -229,7 +249,13 @@ class DummyUsb(Module, AutoDoc, ModuleDoc):
 
         # Wire up debug signals if required
         data_phase = Signal()
-        if debug and not burst:
+        bulk_selected = Signal()
+        bulk_functions = []
+        if debug and bulk:
+            debug_bridge = USBWishboneBulkBridge(usb_core)
+            self.submodules.debug_bridge = debug_bridge
+            bulk_functions.append(debug_bridge)
+        elif debug and not burst:
             debug_bridge = USBWishboneBridge(usb_core, cdc=cdc, relax_timing=relax_timing)
             self.submodules.debug_bridge = debug_bridge
             self.comb += [
@@ -258,14 +284,32 @@ class DummyUsb(Module, AutoDoc, ModuleDoc):
                 usb_core.data_send_payload.eq(debug_sink_data),
                 have_response.eq(debug_sink_data_ready),
             ).Else(
-                usb_core.sta.eq(~(have_response | response_ack)),
+                usb_core.sta.eq(~(have_response | response_ack | lookup.busy)),
                 usb_core.arm.eq(have_response | response_ack),
                 usb_core.data_send_payload.eq(out_buffer_rd.dat_r),
                 have_response.eq(bytes_remaining > 0),
             ),
-            out_buffer_rd.adr.eq(bytes_addr),
+            out_buffer_rd.adr.eq(Mux(lookup.busy, lookup.adr, bytes_addr)),
             usb_core.data_send_have.eq(have_response),
         ]
+        if stream:
+            self.submodules.bulk_stream = bulk_stream = BulkStream(usb_core)
+            self.source = bulk_stream.source
+            self.sink = bulk_stream.sink
+            bulk_functions.append(bulk_stream)
+        for function in bulk_functions:
+            self.comb += [
+                If(function.selected,
+                    usb_core.dtb.eq(function.dtb),
+                    usb_core.sta.eq(0),
+                    usb_core.arm.eq(function.arm),
+                    usb_core.data_send_payload.eq(function.data_send_payload),
+                    have_response.eq(function.data_send_have),
+                ),
+                function.reset_toggles.eq(usb_core.setup & (wRequestAndType == 0x0009)),
+            ]
+        if bulk_functions:
+            self.comb += bulk_selected.eq(reduce(or_, [f.selected for f in bulk_functions]))
 
         self.sync.usb_12 += [
             usb_core.reset.eq(usb_core.error),
@@ -311,22 +355,24 @@ class DummyUsb(Module, AutoDoc, ModuleDoc):
                     configuration.eq(wValue[8:15]),
                     response_ack.eq(1),
                 ),
-                If(response_len > wLength,
+            ),
+            If(lookup_done,
+                If(lookup.length > wLength,
                     bytes_remaining.eq(wLength),
                 ).Else(
-                    bytes_remaining.eq(response_len),
+                    bytes_remaining.eq(lookup.length),
                 ),
-                bytes_addr.eq(response_addr),
+                bytes_addr.eq(lookup.offset),
             ),
 
-            If(usb_core.data_send_get,
+            If(usb_core.data_send_get & ~bulk_selected,
                 response_ack.eq(1),
                 bytes_addr.eq(bytes_addr + 1),
                 If(bytes_remaining,
                     bytes_remaining.eq(bytes_remaining - 1),
                 ),
             ),
-            If(self.data_recv_put_delayed,
+            If(self.data_recv_put_delayed & ~bulk_selected,
                 response_ack.eq(0),
                 transaction_queued.eq(1),
             ),
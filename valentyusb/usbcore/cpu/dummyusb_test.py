@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest import TestCase
+
+from migen import *
+
+from ..io import FakeIoBuf
+from ..test.host import WireHost
+from ..utils.bridge import ControlTransfer
+
+from .dummyusb import DummyUsb
+
+
+class TestDummyUsb(TestCase):
+    def test_get_descriptors(self):
+        dut = DummyUsb(FakeIoBuf(), vid=0x1234, pid=0x5678, product="Thing")
+        host = WireHost(dut.iobuf)
+        def get(request_type, request, value, length):
+            return (yield from host.control(ControlTransfer(request_type, request, value, 0, length)))
+        def stim():
+            yield from dut.iobuf.recv("J")
+            for _ in range(20):
+                yield
+            device = yield from get(0x80, 0x06, 0x0100, 64)
+            self.assertEqual(list(device[:12]),
+                [0x12, 0x01, 0x00, 0x02, 0x00, 0x00, 0x00, 0x40, 0x34, 0x12, 0x78, 0x56])
+            self.assertEqual(len(device), 18)
+            # Cut short by wLength
+            config = yield from get(0x80, 0x06, 0x0200, 9)
+            self.assertEqual(list(config), [0x09, 0x02, 0x12, 0x00, 0x01, 0x01, 0x01, 0x80, 0x32])
+            product = yield from get(0x80, 0x06, 0x0302, 255)
+            self.assertEqual(product, bytes([12, 3]) + "Thing".encode("utf_16_le"))
+            # The last entry in the table
+            compat = yield from get(0xc0, 0x7e, 0x0000, 64)
+            self.assertEqual(len(compat), 40)
+            self.assertEqual(compat[18:24], b"WINUSB")
+        run_simulation(dut, {"usb_48": stim()},
+            clocks={"usb_48": 4, "usb_12": 16})
+
+    def test_stream(self):
+        dut = DummyUsb(FakeIoBuf(), stream=True)
+        host = WireHost(dut.iobuf)
+        received = []
+        read = {}
+        def stim():
+            yield from dut.iobuf.recv("J")
+            for _ in range(20):
+                yield
+            yield from host.write_stream(2, list(range(70)))
+            # Sent again, as if the ACK had been lost
+            host.toggle[2] = not host.toggle[2]
+            self.assertTrue((yield from host.out(2, list(range(64, 70)))))
+            # A transfer that ends on a full packet
+            yield from host.write_stream(2, [0xaa] * 64)
+            self.assertTrue((yield from host.out(2, [])))
+            packets = []
+            while len(packets) < 3:
+                packet = yield from host.in_(2)
+                if packet is not None:
+                    packets.append(packet)
+            read["packets"] = packets
+            read["idle"] = yield from host.in_(2)
+            for _ in range(200):
+                yield
+        def fabric():
+            for data, last in [(b, 0) for b in range(63)] + [(63, 1), (0x55, 0), (0x56, 0), (0x57, 1)]:
+                yield dut.sink.data.eq(data)
+                yield dut.sink.last.eq(last)
+                yield dut.sink.valid.eq(1)
+                while True:
+                    ready = yield dut.sink.ready
+                    yield
+                    if ready:
+                        break
+            yield dut.sink.valid.eq(0)
+        @passive
+        def drain():
+            yield dut.source.ready.eq(1)
+            while True:
+                if (yield dut.source.valid):
+                    received.append(((yield dut.source.data), (yield dut.source.last)))
+                yield
+        run_simulation(dut, {"usb_48": stim(), "sys": [fabric(), drain()]},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+        self.assertEqual(received,
+            [(b, int(b == 69)) for b in range(70)] + [(0xaa, 0)] * 63 + [(0xaa, 1)])
+        # The full packet that ends the transfer is followed by an empty one
+        self.assertEqual(read["packets"], [list(range(64)), [], [0x55, 0x56, 0x57]])
+        self.assertIsNone(read["idle"])
+
+    def test_descriptor_cost(self):
+        dut = DummyUsb(FakeIoBuf(), debug=True, bulk=True)
+        table = dut.descriptors
+        data = sum(len(mem) for mem in table.responses.values())
+        # Shared runs take up less room than the table needs
+        self.assertLess(len(table.contents), table.ENTRY_SIZE * len(table.entries) + data)
+        cost = table.estimate()
+        self.assertEqual(cost.brams, 1)
+        self.assertLess(cost.table_luts, cost.case_luts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,7 @@ from litex.soc.cores.gpio import GPIOOut
 from ..endpoint import EndpointType, EndpointResponse
 from ..pid import PID, PIDTypes
 from ..sm.transfer import UsbTransfer
+from .bufpool import PacketPool, PooledFifo
 from .usbwishbonebridge import USBWishboneBridge
 
 
@@ -30,6 +31,49 @@ class FakeFifo(Module):
         self.re = Signal(1)
 
 
+class StagedFifo(Module):
+    """An ``AsyncFIFO`` that knows how full it is on the ``write`` side.
+
+    Bytes wait in a ``SyncFIFOBuffered`` of `depth` bytes in the ``write``
+    domain, where ``level`` counts them, and cross to the ``read`` side
+    through a four byte ``AsyncFIFO``, the same way as in a :obj:`PooledFifo`.
+
+    On the ``read`` side ``readable`` is set while ``dout`` holds a byte, and
+    ``pending`` is set while anything is left, even if it hasn't crossed yet.
+    """
+    def __init__(self, depth):
+        self.din = Signal(8)
+        self.we = Signal()
+        self.writable = Signal()
+        self.level = Signal(max=depth + 1)
+
+        self.dout = Signal(8)
+        self.readable = Signal()
+        self.re = Signal()
+        self.pending = Signal()
+
+        self.submodules.queue = queue = ClockDomainsRenamer("write")(fifo.SyncFIFOBuffered(width=8, depth=depth))
+        self.submodules.cross = cross = fifo.AsyncFIFO(width=8, depth=4)
+
+        more = Signal()
+        self.specials += cdc.MultiReg(queue.readable, more, odomain="read")
+        self.comb += [
+            queue.din.eq(self.din),
+            queue.we.eq(self.we),
+            self.writable.eq(queue.writable),
+            self.level.eq(queue.level),
+
+            cross.din.eq(queue.dout),
+            cross.we.eq(queue.readable & cross.writable),
+            queue.re.eq(queue.readable & cross.writable),
+
+            self.dout.eq(cross.dout),
+            self.readable.eq(cross.readable),
+            self.pending.eq(cross.readable | more),
+            cross.re.eq(self.re),
+        ]
+
+
 class Endpoint(Module, AutoCSR):
     def __init__(self):
         self.submodules.ev = ev.EventManager()
@@ -37,7 +81,8 @@ class Endpoint(Module, AutoCSR):
         self.ev.submodules.packet = ev.EventSourcePulse()
         self.ev.finalize()
 
-        self.trigger = self.ev.packet.trigger
+        self.trigger = Signal()
+        self.comb += self.ev.packet.trigger.eq(self.trigger)
 
         # Last PID?
         self.last_tok = CSRStatus(2)
@@ -95,6 +140,8 @@ class EndpointNone(Module):
         self.trigger = Signal()
         self.reset = Signal()
 
+        self.obuf_pending = Signal()
+
         self.last_tok = Module()
         self.last_tok.status = Signal(2)
 
@@ -108,12 +155,38 @@ class EndpointOut(Endpoint):
     Raises packet IRQ when new packet has arrived.
     CPU reads from the head CSR to get front data from FIFO.
     CPU writes to head CSR to advance the FIFO by one.
+
+    If `queue` is given, the data is kept in that :obj:`PoolQueue` instead
+    of a FIFO of its own.
+
+    If `flow_control` is set, the FIFO holds two packets of
+    `max_packet_size`, along with their CRC16s, and the ``flow`` CSR can
+    turn on ``auto`` mode.  The endpoint then ACKs whenever there is room for
+    another packet, and NAKs when there isn't, without waiting for the packet
+    event to be cleared.  The event is only raised once ``watermark`` bytes
+    are waiting on the USB side, the endpoint has started to NAK, or a short
+    or zero length packet has ended a transfer.
     """
-    def __init__(self):
+    def __init__(self, queue=None, flow_control=False, max_packet_size=64):
         Endpoint.__init__(self)
 
-        self.submodules.obuf = ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(
-            fifo.AsyncFIFOBuffered(width=8, depth=128))
+        depth = 2 * (max_packet_size + 2)
+        if flow_control:
+            if queue is not None:
+                raise ValueError("flow control needs the endpoint to have a FIFO of its own")
+            obuf = StagedFifo(depth)
+        elif queue is None:
+            obuf = fifo.AsyncFIFOBuffered(width=8, depth=128)
+        else:
+            obuf = PooledFifo(queue, pool="write")
+        self.submodules.obuf = ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(obuf)
+
+        # Set while anything is left to read, even if it isn't at `dout` yet
+        self.obuf_pending = Signal()
+        if queue is None and not flow_control:
+            self.comb += self.obuf_pending.eq(self.obuf.readable)
+        else:
+            self.comb += self.obuf_pending.eq(self.obuf.pending)
 
         self.drain_buffer = Signal()
         self.obuf_head = CSR(8)
@@ -121,10 +194,39 @@ class EndpointOut(Endpoint):
         self.comb += [
             self.obuf_head.w.eq(self.obuf.dout),
             self.obuf.re.eq(self.obuf_head.re | self.drain_buffer),
-            self.obuf_empty.status[0].eq(~self.obuf.readable),
+            self.obuf_empty.status[0].eq(~self.obuf_pending),
         ]
         self.ibuf = self.fake
 
+        if flow_control:
+            self.flow = CSRStorage(
+                fields=[
+                    CSRField("auto", description="Write a ``1`` here to ACK packets whenever there is room for them."),
+                    CSRField("watermark", size=8, offset=8, description="In ``auto`` mode, the number of bytes to wait for before raising the packet event."),
+                ],
+                description="Controls hardware flow control on this endpoint."
+            )
+            room = Signal()
+            # Bytes in the packet so far, along with its CRC16
+            received = Signal(max=max_packet_size + 3)
+            short = Signal()
+            self.comb += [
+                room.eq(self.obuf.level <= depth - (max_packet_size + 2)),
+                short.eq(received < max_packet_size + 2),
+                If(self.flow.fields.auto,
+                    self.response.eq(Cat(self.respond.storage[0] | ~room, self.respond.storage[1])),
+                    self.ev.packet.trigger.eq(self.trigger &
+                        ((self.obuf.level >= self.flow.fields.watermark) | ~room | short)),
+                ),
+            ]
+            self.sync += [
+                If(self.trigger | self.reset,
+                    received.eq(0),
+                ).Elif(self.obuf.we & (received != max_packet_size + 2),
+                    received.eq(received + 1),
+                ),
+            ]
+
 
 class EndpointIn(Endpoint):
     """Endpoint for Device->Host data.
@@ -132,15 +234,24 @@ class EndpointIn(Endpoint):
     Reads from the buffer memory.
     Raises packet IRQ when packet has been sent.
     CPU writes to the head CSR to push data onto the FIFO.
+
+    If `queue` is given, the data is kept in that :obj:`PoolQueue` instead
+    of a FIFO of its own.
     """
-    def __init__(self):
+    def __init__(self, queue=None):
         Endpoint.__init__(self)
 
-        self.submodules.ibuf = ClockDomainsRenamer({"write": "sys", "read": "usb_12"})(
-            fifo.AsyncFIFOBuffered(width=8, depth=128))
+        if queue is None:
+            ibuf = fifo.AsyncFIFOBuffered(width=8, depth=128)
+        else:
+            ibuf = PooledFifo(queue, pool="read")
+        self.submodules.ibuf = ClockDomainsRenamer({"write": "sys", "read": "usb_12"})(ibuf)
 
         xxxx_readable = Signal()
-        self.specials.crc_readable = cdc.MultiReg(self.ibuf.readable, xxxx_readable)
+        if queue is None:
+            self.specials.crc_readable = cdc.MultiReg(self.ibuf.readable, xxxx_readable)
+        else:
+            self.specials.crc_readable = cdc.MultiReg(self.ibuf.pending, xxxx_readable)
 
         self.ibuf_head = CSR(8)
         self.ibuf_empty = CSRStatus(1)
@@ -166,11 +277,34 @@ class PerEndpointFifoInterface(Module, AutoCSR):
     An input FIFO is read using CSR registers.
 
     Extra CSR registers set the response type (ACK/NAK/STALL).
+
+    If `pool_size` is given, the endpoints share a single :obj:`PacketPool`
+    of that many bytes, handed out in blocks of `pool_block_size` bytes as
+    data arrives, instead of each having a 128 byte FIFO in its own RAM.
+    The CSRs are the same either way.  Use :func:`pool_capacity` to see how
+    many packets and endpoints fit in a pool.
+
+    If `flow_control` is set, each ``OUT`` endpoint has a ``flow`` CSR that
+    lets it ACK packets as long as it has room for them, rather than after
+    the firmware has dealt with each one.  See :obj:`EndpointOut`.  This
+    can't be used along with a pool.
     """
 
-    def __init__(self, iobuf, endpoints=[EndpointType.BIDIR, EndpointType.IN, EndpointType.BIDIR], debug=False):
+    def __init__(self, iobuf, endpoints=[EndpointType.BIDIR, EndpointType.IN, EndpointType.BIDIR], debug=False,
+                 pool_size=None, pool_block_size=16, flow_control=False):
         size = 9
 
+        if flow_control and pool_size is not None:
+            raise ValueError("flow control can't be used along with a pool")
+
+        if pool_size is not None:
+            directions = sum(bool(endp & EndpointType.OUT) + bool(endp & EndpointType.IN) for endp in endpoints)
+            self.submodules.pool = ClockDomainsRenamer("usb_12")(
+                PacketPool(directions, size=pool_size, block_size=pool_block_size))
+            queues = iter(self.pool.queues)
+        else:
+            queues = None
+
         # USB Core
         self.submodules.usb_core = usb_core = UsbTransfer(iobuf)
 
@@ -205,7 +339,7 @@ class PerEndpointFifoInterface(Module, AutoCSR):
         trigger_all = []
         for i, endp in enumerate(endpoints):
             if endp & EndpointType.OUT:
-                exec("self.submodules.ep_%s_out = ep = EndpointOut()" % i)
+                exec("self.submodules.ep_%s_out = ep = EndpointOut(next(queues) if queues else None, flow_control)" % i)
                 oep = getattr(self, "ep_%s_out" % i)
                 if i == 0:
                     self.comb += oep.drain_buffer.eq(~iobuf.usb_pullup | setup_do_drain)
@@ -219,7 +353,7 @@ class PerEndpointFifoInterface(Module, AutoCSR):
             eps.append(oep)
 
             if endp & EndpointType.IN:
-                exec("self.submodules.ep_%s_in = ep = EndpointIn()" % i)
+                exec("self.submodules.ep_%s_in = ep = EndpointIn(next(queues) if queues else None)" % i)
                 iep = getattr(self, "ep_%s_in" % i)
                 ems.append(iep.ev)
             else:
@@ -262,7 +396,7 @@ class PerEndpointFifoInterface(Module, AutoCSR):
                             setup_do_drain.eq(1),
                         )
                     )
-                ).Elif(setup_do_drain & ~eps[ep0out_addr].obuf.readable,
+                ).Elif(setup_do_drain & ~eps[ep0out_addr].obuf_pending,
                     setup_do_drain.eq(0),
                 )
             )
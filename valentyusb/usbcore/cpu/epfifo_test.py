@@ -12,8 +12,9 @@ from ..utils.packet import crc16
 
 from ..test.common import BaseUsbTestCase, CommonUsbTestCase
 from ..test.clock import CommonTestMultiClockDomain
+from ..test.host import WireHost
 
-from .epfifo import PerEndpointFifoInterface
+from .epfifo import EndpointOut, PerEndpointFifoInterface, StagedFifo
 
 
 class TestPerEndpointFifoInterface(
@@ -233,5 +234,213 @@ class TestPerEndpointFifoInterface(
         return bool(status)
 
 
+class TestPooledEndpoints(TestCase):
+    def test_shared_pool(self):
+        dut = PerEndpointFifoInterface(FakeIoBuf(), pool_size=1024)
+        self.assertEqual(len(dut.pool.queues), 5)
+
+    def test_in_data(self):
+        dut = PerEndpointFifoInterface(FakeIoBuf(), pool_size=256)
+        ep = dut.ep_1_in
+        data = [0x12, 0x34, 0x56, 0x78]
+
+        def cpu():
+            # Let the pool fill its free list
+            for _ in range(40):
+                yield
+            self.assertTrue((yield ep.ibuf_empty.status))
+            free = yield dut.pool.free
+            for b in data:
+                yield ep.ibuf_head.r.eq(b)
+                yield ep.ibuf_head.re.eq(1)
+                yield
+                yield ep.ibuf_head.re.eq(0)
+                yield
+                yield
+            for _ in range(10):
+                yield
+            self.assertFalse((yield ep.ibuf_empty.status))
+            self.assertTrue((yield ep.ibuf.readable))
+            self.assertEqual((yield ep.ibuf.dout), data[0])
+            # Only one block is taken for the rest of the packet
+            self.assertEqual((yield dut.pool.free), free - 1)
+
+        run_simulation(dut, {"sys": cpu()},
+            clocks={"sys": 10, "usb_12": 10, "usb_48": 10})
+
+    def test_out_data(self):
+        dut = PerEndpointFifoInterface(FakeIoBuf(), pool_size=256)
+        ep = dut.ep_2_out
+        host = WireHost(dut.iobuf)
+        # Longer than a block, so it is chained across several
+        data = list(range(0x40, 0x54))
+        read = []
+
+        def wire():
+            yield from dut.iobuf.recv("J")
+            for _ in range(20):
+                yield
+            for _ in range(20):
+                if (yield from host.out(2, data)):
+                    break
+            else:
+                self.fail("OUT packet was never ACKed")
+            for _ in range(300):
+                yield
+
+        def cpu():
+            yield dut.pullup.out.storage.eq(1)
+            yield ep.respond.storage.eq(EndpointResponse.ACK)
+            yield
+            # Every event is raised while the pullup is off
+            yield ep.ev.pending.r.eq(0b11)
+            yield ep.ev.pending.re.eq(1)
+            yield
+            yield ep.ev.pending.re.eq(0)
+            for _ in range(40):
+                yield
+            free = yield dut.pool.free
+            while not (yield ep.ev.packet.pending):
+                yield
+            # Each byte is read as soon as it reaches the head
+            while not (yield ep.obuf_empty.status):
+                if (yield ep.obuf.readable):
+                    read.append((yield ep.obuf_head.w))
+                    yield ep.obuf_head.re.eq(1)
+                    yield
+                    yield ep.obuf_head.re.eq(0)
+                yield
+            for _ in range(10):
+                yield
+            # Every block has gone back to the pool
+            self.assertEqual((yield dut.pool.free), free)
+
+        run_simulation(dut, {"usb_48": wire(), "sys": cpu()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+        self.assertEqual(read, data + crc16(data))
+
+
+class StagedFifoTestBench(Module):
+    """Takes a byte from the FIFO on every cycle there is one, once `take` is set."""
+    def __init__(self):
+        self.submodules.fifo = fifo = ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(StagedFifo(132))
+        self.take = Signal()
+        self.comb += fifo.re.eq(fifo.readable & self.take)
+
+
+class TestStagedFifo(TestCase):
+    def test_back_to_back(self):
+        dut = StagedFifoTestBench()
+        data = list(range(40))
+        received = []
+
+        def writer():
+            for b in data:
+                while not (yield dut.fifo.writable):
+                    yield
+                yield dut.fifo.din.eq(b)
+                yield dut.fifo.we.eq(1)
+                yield
+            yield dut.fifo.we.eq(0)
+
+        def reader():
+            yield dut.take.eq(1)
+            for _ in range(500):
+                if (yield dut.fifo.readable):
+                    received.append((yield dut.fifo.dout))
+                yield
+            self.assertFalse((yield dut.fifo.pending))
+
+        run_simulation(dut, {"usb_12": writer(), "sys": reader()},
+            clocks={"sys": 10, "usb_12": 14})
+        self.assertEqual(received, data)
+
+
+class TestFlowControl(TestCase):
+    def packet(self, ep, length):
+        for i in range(length):
+            yield ep.obuf.din.eq(i)
+            yield ep.obuf.we.eq(1)
+            yield
+        yield ep.obuf.we.eq(0)
+        yield ep.trigger.eq(1)
+        yield
+        yield ep.trigger.eq(0)
+        for _ in range(4):
+            yield
+
+    def test_auto(self):
+        ep = EndpointOut(flow_control=True)
+        def usb():
+            yield ep.flow.fields.auto.eq(1)
+            yield ep.flow.fields.watermark.eq(100)
+            yield ep.respond.storage.eq(EndpointResponse.ACK)
+            yield
+            yield from self.packet(ep, 66)
+            # Room for another, and not enough to tell the firmware about
+            self.assertEqual((yield ep.response), EndpointResponse.ACK)
+            self.assertFalse((yield ep.ev.packet.pending))
+            yield from self.packet(ep, 66)
+            self.assertEqual((yield ep.response), EndpointResponse.NAK)
+            self.assertTrue((yield ep.ev.packet.pending))
+            # Reading makes room again, while the event is still pending
+            for _ in range(500):
+                yield
+            self.assertEqual((yield ep.response), EndpointResponse.ACK)
+            self.assertTrue((yield ep.ev.packet.pending))
+        def cpu():
+            for _ in range(300):
+                yield
+            data = []
+            for _ in range(70):
+                data.append((yield ep.obuf_head.w))
+                yield ep.obuf_head.re.eq(1)
+                yield
+                yield ep.obuf_head.re.eq(0)
+                yield
+            self.assertEqual(data, list(range(66)) + list(range(4)))
+        run_simulation(ep, {"usb_12": usb(), "sys": cpu()},
+            clocks={"sys": 10, "usb_12": 10})
+
+    def test_short_packets(self):
+        ep = EndpointOut(flow_control=True)
+        def usb():
+            yield ep.flow.fields.auto.eq(1)
+            yield ep.flow.fields.watermark.eq(100)
+            yield ep.respond.storage.eq(EndpointResponse.ACK)
+            yield
+            # A short packet ends the transfer, however little is waiting
+            yield from self.packet(ep, 12)
+            self.assertEqual((yield ep.response), EndpointResponse.ACK)
+            self.assertTrue((yield ep.ev.packet.pending))
+            yield ep.ev.pending.r.eq(0b11)
+            yield ep.ev.pending.re.eq(1)
+            yield
+            yield ep.ev.pending.re.eq(0)
+            yield
+            self.assertFalse((yield ep.ev.packet.pending))
+            # And so does one with only a CRC16
+            yield from self.packet(ep, 2)
+            self.assertTrue((yield ep.ev.packet.pending))
+        run_simulation(ep, {"usb_12": usb()},
+            clocks={"sys": 10, "usb_12": 10})
+
+    def test_manual(self):
+        ep = EndpointOut(flow_control=True)
+        def usb():
+            yield ep.respond.storage.eq(EndpointResponse.ACK)
+            yield
+            yield from self.packet(ep, 10)
+            # Without `auto`, every packet waits for the firmware
+            self.assertEqual((yield ep.response), EndpointResponse.NAK)
+            self.assertTrue((yield ep.ev.packet.pending))
+        run_simulation(ep, {"usb_12": usb()},
+            clocks={"sys": 10, "usb_12": 10})
+
+    def test_pool(self):
+        with self.assertRaises(ValueError):
+            PerEndpointFifoInterface(FakeIoBuf(), pool_size=1024, flow_control=True)
+
+
 if __name__ == '__main__':
     unittest.main()
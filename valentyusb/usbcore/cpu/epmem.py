@@ -22,25 +22,45 @@ class MemInterface(Module, AutoCSR):
     Interfaces the USB state machine core to the soft CPU.
 
     This interface has two memory regions:
-     * Output memory. Writable by CPU, readable by USB Core.
-     * Input memory. Writable by USB Core, readable by CPU.
+     * Output memory (`obuf`). Writable by USB Core, readable by CPU.
+     * Input memory (`ibuf`). Writable by CPU, readable by USB Core.
+
+    The CPU reaches both through `bus`, a 32-bit Wishbone slave of `2*depth`
+    bytes to map into the SoC, so that firmware can copy packets with
+    ordinary loads and stores.  The output memory is at offset 0 and the
+    input memory at offset `depth`, with each word holding four bytes in
+    little-endian order.
 
     Each endpoint has:
-     * A current pointer
-     * A current length
+     * A circular region of `region_size` bytes in each memory, starting
+       at `region_size` times the endpoint number
+     * A head and a tail pointer for each region
      * Control bits
      * A pending flag
 
-    Pointers are all relative to the start of the memory.
+    Pointers are all relative to the start of the memory, and wrap around
+    within their region.  A region is empty when its head and tail are
+    equal.
+
+    On output endpoints, the head (`optr`) is read only, and is moved past
+    each packet that is received, including its CRC16.  The CPU moves the
+    tail (`otail`) on as it reads packets.  The endpoint NAKs while its
+    region has no room for a packet of `max_packet_size` bytes and its
+    CRC16, so packets can be left where they are until the CPU is ready.
+    A SETUP packet empties the EP0 OUT region first.
 
-    On output endpoints, both the pointer and length are read only.
-    On input endpoints, the pointer and length are writable.
+    On input endpoints, the CPU writes data at the head (`ilen`) and then
+    moves it on.  The tail (`iptr`) is the next byte to send, and is moved
+    on once the host has acknowledged a packet.  Data is sent in packets of
+    up to `max_packet_size` bytes, so any number of packets can be queued
+    at once.
 
     To accept / send data from an endpoint you set the arm bit. The USB core
-    will then respond to the next request and update the pointer / length.
+    will then respond to the next request and update the pointers.  An IN
+    endpoint stays armed until its region is empty, and arming it while it
+    is empty sends a zero length packet.  An OUT endpoint stays armed.
 
     After a packet has been sent or received, the pending flag will be raised.
-    While the pending flag is raised, the USB core will respond with NAK.
 
     The `arm`, `dtb`, and `sta` registers are bitmasks.  They are packed
     in pairs of IO.  If you only have one endpoint, then `arm`, `dtb`, and
@@ -75,9 +95,26 @@ class MemInterface(Module, AutoCSR):
         self.comb += [bits[i].eq(csr.storage[i]) for i in range(l)]
         return Array(bits)
 
-    def __init__(self, iobuf, num_endpoints=3, depth=512):
+    def __init__(self, iobuf, num_endpoints=3, depth=512, region_size=None, max_packet_size=64):
+
+        ptr_width = bits_for(depth - 1)
+
+        if depth < 8 or depth & (depth - 1):
+            raise ValueError("depth must be a power of two")
+        word_bits = log2_int(depth // 4)
 
-        ptr_width = 9 # Signal(max=depth).size
+        if region_size is None:
+            region_size = 1 << ((depth // num_endpoints).bit_length() - 1)
+        if region_size & (region_size - 1) or region_size * num_endpoints > depth:
+            raise ValueError("region_size must be a power of two, and {} of them must fit in {} bytes".format(
+                num_endpoints, depth))
+        if region_size < max_packet_size + 3:
+            raise ValueError("region_size must hold a {} byte packet and its CRC16".format(max_packet_size))
+        region_bits = log2_int(region_size)
+        self.region_size = region_size
+
+        def ring_next(ptr):
+            return Cat((ptr[:region_bits] + 1)[:region_bits], ptr[region_bits:])
 
         self.submodules.usb_core = usb_core = UsbTransfer(iobuf)
 
@@ -132,11 +169,37 @@ class MemInterface(Module, AutoCSR):
         # Endpoint is ready
         self.arm = CSRStorage(signal_bits, write_from_dev=True)
 
+        # Output pathway
+        # -----------------------
+        self.specials.obuf = Memory(32, depth // 4)
+        self.specials.oport_wr = self.obuf.get_port(write_capable=True, we_granularity=8, clock_domain="usb_12")
+        self.specials.oport_rd = self.obuf.get_port(clock_domain="sys")
+
+        # `optr` is the head of each region, where the next packet goes, and
+        # `otail` is the tail, which the CPU moves on as it reads packets.
+        # An endpoint NAKs while its region has no room for another packet.
+        optrs = []
+        otails = []
+        orooms = []
+        for i in range(0, num_endpoints):
+            exec("self.optr_ep{0} = CSRStatus(ptr_width, name='optr_ep{0}')".format(i))
+            exec("self.otail_ep{0} = CSRStorage(ptr_width, reset=i*region_size, write_from_dev=(i == 0), name='otail_ep{0}')".format(i))
+            optr = Signal(ptr_width, reset=i*region_size)
+            otail = getattr(self, "otail_ep{}".format(i)).storage
+            oroom = Signal()
+            self.comb += [
+                getattr(self, "optr_ep{}".format(i)).status.eq(optr),
+                oroom.eq((otail[:region_bits] - optr[:region_bits] - 1)[:region_bits] >= max_packet_size + 2),
+            ]
+            optrs.append(optr)
+            otails.append(otail)
+            orooms.append(oroom)
+
         # Wire up the USB core control bits to the currently-active
         # endpoint bit.
         self.comb += [
             usb_core.sta.eq(self.csr_bits(self.sta)[eps_idx]),
-            usb_core.arm.eq(self.csr_bits(self.arm)[eps_idx]),
+            usb_core.arm.eq(self.csr_bits(self.arm)[eps_idx] & (eps_idx[0] | Array(orooms)[usb_core.endp])),
             usb_core.dtb.eq(~self.csr_bits(self.dtb)[eps_idx]),
             If(~iobuf.usb_pullup,
                 *all_trig,
@@ -145,51 +208,101 @@ class MemInterface(Module, AutoCSR):
             ),
         ]
 
-        # Output pathway
-        # -----------------------
-        self.specials.obuf = Memory(8, depth)
-        self.specials.oport_wr = self.obuf.get_port(write_capable=True, clock_domain="usb_12")
-        self.specials.oport_rd = self.obuf.get_port(clock_domain="sys")
-
-        optrs = []
-        for i in range(0, num_endpoints):
-            exec("self.optr_ep{0} = CSRStatus(ptr_width, name='optr_ep{0}')".format(i))
-            optrs.append(getattr(self, "optr_ep{}".format(i)).status)
-
+        # Never write more than a packet and its CRC16, even if the host does
         self.obuf_ptr = Signal(ptr_width)
+        orecv = Signal(max=max_packet_size + 3)
+        owrite = Signal()
         self.comb += [
-            self.oport_wr.adr.eq(self.obuf_ptr),
-            self.oport_wr.dat_w.eq(usb_core.data_recv_payload),
-            self.oport_wr.we.eq(usb_core.data_recv_put),
+            owrite.eq(usb_core.data_recv_put & (orecv != max_packet_size + 2)),
+            self.oport_wr.adr.eq(self.obuf_ptr[2:]),
+            self.oport_wr.dat_w.eq(Replicate(usb_core.data_recv_payload, 4)),
+            self.oport_wr.we.eq(Cat(*[owrite & (self.obuf_ptr[:2] == i) for i in range(4)])),
         ]
-        # On a commit, copy the current obuf_ptr to the CSR register.
         self.sync.usb_12 += [
-            If(usb_core.commit,
-                If((usb_core.tok == PID.OUT) | (usb_core.tok == PID.SETUP),
-                    Array(optrs)[usb_core.endp].eq(self.obuf_ptr),
-                ),
+            If(usb_core.poll,
+                self.obuf_ptr.eq(Array(optrs)[usb_core.endp]),
+                orecv.eq(0),
+            ).Elif(owrite,
+                self.obuf_ptr.eq(ring_next(self.obuf_ptr)),
+                orecv.eq(orecv + 1),
             ),
         ]
+        # On a commit, move the head of the region past the new packet.
+        for i in range(0, num_endpoints):
+            self.sync.usb_12 += [
+                If(usb_core.commit & (usb_core.endp == i),
+                    If((usb_core.tok == PID.OUT) | (usb_core.tok == PID.SETUP),
+                        optrs[i].eq(self.obuf_ptr),
+                    ),
+                ),
+            ]
 
         # Set up a signal to reset EP0 when we get a SETUP packet
         self.usb_ep0_reset = Signal()
         self.update_dtb = Signal()
         self.update_ctrl = Signal()
         self.should_check_ep0 = Signal()
-        #self.obuf_full = Signal()
-        #self.ibuf_empty = Signal()
 
-        # self.comb += [
-        #     self.usb_ep0_reset.eq(usb_core.start & (usb_core.tok == PID.SETUP))
-        # ]
+        # A SETUP packet starts a new control transfer, so drop anything left
+        # in the EP0 OUT region.  This also makes sure there is room for it.
+        self.comb += [
+            self.otail_ep0.dat_w.eq(optrs[0]),
+            self.otail_ep0.we.eq(self.should_check_ep0 & (usb_core.tok == PID.SETUP)),
+        ]
+
+        # Input pathway
+        # -----------------------
+        self.specials.ibuf = Memory(32, depth // 4)
+        self.specials.iport_wr = self.ibuf.get_port(write_capable=True, we_granularity=8, clock_domain="sys")
+        self.specials.iport_rd = self.ibuf.get_port(clock_domain="usb_12")
+
+        # `iptr` is the tail of each region, the next byte to send, and is
+        # moved on once the host has acknowledged a packet.  `ilen` is the
+        # head, which the CPU moves on as it queues data.  Data is sent in
+        # packets of up to `max_packet_size` bytes.
+        iptrs = []
+        ilens = []
+        iptr_csrs = []
+        for i in range(0, num_endpoints):
+            exec("self.iptr_ep{0} = CSRStorage(ptr_width, reset=i*region_size, write_from_dev=True, name='iptr_ep{0}')".format(i))
+            exec("self.ilen_ep{0} = CSRStorage(ptr_width, reset=i*region_size, name='ilen_ep{0}')".format(i))
+            iptr_csrs.append(getattr(self, "iptr_ep{}".format(i)))
+            iptrs.append(getattr(self, "iptr_ep{}".format(i)).storage)
+            ilens.append(getattr(self, "ilen_ep{}".format(i)).storage)
+
+        self.ibuf_ptr = Signal(ptr_width)
+        isent = Signal(max=max_packet_size + 1)
+        in_empty = Signal()
+        # The word is read a cycle after its address, so pick the byte with
+        # the address it was read with
+        ibuf_lane = Signal(2)
+        self.sync.usb_12 += ibuf_lane.eq(self.ibuf_ptr[:2])
+        self.comb += [
+            self.iport_rd.adr.eq(self.ibuf_ptr[2:]),
+            usb_core.data_send_payload.eq(self.iport_rd.dat_r.part(ibuf_lane * 8, 8)),
+            in_empty.eq(self.ibuf_ptr == Array(ilens)[usb_core.endp]),
+            usb_core.data_send_have.eq(~in_empty & (isent != max_packet_size)),
+        ]
+        # Start each packet from the tail, including one the host didn't get
+        self.sync.usb_12 += [
+            If(usb_core.poll | usb_core.retry,
+                self.ibuf_ptr.eq(Array(iptrs)[usb_core.endp]),
+                isent.eq(0),
+            ).Elif(usb_core.data_send_get,
+                self.ibuf_ptr.eq(ring_next(self.ibuf_ptr)),
+                isent.eq(isent + 1),
+            ),
+        ]
+        for i, iptr in enumerate(iptr_csrs):
+            self.comb += [
+                iptr.dat_w.eq(self.ibuf_ptr),
+                iptr.we.eq(usb_core.commit & ~usb_core.retry & (usb_core.tok == PID.IN) & (usb_core.endp == i)),
+            ]
 
         self.sync.usb_12 += [
             self.arm.we.eq(0),
             self.sta.we.eq(0),
             self.dtb.we.eq(0),
-            If(usb_core.data_recv_put,
-                self.obuf_ptr.eq(self.obuf_ptr + 1)
-            ),
 
             # If the EP0 needs resetting, then clear the EP0 IN and OUT bits, which
             # are stored in the lower two bits of the three control registers.
@@ -204,11 +317,16 @@ class MemInterface(Module, AutoCSR):
                     self.sta.dat_w.eq(self.sta.storage & ~0b11),
                     self.dtb.dat_w.eq(self.dtb.storage & ~0b11),
                 ),
-            ).Elif(usb_core.commit,
-                #self.update_ctrl.eq((self.obuf_full & ~eps_idx[0]) | (self.ibuf_empty & eps_idx[0])),
+            ).Elif(usb_core.commit & ~usb_core.retry,
                 self.update_ctrl.eq(1),
                 self.update_dtb.eq(1),
-                self.arm.dat_w.eq((self.arm.storage & ~(1 << eps_idx))),
+                # An IN endpoint stays armed until it has sent everything, and
+                # an OUT endpoint stays armed, NAKing while its region is full.
+                If(eps_idx[0] & in_empty,
+                    self.arm.dat_w.eq((self.arm.storage & ~(1 << eps_idx))),
+                ).Else(
+                    self.arm.dat_w.eq(self.arm.storage),
+                ),
                 self.sta.dat_w.eq(self.sta.storage),
                 self.dtb.dat_w.eq((self.dtb.storage ^ (1 << eps_idx))),
             ),
@@ -223,52 +341,24 @@ class MemInterface(Module, AutoCSR):
             )
         ]
 
-        #self.diff_addr = Signal(ptr_width)
-        #self.comb += [
-        #    self.diff_addr.eq(self.oport_rd.adr - self.oport_wr.adr),
-        #    # check if there are at least 64 Bytes (== FS max packet size) left in the out buffer
-        #    self.obuf_full.eq((self.diff_addr != 0) & (self.diff_addr <= 64)),
-        #    #self.obuf_full.eq(  (self.diff_addr[7::] == 0) &
-        #    #                    (self.diff_addr[0:7] != 0)),
-        #]
-
-        # Input pathway
+        # CPU pathway
         # -----------------------
-        self.specials.ibuf = Memory(8, depth)
-        self.specials.iport_wr = self.ibuf.get_port(write_capable=True, clock_domain="sys")
-        self.specials.iport_rd = self.ibuf.get_port(clock_domain="usb_12")
-
-        #for i in range(0, num_endpoints):
-        #    exec("self.submodules.iptr_ep{0} = CSRStorage(ptr_width, name='iptr_ep{0}')".format(i))
-        #    iptrs.append(getattr(self, "iptr_ep{}".format(i)).storage)
-        #
-        #    exec("self.submodules.ilen_ep{0} = CSRStorage(ptr_width, name='ilen_ep{0}')".format(i))
-        #    ilens.append(getattr(self, "ilen_ep{}".format(i)).storage)
-        assert num_endpoints == 3
-        self.iptr_ep0 = CSRStorage(ptr_width)
-        self.ilen_ep0 = CSRStorage(ptr_width)
-        self.iptr_ep1 = CSRStorage(ptr_width)
-        self.ilen_ep1 = CSRStorage(ptr_width)
-        self.iptr_ep2 = CSRStorage(ptr_width)
-        self.ilen_ep2 = CSRStorage(ptr_width)
-        iptrs = [self.iptr_ep0.storage,self.iptr_ep1.storage,self.iptr_ep2.storage]
-        ilens = [self.ilen_ep0.storage,self.ilen_ep1.storage,self.ilen_ep2.storage]
-
-        self.ibuf_ptr = Signal(ptr_width)
+        # Both memories as a Wishbone slave: the OUT memory first, read only,
+        # and then the IN memory.
+        self.bus = bus = wishbone.Interface()
+        in_ibuf = Signal()
         self.comb += [
-            self.iport_rd.adr.eq(self.ibuf_ptr),
-            usb_core.data_send_payload.eq(self.iport_rd.dat_r),
-            #self.iport_rd.re.eq(),
-        ]
-        # On a transfer start, copy the CSR register into ibuf_ptr
-        self.sync.usb_12 += [
-            If(usb_core.start,
-                self.ibuf_ptr.eq(Array(iptrs)[usb_core.endp]),
+            in_ibuf.eq(bus.adr[word_bits]),
+            self.oport_rd.adr.eq(bus.adr[:word_bits]),
+            self.iport_wr.adr.eq(bus.adr[:word_bits]),
+            self.iport_wr.dat_w.eq(bus.dat_w),
+            If(bus.cyc & bus.stb & bus.we & ~bus.ack & in_ibuf,
+                self.iport_wr.we.eq(bus.sel),
+            ),
+            If(in_ibuf,
+                bus.dat_r.eq(self.iport_wr.dat_r),
+            ).Else(
+                bus.dat_r.eq(self.oport_rd.dat_r),
             ),
         ]
-        self.sync.usb_12 += [
-            If(usb_core.data_send_get, self.ibuf_ptr.eq(self.ibuf_ptr + 1)),
-        ]
-        self.comb += [
-            usb_core.data_send_have.eq(self.ibuf_ptr != Array(ilens)[usb_core.endp]),
-        ]
+        self.sync += bus.ack.eq(bus.cyc & bus.stb & ~bus.ack)
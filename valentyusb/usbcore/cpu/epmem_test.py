@@ -5,14 +5,37 @@ from unittest import TestCase
 
 from migen import *
 
+from litex.soc.interconnect import csr_bus, wishbone
+from litex.soc.interconnect.csr import CSRStorage
+
 from ..test.common import BaseUsbTestCase, CommonUsbTestCase
 from ..io_test import FakeIoBuf
+from ..pid import PID
+from ..utils.packet import crc16, data_packet, handshake_packet, token_packet
 
+from .epfifo import PerEndpointFifoInterface
 from .epmem import MemInterface
+from .eptri import TriEndpointInterface
 from ..endpoint import EndpointType, EndpointResponse
 from ..test.clock import CommonTestMultiClockDomain
+from ..test.host import WireHost
 from ..utils.bits import get_bit, set_bit
 
+
+def read_byte(mem, addr):
+    """Read a byte from one of the 32-bit wide endpoint memories."""
+    word = yield mem[addr // 4]
+    return (word >> (8 * (addr % 4))) & 0xff
+
+
+def write_byte(mem, addr, v):
+    """Write a byte to one of the 32-bit wide endpoint memories."""
+    word = yield mem[addr // 4]
+    shift = 8 * (addr % 4)
+    yield mem[addr // 4].eq((word & ~(0xff << shift)) | (v << shift))
+    yield
+
+
 class TestMemInterface(
         BaseUsbTestCase,
         CommonUsbTestCase,
@@ -219,12 +242,18 @@ class TestMemInterface(
             print("Unknown EP response to {}: {}".format(self.format_epaddr(epaddr), v))
 
     # Get/set endpoint data ----------------
+    def ring_addr(self, ptr, offset):
+        """The address `offset` bytes on from `ptr`, within its region."""
+        size = self.dut.region_size
+        return (ptr & ~(size - 1)) | ((ptr + offset) & (size - 1))
+
     def set_data(self, epaddr, data):
         """Set an endpoints buffer to given data to be sent."""
         assert isinstance(data, (list, tuple))
         # self.ep_print(epaddr, "Set: %r", data)
 
-        ep_ptr = yield from self.get_ptr_csr(epaddr).read()
+        ep_len = self.get_len_csr(epaddr)
+        ep_ptr = yield from ep_len.read()
         buf = self.get_module(epaddr, "buf")
 
         # # Make sure the endpoint is empty
@@ -233,10 +262,9 @@ class TestMemInterface(
         #     empty, "Device->Host buffer not empty when setting data!")
 
         for i, v in enumerate(data):
-            yield buf[ep_ptr+i].eq(v)
+            yield from write_byte(buf, self.ring_addr(ep_ptr, i), v)
 
-        ep_len = self.get_len_csr(epaddr)
-        yield from ep_len.write(ep_ptr + len(data))
+        yield from ep_len.write(self.ring_addr(ep_ptr, len(data)))
 
         yield
 
@@ -262,7 +290,7 @@ class TestMemInterface(
         actual_data = []
         for i in range(len(data), 0, -1):
             # Subtract two bytes, since the CRC16 is stripped from the buffer.
-            d = yield buf[ep_ptr-i-2]
+            d = yield from read_byte(buf, self.ring_addr(ep_ptr, -i-2))
             actual_data.append(d)
 
         msg = "\n"
@@ -289,5 +317,259 @@ class TestMemInterface(
         self.assertSequenceEqual(data, actual_data, msg)
 
 
+class RingTestBench(Module):
+    def __init__(self, **kwargs):
+        self.submodules.usb = usb = MemInterface(FakeIoBuf(), **kwargs)
+        # CSRs only get their own logic once they are added to a CSR bank,
+        # so apply hardware writes here.
+        for csr in usb.get_csrs():
+            if isinstance(csr, CSRStorage) and hasattr(csr, "dat_w"):
+                self.sync += If(csr.we, csr.storage.eq(csr.dat_w))
+
+
+class TestMemInterfaceRing(TestCase):
+    def setUp(self):
+        self.dut = RingTestBench(max_packet_size=32)
+        self.usb = self.dut.usb
+        self.host = WireHost(self.usb.iobuf)
+
+    def out(self, epno, data):
+        yield from self.host.send(token_packet(PID.OUT, 0, epno))
+        yield from self.host.send(data_packet(PID.DATA0, data))
+        handshake = yield from self.host.receive()
+        # The packet is committed once the handshake has gone
+        for _ in range(20):
+            yield
+        return handshake
+
+    def run_sim(self, stim):
+        def padfront():
+            yield self.usb.iobuf.usb_pullup.eq(1)
+            for _ in range(20):
+                yield
+            yield from stim()
+        run_simulation(self.dut, {"usb_48": padfront()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+
+    def test_out_ring(self):
+        ack = [PID.ACK | ((PID.ACK ^ 0xf) << 4)]
+        nak = [PID.NAK | ((PID.NAK ^ 0xf) << 4)]
+        def stim():
+            base = self.usb.region_size
+            yield self.usb.arm.storage.eq(1 << 2)
+            first = list(range(30))
+            self.assertEqual((yield from self.out(1, first)), ack)
+            head = yield self.usb.optr_ep1.status
+            self.assertEqual(head, base + 32)
+            # Packets keep coming in until there is no room for a full one
+            second = list(range(100, 130))
+            self.assertEqual((yield from self.out(1, second)), ack)
+            third = list(range(50, 80))
+            self.assertEqual((yield from self.out(1, third)), ack)
+            self.assertEqual((yield from self.out(1, third)), nak)
+            self.assertEqual((yield self.usb.optr_ep1.status), base + 96)
+
+            # Reading the first packet makes room for another, which wraps around
+            yield self.usb.otail_ep1.storage.eq(base + 32)
+            self.assertEqual((yield from self.out(1, third)), ack)
+            self.assertEqual((yield self.usb.optr_ep1.status), base + 0)
+            data = []
+            for i in range(96, 128):
+                data.append((yield from read_byte(self.usb.obuf, base + i)))
+            self.assertEqual(data, third + crc16(third))
+            self.assertTrue((yield self.usb.arm.storage) & (1 << 2))
+        self.run_sim(stim)
+
+    def test_setup_empties_ep0(self):
+        def stim():
+            yield self.usb.arm.storage.eq(1)
+            yield from self.out(0, list(range(30)))
+            yield from self.out(0, list(range(30)))
+            self.assertEqual((yield self.usb.optr_ep0.status), 64)
+            setup = [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00]
+            yield from self.host.send(token_packet(PID.SETUP, 0, 0))
+            yield from self.host.send(data_packet(PID.DATA0, setup))
+            yield from self.host.receive()
+            for _ in range(20):
+                yield
+            self.assertEqual((yield self.usb.otail_ep0.storage), 64)
+            self.assertEqual((yield self.usb.optr_ep0.status), 74)
+        self.run_sim(stim)
+
+    def test_in_queue(self):
+        def stim():
+            base = 2 * self.usb.region_size
+            data = list(range(1, 71))
+            for i, v in enumerate(data):
+                yield from write_byte(self.usb.ibuf, base + i, v)
+            yield self.usb.ilen_ep2.storage.eq(base + len(data))
+            yield self.usb.arm.storage.eq(1 << 5)
+
+            packets = []
+            for pid in (PID.DATA1, PID.DATA0, PID.DATA1):
+                yield from self.host.send(token_packet(PID.IN, 0, 2))
+                packet = yield from self.host.receive()
+                self.assertEqual(packet[0] & 0xf, pid)
+                # Don't acknowledge the first try, so it is sent again
+                if not packets:
+                    yield from self.host.send(token_packet(PID.IN, 0, 2))
+                    self.assertEqual((yield from self.host.receive()), packet)
+                yield from self.host.send(handshake_packet(PID.ACK))
+                for _ in range(20):
+                    yield
+                packets.append(packet[1:-2])
+            self.assertEqual(packets, [data[0:32], data[32:64], data[64:70]])
+            self.assertEqual((yield self.usb.iptr_ep2.storage), base + len(data))
+
+            # Everything has been sent, so the endpoint is no longer armed
+            self.assertFalse((yield self.usb.arm.storage) & (1 << 5))
+            yield from self.host.send(token_packet(PID.IN, 0, 2))
+            self.assertEqual((yield from self.host.receive()), [PID.NAK | ((PID.NAK ^ 0xf) << 4)])
+        self.run_sim(stim)
+
+    def test_sizes(self):
+        with self.assertRaises(ValueError):
+            MemInterface(FakeIoBuf(), num_endpoints=5)
+        with self.assertRaises(ValueError):
+            MemInterface(FakeIoBuf(), region_size=96)
+        with self.assertRaises(ValueError):
+            MemInterface(FakeIoBuf(), num_endpoints=3, region_size=256)
+        dut = MemInterface(FakeIoBuf(), num_endpoints=8, depth=1024)
+        self.assertEqual(dut.region_size, 128)
+        self.assertEqual(dut.iptr_ep7.storage.reset.value, 7 * 128)
+
+
+class TestMemInterfaceBus(TestCase):
+    def setUp(self):
+        self.dut = RingTestBench()
+        self.usb = self.dut.usb
+        self.ibuf_base = self.usb.obuf.depth
+
+    def test_read_out(self):
+        def stim():
+            yield self.usb.obuf[0].eq(0x04030201)
+            yield self.usb.obuf[5].eq(0xddccbbaa)
+            yield
+            self.assertEqual((yield from self.usb.bus.read(0)), 0x04030201)
+            self.assertEqual((yield from self.usb.bus.read(5)), 0xddccbbaa)
+            # The OUT memory can't be written from the bus
+            yield from self.usb.bus.write(5, 0x12345678)
+            self.assertEqual((yield self.usb.obuf[5]), 0xddccbbaa)
+        run_simulation(self.dut, stim(), clocks={"sys": 10, "usb_12": 10, "usb_48": 10})
+
+    def test_write_in(self):
+        def stim():
+            yield from self.usb.bus.write(self.ibuf_base + 2, 0xddccbbaa)
+            yield from self.usb.bus.write(self.ibuf_base + 2, 0x00001100, sel=0b0010)
+            yield
+            self.assertEqual((yield self.usb.ibuf[2]), 0xddcc11aa)
+            self.assertEqual((yield from self.usb.bus.read(self.ibuf_base + 2)), 0xddcc11aa)
+        run_simulation(self.dut, stim(), clocks={"sys": 10, "usb_12": 10, "usb_48": 10})
+
+    def test_in_packet(self):
+        data = list(range(1, 33))
+        base = self.usb.region_size
+        sent = []
+
+        def cpu():
+            # Copy the packet in a word at a time
+            for i in range(0, len(data), 4):
+                word = data[i] | data[i+1] << 8 | data[i+2] << 16 | data[i+3] << 24
+                yield from self.usb.bus.write(self.ibuf_base + (base + i) // 4, word)
+            yield self.usb.ilen_ep1.storage.eq(base + len(data))
+            yield self.usb.arm.storage.eq(1 << 3)
+
+        def host():
+            wire = WireHost(self.usb.iobuf)
+            yield self.usb.iobuf.usb_pullup.eq(1)
+            for _ in range(400):
+                yield
+            yield from wire.send(token_packet(PID.IN, 0, 1))
+            sent.extend((yield from wire.receive()))
+
+        run_simulation(self.dut, {"sys": cpu(), "usb_48": host()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+        self.assertEqual(sent[1:-2], data)
+
+    def test_depth(self):
+        with self.assertRaises(ValueError):
+            MemInterface(FakeIoBuf(), depth=384, region_size=128)
+
+
+class CSRTestBench(Module):
+    """Put the CSRs of `usb` on a Wishbone bus, the way a SoC does."""
+    def __init__(self, usb):
+        self.submodules.usb = usb
+        self.submodules.csrbanks = csr_bus.CSRBankArray(self,
+            lambda name, memory: 0 if name == "usb" else None, data_width=32)
+        self.bus = wishbone.Interface()
+        self.submodules.wb2csr = wishbone.Wishbone2CSR(self.bus, csr_bus.Interface(data_width=32))
+        self.submodules.csrcon = csr_bus.Interconnect(self.wb2csr.csr, self.csrbanks.get_buses())
+
+    def csr(self, name):
+        """The bus address of CSR `name`."""
+        for _, _, _, rmap in self.csrbanks.banks:
+            for i, c in enumerate(rmap.simple_csrs):
+                if c.name in (name, name + "0"):
+                    return i
+        raise KeyError(name)
+
+
+class TestBusBenchmark(TestCase):
+    """Bus cycles to move a 64 byte packet each way, through the Wishbone
+    memory of `MemInterface` and through the CSRs of the FIFO interfaces."""
+    PACKET = 64
+
+    def measure(self, dut, bus, out, in_):
+        """Count the cycles of each list of ``(write, address)`` accesses."""
+        cycles = Signal(32)
+        dut.sync += cycles.eq(cycles + 1)
+        result = {}
+        def access(accesses):
+            start = yield cycles
+            for write, adr in accesses:
+                if write:
+                    yield from bus.write(adr, 0xa5)
+                else:
+                    yield from bus.read(adr)
+            return (yield cycles) - start
+        def stim():
+            result["out"] = yield from access(out)
+            result["in"] = yield from access(in_)
+        run_simulation(dut, stim(), clocks={"sys": 10, "usb_12": 10, "usb_48": 10})
+        return result
+
+    def test_cycles_per_packet(self):
+        words = self.PACKET // 4
+        results = {}
+
+        dut = RingTestBench()
+        ibuf_base = dut.usb.obuf.depth
+        results["MemInterface (Wishbone)"] = self.measure(dut, dut.usb.bus,
+            [(False, i) for i in range(words)],
+            [(True, ibuf_base + i) for i in range(words)])
+
+        dut = CSRTestBench(PerEndpointFifoInterface(FakeIoBuf()))
+        # Check for data, read the head, and move on to the next byte
+        results["PerEndpointFifoInterface (CSR)"] = self.measure(dut, dut.bus,
+            [(False, dut.csr("ep_2_out_obuf_empty")),
+             (False, dut.csr("ep_2_out_obuf_head")),
+             (True, dut.csr("ep_2_out_obuf_head"))] * self.PACKET,
+            [(True, dut.csr("ep_1_in_ibuf_head"))] * self.PACKET)
+
+        dut = CSRTestBench(TriEndpointInterface(FakeIoBuf()))
+        results["TriEndpointInterface (CSR)"] = self.measure(dut, dut.bus,
+            [(False, dut.csr("out_data"))] * self.PACKET,
+            [(True, dut.csr("in_data"))] * self.PACKET)
+
+        for name, r in results.items():
+            print("{}: {} cycles per {} byte OUT packet, {} per IN packet".format(
+                name, r["out"], self.PACKET, r["in"]))
+        mem = results.pop("MemInterface (Wishbone)")
+        for r in results.values():
+            self.assertLess(mem["out"], r["out"])
+            self.assertLess(mem["in"], r["in"])
+
+
 if __name__ == '__main__':
     unittest.main()
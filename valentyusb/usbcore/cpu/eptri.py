@@ -19,6 +19,9 @@ from ..pid import PID, PIDTypes
 from ..sm.transfer import UsbTransfer
 from .usbwishbonebridge import USBWishboneBridge
 from .usbwishboneburstbridge import USBWishboneBurstBridge
+from .eptridma import TriEndpointDMA
+from .eventqueue import EventQueue
+from .stdreq import StandardRequests
 
 """
 Register Interface:
@@ -82,15 +85,86 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
         Set ``relax_timing=True`` to enable registered accesses for certain operations
         to allow for a higher Fmax at the expense of logic cells.
 
+    wide (bool, optional): Add 32-bit ``IN_WDATA``, ``OUT_WDATA`` and ``SETUP_WDATA``
+        registers which move up to four bytes per access, cutting the number of CSR
+        accesses needed per packet by four.  The byte-wide ``DATA`` registers keep
+        working.  Not supported together with ``cdc``.
+
+    dma (bool, optional): Add a :obj:`TriEndpointDMA` engine which copies ``IN`` and
+        ``OUT`` packets between RAM and the FIFOs on its own.  Not supported together
+        with ``cdc``.
+
+    in_slots (int, optional): Number of ``IN`` packets that can be queued at once.
+        With two or more, firmware can fill the next packet while the previous one
+        is on the wire, instead of the host getting a ``NAK``.  Not supported
+        together with ``cdc``.
+
+    out_slots (int, optional): Number of ``OUT`` packets that can be received before
+        firmware has to drain the FIFO.  With two or more, the host keeps getting an
+        ``ACK`` as long as there is room for another packet.  Not supported together
+        with ``cdc`` or ``dma``.
+
+    in_buffers (int, optional): Give each of the first ``in_buffers`` ``IN`` endpoints
+        a buffer of its own in one shared block RAM, so that all of them can be armed
+        at the same time.  See :obj:`InBufferHandler`.  Not supported together with
+        ``cdc``, ``wide``, ``dma`` or ``in_slots``.
+
+    descriptors (:obj:`DescriptorRom`, optional): Add a :obj:`StandardRequests` engine
+        which answers ``GET_DESCRIPTOR`` from these descriptors, as well as device
+        ``GET_STATUS``, ``SET_ADDRESS`` and ``SET_CONFIGURATION``, so that the device
+        enumerates without the CPU.  Other requests still go to the ``SETUP`` FIFO.
+        Not supported together with ``cdc``.
+
+    event_queue (int, optional): Add an :obj:`EventQueue` holding this many events,
+        which records every ``SETUP``, ``IN``, ``OUT`` and reset event in order, with
+        its endpoint, length and a timestamp.  Not supported together with ``cdc``.
+
+    irq_moderation (bool, optional): Add an ``IRQ_MODERATION`` register which holds the
+        ``IN`` and ``OUT`` interrupts back until several packets have been handled, or
+        until a timeout.  ``SETUP`` and reset events still interrupt straight away.
+        See :obj:`ModeratedIRQ`.  Not supported together with ``cdc``.
+
+    iso_in (int, optional): Make this ``IN`` endpoint isochronous.  See :obj:`IsoInHandler`.
+        Not supported together with ``cdc``.
+
+    iso_out (int, optional): Make this ``OUT`` endpoint isochronous.  See :obj:`IsoOutHandler`.
+        Not supported together with ``cdc``.
+
+    iso_max_packet_size (int, optional): The size of the isochronous buffers, up to 1023 bytes.
+
+    clk_freq (int, optional): The frequency of the ``sys`` clock, which the event queue
+        counts its timestamps in.
+
     Attributes
     ----------
 
     debug_bridge (:obj:`wishbone.Interface`): The wishbone interface master for debug
         If `debug=True`, this attribute will contain the Wishbone Interface
         master for you to connect to your desired Wishbone bus.
+
+    dma_bus (:obj:`wishbone.Interface`): The wishbone interface master for DMA
+        If `dma=True`, connect this to the bus the packet buffers live on.
     """
 
-    def __init__(self, iobuf, debug=False, burst=False, cdc=False, relax_timing=False):
+    def __init__(self, iobuf, debug=False, burst=False, cdc=False, relax_timing=False, wide=False, dma=False, in_slots=1, out_slots=1, in_buffers=1, descriptors=None, event_queue=0, irq_moderation=False, iso_in=None, iso_out=None, iso_max_packet_size=1023, clk_freq=12e6):
+        if wide and cdc:
+            raise ValueError("eptri does not support wide data registers with cdc=True")
+        if dma and cdc:
+            raise ValueError("eptri does not support DMA with cdc=True")
+        if in_slots > 1 and cdc:
+            raise ValueError("eptri does not support multiple IN slots with cdc=True")
+        if out_slots > 1 and (cdc or dma):
+            raise ValueError("eptri does not support multiple OUT slots with cdc=True or dma=True")
+        if in_buffers > 1 and (cdc or wide or dma or in_slots > 1):
+            raise ValueError("eptri does not support IN endpoint buffers with cdc, wide, dma or in_slots")
+        if descriptors is not None and cdc:
+            raise ValueError("eptri does not support the standard request engine with cdc=True")
+        if event_queue and cdc:
+            raise ValueError("eptri does not support the event queue with cdc=True")
+        if irq_moderation and cdc:
+            raise ValueError("eptri does not support interrupt moderation with cdc=True")
+        if (iso_in is not None or iso_out is not None) and cdc:
+            raise ValueError("eptri does not support isochronous endpoints with cdc=True")
 
         self.background = ModuleDoc(title="USB Device Tri-FIFO", body="""
             This is a three-FIFO USB device.  It presents one FIFO each for ``IN``, ``OUT``, and
@@ -98,8 +172,27 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
             without sacrificing many FPGA resources.
 
             USB supports four types of transfers: control, bulk, interrupt, and isochronous.
-            This device does not yet support isochronous transfers, however it supports the
-            other types of transfers.
+            Isochronous transfers are only supported on the endpoints given as ``iso_in`` and
+            ``iso_out``.
+            """)
+
+        self.isochronous_transfers = ModuleDoc(title="Isochronous Transfers", body="""
+            Isochronous transfers carry one packet of up to 1023 bytes per endpoint in every
+            frame, and are never acknowledged or retried.  If ``eptri`` was built with
+            ``iso_in`` or ``iso_out``, those endpoints are handled by the ``ISO_IN`` and
+            ``ISO_OUT`` registers instead of the ``IN`` and ``OUT`` FIFOs.  Do not arm them
+            through ``IN_CTRL`` or ``OUT_CTRL``.
+
+            Each one has two buffers, which are swapped when the host sends a ``SOF`` at the
+            start of every frame.  The ``SOF`` interrupt then fires, and the firmware writes the
+            packet for the next frame to ``ISO_IN_DATA`` and sets ``ISO_IN_CTRL.READY``, or reads
+            the packet from the previous frame from ``ISO_OUT_DATA``.  Nothing else is needed
+            while the frame is on the wire.
+
+            ``ISO_IN_LATE`` counts frames in which an empty packet was sent because the next
+            packet was not ready, and ``ISO_IN_MISSED`` counts packets the host never asked
+            for.  ``ISO_OUT_MISSED`` counts frames without a packet, and ``ISO_OUT_LATE``
+            counts packets that were replaced before the firmware had read all of them.
             """)
 
         self.interrupt_bulk_transfers = ModuleDoc(title="Interrupt and Bulk Transfers", body="""
@@ -129,6 +222,21 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
             To send an empty packet, avoid writing any data to ``IN_DATA`` and simply write
             the endpoint number to ``IN_CTRL.EPNO``.
 
+            If ``eptri`` was built with ``in_slots`` greater than one, you may write the
+            next packet and arm it as soon as ``IN_STATUS.FULL`` is ``0``, without waiting
+            for the previous packet to be sent.  Packets are sent in the order they were
+            armed, and the interrupt fires each time one of them has been sent.
+
+            If ``eptri`` was built with ``in_buffers`` greater than one, each of the first
+            ``in_buffers`` endpoints has a buffer of its own instead, and any number of them
+            can be armed at once.  Write the endpoint number to ``IN_SELECT`` before writing
+            its data to ``IN_DATA``, then arm it through ``IN_CTRL`` as usual.  ``IN_QUEUED``
+            shows which endpoints are still waiting to be sent.
+
+            If ``eptri`` was built with ``wide=True``, write four bytes at a time to
+            ``IN_WDATA`` instead, least significant byte first, and write the last one to
+            three bytes of the packet to ``IN_DATA``.  The FIFO still holds 64 bytes.
+
             The CRC16 will be automatically appended to the end of the transfer.
 
             OUT Transfers
@@ -209,6 +317,26 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
             ``OUT_CTRL.STALL`` bit and ``OUT_CTRL.ENABLE`` bits cleared.  Note that
             ``OUT_CTRL.ENABLE`` indicates whether any response sould be sent at all, which is
             why it must be set or cleared at the same time.
+
+            If ``eptri`` was built with ``out_slots`` greater than one, packets keep being
+            accepted while there is room for them, even if the interrupt is still pending.
+            ``OUT_SLOT`` shows the endpoint and length of the oldest packet in the FIFO, and
+            how many packets are waiting.  Once all ``OUT_SLOT.LEN`` bytes of it have been
+            read, ``OUT_SLOT`` moves on to the next packet.  Set ``OUT_CTRL.AUTO`` together
+            with ``OUT_CTRL.ENABLE`` to keep an endpoint enabled after each packet, so that
+            it does not have to be re-enabled every time.
+
+            Standard Requests
+            ^^^^^^^^^^^^^^^^^
+
+            If ``eptri`` was built with ``descriptors``, ``GET_DESCRIPTOR`` requests for those
+            descriptors, device ``GET_STATUS``, ``SET_ADDRESS`` and ``SET_CONFIGURATION`` are
+            answered in hardware, and never show up in the ``SETUP`` FIFO.  ``ADDRESS`` is
+            updated once ``SET_ADDRESS`` has completed, and ``STDREQ_STATUS.CONFIGURATION``
+            holds the current configuration.  The ``IN`` and ``OUT`` handlers don't see the
+            data and status stages of these requests, so they raise no events for them, and
+            a packet armed on endpoint 0 waits until the request is over.  Clear
+            ``STDREQ_CTRL.ENABLE`` to handle every request in firmware again.
             """)
 
         # USB Core
@@ -247,7 +375,8 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
                 Sets the USB device address, in order to ignore packets
                 going to other devices on the bus. This value is reset when the host
                 issues a USB Device Reset condition.
-            """))
+            """,
+            write_from_dev=descriptors is not None))
         self.comb += self.address.reset.eq(usb_core.usb_reset)
 
         self.next_ev = CSRStatus(
@@ -262,23 +391,187 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
                 and have all three bits set.  Under these circumstances it can be difficult
                 to know which event to process first.  Use this register to determine which
                 event needs to be processed first.
-                Only one bit will ever be set at a time.
+                Only one bit will ever be set at a time.  If ``eptri`` was built with an
+                event queue, ``EVQ_DATA`` gives the full order of events instead.
             """,
         )
 
+        # The standard request engine takes over endpoint 0 while it is
+        # answering a request, and the IN and OUT handlers don't see those
+        # transactions at all.
+        handler_core = usb_core
+        if descriptors is not None:
+            self.submodules.stdreq = stdreq = StandardRequests(usb_core, descriptors)
+            std_owns = Signal()
+            self.comb += std_owns.eq(stdreq.active & (usb_core.endp == 0))
+            self.submodules.handler_core = handler_core = HiddenTransactions(usb_core)
+            self.comb += handler_core.hide.eq(std_owns & (usb_core.tok != PID.SETUP))
+
         # Handlers
-        self.submodules.setup = setup_handler = SetupHandler(usb_core, cdc=cdc)
+        self.submodules.setup = setup_handler = SetupHandler(usb_core, cdc=cdc, wide=wide)
         self.comb += setup_handler.usb_reset.eq(usb_core.usb_reset)
         ems.append(setup_handler.ev)
 
-        in_handler = InHandler(usb_core, cdc=cdc)
+        if in_buffers > 1:
+            in_handler = InBufferHandler(handler_core, buffers=in_buffers)
+        else:
+            in_handler = InHandler(handler_core, cdc=cdc, wide=wide, dma=dma, slots=in_slots)
         self.submodules.__setattr__("in", in_handler)
         ems.append(in_handler.ev)
 
-        self.submodules.out = out_handler = OutHandler(usb_core, cdc=cdc)
+        self.submodules.out = out_handler = OutHandler(handler_core, cdc=cdc, wide=wide, dma=dma, slots=out_slots)
         ems.append(out_handler.ev)
 
-        self.submodules.ev = ev.SharedIRQ(*ems)
+        iso_handlers = []
+        if iso_in is not None:
+            self.submodules.iso_in = iso_in_handler = IsoInHandler(usb_core, iso_in, iso_max_packet_size)
+            iso_handlers.append(iso_in_handler)
+        if iso_out is not None:
+            self.submodules.iso_out = iso_out_handler = IsoOutHandler(usb_core, iso_out, iso_max_packet_size)
+            iso_handlers.append(iso_out_handler)
+        for iso_handler in iso_handlers:
+            self.comb += iso_handler.usb_reset.eq(usb_core.usb_reset)
+            ems.append(iso_handler.ev)
+
+        if dma:
+            self.submodules.dma = dma_engine = TriEndpointDMA(wide=wide)
+            self.dma_bus = dma_engine.bus
+            self.comb += [
+                in_handler.dma_din.eq(dma_engine.in_data),
+                in_handler.dma_we.eq(dma_engine.in_we),
+                in_handler.dma_wdin.eq(dma_engine.in_wdata),
+                in_handler.dma_wwe.eq(dma_engine.in_wwe),
+                in_handler.dma_epno.eq(dma_engine.in_epno),
+                in_handler.dma_arm.eq(dma_engine.in_arm),
+                dma_engine.in_sent.eq(in_handler.dma_sent),
+                in_handler.dma_hold.eq(dma_engine.in_hold),
+                in_handler.dma_done.eq(dma_engine.in_done),
+
+                dma_engine.out_data.eq(out_handler.data_buf.dout),
+                dma_engine.out_readable.eq(out_handler.data_buf.readable),
+                out_handler.dma_re.eq(dma_engine.out_re),
+                dma_engine.out_received.eq(out_handler.dma_received),
+                out_handler.dma_done.eq(dma_engine.out_done),
+                out_handler.dma_epno.eq(dma_engine.out_epno),
+                out_handler.dma_enable.eq(dma_engine.out_enable),
+                out_handler.dma_active.eq(dma_engine.out_active),
+            ]
+
+        if irq_moderation:
+            self.irq_moderation = CSRStorage(
+                fields=[
+                    CSRField("count", 8, description="Interrupt once this many ``IN`` and ``OUT`` packets have been handled.  ``0`` or ``1`` interrupts on every packet."),
+                    CSRField("timeout", 16, offset=8, description="Interrupt this many ``sys`` clock cycles after the first packet, even if fewer than ``COUNT`` have been handled.  ``0`` disables the timeout."),
+                ],
+                description="""
+                    Reduces the number of ``IN`` and ``OUT`` interrupts.  This is only useful if the
+                    handlers can take more than one packet without firmware, for example with
+                    ``in_slots``, ``out_slots`` or ``dma``."""
+            )
+            self.submodules.ev = ModeratedIRQ([setup_handler.ev] + [h.ev for h in iso_handlers], [in_handler.ev, out_handler.ev],
+                [in_handler.ev.packet.trigger, out_handler.ev.packet.trigger])
+            self.comb += [
+                self.ev.threshold.eq(self.irq_moderation.fields.count),
+                self.ev.timeout.eq(self.irq_moderation.fields.timeout),
+            ]
+        else:
+            self.submodules.ev = ev.SharedIRQ(*ems)
+
+        if event_queue:
+            self.submodules.evq = evq = EventQueue(usb_core, depth=event_queue, clk_freq=clk_freq)
+            self.comb += [
+                evq.setup.eq(setup_handler.trigger),
+                evq.in_done.eq(in_handler.ev.packet.trigger),
+                evq.out_done.eq(out_handler.ev.packet.trigger),
+            ]
+
+        # The signals the stage machine below uses to talk to the IN and OUT
+        # handlers, or to the standard request engine.
+        if descriptors is None:
+            in_dtb = in_handler.dtb if not cdc else None
+            in_stalled = in_handler.stalled
+            in_response = in_handler.response
+            in_data_out = in_handler.data_out
+            in_data_out_have = in_handler.data_out_have
+            in_advance = in_handler.data_out_advance
+            out_stalled = out_handler.stalled
+            out_response = out_handler.response
+            out_put = out_handler.data_recv_put
+        else:
+            in_dtb = Signal()
+            in_stalled = Signal()
+            in_response = Signal()
+            in_data_out = Signal(8)
+            in_data_out_have = Signal()
+            in_advance = Signal()
+            out_stalled = Signal()
+            out_response = Signal()
+            out_put = Signal()
+            self.comb += [
+                stdreq.usb_reset.eq(usb_core.usb_reset),
+                setup_handler.claimed.eq(stdreq.claim),
+                self.address.we.eq(stdreq.address_we),
+                self.address.dat_w.eq(stdreq.address),
+
+                If(std_owns,
+                    in_dtb.eq(stdreq.dtb),
+                    in_response.eq(stdreq.response),
+                    in_data_out.eq(stdreq.data_out),
+                    in_data_out_have.eq(stdreq.data_out_have),
+                    stdreq.data_out_advance.eq(in_advance),
+                    out_response.eq(stdreq.response),
+                ).Else(
+                    in_dtb.eq(in_handler.dtb),
+                    in_stalled.eq(in_handler.stalled),
+                    in_response.eq(in_handler.response),
+                    in_data_out.eq(in_handler.data_out),
+                    in_data_out_have.eq(in_handler.data_out_have),
+                    in_handler.data_out_advance.eq(in_advance),
+                    out_stalled.eq(out_handler.stalled),
+                    out_response.eq(out_handler.response),
+                    out_handler.data_recv_put.eq(out_put),
+                ),
+            ]
+
+        # Isochronous endpoints take over the IN and OUT signals for their own
+        # endpoint number, and the transfer skips the handshake.
+        if iso_in is not None:
+            next_in = (in_dtb, in_stalled, in_response, in_data_out, in_data_out_have, in_advance)
+            in_dtb = Signal()
+            in_stalled = Signal()
+            in_response = Signal()
+            in_data_out = Signal(8)
+            in_data_out_have = Signal()
+            in_advance = Signal()
+            self.comb += If(iso_in_handler.owns,
+                in_dtb.eq(iso_in_handler.dtb),
+                in_response.eq(iso_in_handler.response),
+                in_data_out.eq(iso_in_handler.data_out),
+                in_data_out_have.eq(iso_in_handler.data_out_have),
+                iso_in_handler.data_out_advance.eq(in_advance),
+            ).Else(
+                in_dtb.eq(next_in[0]),
+                in_stalled.eq(next_in[1]),
+                in_response.eq(next_in[2]),
+                in_data_out.eq(next_in[3]),
+                in_data_out_have.eq(next_in[4]),
+                next_in[5].eq(in_advance),
+            )
+        if iso_out is not None:
+            next_out = (out_stalled, out_response, out_put)
+            out_stalled = Signal()
+            out_response = Signal()
+            out_put = Signal()
+            self.comb += If(iso_out_handler.owns,
+                out_response.eq(iso_out_handler.response),
+                iso_out_handler.data_recv_put.eq(out_put),
+            ).Else(
+                out_stalled.eq(next_out[0]),
+                out_response.eq(next_out[1]),
+                next_out[2].eq(out_put),
+            )
+        if iso_handlers:
+            self.comb += usb_core.iso.eq(Cat(*[h.owns for h in iso_handlers]) != 0)
 
         in_next = Signal()
         out_next = Signal()
@@ -328,7 +621,7 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
                 If(debug_packet_detected,
                    usb_core.dtb.eq( 1 ^ debug_phase ),
                 ).Else(
-                    usb_core.dtb.eq(in_handler.dtb),
+                    usb_core.dtb.eq(in_dtb),
                 )
             ]
         usb_core_reset = Signal()
@@ -367,12 +660,12 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
                 usb_core.arm.eq(1),
             ).Elif(usb_core.tok == PID.IN,
                 NextState("IN"),
-                usb_core.sta.eq(in_handler.stalled),
-                usb_core.arm.eq(in_handler.response),
+                usb_core.sta.eq(in_stalled),
+                usb_core.arm.eq(in_response),
             ).Elif(usb_core.tok == PID.OUT,
                 NextState("OUT"),
-                usb_core.sta.eq(out_handler.stalled),
-                usb_core.arm.eq(out_handler.response),
+                usb_core.sta.eq(out_stalled),
+                usb_core.arm.eq(out_response),
             ).Else(
                 NextState("IDLE"),
             )
@@ -418,12 +711,12 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
         stage.act("IN",
             If(usb_core.tok == PID.IN,
                 # IN packet (device-to-host)
-                usb_core.data_send_have.eq(in_handler.data_out_have),
-                usb_core.data_send_payload.eq(in_handler.data_out),
-                in_handler.data_out_advance.eq(usb_core.data_send_get),
+                usb_core.data_send_have.eq(in_data_out_have),
+                usb_core.data_send_payload.eq(in_data_out),
+                in_advance.eq(usb_core.data_send_get),
 
-                usb_core.sta.eq(in_handler.stalled),
-                usb_core.arm.eq(in_handler.response),
+                usb_core.sta.eq(in_stalled),
+                usb_core.arm.eq(in_response),
 
                 # After an IN transfer, the host sends an OUT
                 # packet.  We must ACK this and then return to IDLE.
@@ -437,10 +730,10 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
             If(usb_core.tok == PID.OUT,
                 # OUT packet (host-to-device)
                 out_handler.data_recv_payload.eq(usb_core.data_recv_payload),
-                out_handler.data_recv_put.eq(usb_core.data_recv_put),
+                out_put.eq(usb_core.data_recv_put),
 
-                usb_core.sta.eq(out_handler.stalled),
-                usb_core.arm.eq(out_handler.response),
+                usb_core.sta.eq(out_stalled),
+                usb_core.arm.eq(out_response),
 
                 # After an OUT transfer, the host sends an IN
                 # packet.  We must ACK this and then return to IDLE.
@@ -452,6 +745,194 @@ class TriEndpointInterface(Module, AutoCSR, AutoDoc):
 
         self.comb += usb_core.reset.eq(usb_core.error | usb_core_reset)
 
+class HiddenTransactions(Module):
+    """The :obj:`UsbTransfer` signals that the handlers look at, with some transactions hidden.
+
+    While ``hide`` is set, ``poll``, ``commit``, ``end`` and ``retry`` are held low,
+    so a handler given this in place of the USB core neither answers nor finishes the
+    transaction in progress.  Everything else is passed straight through.
+    """
+    def __init__(self, usb_core):
+        self.hide = Signal()
+
+        self.tok = usb_core.tok
+        self.endp = usb_core.endp
+        self.setup = usb_core.setup
+        self.poll = Signal()
+        self.commit = Signal()
+        self.end = Signal()
+        self.retry = Signal()
+
+        # # #
+
+        self.comb += [
+            self.poll.eq(usb_core.poll & ~self.hide),
+            self.commit.eq(usb_core.commit & ~self.hide),
+            self.end.eq(usb_core.end & ~self.hide),
+            self.retry.eq(usb_core.retry & ~self.hide),
+        ]
+
+
+class WordBuffer(Module):
+    """A FIFO of little-endian words holding one to four bytes each.
+
+    This backs the ``wide`` data ports of the handlers, letting the CPU move a
+    whole word per CSR access while the USB side keeps moving single bytes.
+
+    Bytes written through ``din``/``we`` and words written through
+    ``wdin``/``wwe`` are packed four bytes to a word, in the order they were
+    written, so the two may be mixed.  ``flush`` pushes out a partially filled
+    word at the end of a packet.
+
+    Reading a byte at a time through ``dout``/``re`` walks through each entry
+    before moving on to the next.  ``wdout``/``wcount`` show the entry at the
+    head of the FIFO, and ``wre`` discards it.
+
+    Parameters
+    ----------
+
+    depth : int
+        Number of entries (not bytes) in the FIFO.
+    """
+    def __init__(self, depth):
+        # Byte interface
+        self.din = Signal(8)
+        self.we = Signal()
+        self.flush = Signal()
+        self.dout = Signal(8)
+        self.re = Signal()
+        self.readable = Signal()
+
+        # Word interface
+        self.wdin = Signal(32)
+        self.wwe = Signal()
+        self.wdout = Signal(32)
+        self.wcount = Signal(3)
+        self.wre = Signal()
+
+        # Each entry is 32 bits of data followed by the number of bytes, minus one
+        self.submodules.fifo = buf = fifo.SyncFIFOBuffered(width=34, depth=depth)
+
+        # A word goes in behind the bytes already waiting, and whatever is
+        # left of it waits in their place.
+        partial = Signal(24)
+        partial_count = Signal(2)
+        flush_count = Signal(2)
+        self.comb += [
+            flush_count.eq(partial_count - 1),
+            If(self.wwe,
+                Case(partial_count, {
+                    0: buf.din.eq(Cat(self.wdin, C(3, 2))),
+                    1: buf.din.eq(Cat(partial[0:8], self.wdin[0:24], C(3, 2))),
+                    2: buf.din.eq(Cat(partial[0:16], self.wdin[0:16], C(3, 2))),
+                    3: buf.din.eq(Cat(partial[0:24], self.wdin[0:8], C(3, 2))),
+                }),
+                buf.we.eq(1),
+            ).Elif(self.we & (partial_count == 3),
+                buf.din.eq(Cat(partial, self.din, C(3, 2))),
+                buf.we.eq(1),
+            ).Elif(self.flush & (partial_count != 0),
+                buf.din.eq(Cat(partial, C(0, 8), flush_count)),
+                buf.we.eq(1),
+            ),
+        ]
+        self.sync += [
+            If(self.wwe,
+                Case(partial_count, {
+                    1: partial.eq(self.wdin[24:32]),
+                    2: partial.eq(self.wdin[16:32]),
+                    3: partial.eq(self.wdin[8:32]),
+                }),
+            ).Elif(self.we,
+                Case(partial_count, {
+                    0: partial[0:8].eq(self.din),
+                    1: partial[8:16].eq(self.din),
+                    2: partial[16:24].eq(self.din),
+                    3: partial.eq(0),
+                }),
+                partial_count.eq(partial_count + 1),
+            ).Elif(self.flush,
+                partial.eq(0),
+                partial_count.eq(0),
+            ),
+        ]
+
+        # Index of the next byte to read from the head entry
+        index = Signal(2)
+        last = Signal()
+        self.comb += [
+            self.readable.eq(buf.readable),
+            self.dout.eq(Array(buf.dout[i*8:(i+1)*8] for i in range(4))[index]),
+            last.eq(index == buf.dout[32:34]),
+            self.wdout.eq(buf.dout[0:32]),
+            self.wcount.eq(buf.dout[32:34] + 1),
+            buf.re.eq(buf.readable & (self.wre | (self.re & last))),
+        ]
+        self.sync += [
+            If(self.wre,
+                index.eq(0),
+            ).Elif(self.re & buf.readable,
+                If(last,
+                    index.eq(0),
+                ).Else(
+                    index.eq(index + 1),
+                ),
+            ),
+        ]
+
+
+class ModeratedIRQ(Module):
+    """A :obj:`SharedIRQ` that waits for several events before interrupting.
+
+    The ``urgent`` event managers raise the interrupt straight away, just as they
+    would through ``SharedIRQ``.  For the ``moderated`` ones, the interrupt is held
+    back until ``threshold`` pulses have been counted on ``events``, or until
+    ``timeout`` cycles have passed since the first of them.  It then stays up
+    until firmware has cleared every pending event.
+
+    A ``threshold`` of ``0`` or ``1`` interrupts on every event, and a ``timeout`` of
+    ``0`` waits for ``threshold`` events however long that takes.
+    """
+    def __init__(self, urgent, moderated, events, threshold_width=8, timeout_width=16):
+        self.irq = Signal()
+        self.threshold = Signal(threshold_width)
+        self.timeout = Signal(timeout_width)
+
+        pending = Signal()
+        pending_last = Signal()
+        event = Signal()
+        fired = Signal()
+        count = Signal(threshold_width)
+        timer = Signal(timeout_width)
+        self.comb += [
+            pending.eq(Cat(*[em.irq for em in moderated]) != 0),
+            event.eq(Cat(*events) != 0),
+            self.irq.eq((Cat(*[em.irq for em in urgent]) != 0) |
+                (pending & (fired | (self.threshold <= 1)))),
+        ]
+        self.sync += [
+            pending_last.eq(pending),
+            # Start counting again once everything has been handled
+            If(pending_last & ~pending,
+                fired.eq(0),
+                count.eq(0),
+                timer.eq(0),
+            ).Else(
+                If(event & (count != 2**threshold_width - 1),
+                    count.eq(count + 1),
+                ),
+                If((count != 0) & ~fired,
+                    timer.eq(timer + 1),
+                ),
+                If((count >= self.threshold) & (count != 0),
+                    fired.eq(1),
+                ).Elif((self.timeout != 0) & (timer >= self.timeout),
+                    fired.eq(1),
+                ),
+            ),
+        ]
+
+
 class SetupHandler(Module, AutoCSR):
     """Handle ``SETUP`` packets
 
@@ -470,6 +951,9 @@ class SetupHandler(Module, AutoCSR):
     Drain the FIFO by reading from ``SETUP_DATA``, then setting
     ``SETUP_CTRL.ADVANCE``.
 
+    With ``wide=True``, ``SETUP_WDATA`` reads the ``SETUP`` data four bytes at a
+    time, and ``SETUP_STATUS.WCOUNT`` says how many of them are valid.
+
     Attributes
     ----------
 
@@ -491,11 +975,16 @@ class SetupHandler(Module, AutoCSR):
         This signal feeds into the EventManager, which is used to indicate to the device
         that a USB reset has occurred.
 
+    claimed : Signal
+        Assert this when ``usb_core.setup`` pulses to drop the ``SETUP`` packet instead
+        of raising the interrupt, because something else is answering it.
+
     """
 
-    def __init__(self, usb_core, cdc=False):
+    def __init__(self, usb_core, cdc=False, wide=False):
 
         self.reset = Signal()
+        self.claimed = claimed = Signal()
         self.begin = Signal()
         self.begin_sys = Signal()
         self.specials += MultiReg(self.begin, self.begin_sys)
@@ -509,6 +998,14 @@ class SetupHandler(Module, AutoCSR):
                            it will include the CRC16.  This is a FIFO, and the queue is advanced automatically."""
         )
 
+        if wide:
+            self.wdata = wdata = CSRStatus(
+                fields=[CSRField("data", 32, description="The next four bytes of ``SETUP`` data")],
+                description="""Data from the last ``SETUP`` transactions, four bytes at a time with the first
+                               byte in the least significant bits.  ``SETUP_STATUS.WCOUNT`` says how many bytes
+                               are valid.  Reading this register advances the FIFO by a whole word."""
+            )
+
         self.ctrl = ctrl = CSRStorage(
             fields=[
                 CSRField("reset", offset=5, description="Write a ``1`` here to reset the `SETUP` handler.", pulse=True),
@@ -516,14 +1013,17 @@ class SetupHandler(Module, AutoCSR):
             description="Controls for managing how to handle ``SETUP`` transactions."
         )
 
+        status_fields = [
+            CSRField("epno", 4, description="The destination endpoint for the most recent SETUP token."),
+            CSRField("have", description="``1`` if there is data in the FIFO."),
+            CSRField("pend", description="``1`` if there is an IRQ pending."),
+            CSRField("is_in", description="``1`` if an IN stage was detected."),
+            CSRField("data", description="``1`` if a DATA stage is expected."),
+        ]
+        if wide:
+            status_fields.append(CSRField("wcount", 3, description="The number of valid bytes in ``SETUP_WDATA``."))
         self.status = status = CSRStatus(
-            fields=[
-                CSRField("epno", 4, description="The destination endpoint for the most recent SETUP token."),
-                CSRField("have", description="``1`` if there is data in the FIFO."),
-                CSRField("pend", description="``1`` if there is an IRQ pending."),
-                CSRField("is_in", description="``1`` if an IN stage was detected."),
-                CSRField("data", description="``1`` if a DATA stage is expected."),
-            ],
+            fields=status_fields,
             description="Status about the most recent ``SETUP`` transactions, and the state of the FIFO."
         )
 
@@ -552,6 +1052,8 @@ class SetupHandler(Module, AutoCSR):
                 if cdc:
                     self.submodules.setupfifo = ResetInserter(["usb_12", "sys"])(ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(
                         fifo.AsyncFIFO(width=8, depth=16)))  # 10
+                elif wide:
+                    self.submodules.setupfifo = WordBuffer(depth=3)
                 else:
                     self.submodules.setupfifo = fifo.SyncFIFOBuffered(width=8, depth=10)
 
@@ -614,9 +1116,21 @@ class SetupHandler(Module, AutoCSR):
                     ),
 
                     # Tie the trigger to the STATUS.HAVE bit
-                    trigger.eq(self.setupfifo.readable & setup_sys),
+                    trigger.eq(self.setupfifo.readable & setup_sys & ~claimed),
                 ]
 
+                if wide:
+                    self.comb += [
+                        # The CRC16 leaves a partial word at the end of the packet
+                        self.setupfifo.flush.eq(usb_core.end),
+
+                        wdata.fields.data.eq(self.setupfifo.wdout),
+                        self.setupfifo.wre.eq(wdata.we),
+                        If(self.setupfifo.readable,
+                            status.fields.wcount.eq(self.setupfifo.wcount),
+                        ),
+                    ]
+
                 self.sync.usb_12 += [
                     # The 6th and 7th bytes of SETUP data are
                     # the wLength field.  If these are nonzero,
@@ -661,7 +1175,7 @@ class SetupHandler(Module, AutoCSR):
         else:
             self.submodules.inner = inner = ResetInserter()(ClockDomainsRenamer({"usb_12":"sys"})(SetupHandlerInner()))
             self.comb += [
-                inner.reset.eq(self.reset | self.begin | ctrl.fields.reset),
+                inner.reset.eq(self.reset | self.begin | ctrl.fields.reset | self.claimed),
                 self.ev.packet.clear.eq(self.begin),
             ]
 
@@ -682,11 +1196,25 @@ class InHandler(Module, AutoCSR):
     To send data, fill the FIFO by writing bytes to ``IN_DATA``.  When you're ready
     to transmit, write the destination endpoint number to ``IN_CTRL``.
 
+    With ``wide=True``, whole words can be written to ``IN_WDATA``, leaving only the
+    last one to three bytes of a packet to ``IN_DATA``.
+
+    With ``slots`` greater than one, the FIFO holds that many packets.  Each write
+    to ``IN_CTRL`` arms the data written since the previous one as a packet of its
+    own, and packets are sent one per ``IN`` transaction in the order they were
+    armed.
+
+    With ``dma=True``, a :obj:`TriEndpointDMA` engine can fill the FIFO through
+    ``dma_din``/``dma_we`` (``dma_wdin``/``dma_wwe``) and arm ``dma_epno`` by pulsing
+    ``dma_arm``.  ``dma_sent`` pulses each time a packet has been sent.  While
+    ``dma_hold`` is set, the interrupt only fires when ``dma_done`` is pulsed, so a
+    multi-packet transfer raises it once at the end.
+
     Attributes
     ----------
 
     """
-    def __init__(self, usb_core, cdc=False):
+    def __init__(self, usb_core, cdc=False, wide=False, dma=False, slots=1):
         if cdc:
             self.dtb_12 = Signal()
 
@@ -709,8 +1237,11 @@ class InHandler(Module, AutoCSR):
 
         if cdc:
             self.submodules.data_buf = buf = ResetInserter(["usb_12", "sys"])(ClockDomainsRenamer({"write":"sys","read":"usb_12"})(fifo.AsyncFIFOBuffered(width=8, depth=64)))
+        elif wide:
+            # Bytes are packed into words, so a 64-byte packet fills 16 entries
+            self.submodules.data_buf = buf = ResetInserter()(WordBuffer(depth=16*slots))
         else:
-            self.submodules.data_buf = buf = ResetInserter()(fifo.SyncFIFOBuffered(width=8, depth=64))
+            self.submodules.data_buf = buf = ResetInserter()(fifo.SyncFIFOBuffered(width=8, depth=64*slots))
 
         self.data = CSRStorage(
             fields=[
@@ -723,6 +1254,18 @@ class InHandler(Module, AutoCSR):
                 The FIFO queue is 64 bytes deep.  If you exceed this amount, the result is undefined."""
         )
 
+        if wide:
+            self.wdata = CSRStorage(
+                fields=[
+                    CSRField("data", 32, description="The next four bytes to add to the queue."),
+                ],
+                description="""
+                    Each write adds four bytes to the outgoing FIFO, least significant byte first.
+                    Writes here and to ``IN_DATA`` may be mixed, and the FIFO holds 64 bytes
+                    either way, so write whole words here and the remainder of the packet
+                    to ``IN_DATA``."""
+            )
+
         self.ctrl = ctrl = CSRStorage(
             fields=[
                 CSRField("epno", 4, description="The endpoint number for the transaction that is queued in the FIFO."),
@@ -731,15 +1274,30 @@ class InHandler(Module, AutoCSR):
             ],
             description="""
                 Enables transmission of data in response to ``IN`` tokens,
-                or resets the contents of the FIFO."""
+                or resets the contents of the FIFO.""",
+            write_from_dev=dma,
         )
 
+        if dma:
+            self.dma_din = Signal(8)
+            self.dma_we = Signal()
+            self.dma_wdin = Signal(32)
+            self.dma_wwe = Signal()
+            self.dma_epno = Signal(4)
+            self.dma_arm = Signal()
+            self.dma_sent = Signal()
+            self.dma_hold = Signal()
+            self.dma_done = Signal()
+
+        status_fields = [
+            CSRField("idle", description="This value is ``1`` if the packet has finished transmitting."),
+            CSRField("have", offset=4, description="This value is ``0`` if the FIFO is empty."),
+            CSRField("pend", offset=5, description="``1`` if there is an IRQ pending."),
+        ]
+        if slots > 1:
+            status_fields.append(CSRField("full", description="``1`` if every packet slot is armed."))
         self.status = CSRStatus(
-            fields=[
-                CSRField("idle", description="This value is ``1`` if the packet has finished transmitting."),
-                CSRField("have", offset=4, description="This value is ``0`` if the FIFO is empty."),
-                CSRField("pend", offset=5, description="``1`` if there is an IRQ pending."),
-            ],
+            fields=status_fields,
             description="""
                 Status about the IN handler.  As soon as you write to `IN_DATA`,
                 ``IN_STATUS.HAVE`` should go to ``1``."""
@@ -815,6 +1373,9 @@ class InHandler(Module, AutoCSR):
         # to avoid skipping packets when a packet is queued during a transmission.
         transmitted = Signal()
 
+        # Pulses when the host has received a packet
+        packet_sent = Signal()
+
         self.dtb_reset = Signal()
         if cdc:
             response_sys = Signal()
@@ -831,6 +1392,10 @@ class InHandler(Module, AutoCSR):
                 self.bufressync.i.eq(buf.reset_sys),
                 buf.reset_usb_12.eq(self.bufressync.o),
             ]
+        elif slots > 1:
+            # The next packet may already be in the FIFO, so it is only
+            # ever emptied by a reset.
+            self.comb += buf.reset.eq(ctrl.fields.reset)
         else:
             self.comb += [
                 buf.reset.eq(ctrl.fields.reset | (usb_core.commit & transmitted & queued)),
@@ -958,27 +1523,130 @@ class InHandler(Module, AutoCSR):
             ]
         else:
             self.comb += [
-                # We will respond with "ACK" if the register matches the current endpoint number
-                self.response.eq(queued & is_our_packet & is_in_packet),
-
                 # Wire up the "status" register
                 self.status.fields.have.eq(buf.readable),
                 self.status.fields.idle.eq(~queued),
                 self.status.fields.pend.eq(self.ev.packet.pending),
 
-                # Cause a trigger event when the `queued` value goes to 0
-                self.ev.packet.trigger.eq(~queued & was_queued),
-
                 self.dtb.eq(dtbs >> usb_core.endp),
 
                 self.data_out.eq(buf.dout),
-                self.data_out_have.eq(buf.readable),
                 buf.re.eq(self.data_out_advance & is_in_packet & is_our_packet),
                 buf.we.eq(self.data.re),
                 buf.din.eq(self.data.storage),
-                is_our_packet.eq(usb_core.endp == ctrl.fields.epno),
                 is_in_packet.eq(usb_core.tok == PID.IN),
             ]
+            if wide:
+                self.comb += [
+                    buf.wwe.eq(self.wdata.re),
+                    buf.wdin.eq(self.wdata.storage),
+                ]
+            armed = ctrl.re & ~ctrl.fields.stall
+            if dma:
+                # The DMA engine writes to the FIFO in place of the CPU, and
+                # arms the endpoint as if `ctrl` had been written.
+                self.comb += [
+                    If(self.dma_we,
+                        buf.we.eq(1),
+                        buf.din.eq(self.dma_din),
+                    ),
+                    ctrl.we.eq(self.dma_arm),
+                    ctrl.dat_w.eq(self.dma_epno),
+                ]
+                if wide:
+                    self.comb += If(self.dma_wwe,
+                        buf.wwe.eq(1),
+                        buf.wdin.eq(self.dma_wdin),
+                    )
+                armed = armed | self.dma_arm
+            if wide:
+                # Push out the last few bytes of the packet along with it
+                self.comb += buf.flush.eq(armed)
+
+        if slots > 1 and not cdc:
+            # Every time a packet is armed, its endpoint and length are queued
+            # here.  The head entry is the packet that goes out next.
+            self.submodules.slots = slot_fifo = ResetInserter()(fifo.SyncFIFO(width=4+7, depth=slots))
+
+            arm_epno = ctrl.fields.epno
+            if dma:
+                arm_epno = Mux(self.dma_arm, self.dma_epno, ctrl.fields.epno)
+
+            # Bytes written since the last packet was armed, and bytes sent
+            # from the head packet.
+            fill_len = Signal(7)
+            sent = Signal(7)
+            slot_epno = Signal(4)
+            slot_len = Signal(7)
+            done = Signal()
+            self.comb += [
+                slot_fifo.reset.eq(ctrl.fields.reset),
+                slot_fifo.din.eq(Cat(arm_epno, fill_len)),
+                slot_fifo.we.eq(armed),
+                slot_epno.eq(slot_fifo.dout[0:4]),
+                slot_len.eq(slot_fifo.dout[4:11]),
+                queued.eq(slot_fifo.readable),
+                self.status.fields.full.eq(~slot_fifo.writable),
+
+                # We will respond with "ACK" if the head packet is for the current endpoint number
+                self.response.eq(queued & is_our_packet & is_in_packet),
+                is_our_packet.eq(usb_core.endp == slot_epno),
+
+                # Stop at the end of the head packet, even if the next one is already in the FIFO
+                self.data_out_have.eq(buf.readable & (sent != slot_len)),
+
+                # Once the host acknowledges the head packet, move on to the next one
+                done.eq(usb_core.commit & transmitted & self.response & ~self.stalled),
+                slot_fifo.re.eq(done),
+                packet_sent.eq(done),
+                self.ev.packet.trigger.eq(packet_sent),
+            ]
+
+            fill = If(armed,
+                fill_len.eq(0),
+            ).Elif(buf.we,
+                fill_len.eq(fill_len + 1),
+            )
+            if wide:
+                fill = fill.Elif(buf.wwe,
+                    fill_len.eq(fill_len + 4),
+                )
+            self.sync += [
+                If(ctrl.fields.reset,
+                    fill_len.eq(0),
+                    sent.eq(0),
+                    transmitted.eq(0),
+                    dtbs.eq(0x0001),
+                ).Else(
+                    fill,
+                    If(done,
+                        sent.eq(0),
+                    ).Elif(buf.re & buf.readable,
+                        sent.eq(sent + 1),
+                    ),
+                    If(done,
+                        transmitted.eq(0),
+                        # Toggle the "DTB" line for the endpoint that was sent
+                        dtbs.eq(dtbs ^ (1 << slot_epno)),
+                    ).Elif(self.dtb_reset,
+                        dtbs.eq(dtbs | 1),
+                    ).Elif(usb_core.poll & self.response,
+                        transmitted.eq(1),
+                    ),
+                ),
+            ]
+        elif not cdc:
+            self.comb += [
+                # We will respond with "ACK" if the register matches the current endpoint number
+                self.response.eq(queued & is_our_packet & is_in_packet),
+
+                # Cause a trigger event when the `queued` value goes to 0
+                packet_sent.eq(~queued & was_queued),
+                self.ev.packet.trigger.eq(packet_sent),
+
+                self.data_out_have.eq(buf.readable),
+                is_our_packet.eq(usb_core.endp == ctrl.fields.epno),
+            ]
 
             self.sync += [
                 If(ctrl.fields.reset,
@@ -990,7 +1658,7 @@ class InHandler(Module, AutoCSR):
                     dtbs.eq(dtbs | 1),
                 )
                     # When the user updates the `ctrl` register, enable writing.
-                    .Elif(ctrl.re & ~ctrl.fields.stall,
+                    .Elif(armed,
                     queued.eq(1),
                           )
                     .Elif(usb_core.poll & self.response,
@@ -1008,6 +1676,237 @@ class InHandler(Module, AutoCSR):
                 ),
             ]
 
+        if dma:
+            # During a multi-packet transfer, only interrupt once it is complete
+            self.comb += [
+                self.dma_sent.eq(packet_sent),
+                If(self.dma_hold,
+                    self.ev.packet.trigger.eq(self.dma_done),
+                ),
+            ]
+
+
+class InBufferHandler(Module, AutoCSR):
+    """Endpoint for Device->Host transactions, with a buffer for each endpoint.
+
+    This works like :obj:`InHandler`, except that endpoints ``0`` to ``buffers - 1``
+    each have a 64-byte buffer of their own in one shared block RAM, so that several
+    of them can be armed at the same time.  The buffer is picked by the endpoint
+    number of the ``IN`` token, and each endpoint keeps its own armed, ``STALL`` and
+    data toggle state.  Endpoints from ``buffers`` upwards always ``NAK``.
+
+    To send data, write the endpoint number to ``IN_SELECT``, which empties its
+    buffer, then write the packet to ``IN_DATA``.  Arm it by writing the endpoint
+    number to ``IN_CTRL``.  The buffer is only read as the packet goes out, so the
+    packet is sent again if the host asks for it again.
+
+    Attributes
+    ----------
+
+    response : Signal
+        ``1`` if the ``IN`` token in progress should be answered with data, ``0`` for a ``NAK``.
+
+    stalled : Signal
+        ``1`` if the endpoint of the token in progress is stalled.
+
+    dtb : Signal
+        The data toggle of the endpoint of the token in progress.
+
+    dtb_reset : Signal
+        Pulse this to put endpoint ``0`` back to ``DATA1``.
+
+    data_out : Signal(8)
+        The next byte of the packet being sent.
+
+    data_out_have : Signal
+        ``1`` while ``data_out`` holds a byte.
+
+    data_out_advance : Signal
+        Pulse this to move on to the next byte.
+    """
+    def __init__(self, usb_core, buffers=2):
+        self.dtb = Signal()
+        self.dtb_reset = Signal()
+
+        # Keep track of the current DTB for each of the 16 endpoints
+        dtbs = Signal(16, reset=0x0001)
+
+        # A list of endpoints that are stalled
+        stall_status = Signal(16)
+
+        # A list of endpoints that have a packet armed
+        queued = Signal(16)
+
+        self.specials.buf = Memory(8, 64*buffers)
+        self.specials.buf_wr = buf_wr = self.buf.get_port(write_capable=True)
+        self.specials.buf_rd = buf_rd = self.buf.get_port()
+
+        self.select = CSRStorage(
+            fields=[
+                CSRField("epno", 4, description="The endpoint whose buffer ``IN_DATA`` writes to."),
+            ],
+            description="""
+                Selects the buffer that is filled through ``IN_DATA``.  Writing this
+                register empties the buffer of that endpoint."""
+        )
+
+        self.data = CSRStorage(
+            fields=[
+                CSRField("data", 8, description="The next byte to add to the selected buffer."),
+            ],
+            description="""
+                Each byte written into this register gets added to the buffer selected by
+                ``IN_SELECT``.  Each buffer is 64 bytes long.  If you exceed this amount,
+                the result is undefined."""
+        )
+
+        self.ctrl = ctrl = CSRStorage(
+            fields=[
+                CSRField("epno", 4, description="The endpoint number whose buffer should be sent."),
+                CSRField("reset", offset=5, description="Write a ``1`` here to empty every buffer.", pulse=True),
+                CSRField("stall", description="Write a ``1`` here to stall the EP written in ``EP``."),
+            ],
+            description="""
+                Enables transmission of a buffer in response to ``IN`` tokens,
+                or resets all of the buffers."""
+        )
+
+        self.status = CSRStatus(
+            fields=[
+                CSRField("idle", description="This value is ``1`` if the selected buffer has finished transmitting."),
+                CSRField("have", offset=4, description="This value is ``0`` if the selected buffer is empty."),
+                CSRField("pend", offset=5, description="``1`` if there is an IRQ pending."),
+            ],
+            description="Status about the IN handler."
+        )
+
+        self.queued = CSRStatus(16, description="One bit for each endpoint that has a packet armed.")
+
+        self.submodules.ev = ev.EventManager()
+        self.ev.submodules.packet = ev.EventSourcePulse(name="done", description="""
+            Indicates that the host has successfully transferred an ``IN`` packet.
+            ``IN_QUEUED`` shows which endpoints are still waiting.
+            """)
+        self.ev.finalize()
+
+        # Keep track of which endpoints are currently stalled
+        ep_stall_mask = Signal(16)
+        self.stalled = Signal()
+        self.comb += [
+            ep_stall_mask.eq(1 << ctrl.fields.epno),
+            self.stalled.eq(stall_status >> usb_core.endp),
+        ]
+        self.sync += [
+            If(ctrl.fields.reset,
+                stall_status.eq(0),
+            ).Elif(usb_core.setup | (ctrl.re & ~ctrl.fields.stall),
+                # If a SETUP packet comes in, clear the STALL bit.
+                stall_status.eq(stall_status & ~ep_stall_mask),
+            ).Elif(ctrl.re,
+                stall_status.eq(stall_status | ep_stall_mask),
+            ),
+        ]
+
+        # The number of bytes in each buffer
+        lens = Array(Signal(7) for _ in range(buffers))
+        fill_len = lens[self.select.fields.epno]
+        fill = Signal()
+        self.comb += fill.eq(self.select.fields.epno < buffers)
+
+        # How to respond to requests:
+        #  - 1 - ACK
+        #  - 0 - NAK
+        self.response = Signal()
+        transmitted = Signal()
+        done = Signal()
+        done_mask = Signal(16)
+        arm_mask = Signal(16)
+        is_in_packet = Signal()
+        has_buffer = Signal()
+
+        # Outgoing data will be placed on this signal
+        self.data_out = Signal(8)
+
+        # This is "1" if `data_out` contains data
+        self.data_out_have = Signal()
+
+        # Pulse this to advance the data output
+        self.data_out_advance = Signal()
+
+        # The buffer is read one byte ahead, so address it with the next value of `sent`
+        sent = Signal(7)
+        sent_next = Signal(7)
+        self.comb += [
+            is_in_packet.eq(usb_core.tok == PID.IN),
+            has_buffer.eq(usb_core.endp < buffers),
+            self.response.eq(has_buffer & is_in_packet & (queued >> usb_core.endp)),
+            self.dtb.eq(dtbs >> usb_core.endp),
+
+            # Start again from the top of the buffer for every IN token, including retries
+            If(usb_core.poll | usb_core.retry,
+                sent_next.eq(0),
+            ).Elif(self.data_out_advance & self.data_out_have,
+                sent_next.eq(sent + 1),
+            ).Else(
+                sent_next.eq(sent),
+            ),
+            buf_rd.adr.eq(Cat(sent_next[0:6], usb_core.endp)),
+            self.data_out.eq(buf_rd.dat_r),
+            self.data_out_have.eq(has_buffer & (sent != lens[usb_core.endp])),
+
+            buf_wr.adr.eq(Cat(fill_len[0:6], self.select.fields.epno)),
+            buf_wr.dat_w.eq(self.data.storage),
+            buf_wr.we.eq(self.data.re & fill),
+
+            # When the host acknowledges the packet, disarm the endpoint.  An
+            # IN in place of the ACK also ends the transaction, but the
+            # packet is sent again rather than being done with.
+            done.eq(usb_core.commit & ~usb_core.retry & transmitted & ~self.stalled),
+            self.ev.packet.trigger.eq(done),
+            If(done,
+                done_mask.eq(1 << usb_core.endp),
+            ),
+
+            # When the user updates the `ctrl` register, arm the endpoint.
+            If(ctrl.re & ~ctrl.fields.stall & (ctrl.fields.epno < buffers),
+                arm_mask.eq(ep_stall_mask),
+            ),
+
+            # Wire up the "status" registers
+            self.status.fields.idle.eq(~(queued >> self.select.fields.epno)),
+            self.status.fields.have.eq(fill_len != 0),
+            self.status.fields.pend.eq(self.ev.packet.pending),
+            self.queued.status.eq(queued),
+        ]
+
+        self.sync += [
+            sent.eq(sent_next),
+            If(usb_core.poll,
+                transmitted.eq(self.response),
+            ).Elif(done,
+                transmitted.eq(0),
+            ),
+            If(ctrl.fields.reset,
+                queued.eq(0),
+                dtbs.eq(0x0001),
+                [l.eq(0) for l in lens],
+            ).Else(
+                If(self.select.re & fill,
+                    fill_len.eq(0),
+                ).Elif(self.data.re & fill,
+                    fill_len.eq(fill_len + 1),
+                ),
+                # Another endpoint may be armed while this one finishes
+                queued.eq((queued & ~done_mask) | arm_mask),
+                If(done,
+                    # Toggle the "DTB" line if we transmitted data
+                    dtbs.eq(dtbs ^ done_mask),
+                ).Elif(self.dtb_reset,
+                    dtbs.eq(dtbs | 1),
+                ),
+            ),
+        ]
+
 
 class OutHandler(Module, AutoCSR):
     """
@@ -1022,15 +1921,30 @@ class OutHandler(Module, AutoCSR):
     To drain the FIFO, read from ``OUT.DATA``.  Don't forget to re-
     enable the FIFO by ensuring ``OUT_CTRL.ENABLE`` is set after advancing the FIFO!
 
+    With ``wide=True``, ``OUT_WDATA`` drains the FIFO four bytes at a time, and
+    ``OUT_STATUS.WCOUNT`` says how many of them are valid.
+
+    With ``dma=True``, a :obj:`TriEndpointDMA` engine can enable ``dma_epno`` by
+    pulsing ``dma_enable``.  While ``dma_active`` is set, ``dma_received`` pulses when
+    a packet has arrived on ``dma_epno``, and the engine drains the FIFO through
+    ``dma_re`` before pulsing ``dma_done`` to raise the interrupt.  Packets on other
+    endpoints raise the interrupt as usual, for the CPU to read.
+
+    With ``slots`` greater than one, the FIFO holds that many packets, and
+    ``OUT_SLOT`` describes the oldest one.  A packet that fails part of the way
+    through holds on to its slot until it is the oldest, and is then dropped.
+
     Attributes
     ----------
 
     """
-    def __init__(self, usb_core, cdc=False):
+    def __init__(self, usb_core, cdc=False, wide=False, dma=False, slots=1):
         if cdc:
             self.submodules.data_buf = buf = ResetInserter(["sys", "usb_12"])(ClockDomainsRenamer({"write":"usb_12","read":"sys"})(fifo.AsyncFIFO(width=8, depth=128))) # 66
+        elif wide:
+            self.submodules.data_buf = buf = ResetInserter()(WordBuffer(depth=17*slots)) # 66 bytes
         else:
-            self.submodules.data_buf = buf = ResetInserter()(fifo.SyncFIFOBuffered(width=8, depth=66))
+            self.submodules.data_buf = buf = ResetInserter()(fifo.SyncFIFOBuffered(width=8, depth=66*slots))
 
         self.data = data = CSRStatus(
             fields=[
@@ -1042,13 +1956,27 @@ class OutHandler(Module, AutoCSR):
                 this register advances the FIFO pointer."""
         )
 
+        if wide:
+            self.wdata = wdata = CSRStatus(
+                fields=[
+                    CSRField("data", 32, description="The top word of the receive FIFO."),
+                ],
+                description="""
+                    The next four bytes of the receive FIFO, with the first byte in the least
+                    significant bits.  ``OUT_STATUS.WCOUNT`` says how many bytes are valid.
+                    Reading from this register advances the FIFO by a whole word."""
+            )
+
+        ctrl_fields = [
+            CSRField("epno", 4, description="The endpoint number to update the ``enable`` and ``status`` bits for."),
+            CSRField("enable", description="Write a ``1`` here to enable receiving data"),
+            CSRField("reset", pulse=True, description="Write a ``1`` here to reset the ``OUT`` handler"),
+            CSRField("stall", description="Write a ``1`` here to stall an endpoint"),
+        ]
+        if slots > 1:
+            ctrl_fields.append(CSRField("auto", description="Write a ``1`` here to keep the endpoint enabled after each packet"))
         self.ctrl = ctrl = CSRStorage(
-            fields=[
-                CSRField("epno", 4, description="The endpoint number to update the ``enable`` and ``status`` bits for."),
-                CSRField("enable", description="Write a ``1`` here to enable receiving data"),
-                CSRField("reset", pulse=True, description="Write a ``1`` here to reset the ``OUT`` handler"),
-                CSRField("stall", description="Write a ``1`` here to stall an endpoint"),
-            ],
+            fields=ctrl_fields,
             description="""
                 Controls for receiving packet data.  To enable an endpoint, write its value to ``epno``,
                 with the ``enable`` bit set to ``1`` to enable an endpoint, or ``0`` to disable it.
@@ -1057,15 +1985,34 @@ class OutHandler(Module, AutoCSR):
                 Similarly, you can adjust the ``STALL`` state by setting or clearing the ``stall`` bit."""
         )
 
+        status_fields = [
+            CSRField("epno", 4, description="The destination endpoint for the most recent ``OUT`` packet."),
+            CSRField("have", description="``1`` if there is data in the FIFO."),
+            CSRField("pend", description="``1`` if there is an IRQ pending."),
+        ]
+        if wide:
+            status_fields.append(CSRField("wcount", 3, offset=8, description="The number of valid bytes in ``OUT_WDATA``."))
         self.status = CSRStatus(
-            fields=[
-                CSRField("epno", 4, description="The destination endpoint for the most recent ``OUT`` packet."),
-                CSRField("have", description="``1`` if there is data in the FIFO."),
-                CSRField("pend", description="``1`` if there is an IRQ pending."),
-            ],
+            fields=status_fields,
             description="Status about the current state of the `OUT` endpoint."
         )
 
+        if slots > 1:
+            self.slot = CSRStatus(
+                fields=[
+                    CSRField("epno", 4, description="The endpoint the oldest packet in the FIFO was sent to."),
+                    CSRField("len", 7, offset=8, description="The number of bytes in the oldest packet, including the CRC16."),
+                    CSRField("count", bits_for(slots), offset=16, description="The number of packets in the FIFO."),
+                ],
+                description="""
+                    Describes the oldest packet in the ``OUT`` FIFO.  Once ``LEN`` bytes have been
+                    read from ``OUT_DATA``, this moves on to the next packet."""
+            )
+
+            # The endpoint and length of every packet in the FIFO, and whether
+            # it is to be dropped
+            self.submodules.slots = slot_fifo = ResetInserter()(fifo.SyncFIFO(width=4+7+1, depth=slots))
+
         self.submodules.ev = ev.EventManager()
         self.ev.submodules.packet = ev.EventSourcePulse(name="done", description="""
             Indicates that an ``OUT`` packet has successfully been transferred
@@ -1075,6 +2022,16 @@ class OutHandler(Module, AutoCSR):
 
         self.usb_reset = Signal()
 
+        if dma:
+            self.dma_re = Signal()
+            self.dma_received = Signal()
+            self.dma_done = Signal()
+            self.dma_epno = Signal(4)
+            self.dma_enable = Signal()
+            self.dma_active = Signal()
+            # Set from when a packet for the engine arrives until it is in RAM
+            dma_draining = Signal()
+
         self.stalled = Signal()
         self.enabled = Signal()
         stall_status = Signal(16)
@@ -1178,7 +2135,13 @@ class OutHandler(Module, AutoCSR):
         else:
             # Keep track of whether we're currently responding.
             self.comb += is_out_packet.eq(usb_core.tok == PID.OUT)
-            self.comb += self.response.eq(self.enabled & is_out_packet & ~self.ev.packet.pending)
+            if slots > 1:
+                # Keep accepting packets for as long as there is a free slot
+                self.comb += self.response.eq(self.enabled & is_out_packet & slot_fifo.writable)
+            elif dma:
+                self.comb += self.response.eq(self.enabled & is_out_packet & ~self.ev.packet.pending & ~dma_draining)
+            else:
+                self.comb += self.response.eq(self.enabled & is_out_packet & ~self.ev.packet.pending)
             self.sync += If(usb_core.poll, responding.eq(self.response))
 
         # Connect the buffer to the USB system
@@ -1243,6 +2206,8 @@ class OutHandler(Module, AutoCSR):
                 ),
             ]
         else:
+            # Pulses once a packet is ready to be read from the FIFO
+            received = Signal()
             self.comb += [
                 buf.din.eq(self.data_recv_payload),
                 buf.we.eq(self.data_recv_put & responding),
@@ -1260,17 +2225,115 @@ class OutHandler(Module, AutoCSR):
                 # This is true even if "no" data was transferred, because the
                 # buffer will then contain two bytes of CRC16 data.
                 # Therefore, if the FIFO is readable, an interrupt must be triggered.
-                self.ev.packet.trigger.eq(responding & usb_core.commit),
+                received.eq(responding & usb_core.commit),
+                self.ev.packet.trigger.eq(received),
             ]
+            if wide:
+                # The last partial word only reaches the head of the FIFO two
+                # cycles after it is flushed, so hold the interrupt back until then.
+                committed = Signal(2)
+                self.sync += committed.eq(Cat(responding & usb_core.commit, committed[0]))
+                self.comb += [
+                    received.eq(committed[1]),
+                    # Push out the last partial word of the packet
+                    buf.flush.eq(usb_core.end),
+
+                    wdata.fields.data.eq(buf.wdout),
+                    buf.wre.eq(wdata.we),
+                    If(buf.readable,
+                        self.status.fields.wcount.eq(buf.wcount),
+                    ),
+                ]
+
+            disable_mask = ep_mask
+            if slots > 1:
+                # Endpoints set to re-arm automatically stay enabled
+                auto_status = Signal(16)
+                disable_mask = ep_mask & ~auto_status
+                self.sync += [
+                    If(ctrl.fields.reset | self.usb_reset,
+                        auto_status.eq(0),
+                    ).Elif(ctrl.re,
+                        If(ctrl.fields.enable & ctrl.fields.auto,
+                            auto_status.eq(auto_status | ep_mask),
+                        ).Else(
+                            auto_status.eq(auto_status & ~ep_mask),
+                        ),
+                    ),
+                ]
+
+                # Bytes received for the current packet, and bytes read from the oldest one
+                recv_len = Signal(7)
+                read_len = Signal(7)
+                read_count = Signal(3)
+                slot_len = Signal(7)
+                slot_done = Signal()
+
+                # The bytes of a packet that failed are already in the FIFO, so
+                # it gets a slot as well, and is drained here once it is the
+                # oldest.  The firmware never sees it.
+                failed = Signal()
+                dropping = Signal()
+                packets = Signal(bits_for(slots))
+                self.comb += [
+                    failed.eq(responding & usb_core.end & ~usb_core.commit & (recv_len != 0)),
+                    dropping.eq(slot_fifo.readable & slot_fifo.dout[11]),
+                    slot_fifo.reset.eq(ctrl.fields.reset),
+                    slot_fifo.din.eq(Cat(usb_core.endp, recv_len, failed)),
+                    slot_fifo.we.eq((responding & usb_core.commit) | failed),
+                    slot_len.eq(slot_fifo.dout[4:11]),
+
+                    If(dropping,
+                        buf.re.eq(1),
+                    ),
+                    If(buf.readable & buf.re,
+                        read_count.eq(1),
+                    ),
+                    slot_done.eq(slot_fifo.readable & (read_count != 0) & (read_len + read_count >= slot_len)),
+                    slot_fifo.re.eq(slot_done),
+
+                    self.status.fields.have.eq(buf.readable & ~dropping),
+                    If(~dropping,
+                        self.slot.fields.epno.eq(slot_fifo.dout[0:4]),
+                    ),
+                    If(slot_fifo.readable & ~dropping,
+                        self.slot.fields.len.eq(slot_len),
+                    ),
+                    self.slot.fields.count.eq(packets),
+                ]
+                if wide:
+                    self.comb += If(buf.readable & buf.wre & ~dropping,
+                        read_count.eq(buf.wcount),
+                    )
+                self.sync += [
+                    If(ctrl.fields.reset | usb_core.end,
+                        recv_len.eq(0),
+                    ).Elif(buf.we,
+                        recv_len.eq(recv_len + 1),
+                    ),
+                    If(ctrl.fields.reset | slot_done,
+                        read_len.eq(0),
+                    ).Else(
+                        read_len.eq(read_len + read_count),
+                    ),
+                    If(ctrl.fields.reset,
+                        packets.eq(0),
+                    ).Elif(responding & usb_core.commit,
+                        If(~(slot_done & ~dropping),
+                            packets.eq(packets + 1),
+                        ),
+                    ).Elif(slot_done & ~dropping,
+                        packets.eq(packets - 1),
+                    ),
+                ]
 
             # If we get a packet, turn off the "IDLE" flag and keep it off until the packet has finished.
-            self.sync += [
-                If(ctrl.fields.reset,
+            enable = If(ctrl.fields.reset,
                     enable_status.eq(0),
                 ).Elif(usb_core.commit & responding,
                     epno.eq(usb_core.endp),
                     # Disable this EP when a transfer finishes
-                    enable_status.eq(enable_status & ~ep_mask),
+                    enable_status.eq(enable_status & ~disable_mask),
                     responding.eq(0),
                        ).Elif(ctrl.re,
                     # Enable or disable the EP as necessary
@@ -1279,11 +2342,400 @@ class OutHandler(Module, AutoCSR):
                     ).Else(
                         enable_status.eq(enable_status & ~ep_mask),
                     ),
-                ),
-            ]
+                )
+
+            if dma:
+                # The DMA engine drains the FIFO in place of the CPU, and the
+                # interrupt only fires once the packet is in RAM.  Packets for
+                # any other endpoint are left for the CPU.
+                self.comb += [
+                    If(self.dma_re,
+                        buf.re.eq(1),
+                    ),
+                    self.dma_received.eq(received & self.dma_active & (usb_core.endp == self.dma_epno)),
+                    self.ev.packet.trigger.eq(self.dma_done | (received & ~self.dma_received)),
+                ]
+                self.sync += [
+                    If(self.dma_received,
+                        dma_draining.eq(1),
+                    ).Elif(self.dma_done | ctrl.fields.reset,
+                        dma_draining.eq(0),
+                    ),
+                ]
+
+                # Enabling an endpoint for the engine waits for a cycle when
+                # the CPU or the USB core isn't changing the enables itself.
+                dma_enabling = Signal()
+                enable = enable.Elif(self.dma_enable | dma_enabling,
+                    enable_status.eq(enable_status | (1 << self.dma_epno)),
+                )
+                self.sync += dma_enabling.eq((self.dma_enable | dma_enabling) &
+                    (ctrl.fields.reset | (usb_core.commit & responding) | ctrl.re))
+            self.sync += enable
 
         # These are useful for debugging
         # self.enable_status = CSRStatus(8, description)
         # self.comb += self.enable_status.status.eq(enable_status)
         # self.stall_status = CSRStatus(8)
         # self.comb += self.stall_status.status.eq(stall_status)
+
+
+class IsoInHandler(Module, AutoCSR):
+    """Isochronous endpoint for Device->Host transactions.
+
+    An isochronous endpoint sends one packet in every frame, and the host never
+    acknowledges it.  This handler has two buffers of up to ``max_packet_size``
+    bytes: one is sent in the current frame, while the next packet is written to
+    the other through ``ISO_IN_DATA``.  Write ``ISO_IN_CTRL.READY`` once it is
+    complete, and it is sent in the next frame.  The buffers are swapped on
+    every ``SOF``, and the ``SOF`` interrupt fires, so the firmware only has to
+    run once per frame.
+
+    If no packet was ready when the frame started, an empty packet is sent and
+    ``ISO_IN_LATE`` counts up.  If the host never asked for a packet during its
+    frame, ``ISO_IN_MISSED`` counts up.
+
+    Parameters
+    ----------
+
+    epno : int
+        The endpoint number.
+
+    max_packet_size : int, optional
+        The size of each buffer, up to 1023 bytes.
+
+    Attributes
+    ----------
+
+    owns : Signal
+        ``1`` while the current token is an ``IN`` to this endpoint.
+    """
+    def __init__(self, usb_core, epno, max_packet_size=1023):
+        if max_packet_size > 1023:
+            raise ValueError("isochronous packets are at most 1023 bytes, not {}".format(max_packet_size))
+
+        abits = bits_for(max_packet_size - 1)
+        self.specials.buf = Memory(8, 2 << abits)
+        self.specials.buf_wr = buf_wr = self.buf.get_port(write_capable=True)
+        self.specials.buf_rd = buf_rd = self.buf.get_port()
+
+        self.data = CSRStorage(
+            fields=[
+                CSRField("data", 8, description="The next byte to add to the packet for the next frame."),
+            ],
+            description="""
+                Each byte written into this register gets added to the packet that is sent
+                in the next frame.  Bytes beyond the maximum packet size are dropped."""
+        )
+
+        self.ctrl = ctrl = CSRStorage(
+            fields=[
+                CSRField("enable", description="Write a ``1`` here to start streaming.  While this is ``0`` the endpoint sends empty packets, and the counters stay still."),
+                CSRField("ready", pulse=True, description="Write a ``1`` here once the packet for the next frame is complete."),
+                CSRField("reset", pulse=True, description="Write a ``1`` here to empty both buffers and clear the counters."),
+            ],
+        )
+
+        self.status = CSRStatus(
+            fields=[
+                CSRField("len", 10, description="The number of bytes in the packet for the next frame."),
+                CSRField("ready", description="``1`` if the packet for the next frame is complete."),
+                CSRField("frame", 11, offset=16, description="The number of the current frame."),
+            ],
+        )
+
+        self.missed = CSRStatus(16, description="The number of packets the host did not ask for in their frame.")
+        self.late = CSRStatus(16, description="The number of frames that started before their packet was ready.")
+
+        self.submodules.ev = ev.EventManager()
+        self.ev.submodules.packet = ev.EventSourcePulse(name="sof", description="""
+            Indicates that a new frame has started, and that the packet for the
+            next frame can be written.""")
+        self.ev.finalize()
+
+        self.usb_reset = Signal()
+
+        self.owns = Signal()
+        self.response = Signal()
+        self.dtb = Signal()
+        self.data_out = Signal(8)
+        self.data_out_have = Signal()
+        self.data_out_advance = Signal()
+
+        # The CPU writes to `fill_bank` while the other one is sent
+        fill_bank = Signal()
+        fill_len = Signal(max=max_packet_size + 1)
+        ready = Signal()
+        send_len = Signal(max=max_packet_size + 1)
+        queued = Signal()
+        collected = Signal()
+        missed = Signal(16)
+        late = Signal(16)
+
+        # Only count a frame as late if it started after the endpoint was enabled
+        running = Signal()
+
+        reset = Signal()
+        sof = Signal()
+        self.comb += [
+            reset.eq(ctrl.fields.reset | self.usb_reset),
+            sof.eq(usb_core.sof & ctrl.fields.enable),
+            self.owns.eq((usb_core.tok == PID.IN) & (usb_core.endp == epno)),
+            # There is no NAK, so answer every IN with whatever there is
+            self.response.eq(self.owns),
+            self.ev.packet.trigger.eq(sof),
+        ]
+
+        # The buffer is read one byte ahead, so address it with the next value of `sent`
+        sent = Signal(max=max_packet_size + 1)
+        sent_next = Signal(max=max_packet_size + 1)
+        self.comb += [
+            If(usb_core.poll,
+                sent_next.eq(0),
+            ).Elif(self.data_out_advance & self.data_out_have,
+                sent_next.eq(sent + 1),
+            ).Else(
+                sent_next.eq(sent),
+            ),
+            buf_rd.adr.eq(Cat(sent_next[0:abits], ~fill_bank)),
+            self.data_out.eq(buf_rd.dat_r),
+            self.data_out_have.eq(sent != send_len),
+
+            buf_wr.adr.eq(Cat(fill_len[0:abits], fill_bank)),
+            buf_wr.dat_w.eq(self.data.storage),
+            buf_wr.we.eq(self.data.re & (fill_len != max_packet_size)),
+
+            self.status.fields.len.eq(fill_len),
+            self.status.fields.ready.eq(ready),
+            self.status.fields.frame.eq(usb_core.frame),
+            self.missed.status.eq(missed),
+            self.late.status.eq(late),
+        ]
+
+        self.sync += [
+            sent.eq(sent_next),
+            If(reset | ~ctrl.fields.enable,
+                running.eq(0),
+            ).Elif(sof,
+                running.eq(1),
+            ),
+            If(reset,
+                fill_len.eq(0),
+                ready.eq(0),
+                send_len.eq(0),
+                queued.eq(0),
+                collected.eq(0),
+                missed.eq(0),
+                late.eq(0),
+            ).Elif(sof,
+                If(queued & ~collected,
+                    missed.eq(missed + 1),
+                ),
+                If(ready,
+                    fill_bank.eq(~fill_bank),
+                    send_len.eq(fill_len),
+                    fill_len.eq(0),
+                    ready.eq(0),
+                    queued.eq(1),
+                ).Else(
+                    If(running,
+                        late.eq(late + 1),
+                    ),
+                    send_len.eq(0),
+                    queued.eq(0),
+                    If(buf_wr.we,
+                        fill_len.eq(fill_len + 1),
+                    ),
+                    ready.eq(ctrl.fields.ready),
+                ),
+                collected.eq(0),
+            ).Else(
+                If(buf_wr.we,
+                    fill_len.eq(fill_len + 1),
+                ),
+                If(ctrl.fields.ready,
+                    ready.eq(1),
+                ),
+                If(usb_core.commit & self.owns,
+                    collected.eq(1),
+                ),
+            ),
+        ]
+
+
+class IsoOutHandler(Module, AutoCSR):
+    """Isochronous endpoint for Host->Device transactions.
+
+    The host sends at most one packet to an isochronous endpoint in every frame,
+    and the device never acknowledges it.  This handler has two buffers of up to
+    ``max_packet_size`` bytes: one receives the packet of the current frame, while
+    the packet of the previous frame is read from the other through
+    ``ISO_OUT_DATA``, without its CRC16.  The buffers are swapped on every
+    ``SOF``, and the ``SOF`` interrupt fires, so the firmware only has to run
+    once per frame.
+
+    If no packet arrived during a frame, ``ISO_OUT_MISSED`` counts up and the
+    next packet to read is empty.  If a packet had not been read completely by
+    the time the next one took its place, ``ISO_OUT_LATE`` counts up.
+
+    Parameters
+    ----------
+
+    epno : int
+        The endpoint number.
+
+    max_packet_size : int, optional
+        The size of each buffer, up to 1023 bytes.
+
+    Attributes
+    ----------
+
+    owns : Signal
+        ``1`` while the current token is an ``OUT`` to this endpoint.
+    """
+    def __init__(self, usb_core, epno, max_packet_size=1023):
+        if max_packet_size > 1023:
+            raise ValueError("isochronous packets are at most 1023 bytes, not {}".format(max_packet_size))
+
+        abits = bits_for(max_packet_size - 1)
+        self.specials.buf = Memory(8, 2 << abits)
+        self.specials.buf_wr = buf_wr = self.buf.get_port(write_capable=True)
+        self.specials.buf_rd = buf_rd = self.buf.get_port()
+
+        self.data = data = CSRStatus(
+            fields=[
+                CSRField("data", 8, description="The next byte of the packet from the previous frame."),
+            ],
+            description="""
+                The packet received in the previous frame.  Reading from this register
+                advances to the next byte."""
+        )
+
+        self.ctrl = ctrl = CSRStorage(
+            fields=[
+                CSRField("enable", description="Write a ``1`` here to start receiving.  While this is ``0`` incoming packets are dropped, and the counters stay still."),
+                CSRField("reset", pulse=True, description="Write a ``1`` here to empty both buffers and clear the counters."),
+            ],
+        )
+
+        self.status = CSRStatus(
+            fields=[
+                CSRField("len", 10, description="The number of bytes in the packet from the previous frame."),
+                CSRField("have", description="``1`` if there are bytes left to read from ``ISO_OUT_DATA``."),
+                CSRField("frame", 11, offset=16, description="The number of the current frame."),
+            ],
+        )
+
+        self.missed = CSRStatus(16, description="The number of frames in which no packet arrived.")
+        self.late = CSRStatus(16, description="The number of packets that were replaced before they had been read.")
+
+        self.submodules.ev = ev.EventManager()
+        self.ev.submodules.packet = ev.EventSourcePulse(name="sof", description="""
+            Indicates that a new frame has started, and that the packet from the
+            previous frame can be read.""")
+        self.ev.finalize()
+
+        self.usb_reset = Signal()
+
+        self.owns = Signal()
+        self.response = Signal()
+        self.data_recv_put = Signal()
+
+        # The USB side writes to `recv_bank` while the CPU reads the other one
+        recv_bank = Signal()
+        read_bank = Signal()
+        recv_len = Signal(max=max_packet_size + 3)
+        got = Signal()
+        got_len = Signal(max=max_packet_size + 1)
+        read_len = Signal(max=max_packet_size + 1)
+        missed = Signal(16)
+        late = Signal(16)
+
+        # Only count a frame as missed if it started after the endpoint was enabled
+        running = Signal()
+
+        reset = Signal()
+        sof = Signal()
+        swap = Signal()
+        self.comb += [
+            reset.eq(ctrl.fields.reset | self.usb_reset),
+            sof.eq(usb_core.sof & ctrl.fields.enable),
+            swap.eq(sof & got),
+            self.owns.eq((usb_core.tok == PID.OUT) & (usb_core.endp == epno)),
+            self.response.eq(self.owns & ctrl.fields.enable),
+            self.ev.packet.trigger.eq(sof),
+
+            read_bank.eq(~recv_bank),
+            buf_wr.adr.eq(Cat(recv_len[0:abits], recv_bank)),
+            buf_wr.dat_w.eq(usb_core.data_recv_payload),
+            buf_wr.we.eq(self.data_recv_put & (recv_len < max_packet_size)),
+        ]
+
+        # The buffer is read one byte ahead, so address it with the next value of `read_ptr`
+        read_ptr = Signal(max=max_packet_size + 1)
+        read_ptr_next = Signal(max=max_packet_size + 1)
+        read_bank_next = Signal()
+        have = Signal()
+        self.comb += [
+            have.eq(read_ptr != read_len),
+            If(reset | sof,
+                read_ptr_next.eq(0),
+            ).Elif(data.we & have,
+                read_ptr_next.eq(read_ptr + 1),
+            ).Else(
+                read_ptr_next.eq(read_ptr),
+            ),
+            read_bank_next.eq(read_bank ^ swap),
+            buf_rd.adr.eq(Cat(read_ptr_next[0:abits], read_bank_next)),
+            If(have,
+                data.fields.data.eq(buf_rd.dat_r),
+            ),
+
+            self.status.fields.len.eq(read_len),
+            self.status.fields.have.eq(have),
+            self.status.fields.frame.eq(usb_core.frame),
+            self.missed.status.eq(missed),
+            self.late.status.eq(late),
+        ]
+
+        self.sync += [
+            read_ptr.eq(read_ptr_next),
+            If(reset | ~ctrl.fields.enable,
+                running.eq(0),
+            ).Elif(sof,
+                running.eq(1),
+            ),
+            If(usb_core.poll,
+                recv_len.eq(0),
+            ).Elif(self.data_recv_put & (recv_len != max_packet_size + 2),
+                recv_len.eq(recv_len + 1),
+            ),
+            If(reset,
+                got.eq(0),
+                read_len.eq(0),
+                missed.eq(0),
+                late.eq(0),
+            ).Elif(sof,
+                If(have,
+                    late.eq(late + 1),
+                ),
+                If(got,
+                    recv_bank.eq(~recv_bank),
+                    read_len.eq(got_len),
+                ).Else(
+                    If(running,
+                        missed.eq(missed + 1),
+                    ),
+                    read_len.eq(0),
+                ),
+                got.eq(0),
+            ).Elif(usb_core.commit & self.response,
+                # Leave out the CRC16
+                got.eq(1),
+                If(recv_len >= 2,
+                    got_len.eq(recv_len - 2),
+                ).Else(
+                    got_len.eq(0),
+                ),
+            ),
+        ]
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import json
+import os
+import subprocess
+import sys
+import time
 import unittest
 from unittest import TestCase
 
@@ -7,13 +12,14 @@ from migen import *
 
 from ..endpoint import EndpointType, EndpointResponse
 from ..io_test import FakeIoBuf
-from ..pid import PIDTypes
+from ..pid import PID, PIDTypes
 from ..utils.packet import crc16
 
 from ..test.common import BaseUsbTestCase, CommonUsbTestCase
 from ..test.clock import CommonTestMultiClockDomain
+from ..test.host import WireHost
 
-from .eptri import TriEndpointInterface
+from .eptri import TriEndpointInterface, ModeratedIRQ, InHandler, InBufferHandler, OutHandler, IsoInHandler, IsoOutHandler, WordBuffer
 
 
 class TestTriEndpointInterface(
@@ -263,5 +269,877 @@ class TestTriEndpointInterface(
         return bool(status)
 
 
+class TestWordBuffer(TestCase):
+    def write_bytes(self, dut, data):
+        for b in data:
+            yield dut.din.eq(b)
+            yield dut.we.eq(1)
+            yield
+        yield dut.we.eq(0)
+
+    def read_bytes(self, dut):
+        data = []
+        yield
+        while (yield dut.readable):
+            data.append((yield dut.dout))
+            yield dut.re.eq(1)
+            yield
+            yield dut.re.eq(0)
+            yield
+        return data
+
+    def read_words(self, dut):
+        words = []
+        yield
+        while (yield dut.readable):
+            words.append(((yield dut.wdout), (yield dut.wcount)))
+            yield dut.wre.eq(1)
+            yield
+            yield dut.wre.eq(0)
+            yield
+        return words
+
+    def test_pack_bytes(self):
+        dut = WordBuffer(depth=4)
+        def stim():
+            yield from self.write_bytes(dut, [1, 2, 3, 4, 5, 6])
+            yield dut.flush.eq(1)
+            yield
+            yield dut.flush.eq(0)
+            words = yield from self.read_words(dut)
+            self.assertEqual(words, [(0x04030201, 4), (0x0605, 2)])
+
+            # A packet that fills its last word needs no flush
+            yield from self.write_bytes(dut, [7, 8, 9, 10])
+            yield dut.flush.eq(1)
+            yield
+            yield dut.flush.eq(0)
+            words = yield from self.read_words(dut)
+            self.assertEqual(words, [(0x0a090807, 4)])
+        run_simulation(dut, stim())
+
+    def test_pack_read_bytes(self):
+        dut = WordBuffer(depth=4)
+        def stim():
+            yield from self.write_bytes(dut, [1, 2, 3, 4, 5])
+            yield dut.flush.eq(1)
+            yield
+            yield dut.flush.eq(0)
+            data = yield from self.read_bytes(dut)
+            self.assertEqual(data, [1, 2, 3, 4, 5])
+        run_simulation(dut, stim())
+
+    def write_word(self, dut, word):
+        yield dut.wdin.eq(word)
+        yield dut.wwe.eq(1)
+        yield
+        yield dut.wwe.eq(0)
+
+    def test_words_and_bytes(self):
+        dut = WordBuffer(depth=4)
+        def stim():
+            yield from self.write_word(dut, 0x44332211)
+            yield from self.write_bytes(dut, [0x55, 0x66])
+            # A word lines up behind the bytes before it
+            yield from self.write_word(dut, 0xaa998877)
+            yield from self.write_bytes(dut, [0xbb])
+            yield dut.flush.eq(1)
+            yield
+            yield dut.flush.eq(0)
+            words = yield from self.read_words(dut)
+            self.assertEqual(words, [(0x44332211, 4), (0x88776655, 4), (0xbbaa99, 3)])
+        run_simulation(dut, stim())
+
+    def test_wide_cdc(self):
+        with self.assertRaises(ValueError):
+            TriEndpointInterface(FakeIoBuf(), cdc=True, wide=True)
+
+    def test_wide_registers(self):
+        dut = TriEndpointInterface(FakeIoBuf(), wide=True)
+        self.assertEqual(len(getattr(dut, "in").wdata.storage), 32)
+        self.assertEqual(len(dut.out.wdata.status), 32)
+        self.assertEqual(len(dut.setup.wdata.status), 32)
+
+
+class TestWideTransfers(TestCase):
+    """Whole packets through the 32-bit registers of ``TriEndpointInterface``."""
+    def setUp(self):
+        self.dut = TriEndpointInterface(FakeIoBuf(), wide=True)
+        self.host = WireHost(self.dut.iobuf)
+
+    def run_device(self, host, firmware):
+        def wire():
+            yield from self.dut.iobuf.recv("J")
+            for _ in range(20):
+                yield
+            yield from host()
+            for _ in range(200):
+                yield
+        run_simulation(self.dut, {"usb_48": wire(), "sys": firmware()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+
+    def clear_pending(self, handler):
+        yield handler.ev.pending.r.eq(1)
+        yield handler.ev.pending.re.eq(1)
+        yield
+        yield handler.ev.pending.re.eq(0)
+        yield
+
+    def read_words(self, handler):
+        """Drain a handler through its ``WDATA`` register, a word at a time."""
+        data = []
+        while (yield handler.status.fields.have):
+            word = yield handler.wdata.fields.data
+            count = yield handler.status.fields.wcount
+            self.assertIn(count, range(1, 5))
+            data += [(word >> (8*i)) & 0xff for i in range(count)]
+            yield from handler.wdata.read()
+            yield
+        return data
+
+    def test_setup_wdata(self):
+        setup_data = [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x12, 0x00]
+        read = []
+        def host():
+            self.assertTrue((yield from self.host.setup(setup_data)))
+        def firmware():
+            while not (yield self.dut.setup.ev.packet.pending):
+                yield
+            read.extend((yield from self.read_words(self.dut.setup)))
+        self.run_device(host, firmware)
+        # Two whole words, then the CRC16 in a word of its own
+        self.assertEqual(read, setup_data + crc16(setup_data))
+
+    def test_out_wdata(self):
+        packets = [list(range(1, 12)), list(range(0x20, 0x28)), []]
+        read = []
+        def host():
+            for packet in packets:
+                while not (yield from self.host.out(1, packet)):
+                    pass
+        def firmware():
+            for _ in packets:
+                yield from self.dut.out.ctrl.write(1 | (1 << 4))
+                while not (yield self.dut.out.ev.packet.pending):
+                    yield
+                read.append((yield from self.read_words(self.dut.out)))
+                yield from self.clear_pending(self.dut.out)
+        self.run_device(host, firmware)
+        self.assertEqual(read, [p + crc16(p) for p in packets])
+
+    def test_in_wdata(self):
+        in_handler = getattr(self.dut, "in")
+        # Whole words only, then a tail of one to three bytes through IN_DATA
+        packets = [list(range(1, 9)), list(range(0x10, 0x17)), [0x30], list(range(0x40, 0x80))]
+        received = []
+        def host():
+            for _ in packets:
+                packet = None
+                while packet is None:
+                    packet = yield from self.host.in_(1)
+                received.append(packet)
+        def firmware():
+            for packet in packets:
+                words = len(packet) // 4
+                for i in range(words):
+                    yield from in_handler.wdata.write(int.from_bytes(bytes(packet[4*i:4*i+4]), "little"))
+                for b in packet[4*words:]:
+                    yield from in_handler.data.write(b)
+                yield from in_handler.ctrl.write(1)
+                while not (yield in_handler.ev.packet.pending):
+                    yield
+                yield from self.clear_pending(in_handler)
+        self.run_device(host, firmware)
+        self.assertEqual(received, packets)
+
+    def test_in_data_bytes(self):
+        in_handler = getattr(self.dut, "in")
+        # Firmware that only knows about IN_DATA still gets a whole packet
+        packets = [list(range(64)), list(range(0x80, 0x85))]
+        received = []
+        def host():
+            for _ in packets:
+                packet = None
+                while packet is None:
+                    packet = yield from self.host.in_(1)
+                received.append(packet)
+        def firmware():
+            for packet in packets:
+                for b in packet:
+                    yield from in_handler.data.write(b)
+                yield from in_handler.ctrl.write(1)
+                while not (yield in_handler.ev.packet.pending):
+                    yield
+                yield from self.clear_pending(in_handler)
+        self.run_device(host, firmware)
+        self.assertEqual(received, packets)
+
+
+class FakeUsbCore(Module):
+    """The `UsbTransfer` signals that the handlers look at."""
+    def __init__(self):
+        self.tok = Signal(4)
+        self.endp = Signal(4)
+        self.poll = Signal()
+        self.setup = Signal()
+        self.commit = Signal()
+        self.end = Signal()
+        self.retry = Signal()
+        self.data_recv_put = Signal()
+        self.data_recv_payload = Signal(8)
+        self.start = Signal()
+        self.data_send_get = Signal()
+        self.usb_reset = Signal()
+        self.sof = Signal()
+        self.frame = Signal(11)
+
+
+class FakeEventManager(Module):
+    """An `EventManager` with a single pulse source."""
+    def __init__(self):
+        self.irq = Signal()
+        self.trigger = Signal()
+        self.clear = Signal()
+        self.sync += If(self.trigger,
+            self.irq.eq(1),
+        ).Elif(self.clear,
+            self.irq.eq(0),
+        )
+
+
+class TestModeratedIRQ(TestCase):
+    def setUp(self):
+        self.urgent = FakeEventManager()
+        self.packets = FakeEventManager()
+        self.dut = ModeratedIRQ([self.urgent], [self.packets], [self.packets.trigger])
+        self.dut.submodules += [self.urgent, self.packets]
+
+    def pulse(self, signal):
+        yield signal.eq(1)
+        yield
+        yield signal.eq(0)
+        yield
+        yield
+
+    def test_every_packet(self):
+        def stim():
+            yield from self.pulse(self.packets.trigger)
+            self.assertTrue((yield self.dut.irq))
+        run_simulation(self.dut, stim())
+
+    def test_count(self):
+        def stim():
+            yield self.dut.threshold.eq(3)
+            yield from self.pulse(self.packets.trigger)
+            yield from self.pulse(self.packets.trigger)
+            self.assertFalse((yield self.dut.irq))
+            yield from self.pulse(self.packets.trigger)
+            self.assertTrue((yield self.dut.irq))
+
+            # Once everything is cleared, it starts counting again
+            yield from self.pulse(self.packets.clear)
+            self.assertFalse((yield self.dut.irq))
+            yield from self.pulse(self.packets.trigger)
+            self.assertFalse((yield self.dut.irq))
+        run_simulation(self.dut, stim())
+
+    def test_timeout(self):
+        def stim():
+            yield self.dut.threshold.eq(8)
+            yield self.dut.timeout.eq(10)
+            yield from self.pulse(self.packets.trigger)
+            self.assertFalse((yield self.dut.irq))
+            for _ in range(10):
+                yield
+            self.assertTrue((yield self.dut.irq))
+        run_simulation(self.dut, stim())
+
+    def test_urgent(self):
+        def stim():
+            yield self.dut.threshold.eq(8)
+            yield from self.pulse(self.urgent.trigger)
+            self.assertTrue((yield self.dut.irq))
+        run_simulation(self.dut, stim())
+
+    def test_cdc(self):
+        with self.assertRaises(ValueError):
+            TriEndpointInterface(FakeIoBuf(), cdc=True, irq_moderation=True)
+
+
+class TestInHandlerSlots(TestCase):
+    def setUp(self):
+        self.usb_core = FakeUsbCore()
+        self.dut = InHandler(self.usb_core, slots=2)
+        self.dut.submodules.usb_core = self.usb_core
+
+    def queue_packet(self, epno, data):
+        for b in data:
+            yield from self.dut.data.write(b)
+        yield from self.dut.ctrl.write(epno)
+        yield
+
+    def host_in(self, epno):
+        """Run an IN transaction and return the data, or None for a NAK."""
+        yield self.usb_core.tok.eq(PID.IN)
+        yield self.usb_core.endp.eq(epno)
+        yield self.usb_core.poll.eq(1)
+        yield
+        yield self.usb_core.poll.eq(0)
+        yield
+        if not (yield self.dut.response):
+            return None
+        data = []
+        while (yield self.dut.data_out_have):
+            data.append((yield self.dut.data_out))
+            yield self.dut.data_out_advance.eq(1)
+            yield
+            yield self.dut.data_out_advance.eq(0)
+            yield
+        yield self.usb_core.commit.eq(1)
+        yield
+        yield self.usb_core.commit.eq(0)
+        yield
+        return data
+
+    def test_two_packets_queued(self):
+        def stim():
+            yield from self.queue_packet(1, [1, 2, 3])
+            self.assertFalse((yield self.dut.status.fields.full))
+            yield from self.queue_packet(1, [4, 5])
+            self.assertTrue((yield self.dut.status.fields.full))
+
+            self.assertEqual((yield from self.host_in(1)), [1, 2, 3])
+            self.assertEqual((yield self.dut.dtb), 1)
+            self.assertFalse((yield self.dut.status.fields.full))
+
+            # The next packet can be queued while the second one waits
+            yield from self.queue_packet(1, [])
+            self.assertEqual((yield from self.host_in(1)), [4, 5])
+            self.assertEqual((yield self.dut.dtb), 0)
+            self.assertEqual((yield from self.host_in(1)), [])
+            self.assertTrue((yield self.dut.status.fields.idle))
+            self.assertEqual((yield from self.host_in(1)), None)
+        run_simulation(self.dut, stim())
+
+    def test_other_endpoint_naks(self):
+        def stim():
+            yield from self.queue_packet(2, [1])
+            yield from self.queue_packet(1, [2])
+            self.assertEqual((yield from self.host_in(1)), None)
+            self.assertEqual((yield from self.host_in(2)), [1])
+            self.assertEqual((yield from self.host_in(1)), [2])
+        run_simulation(self.dut, stim())
+
+
+class TestInBufferHandler(TestCase):
+    def setUp(self):
+        self.usb_core = FakeUsbCore()
+        self.dut = InBufferHandler(self.usb_core, buffers=4)
+        self.dut.submodules.usb_core = self.usb_core
+
+    def queue_packet(self, epno, data):
+        yield from self.dut.select.write(epno)
+        for b in data:
+            yield from self.dut.data.write(b)
+        yield from self.dut.ctrl.write(epno)
+        yield
+
+    def send_data(self):
+        data = []
+        while (yield self.dut.data_out_have):
+            data.append((yield self.dut.data_out))
+            yield self.dut.data_out_advance.eq(1)
+            yield
+            yield self.dut.data_out_advance.eq(0)
+            yield
+        return data
+
+    def host_in(self, epno, ack=True):
+        """Run an IN transaction and return the data, or None for a NAK."""
+        yield self.usb_core.tok.eq(PID.IN)
+        yield self.usb_core.endp.eq(epno)
+        yield self.usb_core.poll.eq(1)
+        yield
+        yield self.usb_core.poll.eq(0)
+        yield
+        if not (yield self.dut.response):
+            return None
+        data = yield from self.send_data()
+        if ack:
+            yield self.usb_core.commit.eq(1)
+            yield
+            yield self.usb_core.commit.eq(0)
+            yield
+        return data
+
+    def test_endpoints_armed_together(self):
+        def stim():
+            yield from self.queue_packet(1, [1, 2, 3])
+            yield from self.queue_packet(2, [4])
+            yield from self.queue_packet(3, [])
+            self.assertEqual((yield self.dut.queued.status), 0b1110)
+
+            self.assertEqual((yield from self.host_in(2)), [4])
+            self.assertEqual((yield from self.host_in(1)), [1, 2, 3])
+            self.assertEqual((yield from self.host_in(3)), [])
+            self.assertEqual((yield from self.host_in(1)), None)
+            self.assertEqual((yield self.dut.queued.status), 0)
+
+            # Each endpoint keeps its own data toggle
+            yield self.usb_core.endp.eq(1)
+            yield
+            self.assertEqual((yield self.dut.dtb), 1)
+            yield self.usb_core.endp.eq(0)
+            yield
+            self.assertEqual((yield self.dut.dtb), 1)
+        run_simulation(self.dut, stim())
+
+    def test_retry(self):
+        def stim():
+            yield from self.queue_packet(1, [5, 6])
+            self.assertEqual((yield from self.host_in(1, ack=False)), [5, 6])
+            # The host asks again instead of acknowledging the packet, which
+            # ends the transaction as the ACK would
+            yield self.usb_core.commit.eq(1)
+            yield self.usb_core.retry.eq(1)
+            yield
+            yield self.usb_core.commit.eq(0)
+            yield self.usb_core.retry.eq(0)
+            yield
+            self.assertEqual((yield self.dut.queued.status), 0b10)
+            self.assertFalse((yield self.dut.ev.packet.pending))
+            self.assertEqual((yield from self.send_data()), [5, 6])
+            yield self.usb_core.commit.eq(1)
+            yield
+            yield self.usb_core.commit.eq(0)
+            yield
+            self.assertEqual((yield self.dut.queued.status), 0)
+            self.assertEqual((yield self.dut.dtb), 1)
+            # A stray handshake doesn't finish the packet a second time
+            yield self.usb_core.commit.eq(1)
+            yield
+            yield self.usb_core.commit.eq(0)
+            yield
+            self.assertEqual((yield self.dut.dtb), 1)
+        run_simulation(self.dut, stim())
+
+    def test_no_buffer(self):
+        def stim():
+            yield from self.queue_packet(5, [1])
+            self.assertEqual((yield self.dut.queued.status), 0)
+            self.assertEqual((yield from self.host_in(5)), None)
+        run_simulation(self.dut, stim())
+
+
+class TestOutHandlerSlots(TestCase):
+    def setUp(self):
+        self.usb_core = FakeUsbCore()
+        self.dut = OutHandler(self.usb_core, slots=2)
+        self.dut.submodules.usb_core = self.usb_core
+
+    def host_out(self, epno, data, fail=False):
+        """Run an OUT transaction and return whether it was ACKed.
+
+        With `fail`, the packet breaks off after `data`, as if it had been
+        corrupted on the wire.
+        """
+        yield self.usb_core.tok.eq(PID.OUT)
+        yield self.usb_core.endp.eq(epno)
+        yield self.usb_core.poll.eq(1)
+        yield
+        yield self.usb_core.poll.eq(0)
+        yield
+        if not (yield self.dut.response):
+            return False
+        # The packet is followed by its CRC16
+        for b in data + ([] if fail else [0xaa, 0xbb]):
+            yield self.dut.data_recv_payload.eq(b)
+            yield self.dut.data_recv_put.eq(1)
+            yield
+        yield self.dut.data_recv_put.eq(0)
+        yield self.usb_core.commit.eq(not fail)
+        yield self.usb_core.end.eq(1)
+        yield
+        yield self.usb_core.commit.eq(0)
+        yield self.usb_core.end.eq(0)
+        yield
+        return not fail
+
+    def read_slot(self):
+        length = yield self.dut.slot.fields.len
+        epno = yield self.dut.slot.fields.epno
+        data = []
+        for _ in range(length):
+            data.append((yield self.dut.data.fields.data))
+            yield from self.dut.data.read()
+            yield
+        return epno, data[:-2]
+
+    def test_two_packets_received(self):
+        def stim():
+            yield from self.dut.ctrl.write(1 | (1 << 4) | (1 << 7))
+            yield
+            self.assertTrue((yield from self.host_out(1, [1, 2, 3])))
+            self.assertTrue((yield from self.host_out(1, [4])))
+            self.assertEqual((yield self.dut.slot.fields.count), 2)
+            # Both slots are taken
+            self.assertFalse((yield from self.host_out(1, [5])))
+
+            self.assertEqual((yield from self.read_slot()), (1, [1, 2, 3]))
+            self.assertEqual((yield self.dut.slot.fields.count), 1)
+            self.assertTrue((yield from self.host_out(1, [])))
+            self.assertEqual((yield from self.read_slot()), (1, [4]))
+            self.assertEqual((yield from self.read_slot()), (1, []))
+            self.assertEqual((yield self.dut.slot.fields.count), 0)
+            self.assertFalse((yield self.dut.status.fields.have))
+        run_simulation(self.dut, stim())
+
+    def test_failed_packet(self):
+        def stim():
+            yield from self.dut.ctrl.write(1 | (1 << 4) | (1 << 7))
+            yield
+            self.assertTrue((yield from self.host_out(1, [1, 2, 3])))
+            yield from self.host_out(1, [7, 8, 9], fail=True)
+            self.assertEqual((yield self.dut.slot.fields.count), 1)
+            self.assertEqual((yield from self.read_slot()), (1, [1, 2, 3]))
+            # The bytes of the failed packet are dropped once they are the oldest
+            for _ in range(10):
+                yield
+            self.assertFalse((yield self.dut.status.fields.have))
+            self.assertEqual((yield self.dut.slot.fields.count), 0)
+            self.assertTrue((yield from self.host_out(1, [4, 5])))
+            self.assertEqual((yield self.dut.slot.fields.count), 1)
+            self.assertEqual((yield from self.read_slot()), (1, [4, 5]))
+            self.assertFalse((yield self.dut.status.fields.have))
+        run_simulation(self.dut, stim())
+
+    def test_without_auto(self):
+        def stim():
+            yield from self.dut.ctrl.write(2 | (1 << 4))
+            yield
+            self.assertTrue((yield from self.host_out(2, [1])))
+            self.assertFalse((yield from self.host_out(2, [2])))
+            self.assertEqual((yield from self.read_slot()), (2, [1]))
+        run_simulation(self.dut, stim())
+
+
+class IsoHost:
+    """Pretend to be the host, over the `FakeUsbCore` of `self.usb_core`."""
+    def pulse(self, signal):
+        yield signal.eq(1)
+        yield
+        yield signal.eq(0)
+        yield
+
+    def sof(self, frame=0):
+        yield self.usb_core.frame.eq(frame)
+        yield from self.pulse(self.usb_core.sof)
+
+    def token(self, pid, epno):
+        yield self.usb_core.tok.eq(pid)
+        yield self.usb_core.endp.eq(epno)
+        yield from self.pulse(self.usb_core.poll)
+
+    def host_in(self, dut, epno, byte_time=2):
+        """Collect a packet from `dut`, one byte every `byte_time` cycles."""
+        yield from self.token(PID.IN, epno)
+        self.assertTrue((yield dut.response))
+        data = []
+        while (yield dut.data_out_have):
+            data.append((yield dut.data_out))
+            yield dut.data_out_advance.eq(1)
+            yield
+            yield dut.data_out_advance.eq(0)
+            for _ in range(byte_time - 1):
+                yield
+        # There is no handshake, the packet is done once it has been sent
+        yield from self.pulse(self.usb_core.commit)
+        return data
+
+    def host_out(self, dut, epno, data, byte_time=1):
+        """Send a packet, followed by its CRC16, to `dut`."""
+        yield from self.token(PID.OUT, epno)
+        accepted = yield dut.response
+        for b in data + crc16(data):
+            yield self.usb_core.data_recv_payload.eq(b)
+            yield dut.data_recv_put.eq(accepted)
+            yield
+            yield dut.data_recv_put.eq(0)
+            for _ in range(byte_time - 1):
+                yield
+        yield from self.pulse(self.usb_core.commit if accepted else self.usb_core.end)
+        return bool(accepted)
+
+
+class TestIsoInHandler(IsoHost, TestCase):
+    def setUp(self):
+        self.usb_core = FakeUsbCore()
+        self.dut = IsoInHandler(self.usb_core, 1, max_packet_size=8)
+        self.dut.submodules.usb_core = self.usb_core
+
+    def write_packet(self, data):
+        for b in data:
+            yield from self.dut.data.write(b)
+        yield from self.dut.ctrl.write(0b011)
+        yield
+
+    def test_frames(self):
+        def stim():
+            yield from self.dut.ctrl.write(0b001)
+            yield from self.write_packet([1, 2, 3])
+            self.assertTrue((yield self.dut.status.fields.ready))
+            self.assertEqual((yield self.dut.status.fields.len), 3)
+            yield from self.sof(5)
+            self.assertTrue((yield self.dut.ev.packet.pending))
+            self.assertEqual((yield self.dut.status.fields.frame), 5)
+            # The next packet is written while this one waits for the host
+            yield from self.write_packet([4])
+            self.assertEqual((yield from self.host_in(self.dut, 1)), [1, 2, 3])
+            # The host may ask again in the same frame
+            self.assertEqual((yield from self.host_in(self.dut, 1)), [1, 2, 3])
+            yield from self.sof(6)
+            self.assertEqual((yield from self.host_in(self.dut, 1)), [4])
+            self.assertEqual((yield self.dut.missed.status), 0)
+            self.assertEqual((yield self.dut.late.status), 0)
+        run_simulation(self.dut, stim())
+
+    def test_late(self):
+        def stim():
+            yield from self.dut.ctrl.write(0b001)
+            # The first frame only starts the stream, so it is never late
+            yield from self.sof()
+            self.assertEqual((yield self.dut.late.status), 0)
+            yield from self.sof()
+            # Nothing was ready, so the host gets an empty packet
+            self.assertEqual((yield from self.host_in(self.dut, 1)), [])
+            self.assertEqual((yield self.dut.late.status), 1)
+            self.assertEqual((yield self.dut.missed.status), 0)
+        run_simulation(self.dut, stim())
+
+    def test_missed(self):
+        def stim():
+            yield from self.dut.ctrl.write(0b001)
+            yield from self.write_packet([1])
+            yield from self.sof()
+            yield from self.write_packet([2])
+            yield from self.sof()
+            self.assertEqual((yield self.dut.missed.status), 1)
+            self.assertEqual((yield from self.host_in(self.dut, 1)), [2])
+            yield from self.dut.ctrl.write(0b101)
+            yield
+            self.assertEqual((yield self.dut.missed.status), 0)
+        run_simulation(self.dut, stim())
+
+    def test_disabled(self):
+        def stim():
+            yield from self.write_packet([1])
+            yield from self.dut.ctrl.write(0b000)
+            yield from self.sof()
+            self.assertFalse((yield self.dut.ev.packet.pending))
+            self.assertEqual((yield from self.host_in(self.dut, 1)), [])
+            self.assertEqual((yield self.dut.late.status), 0)
+        run_simulation(self.dut, stim())
+
+    def test_max_packet_size(self):
+        with self.assertRaises(ValueError):
+            IsoInHandler(FakeUsbCore(), 1, max_packet_size=1024)
+
+    def test_cdc(self):
+        with self.assertRaises(ValueError):
+            TriEndpointInterface(FakeIoBuf(), cdc=True, iso_in=1)
+
+
+class TestIsoOutHandler(IsoHost, TestCase):
+    def setUp(self):
+        self.usb_core = FakeUsbCore()
+        self.dut = IsoOutHandler(self.usb_core, 2, max_packet_size=8)
+        self.dut.submodules.usb_core = self.usb_core
+
+    def read_packet(self):
+        data = []
+        while (yield self.dut.status.fields.have):
+            data.append((yield self.dut.data.fields.data))
+            yield from self.dut.data.read()
+            yield
+        return data
+
+    def test_frames(self):
+        def stim():
+            yield from self.dut.ctrl.write(0b01)
+            yield
+            self.assertTrue((yield from self.host_out(self.dut, 2, [1, 2, 3])))
+            yield from self.sof()
+            self.assertTrue((yield self.dut.ev.packet.pending))
+            self.assertEqual((yield self.dut.status.fields.len), 3)
+            # The next packet arrives while this one is read
+            self.assertTrue((yield from self.host_out(self.dut, 2, [4, 5])))
+            self.assertEqual((yield from self.read_packet()), [1, 2, 3])
+            yield from self.sof()
+            self.assertEqual((yield from self.read_packet()), [4, 5])
+            self.assertEqual((yield self.dut.missed.status), 0)
+            self.assertEqual((yield self.dut.late.status), 0)
+        run_simulation(self.dut, stim())
+
+    def test_missed_and_late(self):
+        def stim():
+            yield from self.dut.ctrl.write(0b01)
+            yield
+            # The frame that was under way when the endpoint was enabled doesn't count
+            yield from self.sof()
+            self.assertEqual((yield self.dut.missed.status), 0)
+            yield from self.sof()
+            self.assertEqual((yield self.dut.missed.status), 1)
+            self.assertEqual((yield self.dut.status.fields.len), 0)
+            self.assertTrue((yield from self.host_out(self.dut, 2, [1, 2])))
+            yield from self.sof()
+            self.assertTrue((yield from self.host_out(self.dut, 2, [3])))
+            # [1, 2] was never read
+            yield from self.sof()
+            self.assertEqual((yield self.dut.late.status), 1)
+            self.assertEqual((yield from self.read_packet()), [3])
+        run_simulation(self.dut, stim())
+
+    def test_too_long(self):
+        def stim():
+            yield from self.dut.ctrl.write(0b01)
+            yield
+            self.assertTrue((yield from self.host_out(self.dut, 2, list(range(10)))))
+            yield from self.sof()
+            self.assertEqual((yield from self.read_packet()), list(range(8)))
+        run_simulation(self.dut, stim())
+
+    def test_disabled(self):
+        def stim():
+            self.assertFalse((yield from self.host_out(self.dut, 2, [1])))
+            yield from self.sof()
+            self.assertFalse((yield self.dut.ev.packet.pending))
+            self.assertEqual((yield self.dut.missed.status), 0)
+        run_simulation(self.dut, stim())
+
+
+class TestIsoStreaming(IsoHost, TestCase):
+    """Stream full 1023-byte packets at 12 Mbit/s, 12000 cycles to a frame.
+
+    The firmware only runs once the ``SOF`` interrupt has fired, and no frame
+    may be missed or late.
+    """
+    FRAMES = 3
+    FRAME_CYCLES = 12000
+    BYTE_CYCLES = 8
+
+    def stream(self, dut, host, firmware):
+        cycles = Signal(32)
+        dut.sync += cycles.eq(cycles + 1)
+        dut.submodules.usb_core = self.usb_core
+
+        def frames():
+            yield from dut.ctrl.write(0b001)
+            for frame in range(self.FRAMES + 1):
+                start = yield cycles
+                yield from self.sof(frame)
+                yield from host(frame)
+                busy = (yield cycles) - start
+                self.assertLess(busy, self.FRAME_CYCLES)
+                for _ in range(self.FRAME_CYCLES - busy):
+                    yield
+            self.assertEqual((yield dut.missed.status), 0)
+            self.assertEqual((yield dut.late.status), 0)
+
+        @passive
+        def interrupts():
+            while True:
+                while not (yield dut.ev.packet.pending):
+                    yield
+                yield dut.ev.pending.r.eq(1)
+                yield dut.ev.pending.re.eq(1)
+                yield
+                yield dut.ev.pending.re.eq(0)
+                yield
+                yield from firmware()
+
+        started = time.perf_counter()
+        run_simulation(dut, [frames(), interrupts()])
+        elapsed = time.perf_counter() - started
+        print("{}: {} frames of 1023 bytes, {:.0f} simulated cycles per second".format(
+            type(dut).__name__, self.FRAMES, (self.FRAMES + 1) * self.FRAME_CYCLES / elapsed))
+
+    def test_in(self):
+        self.usb_core = FakeUsbCore()
+        dut = IsoInHandler(self.usb_core, 1)
+        written = []
+        received = []
+
+        def host(frame):
+            # The first frame is the one the first packet is written in
+            if frame > 0:
+                received.append((yield from self.host_in(dut, 1, self.BYTE_CYCLES)))
+
+        def firmware():
+            packet = [(len(written) + i) & 0xff for i in range(1023)]
+            for b in packet:
+                yield from dut.data.write(b)
+            yield from dut.ctrl.write(0b011)
+            written.append(packet)
+
+        self.stream(dut, host, firmware)
+        self.assertEqual(received, written[:self.FRAMES])
+
+    def test_out(self):
+        self.usb_core = FakeUsbCore()
+        dut = IsoOutHandler(self.usb_core, 2)
+        sent = []
+        read = []
+
+        def host(frame):
+            # The last frame only collects the last packet
+            if frame < self.FRAMES:
+                packet = [(frame + i) & 0xff for i in range(1023)]
+                yield from self.host_out(dut, 2, packet, self.BYTE_CYCLES)
+                sent.append(packet)
+
+        def firmware():
+            packet = []
+            while (yield dut.status.fields.have):
+                packet.append((yield dut.data.fields.data))
+                yield from dut.data.read()
+                yield
+            read.append(packet)
+
+        self.stream(dut, host, firmware)
+        # Nothing had arrived yet at the first SOF
+        self.assertEqual(read, [[]] + sent)
+
+
+# Run in a fresh interpreter so that nothing the test runner has already
+# imported hides what building a SoC pulls in.
+IMPORT_BENCHMARK = r'''
+import json, sys, time
+t0 = time.perf_counter()
+import valentyusb.usbcore.cpu.eptri as eptri
+t1 = time.perf_counter()
+loaded = sorted(m for m in sys.modules
+    if m == "unittest" or m.startswith("valentyusb.usbcore.test")
+    or m in ("valentyusb.usbcore.utils.sdiff", "valentyusb.usbcore.utils.pprint"))
+from valentyusb.usbcore.io_test import FakeIoBuf
+t2 = time.perf_counter()
+eptri.TriEndpointInterface(FakeIoBuf())
+t3 = time.perf_counter()
+print(json.dumps({"loaded": loaded, "import": t1 - t0, "elaborate": t3 - t2}))
+'''
+
+
+class TestTriEndpointImport(TestCase):
+    def test_import(self):
+        """Importing eptri must not drag in the test infrastructure."""
+        topdir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [topdir, env.get("PYTHONPATH")]))
+        output = subprocess.check_output([sys.executable, "-c", IMPORT_BENCHMARK], env=env)
+        result = json.loads(output.decode().splitlines()[-1])
+        print("import valentyusb.usbcore.cpu.eptri: {import:.3f}s, "
+              "TriEndpointInterface(): {elaborate:.3f}s".format(**result))
+        self.assertEqual(result["loaded"], [])
+
+
 if __name__ == '__main__':
     unittest.main()
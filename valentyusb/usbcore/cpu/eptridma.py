@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+from migen import *
+
+from litex.soc.interconnect import wishbone
+from litex.soc.interconnect.csr import CSRStorage, CSRStatus, CSRField, AutoCSR
+
+
+class TriEndpointDMA(Module, AutoCSR):
+    """Bus-master DMA for the ``eptri`` ``IN`` and ``OUT`` FIFOs.
+
+    Instead of moving every byte through ``IN_DATA`` and ``OUT_DATA``, the CPU
+    hands this engine a descriptor -- a RAM address, a length and an endpoint --
+    and it moves the packet between RAM and the FIFO over its own Wishbone
+    master.
+
+    ``IN``: write the address of the packet to ``DMA_IN_ADDR``, then write the
+    endpoint and length to ``DMA_IN_CTRL``.  The engine copies the packet into the
+    ``IN`` FIFO and arms the endpoint, exactly as a write to ``IN_CTRL`` would.
+    The usual ``IN`` interrupt fires once the host has received the packet.
+
+    ``IN`` transfers: to send more than one packet, write the endpoint, the total
+    length and the maximum packet size to ``DMA_IN_XFER`` instead of writing
+    ``DMA_IN_CTRL``.  The engine splits the buffer into packets, arms each one as
+    soon as the previous one has been sent, and adds a zero length packet at the
+    end if ``ZLP`` is set and the last packet was full.  The ``IN`` interrupt
+    only fires once the whole transfer has been sent.  The maximum packet size
+    must be a multiple of four, up to 64.  A transfer with any other maximum
+    packet size is not started, and sets ``ERROR`` in ``DMA_IN_STATUS``.
+
+    ``OUT``: write the address of a buffer to ``DMA_OUT_ADDR``, then write the
+    endpoint and buffer size to ``DMA_OUT_CTRL``.  This enables the endpoint.
+    When a packet arrives, the engine copies it into the buffer, without the
+    CRC16, and only then raises the ``OUT`` interrupt.  ``DMA_OUT_STATUS.LEN``
+    holds the number of bytes received, which is larger than the buffer size
+    if the packet did not fit.
+
+    Packets to other endpoints, such as control transfers on ``EP0``, still go
+    through the FIFO to the CPU while an ``OUT`` descriptor is waiting.
+
+    If the bus answers a cycle with ``err``, the engine gives up on the packet
+    and sets ``ERROR`` in ``DMA_IN_STATUS`` or ``DMA_OUT_STATUS``.  An ``OUT``
+    packet is still drained from the FIFO, and the ``OUT`` interrupt still
+    fires.  An ``IN`` packet is not armed, so reset the ``IN`` FIFO before
+    using it again.
+
+    Buffers must be word aligned.  The CPU should not touch the ``IN``/``OUT``
+    FIFOs while a descriptor on the same side is active.
+
+    Parameters
+    ----------
+
+    wide : bool
+        Push whole words into the ``IN`` FIFO, matching ``TriEndpointInterface(wide=True)``.
+
+    Attributes
+    ----------
+
+    bus : :obj:`wishbone.Interface`
+        The Wishbone master, to be connected to the SoC bus.
+    """
+    def __init__(self, wide=False):
+        self.bus = wishbone.Interface()
+
+        # IN FIFO
+        self.in_data = Signal(8)
+        self.in_we = Signal()
+        self.in_wdata = Signal(32)
+        self.in_wwe = Signal()
+        self.in_epno = Signal(4)
+        self.in_arm = Signal()
+        self.in_sent = Signal()
+        self.in_hold = Signal()
+        self.in_done = Signal()
+
+        # OUT FIFO
+        self.out_data = Signal(8)
+        self.out_readable = Signal()
+        self.out_re = Signal()
+        self.out_received = Signal()
+        self.out_done = Signal()
+        self.out_epno = Signal(4)
+        self.out_enable = Signal()
+        self.out_active = Signal()
+
+        self.in_addr = CSRStorage(32, description="Address of the next ``IN`` packet.  Must be word aligned.")
+        self.in_ctrl = in_ctrl = CSRStorage(
+            fields=[
+                CSRField("epno", 4, description="The endpoint to send the packet on."),
+                CSRField("len", 7, offset=8, description="The length of the packet, up to 64 bytes."),
+            ],
+            description="Writing this register copies the packet into the ``IN`` FIFO and arms the endpoint."
+        )
+        self.in_xfer = in_xfer = CSRStorage(
+            fields=[
+                CSRField("len", 16, description="The total length of the transfer."),
+                CSRField("mps", 7, offset=16, description="The maximum packet size of the endpoint, a multiple of four up to 64."),
+                CSRField("zlp", offset=23, description="Send a zero length packet if the last packet is full."),
+                CSRField("epno", 4, offset=24, description="The endpoint to send the transfer on."),
+                CSRField("abort", offset=28, pulse=True, description="Write a ``1`` here to stop the transfer after the packet that is being copied or sent."),
+            ],
+            description="Writing this register sends ``LEN`` bytes as a series of packets."
+        )
+        self.in_status = CSRStatus(
+            fields=[
+                CSRField("busy", description="``1`` while the packet is being copied."),
+                CSRField("error", description="``1`` if the bus returned an error while reading the last packet, or the last transfer had a bad ``MPS``."),
+            ],
+        )
+
+        self.out_addr = CSRStorage(32, description="Address of the buffer for the next ``OUT`` packet.  Must be word aligned.")
+        self.out_ctrl = out_ctrl = CSRStorage(
+            fields=[
+                CSRField("epno", 4, description="The endpoint to receive a packet on."),
+                CSRField("len", 7, offset=8, description="The size of the buffer, up to 64 bytes."),
+                CSRField("abort", offset=16, pulse=True, description="Write a ``1`` here to give up waiting for a packet.  A packet that has already arrived is still copied."),
+            ],
+            description="Writing this register enables the endpoint and waits for a packet."
+        )
+        self.out_status = CSRStatus(
+            fields=[
+                CSRField("busy", description="``1`` until a packet has been received and copied."),
+                CSRField("error", description="``1`` if the bus returned an error while writing the last packet."),
+                CSRField("len", 7, offset=8, description="The number of bytes in the last packet."),
+            ],
+        )
+
+        in_bus = wishbone.Interface()
+        out_bus = wishbone.Interface()
+        self.submodules.arbiter = wishbone.Arbiter([in_bus, out_bus], self.bus)
+
+        # IN: RAM -> FIFO
+        in_adr = Signal(30)
+        in_remaining = Signal(7)
+        in_word = Signal(32)
+        in_index = Signal(2)
+        in_epno = Signal(4)
+        in_error = Signal()
+
+        # Multi-packet transfers
+        xfer = Signal()
+        xfer_remaining = Signal(16)
+        xfer_mps = Signal(7)
+        xfer_zlp = Signal()
+        pkt_len = Signal(7)
+        last_full = Signal()
+        self.comb += If(xfer_remaining > xfer_mps,
+            pkt_len.eq(xfer_mps),
+        ).Else(
+            pkt_len.eq(xfer_remaining),
+        )
+
+        # Packets after the first start on the next word, so they must all be
+        # whole words long, and fit in the FIFO.
+        bad_mps = Signal()
+        self.comb += bad_mps.eq((in_xfer.fields.mps == 0) | (in_xfer.fields.mps[0:2] != 0) | (in_xfer.fields.mps > 64))
+
+        # An abort can come in at any point of the transfer, but is only acted
+        # on between packets, so it is kept until the engine is idle again.
+        in_abort = Signal()
+
+        self.submodules.in_fsm = in_fsm = FSM(reset_state="IDLE")
+        in_fsm.act("IDLE",
+            If(in_ctrl.re,
+                NextValue(in_adr, self.in_addr.storage[2:]),
+                NextValue(in_remaining, in_ctrl.fields.len),
+                NextValue(in_epno, in_ctrl.fields.epno),
+                NextValue(in_error, 0),
+                NextValue(xfer, 0),
+                If(in_ctrl.fields.len == 0,
+                    NextState("ARM"),
+                ).Else(
+                    NextState("READ"),
+                ),
+            ).Elif(in_xfer.re & ~in_xfer.fields.abort & bad_mps,
+                NextValue(in_error, 1),
+            ).Elif(in_xfer.re & ~in_xfer.fields.abort,
+                NextValue(in_adr, self.in_addr.storage[2:]),
+                NextValue(in_epno, in_xfer.fields.epno),
+                NextValue(in_error, 0),
+                NextValue(xfer, 1),
+                NextValue(xfer_remaining, in_xfer.fields.len),
+                NextValue(xfer_mps, in_xfer.fields.mps),
+                NextValue(xfer_zlp, in_xfer.fields.zlp),
+                NextState("NEXT"),
+            ),
+        )
+        in_fsm.act("NEXT",
+            NextValue(in_remaining, pkt_len),
+            NextValue(xfer_remaining, xfer_remaining - pkt_len),
+            NextValue(last_full, pkt_len == xfer_mps),
+            If(pkt_len == 0,
+                NextState("ARM"),
+            ).Else(
+                NextState("READ"),
+            ),
+        )
+        in_fsm.act("READ",
+            in_bus.cyc.eq(1),
+            in_bus.stb.eq(1),
+            in_bus.adr.eq(in_adr),
+            in_bus.sel.eq(0xf),
+            If(in_bus.ack,
+                NextValue(in_word, in_bus.dat_r),
+                NextValue(in_adr, in_adr + 1),
+                NextValue(in_index, 0),
+                NextState("PUSH"),
+            ).Elif(in_bus.err,
+                NextValue(in_error, 1),
+                If(xfer,
+                    NextState("DONE"),
+                ).Else(
+                    NextState("IDLE"),
+                ),
+            ),
+        )
+        push_byte = [
+            self.in_data.eq(Array(in_word[i*8:(i+1)*8] for i in range(4))[in_index]),
+            self.in_we.eq(1),
+            NextValue(in_remaining, in_remaining - 1),
+            NextValue(in_index, in_index + 1),
+            If(in_remaining == 1,
+                NextState("ARM"),
+            ).Elif(in_index == 3,
+                NextState("READ"),
+            ),
+        ]
+        if wide:
+            push = If(in_remaining >= 4,
+                self.in_wdata.eq(in_word),
+                self.in_wwe.eq(1),
+                NextValue(in_remaining, in_remaining - 4),
+                If(in_remaining == 4,
+                    NextState("ARM"),
+                ).Else(
+                    NextState("READ"),
+                ),
+            ).Else(*push_byte)
+        else:
+            push = push_byte
+        in_fsm.act("PUSH", push)
+        in_fsm.act("ARM",
+            self.in_epno.eq(in_epno),
+            self.in_arm.eq(1),
+            If(xfer,
+                NextState("WAIT"),
+            ).Else(
+                NextState("IDLE"),
+            ),
+        )
+        in_fsm.act("WAIT",
+            If(in_abort | in_xfer.fields.abort,
+                NextState("DONE"),
+            ).Elif(self.in_sent,
+                If(xfer_remaining != 0,
+                    NextState("NEXT"),
+                ).Elif(last_full & xfer_zlp,
+                    # The transfer ended on a packet boundary
+                    NextValue(last_full, 0),
+                    NextState("ARM"),
+                ).Else(
+                    NextState("DONE"),
+                ),
+            ),
+        )
+        in_fsm.act("DONE",
+            self.in_done.eq(1),
+            NextState("IDLE"),
+        )
+        self.sync += If(in_fsm.ongoing("IDLE"),
+            in_abort.eq(0),
+        ).Elif(in_xfer.fields.abort,
+            in_abort.eq(1),
+        )
+        self.comb += [
+            self.in_status.fields.busy.eq(~in_fsm.ongoing("IDLE")),
+            self.in_status.fields.error.eq(in_error),
+            self.in_hold.eq(xfer & ~in_fsm.ongoing("IDLE")),
+        ]
+
+        # OUT: FIFO -> RAM
+        out_adr = Signal(30)
+        out_limit = Signal(7)
+        out_count = Signal(7)
+        out_word = Signal(32)
+        out_sel = Signal(4)
+        out_last = Signal()
+        out_epno = Signal(4)
+        out_error = Signal()
+        out_abort = Signal()
+
+        # The last two bytes of every packet are its CRC16, so hold back two
+        # bytes and only store a byte once another two have come in behind it.
+        lag = Signal(16)
+        held = Signal(2)
+
+        self.submodules.out_fsm = out_fsm = FSM(reset_state="IDLE")
+        out_fsm.act("IDLE",
+            If(out_ctrl.re & ~out_ctrl.fields.abort,
+                NextValue(out_epno, out_ctrl.fields.epno),
+                NextValue(out_adr, self.out_addr.storage[2:]),
+                NextValue(out_limit, out_ctrl.fields.len),
+                NextValue(out_count, 0),
+                NextValue(out_error, 0),
+                NextValue(held, 0),
+                NextState("ENABLE"),
+            ),
+        )
+        out_fsm.act("ENABLE",
+            self.out_enable.eq(1),
+            NextState("WAIT"),
+        )
+        out_fsm.act("WAIT",
+            self.out_active.eq(1),
+            If(out_abort | out_ctrl.fields.abort,
+                NextState("IDLE"),
+            ).Elif(self.out_received,
+                NextState("DRAIN"),
+            ),
+        )
+        out_fsm.act("DRAIN",
+            If(self.out_readable,
+                self.out_re.eq(1),
+                NextValue(lag, Cat(lag[8:16], self.out_data)),
+                If(held == 2,
+                    NextValue(out_count, out_count + 1),
+                    If((out_count < out_limit) & ~out_error,
+                        Case(out_count[0:2], {
+                            i: [
+                                NextValue(out_word[i*8:(i+1)*8], lag[0:8]),
+                                NextValue(out_sel[i], 1),
+                            ] for i in range(4)
+                        }),
+                        If(out_count[0:2] == 3,
+                            NextState("WRITE"),
+                        ),
+                    ),
+                ).Else(
+                    NextValue(held, held + 1),
+                ),
+            ).Elif(held == 2,
+                # Only the CRC16 is left
+                If(out_sel != 0,
+                    NextValue(out_last, 1),
+                    NextState("WRITE"),
+                ).Else(
+                    NextState("DONE"),
+                ),
+            ),
+        )
+        out_fsm.act("WRITE",
+            out_bus.cyc.eq(1),
+            out_bus.stb.eq(1),
+            out_bus.we.eq(1),
+            out_bus.adr.eq(out_adr),
+            out_bus.dat_w.eq(out_word),
+            out_bus.sel.eq(out_sel),
+            If(out_bus.ack | out_bus.err,
+                If(out_bus.err,
+                    # Keep draining the packet, but don't write any more of it
+                    NextValue(out_error, 1),
+                ),
+                NextValue(out_adr, out_adr + 1),
+                NextValue(out_word, 0),
+                NextValue(out_sel, 0),
+                If(out_last,
+                    NextValue(out_last, 0),
+                    NextState("DONE"),
+                ).Else(
+                    NextState("DRAIN"),
+                ),
+            ),
+        )
+        out_fsm.act("DONE",
+            self.out_done.eq(1),
+            NextState("IDLE"),
+        )
+        self.sync += If(out_fsm.ongoing("IDLE"),
+            out_abort.eq(0),
+        ).Elif(out_ctrl.fields.abort,
+            out_abort.eq(1),
+        )
+        self.comb += [
+            self.out_epno.eq(out_epno),
+            self.out_status.fields.busy.eq(~out_fsm.ongoing("IDLE")),
+            self.out_status.fields.error.eq(out_error),
+            self.out_status.fields.len.eq(out_count),
+        ]
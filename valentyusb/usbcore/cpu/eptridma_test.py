@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest import TestCase
+
+from migen import *
+from migen.genlib import fifo
+
+from litex.soc.interconnect import wishbone
+
+from ..io_test import FakeIoBuf
+from ..test.host import WireHost
+from ..utils.packet import crc16
+from .eptri import TriEndpointInterface
+from .eptridma import TriEndpointDMA
+
+
+class DMATestBench(Module):
+    def __init__(self, init, wide=False, error=False):
+        self.submodules.dma = dma = TriEndpointDMA(wide=wide)
+        self.submodules.sram = sram = wishbone.SRAM(64*4, init=init)
+        self.submodules.out_fifo = out_fifo = fifo.SyncFIFOBuffered(width=8, depth=66)
+        if error:
+            # A bus that answers every cycle with an error
+            self.comb += dma.bus.err.eq(dma.bus.cyc & dma.bus.stb)
+        else:
+            self.comb += dma.bus.connect(sram.bus)
+        self.comb += [
+            dma.out_data.eq(out_fifo.dout),
+            dma.out_readable.eq(out_fifo.readable),
+            out_fifo.re.eq(dma.out_re),
+        ]
+
+
+class TestTriEndpointDMA(TestCase):
+    def send_in(self, dut, addr, epno, length):
+        """Start an IN descriptor, and collect what gets pushed into the FIFO."""
+        pushed = []
+        yield from dut.dma.in_addr.write(addr)
+        yield from dut.dma.in_ctrl.write(epno | (length << 8))
+        for _ in range(200):
+            if (yield dut.dma.in_we):
+                pushed.append((yield dut.dma.in_data))
+            if (yield dut.dma.in_wwe):
+                word = yield dut.dma.in_wdata
+                pushed += [(word >> (8*i)) & 0xff for i in range(4)]
+            if (yield dut.dma.in_arm):
+                return pushed, (yield dut.dma.in_epno)
+            yield
+        self.fail("IN descriptor never armed the endpoint")
+
+    def send_xfer(self, dut, addr, epno, length, mps, zlp):
+        """Start an IN transfer, and collect the packets it arms."""
+        packets = []
+        pushed = []
+        yield from dut.dma.in_addr.write(addr)
+        yield from dut.dma.in_xfer.write(length | (mps << 16) | (zlp << 23) | (epno << 24))
+        yield
+        for _ in range(1000):
+            if (yield dut.dma.in_we):
+                pushed.append((yield dut.dma.in_data))
+            if (yield dut.dma.in_done):
+                return packets
+            self.assertTrue((yield dut.dma.in_hold))
+            if (yield dut.dma.in_arm):
+                self.assertEqual((yield dut.dma.in_epno), epno)
+                packets.append(pushed)
+                pushed = []
+                # The host takes the packet a little later
+                for _ in range(3):
+                    yield
+                yield dut.dma.in_sent.eq(1)
+                yield
+                yield dut.dma.in_sent.eq(0)
+            yield
+        self.fail("IN transfer never finished")
+
+    def receive_out(self, dut, addr, epno, length, packet):
+        yield from dut.dma.out_addr.write(addr)
+        yield from dut.dma.out_ctrl.write(epno | (length << 8))
+        yield
+        self.assertTrue((yield dut.dma.out_status.fields.busy))
+
+        for b in packet:
+            yield dut.out_fifo.din.eq(b)
+            yield dut.out_fifo.we.eq(1)
+            yield
+        yield dut.out_fifo.we.eq(0)
+        yield dut.dma.out_received.eq(1)
+        yield
+        yield dut.dma.out_received.eq(0)
+        for _ in range(200):
+            if (yield dut.dma.out_done):
+                break
+            yield
+        else:
+            self.fail("OUT descriptor never finished")
+        yield
+        self.assertFalse((yield dut.dma.out_status.fields.busy))
+        self.assertFalse((yield dut.out_fifo.readable))
+        return (yield dut.dma.out_status.fields.len)
+
+    def read_ram(self, dut, count):
+        words = []
+        for i in range(count):
+            words.append((yield dut.sram.mem[i]))
+        return words
+
+    def test_in(self):
+        dut = DMATestBench([0xdeadbeef, 0x04030201, 0x08070605, 0xffffffff])
+        def stim():
+            pushed, epno = yield from self.send_in(dut, 4, 2, 6)
+            self.assertEqual(pushed, [1, 2, 3, 4, 5, 6])
+            self.assertEqual(epno, 2)
+            yield
+            self.assertFalse((yield dut.dma.in_status.fields.busy))
+        run_simulation(dut, stim())
+
+    def test_in_wide(self):
+        dut = DMATestBench([0x04030201, 0x08070605, 0x0c0b0a09], wide=True)
+        def stim():
+            pushed, epno = yield from self.send_in(dut, 0, 1, 10)
+            self.assertEqual(pushed, list(range(1, 11)))
+            self.assertEqual(epno, 1)
+        run_simulation(dut, stim())
+
+    def test_in_bus_error(self):
+        dut = DMATestBench([0xffffffff], error=True)
+        def stim():
+            yield from dut.dma.in_addr.write(0)
+            yield from dut.dma.in_ctrl.write(1 | (8 << 8))
+            for _ in range(20):
+                self.assertFalse((yield dut.dma.in_arm))
+                yield
+            self.assertFalse((yield dut.dma.in_status.fields.busy))
+            self.assertTrue((yield dut.dma.in_status.fields.error))
+        run_simulation(dut, stim())
+
+    def test_in_empty(self):
+        dut = DMATestBench([0xffffffff])
+        def stim():
+            pushed, epno = yield from self.send_in(dut, 0, 3, 0)
+            self.assertEqual(pushed, [])
+            self.assertEqual(epno, 3)
+        run_simulation(dut, stim())
+
+    def test_xfer(self):
+        dut = DMATestBench(list(range(0x03020100, 0x3f3e3d3d, 0x04040404)))
+        def stim():
+            packets = yield from self.send_xfer(dut, 0, 2, 20, 8, zlp=True)
+            self.assertEqual(packets, [list(range(0, 8)), list(range(8, 16)), list(range(16, 20))])
+            yield
+            self.assertFalse((yield dut.dma.in_status.fields.busy))
+            self.assertFalse((yield dut.dma.in_hold))
+        run_simulation(dut, stim())
+
+    def test_xfer_zlp(self):
+        dut = DMATestBench(list(range(0x03020100, 0x3f3e3d3d, 0x04040404)))
+        def stim():
+            packets = yield from self.send_xfer(dut, 4, 1, 16, 8, zlp=True)
+            self.assertEqual(packets, [list(range(4, 12)), list(range(12, 20)), []])
+            packets = yield from self.send_xfer(dut, 4, 1, 16, 8, zlp=False)
+            self.assertEqual(packets, [list(range(4, 12)), list(range(12, 20))])
+        run_simulation(dut, stim())
+
+    def test_xfer_empty(self):
+        dut = DMATestBench([0xffffffff])
+        def stim():
+            packets = yield from self.send_xfer(dut, 0, 3, 0, 64, zlp=False)
+            self.assertEqual(packets, [[]])
+        run_simulation(dut, stim())
+
+    def test_xfer_abort(self):
+        dut = DMATestBench(list(range(0x03020100, 0x3f3e3d3d, 0x04040404)))
+        def stim():
+            yield from dut.dma.in_addr.write(0)
+            yield from dut.dma.in_xfer.write(40 | (8 << 16) | (2 << 24))
+            yield
+            # Aborted while the first packet is still being copied
+            self.assertFalse((yield dut.dma.in_arm))
+            yield from dut.dma.in_xfer.write(1 << 28)
+            armed = 0
+            for _ in range(200):
+                if (yield dut.dma.in_done):
+                    break
+                armed += yield dut.dma.in_arm
+                yield
+            else:
+                self.fail("IN transfer never finished")
+            # The packet is left armed, but no more are copied
+            self.assertEqual(armed, 1)
+            yield
+            self.assertFalse((yield dut.dma.in_status.fields.busy))
+        run_simulation(dut, stim())
+
+    def test_xfer_bad_mps(self):
+        dut = DMATestBench([0xffffffff] * 4)
+        def stim():
+            for mps in [0, 6, 68]:
+                yield from dut.dma.in_addr.write(0)
+                yield from dut.dma.in_xfer.write(8 | (mps << 16) | (1 << 24))
+                for _ in range(20):
+                    self.assertFalse((yield dut.dma.in_arm))
+                    yield
+                self.assertFalse((yield dut.dma.in_status.fields.busy))
+                self.assertTrue((yield dut.dma.in_status.fields.error))
+            # A good one clears the error
+            packets = yield from self.send_xfer(dut, 0, 1, 8, 8, zlp=False)
+            self.assertEqual(len(packets), 1)
+            self.assertFalse((yield dut.dma.in_status.fields.error))
+        run_simulation(dut, stim())
+
+    def test_out(self):
+        dut = DMATestBench([0xffffffff] * 4)
+        def stim():
+            length = yield from self.receive_out(dut, 4, 1, 64, [1, 2, 3, 4, 5, 6, 0xaa, 0xbb])
+            self.assertEqual(length, 6)
+            words = yield from self.read_ram(dut, 4)
+            self.assertEqual(words, [0xffffffff, 0x04030201, 0xffff0605, 0xffffffff])
+        run_simulation(dut, stim())
+
+    def test_out_empty(self):
+        dut = DMATestBench([0xffffffff])
+        def stim():
+            length = yield from self.receive_out(dut, 0, 0, 64, [0x00, 0x00])
+            self.assertEqual(length, 0)
+            self.assertEqual((yield dut.sram.mem[0]), 0xffffffff)
+        run_simulation(dut, stim())
+
+    def test_out_overflow(self):
+        dut = DMATestBench([0xffffffff] * 2)
+        def stim():
+            length = yield from self.receive_out(dut, 0, 0, 4, [1, 2, 3, 4, 5, 6, 0xaa, 0xbb])
+            self.assertEqual(length, 6)
+            words = yield from self.read_ram(dut, 2)
+            self.assertEqual(words, [0x04030201, 0xffffffff])
+        run_simulation(dut, stim())
+
+    def test_out_bus_error(self):
+        dut = DMATestBench([0xffffffff] * 2, error=True)
+        def stim():
+            # The packet is still drained, and the descriptor finishes
+            length = yield from self.receive_out(dut, 0, 1, 64, [1, 2, 3, 4, 5, 6, 0xaa, 0xbb])
+            self.assertEqual(length, 6)
+            self.assertTrue((yield dut.dma.out_status.fields.error))
+            words = yield from self.read_ram(dut, 2)
+            self.assertEqual(words, [0xffffffff, 0xffffffff])
+        run_simulation(dut, stim())
+
+    def test_out_abort(self):
+        dut = DMATestBench([0xffffffff])
+        def stim():
+            yield from dut.dma.out_ctrl.write(1 | (64 << 8))
+            yield
+            self.assertTrue((yield dut.dma.out_status.fields.busy))
+            yield from dut.dma.out_ctrl.write(1 << 16)
+            yield
+            self.assertFalse((yield dut.dma.out_status.fields.busy))
+
+            # Written before the endpoint has even been enabled
+            yield from dut.dma.out_ctrl.write(1 | (64 << 8))
+            yield from dut.dma.out_ctrl.write(1 << 16)
+            for _ in range(3):
+                yield
+            self.assertFalse((yield dut.dma.out_status.fields.busy))
+        run_simulation(dut, stim())
+
+
+class TriEndpointDMATestBench(Module):
+    def __init__(self, init):
+        self.submodules.usb = usb = TriEndpointInterface(FakeIoBuf(), dma=True)
+        self.submodules.sram = sram = wishbone.SRAM(64*4, init=init)
+        self.comb += usb.dma_bus.connect(sram.bus)
+
+        # CSRs only get their own logic once they are added to a CSR bank,
+        # so apply hardware writes to `IN_CTRL` here.
+        ctrl = getattr(usb, "in").ctrl
+        self.sync += If(ctrl.we, ctrl.storage.eq(ctrl.dat_w))
+
+
+class TestTriEndpointInterfaceDMA(TestCase):
+    def test_cdc(self):
+        with self.assertRaises(ValueError):
+            TriEndpointInterface(FakeIoBuf(), cdc=True, dma=True)
+
+    def test_in_arms_endpoint(self):
+        dut = TriEndpointDMATestBench([0x04030201, 0x08070605])
+        in_handler = getattr(dut.usb, "in")
+        def stim():
+            yield from dut.usb.dma.in_addr.write(0)
+            yield from dut.usb.dma.in_ctrl.write(3 | (5 << 8))
+            for _ in range(100):
+                yield
+                if not (yield dut.usb.dma.in_status.fields.busy):
+                    break
+            yield
+            self.assertEqual((yield in_handler.ctrl.storage), 3)
+            self.assertTrue((yield in_handler.status.fields.have))
+            self.assertFalse((yield in_handler.status.fields.idle))
+        run_simulation(dut, stim(), clocks={"sys": 10, "usb_12": 10, "usb_48": 10})
+
+    def test_out_with_control(self):
+        dut = TriEndpointDMATestBench([0xffffffff] * 4)
+        out_handler = dut.usb.out
+        host = WireHost(dut.usb.iobuf)
+        control = [0x11, 0x22, 0x33]
+        bulk = list(range(1, 10))
+        def send(ep, data):
+            for _ in range(20):
+                if (yield from host.out(ep, data)):
+                    return
+            self.fail("OUT to endpoint {} was never ACKed".format(ep))
+        def wire():
+            yield from dut.usb.iobuf.recv("J")
+            for _ in range(20):
+                yield
+            yield from send(0, control)
+            yield from send(2, bulk)
+            for _ in range(200):
+                yield
+        def wait_pending():
+            while not (yield out_handler.ev.packet.pending):
+                yield
+        def clear_pending():
+            yield out_handler.ev.pending.r.eq(1)
+            yield out_handler.ev.pending.re.eq(1)
+            yield
+            yield out_handler.ev.pending.re.eq(0)
+            yield
+        def firmware():
+            yield from dut.usb.dma.out_addr.write(4)
+            # The engine enables endpoint 2 on the same cycle as the CPU
+            # enables endpoint 0.
+            out_ctrl = dut.usb.dma.out_ctrl
+            yield out_ctrl.storage.eq(2 | (64 << 8))
+            yield out_ctrl.fields.epno.eq(2)
+            yield out_ctrl.fields.len.eq(64)
+            yield out_ctrl.re.eq(1)
+            yield
+            yield out_ctrl.re.eq(0)
+            yield from out_handler.ctrl.write(1 << 4)
+
+            # The control packet is left in the FIFO for the CPU
+            yield from wait_pending()
+            self.assertEqual((yield out_handler.status.fields.epno), 0)
+            self.assertTrue((yield dut.usb.dma.out_status.fields.busy))
+            read = []
+            while (yield out_handler.status.fields.have):
+                read.append((yield out_handler.data.fields.data))
+                yield from out_handler.data.read()
+                yield
+            self.assertEqual(read, control + crc16(control))
+            yield from clear_pending()
+
+            # And the bulk packet goes to RAM
+            yield from wait_pending()
+            self.assertFalse((yield dut.usb.dma.out_status.fields.busy))
+            self.assertEqual((yield dut.usb.dma.out_status.fields.len), len(bulk))
+            self.assertFalse((yield out_handler.status.fields.have))
+            words = []
+            for i in range(4):
+                words.append((yield dut.sram.mem[i]))
+            self.assertEqual(words, [0xffffffff, 0x04030201, 0x08070605, 0xffffff09])
+        run_simulation(dut, {"usb_48": wire(), "sys": firmware()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+
+
+if __name__ == '__main__':
+    unittest.main()
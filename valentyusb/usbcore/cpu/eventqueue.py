@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+from enum import IntEnum
+
+from migen import *
+from migen.genlib import fifo
+
+from litex.soc.interconnect.csr import CSRStorage, CSRStatus, CSRField, AutoCSR
+
+from ..pid import PID
+
+
+class EventKind(IntEnum):
+    SETUP = 0
+    IN    = 1
+    OUT   = 2
+    RESET = 3
+
+
+class EventQueue(Module, AutoCSR):
+    """A queue of every ``eptri`` event, in the order they happened.
+
+    Each entry records what happened, the endpoint, the number of data bytes
+    (without the CRC16) of the packet, as it was when the packet was
+    committed, and a timestamp in microseconds, so that firmware can
+    drain every event in one go from ``EVQ_DATA`` instead of working the order
+    out from the ``*_STATUS`` registers.  The handlers' interrupts are not
+    changed, so a DMA transfer of several packets, which interrupts once,
+    records the last of them.
+
+    If the queue is full, new events are dropped and ``EVQ_STATUS.OVERFLOW``
+    is set until the queue is reset.
+
+    Parameters
+    ----------
+
+    depth : int
+        The number of events the queue holds.
+
+    clk_freq : int, optional
+        The frequency of the clock, used for the timestamp.
+
+    Attributes
+    ----------
+
+    setup, in_done, out_done : Signal
+        Pulse these when the matching handler raises its interrupt.
+    """
+    def __init__(self, usb_core, depth=16, clk_freq=12e6):
+        self.setup = Signal()
+        self.in_done = Signal()
+        self.out_done = Signal()
+
+        self.data = CSRStatus(
+            fields=[
+                CSRField("kind", 2, description="What happened.", values=[
+                    ("``0b00``", "SETUP", "A ``SETUP`` packet was received"),
+                    ("``0b01``", "IN", "An ``IN`` packet was sent"),
+                    ("``0b10``", "OUT", "An ``OUT`` packet was received"),
+                    ("``0b11``", "RESET", "The host reset the bus"),
+                ]),
+                CSRField("epno", 4, offset=4, description="The endpoint number."),
+                CSRField("len", 7, offset=8, description="The number of data bytes in the packet."),
+                CSRField("timestamp", 16, offset=16, description="When it happened, in microseconds."),
+            ],
+            description="""
+                The oldest event in the queue.  Reading this register removes it
+                from the queue."""
+        )
+        self.status = CSRStatus(
+            fields=[
+                CSRField("have", description="``1`` if there is an event in the queue."),
+                CSRField("overflow", description="``1`` if an event has been dropped because the queue was full."),
+                CSRField("level", bits_for(depth), offset=8, description="The number of events in the queue."),
+            ],
+        )
+        self.ctrl = CSRStorage(
+            fields=[
+                CSRField("reset", pulse=True, description="Write a ``1`` here to empty the queue."),
+            ],
+        )
+
+        # Microseconds since reset
+        timestamp = Signal(16)
+        prescaler = Signal(max=max(int(clk_freq // 1e6), 2))
+        self.sync += If(prescaler == int(clk_freq // 1e6) - 1,
+            prescaler.eq(0),
+            timestamp.eq(timestamp + 1),
+        ).Else(
+            prescaler.eq(prescaler + 1),
+        )
+
+        # Count the bytes of the current transaction
+        count = Signal(7)
+        self.sync += If(usb_core.start,
+            count.eq(0),
+        ).Elif(usb_core.data_recv_put | usb_core.data_send_get,
+            count.eq(count + 1),
+        )
+        payload = Signal(7)
+        self.comb += If(usb_core.tok == PID.IN,
+            payload.eq(count),
+        ).Elif(count >= 2,
+            payload.eq(count - 2),
+        )
+
+        # A handler may only raise its interrupt some time after the
+        # transaction, once DMA has finished with it, by which time another
+        # may have started.  So the endpoint and length of the last
+        # transaction of each kind are kept from when it was committed.
+        committed = {}
+        for kind, tok in [(EventKind.SETUP, PID.SETUP), (EventKind.IN, PID.IN), (EventKind.OUT, PID.OUT)]:
+            now = Signal()
+            last = Signal(4+7)
+            value = Signal(4+7)
+            self.comb += [
+                now.eq(usb_core.commit & (usb_core.tok == tok)),
+                value.eq(Mux(now, Cat(usb_core.endp, payload), last)),
+            ]
+            self.sync += If(now, last.eq(Cat(usb_core.endp, payload)))
+            committed[kind] = value
+        committed[EventKind.RESET] = Cat(usb_core.endp, payload)
+
+        usb_reset_last = Signal()
+        bus_reset = Signal()
+        self.sync += usb_reset_last.eq(usb_core.usb_reset)
+        self.comb += bus_reset.eq(usb_core.usb_reset & ~usb_reset_last)
+
+        # Events may happen together, so each one is held here until it
+        # has gone into the queue.
+        self.submodules.queue = queue = ResetInserter()(fifo.SyncFIFO(width=2+4+7+16, depth=depth))
+        sources = [
+            (EventKind.SETUP, self.setup),
+            (EventKind.IN, self.in_done),
+            (EventKind.OUT, self.out_done),
+            (EventKind.RESET, bus_reset),
+        ]
+        held = []
+        for kind, trigger in sources:
+            pending = Signal()
+            entry = Signal(len(queue.din))
+            taken = Signal()
+            self.sync += If(trigger,
+                pending.eq(1),
+                entry.eq(Cat(C(kind, 2), committed[kind], timestamp)),
+            ).Elif(taken,
+                pending.eq(0),
+            )
+            held.append((pending, entry, taken))
+
+        choose = None
+        for pending, entry, taken in held:
+            step = [
+                queue.din.eq(entry),
+                queue.we.eq(1),
+                taken.eq(1),
+            ]
+            if choose is None:
+                choose = If(pending, *step)
+            else:
+                choose = choose.Elif(pending, *step)
+        self.comb += choose
+
+        overflow = Signal()
+        self.sync += If(self.ctrl.fields.reset,
+            overflow.eq(0),
+        ).Elif(queue.we & ~queue.writable,
+            overflow.eq(1),
+        )
+
+        kind = Signal(2)
+        epno = Signal(4)
+        length = Signal(7)
+        stamp = Signal(16)
+        self.comb += [
+            queue.reset.eq(self.ctrl.fields.reset),
+            Cat(kind, epno, length, stamp).eq(queue.dout),
+            If(queue.readable,
+                self.data.fields.kind.eq(kind),
+                self.data.fields.epno.eq(epno),
+                self.data.fields.len.eq(length),
+                self.data.fields.timestamp.eq(stamp),
+            ),
+            queue.re.eq(self.data.we),
+            self.status.fields.have.eq(queue.readable),
+            self.status.fields.overflow.eq(overflow),
+            self.status.fields.level.eq(queue.level),
+        ]
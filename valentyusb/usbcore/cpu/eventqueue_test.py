@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest import TestCase
+
+from migen import *
+
+from ..io_test import FakeIoBuf
+from ..pid import PID
+from .eptri import TriEndpointInterface
+from .eptri_test import FakeUsbCore
+from .eventqueue import EventKind, EventQueue
+
+
+class TestEventQueue(TestCase):
+    def setUp(self):
+        self.usb_core = FakeUsbCore()
+        self.dut = EventQueue(self.usb_core, depth=4, clk_freq=2e6)
+        self.dut.submodules.usb_core = self.usb_core
+
+    def transaction(self, tok, endp, nbytes, event):
+        yield self.usb_core.tok.eq(tok)
+        yield self.usb_core.endp.eq(endp)
+        yield self.usb_core.start.eq(1)
+        yield
+        yield self.usb_core.start.eq(0)
+        strobe = self.usb_core.data_send_get if tok == PID.IN else self.usb_core.data_recv_put
+        for _ in range(nbytes):
+            yield strobe.eq(1)
+            yield
+            yield strobe.eq(0)
+            yield
+        yield self.usb_core.commit.eq(1)
+        yield
+        yield self.usb_core.commit.eq(0)
+        yield
+        if event is not None:
+            yield event.eq(1)
+            yield
+            yield event.eq(0)
+            yield
+
+    def read_event(self):
+        fields = self.dut.data.fields
+        event = (
+            EventKind((yield fields.kind)),
+            (yield fields.epno),
+            (yield fields.len),
+            (yield fields.timestamp),
+        )
+        yield from self.dut.data.read()
+        yield
+        return event
+
+    def test_order(self):
+        def stim():
+            yield from self.transaction(PID.SETUP, 0, 10, self.dut.setup)
+            yield from self.transaction(PID.IN, 1, 5, self.dut.in_done)
+            yield from self.transaction(PID.OUT, 2, 6, self.dut.out_done)
+            yield self.usb_core.usb_reset.eq(1)
+            yield
+            yield
+            yield self.usb_core.usb_reset.eq(0)
+            yield
+            self.assertEqual((yield self.dut.status.fields.level), 4)
+
+            events = []
+            while (yield self.dut.status.fields.have):
+                events.append((yield from self.read_event()))
+            self.assertEqual([e[0:3] for e in events], [
+                (EventKind.SETUP, 0, 8),
+                (EventKind.IN, 1, 5),
+                (EventKind.OUT, 2, 4),
+                (EventKind.RESET, 2, 4),
+            ])
+            timestamps = [e[3] for e in events]
+            self.assertEqual(timestamps, sorted(timestamps))
+            self.assertGreater(timestamps[-1], timestamps[0])
+        run_simulation(self.dut, stim())
+
+    def test_late_event(self):
+        def stim():
+            # The OUT interrupt only comes once DMA is done with the packet,
+            # after the host has moved on to another endpoint
+            yield from self.transaction(PID.OUT, 2, 10, None)
+            yield from self.transaction(PID.IN, 0, 3, None)
+            yield self.dut.out_done.eq(1)
+            yield
+            yield self.dut.out_done.eq(0)
+            yield
+            yield
+            self.assertEqual((yield from self.read_event())[0:3], (EventKind.OUT, 2, 8))
+        run_simulation(self.dut, stim())
+
+    def test_same_cycle(self):
+        def stim():
+            yield self.dut.in_done.eq(1)
+            yield self.dut.out_done.eq(1)
+            yield
+            yield self.dut.in_done.eq(0)
+            yield self.dut.out_done.eq(0)
+            yield
+            yield
+            kinds = []
+            while (yield self.dut.status.fields.have):
+                kinds.append((yield from self.read_event())[0])
+            self.assertEqual(kinds, [EventKind.IN, EventKind.OUT])
+        run_simulation(self.dut, stim())
+
+    def test_overflow(self):
+        def stim():
+            for _ in range(5):
+                yield from self.transaction(PID.OUT, 1, 2, self.dut.out_done)
+            yield
+            self.assertTrue((yield self.dut.status.fields.overflow))
+            self.assertEqual((yield self.dut.status.fields.level), 4)
+            yield from self.dut.ctrl.write(1)
+            yield
+            self.assertFalse((yield self.dut.status.fields.overflow))
+            self.assertFalse((yield self.dut.status.fields.have))
+        run_simulation(self.dut, stim())
+
+
+class TestTriEndpointInterfaceEventQueue(TestCase):
+    def test_cdc(self):
+        with self.assertRaises(ValueError):
+            TriEndpointInterface(FakeIoBuf(), cdc=True, event_queue=8)
+
+
+if __name__ == '__main__':
+    unittest.main()
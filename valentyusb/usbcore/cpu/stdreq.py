@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+from migen import *
+
+from litex.soc.interconnect.csr import CSRStorage, CSRStatus, CSRField, AutoCSR
+
+from ..pid import PID
+
+
+class DescriptorRom:
+    """Descriptors for :obj:`StandardRequests`, laid out in a single ROM.
+
+    Descriptors are added by type and index, the same way the host asks for
+    them in ``wValue``.  Each descriptor may be a list of bytes, a ``bytes``
+    object, or any object that ``bytes()`` accepts, such as the descriptor
+    objects of a USB descriptor library.
+
+    The first two bytes of the ROM are the answer to a device ``GET_STATUS``.
+
+    >>> rom = DescriptorRom()
+    >>> rom.add(DescriptorRom.DEVICE, 0, [0x12, 0x01, 0x00, 0x02, 0x00, 0x00, 0x00, 0x08])
+    >>> rom.add_string(1, "Fomu")
+    >>> rom.max_packet_size
+    8
+    >>> rom.entries[0x0301]
+    (10, 10)
+    >>> rom.contents[10:]
+    [10, 3, 70, 0, 111, 0, 109, 0, 117, 0]
+    """
+    DEVICE = 0x01
+    CONFIGURATION = 0x02
+    STRING = 0x03
+    BOS = 0x0f
+
+    def __init__(self, self_powered=False):
+        self.contents = [0x01 if self_powered else 0x00, 0x00]
+        self.entries = {}
+
+    def add(self, desc_type, index, data):
+        """Add a descriptor, which is returned for ``wValue`` ``desc_type << 8 | index``."""
+        data = list(bytes(data))
+        self.entries[(desc_type << 8) | index] = (len(self.contents), len(data))
+        self.contents = self.contents + data
+
+    def add_string(self, index, s):
+        """Add string descriptor `index`, encoded as UTF-16."""
+        encoded = s.encode("utf_16_le")
+        assert len(encoded) <= 253, "string descriptor is too long"
+        self.add(self.STRING, index, [len(encoded) + 2, self.STRING] + list(encoded))
+
+    @property
+    def max_packet_size(self):
+        """``bMaxPacketSize0`` from the device descriptor, or 64 if there is none."""
+        key = self.DEVICE << 8
+        if key in self.entries:
+            offset, length = self.entries[key]
+            if length > 7:
+                return self.contents[offset + 7]
+        return 64
+
+
+class StandardRequests(Module, AutoCSR):
+    """Answer standard requests on endpoint 0 without the CPU.
+
+    ``GET_DESCRIPTOR`` requests for a descriptor in the :obj:`DescriptorRom`,
+    device ``GET_STATUS``, ``SET_ADDRESS`` and ``SET_CONFIGURATION`` are
+    handled here, including their data and status stages.  ``claim`` pulses
+    when a ``SETUP`` packet is one of these, and the ``SETUP`` handler should
+    then drop it.  Anything else is left to the firmware.
+
+    While ``active`` is set, this module answers ``IN`` and ``OUT`` tokens on
+    endpoint 0 through the same ``response``/``dtb``/``data_out`` signals as
+    the ``IN`` handler.  ``SET_ADDRESS`` takes effect once its status stage
+    has completed, when ``address_we`` pulses with the new ``address``.
+
+    Parameters
+    ----------
+
+    rom : :obj:`DescriptorRom`
+        The descriptors to serve.
+
+    max_packet_size : int, optional
+        The endpoint 0 packet size.  By default this is taken from the device
+        descriptor.
+    """
+    def __init__(self, usb_core, rom, max_packet_size=None):
+        if max_packet_size is None:
+            max_packet_size = rom.max_packet_size
+
+        self.ctrl = CSRStorage(
+            fields=[
+                CSRField("enable", reset=1, description="Write a ``0`` here to pass every ``SETUP`` packet to the firmware."),
+            ],
+            description="Controls the standard request engine."
+        )
+        self.status = CSRStatus(
+            fields=[
+                CSRField("configuration", 8, description="The value of the last ``SET_CONFIGURATION``."),
+                CSRField("active", offset=8, description="``1`` while a request is being answered."),
+            ],
+        )
+
+        self.claim = Signal()
+        self.active = Signal()
+        self.response = Signal()
+        self.dtb = Signal()
+        self.data_out = Signal(8)
+        self.data_out_have = Signal()
+        self.data_out_advance = Signal()
+        self.address = Signal(7)
+        self.address_we = Signal()
+        self.usb_reset = Signal()
+
+        self.specials.rom = Memory(8, len(rom.contents), init=rom.contents)
+        self.specials.rom_rd = rom_rd = self.rom.get_port()
+
+        # Collect the eight bytes of the SETUP packet, dropping the CRC16
+        setup_data = Signal(64)
+        setup_index = Signal(4)
+        self.sync += [
+            If(usb_core.end,
+                setup_index.eq(0),
+            ).Elif((usb_core.tok == PID.SETUP) & usb_core.data_recv_put & (setup_index != 8),
+                setup_data.eq(Cat(setup_data[8:], usb_core.data_recv_payload)),
+                setup_index.eq(setup_index + 1),
+            ),
+        ]
+
+        request = Signal(16)
+        wValue = Signal(16)
+        wLength = Signal(16)
+        self.comb += [
+            request.eq(Cat(setup_data[8:16], setup_data[0:8])),
+            wValue.eq(setup_data[16:32]),
+            wLength.eq(setup_data[48:64]),
+        ]
+
+        # Look the request up
+        has_data = Signal()
+        data_offset = Signal(max=max(len(rom.contents), 2))
+        data_len = Signal(16)
+        data_clamped = Signal(16)
+        cases = {}
+        for key, (offset, length) in rom.entries.items():
+            cases[key] = [
+                has_data.eq(1),
+                data_offset.eq(offset),
+                data_len.eq(length),
+            ]
+        self.comb += [
+            If(request == 0x8006,
+                Case(wValue, cases),
+            ).Elif(request == 0x8000,
+                has_data.eq(1),
+                data_offset.eq(0),
+                data_len.eq(2),
+            ),
+            If(data_len > wLength,
+                data_clamped.eq(wLength),
+            ).Else(
+                data_clamped.eq(data_len),
+            ),
+            self.claim.eq(usb_core.setup & (usb_core.endp == 0) & self.ctrl.fields.enable &
+                (has_data | (request == 0x0005) | (request == 0x0009))),
+        ]
+
+        in_ep0 = Signal()
+        out_ep0 = Signal()
+        acked = Signal()
+        self.comb += [
+            in_ep0.eq((usb_core.tok == PID.IN) & (usb_core.endp == 0)),
+            out_ep0.eq((usb_core.tok == PID.OUT) & (usb_core.endp == 0)),
+            # When a host retries an IN it also commits, so leave those out
+            acked.eq(usb_core.commit & ~usb_core.retry),
+        ]
+
+        # The data stage.  `pkt_addr` and `pkt_remaining` mark the start of
+        # the packet on the wire, so that it can be sent again.
+        addr = Signal.like(data_offset)
+        addr_next = Signal.like(data_offset)
+        pkt_addr = Signal.like(data_offset)
+        remaining = Signal(16)
+        pkt_remaining = Signal(16)
+        sent = Signal(7)
+        need_zlp = Signal()
+        advance = Signal()
+        rewind = Signal()
+        packet_done = Signal()
+
+        set_address = Signal()
+        set_config = Signal()
+        value = Signal(8)
+        configuration = Signal(8)
+
+        self.submodules.fsm = fsm = ResetInserter()(FSM(reset_state="IDLE"))
+        self.comb += fsm.reset.eq(self.usb_reset)
+
+        # A new SETUP packet always starts over
+        on_setup = If(usb_core.setup & (usb_core.endp == 0),
+            If(self.claim,
+                NextValue(need_zlp, data_len < wLength),
+                NextValue(set_address, request == 0x0005),
+                NextValue(set_config, request == 0x0009),
+                NextValue(value, wValue[0:8]),
+                NextValue(self.dtb, 1),
+                If(has_data,
+                    NextState("DATA"),
+                ).Else(
+                    NextState("STATUS_IN"),
+                ),
+            ).Else(
+                NextState("IDLE"),
+            ),
+        )
+
+        fsm.act("IDLE",
+            on_setup,
+        )
+        fsm.act("DATA",
+            self.active.eq(1),
+            # The host may end the data stage early by moving on to the status stage
+            self.response.eq(in_ep0 | out_ep0),
+            self.data_out_have.eq(in_ep0 & (remaining != 0) & (sent != max_packet_size)),
+            If(acked & in_ep0,
+                packet_done.eq(1),
+                NextValue(self.dtb, ~self.dtb),
+                # A transfer that is shorter than asked for and ends on a full
+                # packet needs a zero length packet to finish it
+                If((remaining == 0) & ~((sent == max_packet_size) & need_zlp),
+                    NextState("STATUS_OUT"),
+                ),
+            ).Elif(acked & out_ep0,
+                NextState("IDLE"),
+            ),
+            on_setup,
+        )
+        fsm.act("STATUS_OUT",
+            self.active.eq(1),
+            self.response.eq(out_ep0),
+            If(acked & out_ep0,
+                NextState("IDLE"),
+            ),
+            on_setup,
+        )
+        fsm.act("STATUS_IN",
+            self.active.eq(1),
+            self.response.eq(in_ep0),
+            If(acked & in_ep0,
+                self.address_we.eq(set_address),
+                If(set_config,
+                    NextValue(configuration, value),
+                ),
+                NextState("IDLE"),
+            ),
+            on_setup,
+        )
+
+        self.comb += [
+            advance.eq(self.data_out_advance & self.data_out_have),
+            rewind.eq(usb_core.poll | usb_core.retry),
+
+            # The ROM is read one byte ahead, so address it with the next value of `addr`
+            If(self.claim,
+                addr_next.eq(data_offset),
+            ).Elif(rewind,
+                addr_next.eq(pkt_addr),
+            ).Elif(advance,
+                addr_next.eq(addr + 1),
+            ).Else(
+                addr_next.eq(addr),
+            ),
+            rom_rd.adr.eq(addr_next),
+            self.data_out.eq(rom_rd.dat_r),
+            self.address.eq(value),
+
+            self.status.fields.configuration.eq(configuration),
+            self.status.fields.active.eq(self.active),
+        ]
+        self.sync += [
+            addr.eq(addr_next),
+            If(self.claim,
+                pkt_addr.eq(data_offset),
+                remaining.eq(data_clamped),
+                pkt_remaining.eq(data_clamped),
+                sent.eq(0),
+            ).Elif(rewind,
+                remaining.eq(pkt_remaining),
+                sent.eq(0),
+            ).Elif(advance,
+                remaining.eq(remaining - 1),
+                sent.eq(sent + 1),
+            ).Elif(packet_done,
+                pkt_addr.eq(addr),
+                pkt_remaining.eq(remaining),
+                sent.eq(0),
+            ),
+            If(self.usb_reset,
+                configuration.eq(0),
+            ),
+        ]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest import TestCase
+
+from migen import *
+
+from ..io_test import FakeIoBuf
+from ..pid import PID
+from ..test.host import WireHost
+from ..utils.bridge import ControlTransfer
+from .eptri import TriEndpointInterface
+from .eptri_test import FakeUsbCore
+from .stdreq import DescriptorRom, StandardRequests
+
+
+DEVICE = [
+    0x12, 0x01, 0x00, 0x02, 0x00, 0x00, 0x00, 0x08,
+    0x09, 0x12, 0xf0, 0x5b, 0x01, 0x01, 0x01, 0x02,
+    0x00, 0x01,
+]
+
+
+class TestStandardRequests(TestCase):
+    def setUp(self):
+        rom = DescriptorRom()
+        rom.add(DescriptorRom.DEVICE, 0, DEVICE)
+        rom.add(DescriptorRom.CONFIGURATION, 0, bytes(range(16)))
+        self.usb_core = FakeUsbCore()
+        self.dut = StandardRequests(self.usb_core, rom)
+        self.dut.submodules.usb_core = self.usb_core
+
+    def setup(self, data):
+        """Send a SETUP packet and return whether it was claimed."""
+        yield self.usb_core.tok.eq(PID.SETUP)
+        yield self.usb_core.endp.eq(0)
+        for b in data + [0xaa, 0xbb]:
+            yield self.usb_core.data_recv_payload.eq(b)
+            yield self.usb_core.data_recv_put.eq(1)
+            yield
+        yield self.usb_core.data_recv_put.eq(0)
+        yield self.usb_core.setup.eq(1)
+        yield self.usb_core.commit.eq(1)
+        yield self.usb_core.end.eq(1)
+        yield
+        claimed = yield self.dut.claim
+        yield self.usb_core.setup.eq(0)
+        yield self.usb_core.commit.eq(0)
+        yield self.usb_core.end.eq(0)
+        yield
+        return claimed
+
+    def token(self, pid):
+        yield self.usb_core.tok.eq(pid)
+        yield self.usb_core.poll.eq(1)
+        yield
+        yield self.usb_core.poll.eq(0)
+        yield
+        return (yield self.dut.response)
+
+    def commit(self):
+        yield self.usb_core.commit.eq(1)
+        yield self.usb_core.end.eq(1)
+        yield
+        yield self.usb_core.commit.eq(0)
+        yield self.usb_core.end.eq(0)
+        yield
+
+    def host_in(self):
+        """Run an IN transaction and return the DATAx PID and data."""
+        self.assertTrue((yield from self.token(PID.IN)))
+        pid = PID.DATA1 if (yield self.dut.dtb) else PID.DATA0
+        data = []
+        while (yield self.dut.data_out_have):
+            data.append((yield self.dut.data_out))
+            yield self.dut.data_out_advance.eq(1)
+            yield
+            yield self.dut.data_out_advance.eq(0)
+            yield
+        yield from self.commit()
+        return pid, data
+
+    def host_out(self):
+        self.assertTrue((yield from self.token(PID.OUT)))
+        yield from self.commit()
+
+    def test_get_device_descriptor(self):
+        def stim():
+            self.assertTrue((yield from self.setup([0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00])))
+            self.assertEqual((yield from self.host_in()), (PID.DATA1, DEVICE[0:8]))
+            self.assertEqual((yield from self.host_in()), (PID.DATA0, DEVICE[8:16]))
+            self.assertEqual((yield from self.host_in()), (PID.DATA1, DEVICE[16:18]))
+            yield from self.host_out()
+            self.assertFalse((yield self.dut.active))
+        run_simulation(self.dut, stim())
+
+    def test_short_read(self):
+        def stim():
+            self.assertTrue((yield from self.setup([0x80, 0x06, 0x00, 0x02, 0x00, 0x00, 0x08, 0x00])))
+            self.assertEqual((yield from self.host_in()), (PID.DATA1, list(range(8))))
+            yield from self.host_out()
+            self.assertFalse((yield self.dut.active))
+        run_simulation(self.dut, stim())
+
+    def test_zlp(self):
+        def stim():
+            self.assertTrue((yield from self.setup([0x80, 0x06, 0x00, 0x02, 0x00, 0x00, 0xff, 0x00])))
+            self.assertEqual((yield from self.host_in()), (PID.DATA1, list(range(8))))
+            self.assertEqual((yield from self.host_in()), (PID.DATA0, list(range(8, 16))))
+            self.assertEqual((yield from self.host_in()), (PID.DATA1, []))
+            yield from self.host_out()
+            self.assertFalse((yield self.dut.active))
+        run_simulation(self.dut, stim())
+
+    def test_retry(self):
+        def stim():
+            self.assertTrue((yield from self.setup([0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00])))
+            self.assertTrue((yield from self.token(PID.IN)))
+            # Only take part of the packet, as if it got lost
+            yield self.dut.data_out_advance.eq(1)
+            yield
+            yield self.dut.data_out_advance.eq(0)
+            yield
+            self.assertEqual((yield from self.host_in()), (PID.DATA1, DEVICE[0:8]))
+        run_simulation(self.dut, stim())
+
+    def test_get_status(self):
+        def stim():
+            self.assertTrue((yield from self.setup([0x80, 0x00, 0x00, 0x00, 0x00, 0x00, 0x02, 0x00])))
+            self.assertEqual((yield from self.host_in()), (PID.DATA1, [0, 0]))
+            yield from self.host_out()
+        run_simulation(self.dut, stim())
+
+    def test_set_address(self):
+        def stim():
+            self.assertTrue((yield from self.setup([0x00, 0x05, 0x12, 0x00, 0x00, 0x00, 0x00, 0x00])))
+            self.assertTrue((yield self.dut.active))
+            self.assertTrue((yield from self.token(PID.IN)))
+            self.assertEqual((yield self.dut.dtb), 1)
+            self.assertFalse((yield self.dut.data_out_have))
+            yield self.usb_core.commit.eq(1)
+            yield
+            self.assertTrue((yield self.dut.address_we))
+            self.assertEqual((yield self.dut.address), 0x12)
+            yield self.usb_core.commit.eq(0)
+            yield
+            self.assertFalse((yield self.dut.active))
+        run_simulation(self.dut, stim())
+
+    def test_set_configuration(self):
+        def stim():
+            self.assertTrue((yield from self.setup([0x00, 0x09, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00])))
+            self.assertEqual((yield from self.host_in()), (PID.DATA1, []))
+            self.assertEqual((yield self.dut.status.fields.configuration), 1)
+        run_simulation(self.dut, stim())
+
+    def test_unknown_requests(self):
+        def stim():
+            # String descriptor that is not in the ROM
+            self.assertFalse((yield from self.setup([0x80, 0x06, 0x01, 0x03, 0x09, 0x04, 0xff, 0x00])))
+            # Class request
+            self.assertFalse((yield from self.setup([0x21, 0x09, 0x00, 0x02, 0x00, 0x00, 0x01, 0x00])))
+            self.assertFalse((yield self.dut.active))
+            self.assertFalse((yield from self.token(PID.IN)))
+        run_simulation(self.dut, stim())
+
+    def test_disabled(self):
+        def stim():
+            yield from self.dut.ctrl.write(0)
+            self.assertFalse((yield from self.setup([0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00])))
+        run_simulation(self.dut, stim())
+
+
+class TestTriEndpointInterfaceStandardRequests(TestCase):
+    def test_endpoint_0_enabled(self):
+        rom = DescriptorRom()
+        rom.add(DescriptorRom.DEVICE, 0, DEVICE)
+        dut = TriEndpointInterface(FakeIoBuf(), descriptors=rom)
+        host = WireHost(dut.iobuf, max_packet_size=8)
+        in_handler = getattr(dut, "in")
+        result = {}
+        def wire():
+            yield from dut.iobuf.recv("J")
+            for _ in range(20):
+                yield
+            result["device"] = yield from host.control(ControlTransfer(0x80, 0x06, 0x0100, 0, 64))
+            for _ in range(200):
+                yield
+        def firmware():
+            # Left enabled by firmware, as it would be for its own requests
+            yield from dut.out.ctrl.write(1 << 4)
+            while "device" not in result:
+                yield
+            for _ in range(100):
+                yield
+            result["out"] = yield dut.out.ev.packet.pending
+            result["in"] = yield in_handler.ev.packet.pending
+            result["setup"] = yield dut.setup.ev.packet.pending
+            result["have"] = yield dut.out.status.fields.have
+        run_simulation(dut, {"usb_48": wire(), "sys": firmware()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+        self.assertEqual(list(result["device"]), DEVICE)
+        # The status stage belongs to the standard request engine, not the OUT handler
+        self.assertEqual((result["out"], result["in"], result["setup"], result["have"]), (0, 0, 0, 0))
+
+    def test_cdc(self):
+        with self.assertRaises(ValueError):
+            TriEndpointInterface(FakeIoBuf(), cdc=True, descriptors=DescriptorRom())
+
+
+if __name__ == '__main__':
+    unittest.main()
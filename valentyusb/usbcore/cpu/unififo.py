@@ -12,6 +12,7 @@ from ..endpoint import *
 from ..io import FakeIoBuf
 from ..rx.pipeline import RxPipeline
 from ..tx.pipeline import TxPipeline
+from ..tx.crc import TxParallelCrcGenerator
 
 from ..utils.packet import *
 
@@ -19,9 +20,45 @@ from ..utils.packet import *
 class UsbUniFifo(Module, AutoCSR):
     """
     Presents the USB data stream as two FIFOs via CSR registers.
+
+    By default every byte on the wire goes through the FIFOs as it is, and
+    firmware has to find where each packet starts and ends.  With `framed`
+    set, the hardware does that instead:
+
+    * Each received packet is read from ``obuf_word``, which takes the
+      place of ``obuf_head``, as a header word followed by
+      ``(length + 3) // 4`` words of payload, first byte in the lowest bits.
+      The header is laid out as ``HEADER_*`` below.  The payload is what
+      comes after the PID, less the CRC16 of a data packet, so a token has
+      none and its address and endpoint are in the header instead (the
+      frame number, for an SOF).  The CRC bit is set if the PID check bits,
+      and the CRC5 or CRC16 of the packet if it has one, are right.  A
+      packet that there isn't room for, for its header or its payload, is
+      dropped as a whole, and the overflow bit is set in the next header.
+
+    * Each packet to send is written to ``ibuf_head`` as a length byte
+      followed by that many bytes, starting with the PID.  While ``arm`` is
+      set the packets go out one at a time, each on its own.
+
+    Parameters
+    ----------
+
+    iobuf : :obj:`io.IoBuf`
+        The USB pins.
+
+    framed : bool, optional
+        Frame packets as described above.
     """
 
-    def __init__(self, iobuf):
+    # Fields of the header word in front of each received packet
+    HEADER_PID = slice(0, 8)
+    HEADER_ADDR = slice(8, 15)
+    HEADER_EP = slice(15, 19)
+    HEADER_CRC_OK = 19
+    HEADER_LENGTH = slice(20, 31)
+    HEADER_OVERFLOW = 31
+
+    def __init__(self, iobuf, framed=False):
         self.submodules.ev = ev.EventManager()
         self.ev.submodules.rx = ev.EventSourcePulse()
 
@@ -31,6 +68,42 @@ class UsbUniFifo(Module, AutoCSR):
         self.submodules.rx = rx = RxPipeline()
         self.byte_count = CSRStatus(8)
 
+        if framed:
+            self._framed_rx(rx)
+        else:
+            self._raw_rx(rx)
+
+        # ---------------------
+        # TX side
+        # ---------------------
+        self.submodules.tx = tx = TxPipeline()
+
+        if framed:
+            self._framed_tx(tx)
+        else:
+            self._raw_tx(tx)
+
+        # ----------------------
+        # USB 48MHz bit strobe
+        # ----------------------
+        self.comb += [
+            tx.i_bit_strobe.eq(rx.o_bit_strobe),
+        ]
+
+        # ----------------------
+        # Tristate
+        # ----------------------
+        self.submodules.iobuf = iobuf
+        self.comb += [
+            rx.i_usbp.eq(iobuf.usb_p_rx),
+            rx.i_usbn.eq(iobuf.usb_n_rx),
+            iobuf.usb_tx_en.eq(tx.o_oe),
+            iobuf.usb_p_tx.eq(tx.o_usbp),
+            iobuf.usb_n_tx.eq(tx.o_usbn),
+        ]
+        self.submodules.pullup = GPIOOut(iobuf.usb_pullup)
+
+    def _raw_rx(self, rx):
         obuf = fifo.AsyncFIFOBuffered(width=8, depth=128)
         self.submodules.obuf = ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(obuf)
 
@@ -53,11 +126,7 @@ class UsbUniFifo(Module, AutoCSR):
             self.obuf_empty.status.eq(~self.obuf.readable),
         ]
 
-        # ---------------------
-        # TX side
-        # ---------------------
-        self.submodules.tx = tx = TxPipeline()
-
+    def _raw_tx(self, tx):
         ibuf = fifo.AsyncFIFOBuffered(width=8, depth=128)
         self.submodules.ibuf = ClockDomainsRenamer({"write": "sys", "read": "usb_12"})(ibuf)
 
@@ -80,22 +149,266 @@ class UsbUniFifo(Module, AutoCSR):
             tx.i_oe.eq(self.ibuf.readable & self.arm.storage),
         ]
 
-        # ----------------------
-        # USB 48MHz bit strobe
-        # ----------------------
+    def _framed_rx(self, rx):
+        # Payload bytes are packed into words on the USB side, and the
+        # header of each packet goes into a FIFO of its own once the packet
+        # has ended, after the last of its payload.  The payload is only
+        # committed along with the header, so that a packet either goes in
+        # whole or not at all.
+        obuf = PacketFifo(width=32, depth=32)
+        self.submodules.obuf = ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(obuf)
+        hbuf = fifo.AsyncFIFOBuffered(width=32, depth=8)
+        self.submodules.hbuf = ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(hbuf)
+
+        # USB side (writing)
+        pid = Signal(8)
+        have_pid = Signal()
+        # The last two bytes are held back, as they are the CRC16 of a data
+        # packet, or the address, endpoint and CRC5 of a token.
+        last = [Signal(8) for _ in range(2)]
+        held = Signal(2)
+        length = Signal(12)
+        word = Signal(32)
+        lane = Signal(2)
+        payload = Signal(8)
+        push = Signal()
+        header = Signal(32)
+        ended = Signal()
+        fits = Signal()
+        overrun = Signal()
+        overflow = Signal()
+
+        self.submodules.crc = crc = ClockDomainsRenamer("usb_12")(
+            TxParallelCrcGenerator(
+                crc_width=16,
+                data_width=8,
+                polynomial=0b1000000000000101,
+                initial=0b1111111111111111,
+            )
+        )
+
+        token = Signal(11)
+        crc5_ok = Signal()
+        crc16_ok = Signal()
+        pid_ok = Signal()
+        crc_ok = Signal()
         self.comb += [
-            tx.i_bit_strobe.eq(rx.o_bit_strobe),
+            token.eq(Cat(last[0], last[1][:3])),
+            crc5_ok.eq(crc5_matches(token, last[1][3:])),
+            crc16_ok.eq((last[0] == crc.o_crc[:8]) & (last[1] == crc.o_crc[8:])),
+            pid_ok.eq(pid[:4] == (pid[4:] ^ 0b1111)),
+            If(pid[:2] == 0b01,
+                crc_ok.eq(pid_ok & (held == 2) & crc5_ok),
+            ).Elif(pid[:2] == 0b11,
+                crc_ok.eq(pid_ok & (held == 2) & crc16_ok),
+            ).Else(
+                crc_ok.eq(pid_ok),
+            ),
+
+            push.eq(rx.o_data_strobe & have_pid & (held == 2)),
+            payload.eq(last[0]),
+            crc.reset.eq(rx.o_pkt_start),
+            crc.i_data_payload.eq(payload),
+            crc.i_data_strobe.eq(push),
+
+            If(push & (lane == 3),
+                self.obuf.din.eq(Cat(word[:24], payload)),
+                self.obuf.we.eq(1),
+            ).Elif(rx.o_pkt_end & (lane != 0),
+                self.obuf.din.eq(word),
+                self.obuf.we.eq(1),
+            ),
+
+            # The packet is taken once the last of its payload is in, if none
+            # of it was turned away and there is room for the header.
+            fits.eq(~overrun & self.hbuf.writable),
+            self.obuf.commit.eq(ended & fits),
+            self.obuf.drop.eq(ended & ~fits),
+            self.hbuf.din.eq(Cat(header[:self.HEADER_OVERFLOW], overflow)),
+            self.hbuf.we.eq(ended & fits),
+        ]
+        self.sync.usb_12 += [
+            self.ev.rx.trigger.eq(self.hbuf.we),
+            If(rx.o_data_strobe, self.byte_count.status.eq(self.byte_count.status + 1)),
+
+            ended.eq(rx.o_pkt_end & have_pid),
+            If(rx.o_pkt_start,
+                overrun.eq(0),
+            ).Elif(self.obuf.we & ~self.obuf.writable,
+                overrun.eq(1),
+            ),
+            If(self.hbuf.we,
+                overflow.eq(0),
+            ).Elif(self.obuf.drop,
+                overflow.eq(1),
+            ),
+            If(rx.o_pkt_end,
+                header[self.HEADER_PID].eq(pid),
+                If(pid[:2] == 0b01,
+                    header[self.HEADER_ADDR.start:self.HEADER_EP.stop].eq(token),
+                ).Else(
+                    header[self.HEADER_ADDR.start:self.HEADER_EP.stop].eq(0),
+                ),
+                header[self.HEADER_CRC_OK].eq(crc_ok),
+                header[self.HEADER_LENGTH].eq(length),
+            ),
+
+            If(rx.o_pkt_start,
+                have_pid.eq(0),
+                held.eq(0),
+                length.eq(0),
+                lane.eq(0),
+            ).Elif(rx.o_data_strobe,
+                If(~have_pid,
+                    pid.eq(rx.o_data_payload),
+                    have_pid.eq(1),
+                ).Else(
+                    last[0].eq(last[1]),
+                    last[1].eq(rx.o_data_payload),
+                    If(held != 2,
+                        held.eq(held + 1),
+                    ),
+                ),
+            ),
+            If(push,
+                length.eq(length + 1),
+                lane.eq(lane + 1),
+                Case(lane, {i: word[8*i:8*(i+1)].eq(payload) for i in range(4)}),
+            ),
         ]
 
-        # ----------------------
-        # Tristate
-        # ----------------------
-        self.submodules.iobuf = iobuf
+        # System side (reading)
+        remaining = Signal(10)
+        self.obuf_word = CSR(32)
+        self.obuf_empty = CSRStatus(1)
         self.comb += [
-            rx.i_usbp.eq(iobuf.usb_p_rx),
-            rx.i_usbn.eq(iobuf.usb_n_rx),
-            iobuf.usb_tx_en.eq(tx.o_oe),
-            iobuf.usb_p_tx.eq(tx.o_usbp),
-            iobuf.usb_n_tx.eq(tx.o_usbn),
+            If(remaining != 0,
+                self.obuf_word.w.eq(self.obuf.dout),
+                self.obuf.re.eq(self.obuf_word.re),
+            ).Else(
+                self.obuf_word.w.eq(self.hbuf.dout),
+                self.hbuf.re.eq(self.obuf_word.re),
+            ),
+            self.obuf_empty.status.eq((remaining == 0) & ~self.hbuf.readable),
         ]
-        self.submodules.pullup = GPIOOut(iobuf.usb_pullup)
+        self.sync += [
+            If(self.obuf_word.re,
+                If(remaining != 0,
+                    remaining.eq(remaining - 1),
+                ).Elif(self.hbuf.readable,
+                    remaining.eq((self.hbuf.dout[self.HEADER_LENGTH] + 3) >> 2),
+                ),
+            ),
+        ]
+
+    def _framed_tx(self, tx):
+        ibuf = fifo.AsyncFIFOBuffered(width=8, depth=128)
+        self.submodules.ibuf = ClockDomainsRenamer({"write": "sys", "read": "usb_12"})(ibuf)
+
+        # System side (writing)
+        self.arm = CSRStorage(1)
+        self.ibuf_head = CSR(8)
+        self.ibuf_empty = CSRStatus(1)
+        self.comb += [
+            self.ibuf.din.eq(self.ibuf_head.r),
+            self.ibuf.we.eq(self.ibuf_head.re),
+            self.ibuf_empty.status.eq(~self.ibuf.readable & ~tx.o_oe),
+        ]
+
+        # USB side (reading).  The transmitter asks for a byte while it
+        # sends the sync pattern, before the PID, which is where the length
+        # byte goes.  An empty packet is dropped.
+        remaining = Signal(8)
+        syncing = Signal()
+        start = Signal()
+        self.comb += [
+            start.eq((remaining == 0) & ~tx.i_oe & ~tx.o_oe & self.ibuf.readable & self.arm.storage),
+            tx.i_data_payload.eq(self.ibuf.dout),
+            self.ibuf.re.eq((start & (self.ibuf.dout == 0)) | (tx.o_data_strobe & (remaining != 0))),
+        ]
+        self.sync.usb_12 += [
+            If(start,
+                remaining.eq(self.ibuf.dout),
+                syncing.eq(1),
+            ).Elif(tx.o_data_strobe & syncing,
+                syncing.eq(0),
+            ).Elif(tx.o_data_strobe & (remaining != 0),
+                remaining.eq(remaining - 1),
+            ),
+            tx.i_oe.eq((remaining != 0) & ~(tx.o_data_strobe & ~syncing & (remaining == 1))),
+        ]
+
+
+class PacketFifo(Module):
+    """An asynchronous FIFO that is written a packet at a time.
+
+    Words written go in behind the last packet that was committed.  Pulsing
+    ``commit`` keeps the words written before it, and pulsing ``drop``
+    throws them away instead.  Words written while ``writable`` is low are
+    lost, so the packet they are part of should be dropped.
+
+    The read side can't tell how many words there are: it has to be told
+    how many to read by something sent alongside, once they are committed,
+    such as a header in a FIFO of its own.  The domains are ``write`` and
+    ``read``, as for :obj:`fifo.AsyncFIFO`.
+    """
+    def __init__(self, width, depth):
+        self.din = Signal(width)
+        self.we = Signal()
+        self.writable = Signal()
+        self.commit = Signal()
+        self.drop = Signal()
+        self.dout = Signal(width)
+        self.re = Signal()
+
+        # # #
+
+        depth_bits = log2_int(depth)
+
+        wr = Signal(depth_bits + 1)
+        end = Signal(depth_bits + 1)
+        consume = ClockDomainsRenamer("read")(cdc.GrayCounter(depth_bits + 1))
+        consume_binary = ClockDomainsRenamer("write")(cdc.GrayDecoder(depth_bits + 1))
+        self.submodules += consume, consume_binary
+        consume_wdomain = Signal(depth_bits + 1)
+        self.specials += cdc.MultiReg(consume.q, consume_wdomain, "write")
+
+        level = Signal(depth_bits + 1)
+        self.comb += [
+            consume.ce.eq(self.re),
+            consume_binary.i.eq(consume_wdomain),
+            level.eq(wr - consume_binary.o),
+            self.writable.eq(level != depth),
+        ]
+        self.sync.write += [
+            If(self.drop,
+                wr.eq(end),
+            ).Elif(self.we & self.writable,
+                wr.eq(wr + 1),
+            ),
+            If(self.commit,
+                end.eq(wr),
+            ),
+        ]
+
+        storage = Memory(width, depth)
+        self.specials += storage
+        wrport = storage.get_port(write_capable=True, clock_domain="write")
+        rdport = storage.get_port(clock_domain="read")
+        self.specials += wrport, rdport
+        self.comb += [
+            wrport.adr.eq(wr[:-1]),
+            wrport.dat_w.eq(self.din),
+            wrport.we.eq(self.we & self.writable),
+            rdport.adr.eq(consume.q_next_binary[:-1]),
+            self.dout.eq(rdport.dat_r),
+        ]
+
+
+def crc5_matches(data, crc5):
+    """Check the CRC5 of the 11 bits of a token, as :obj:`TxPacketSend` makes it."""
+    crc = [C(1, 1) for _ in range(5)]
+    for i in range(len(data)):
+        feedback = crc[0] ^ data[i]
+        crc = [crc[1], crc[2], crc[3] ^ feedback, crc[4], feedback]
+    return Cat(*crc) == (crc5 ^ 0b11111)
@@ -7,10 +7,12 @@ from migen import *
 from ..endpoint import *
 from ..io import FakeIoBuf
 from ..test.common import BaseUsbTestCase, CommonUsbTestCase
+from ..pid import PID
 from ..utils.packet import *
 
 from .unififo import UsbUniFifo
 from ..test.clock import CommonTestMultiClockDomain
+from ..test.host import WireHost
 
 
 class TestUsbUniFifo(
@@ -400,6 +402,165 @@ class TestUsbUniFifo(
         return self.endpoints[epaddr].dtb
 
 
+class TestUsbUniFifoFramed(unittest.TestCase):
+    """Drive the bus from the usb_48 domain, and the CSRs from sys."""
+    def setUp(self):
+        self.dut = UsbUniFifo(FakeIoBuf(), framed=True)
+        self.host = WireHost(self.dut.iobuf)
+
+    def read_word(self):
+        value = yield self.dut.obuf_word.w
+        yield self.dut.obuf_word.re.eq(1)
+        yield
+        yield self.dut.obuf_word.re.eq(0)
+        for _ in range(4):
+            yield
+        return value
+
+    def read_packet(self):
+        """Return the header fields and the payload of the next packet."""
+        self.assertFalse((yield self.dut.obuf_empty.status))
+        header = yield from self.read_word()
+        length = (header >> 20) & 0x7ff
+        payload = []
+        for _ in range((length + 3) // 4):
+            word = yield from self.read_word()
+            payload += [(word >> (8 * i)) & 0xff for i in range(4)]
+        fields = (header & 0xff, (header >> 8) & 0x7f, (header >> 15) & 0xf, (header >> 19) & 1,
+            header >> 31)
+        return fields, payload[:length]
+
+    def write_bytes(self, data):
+        for b in data:
+            yield self.dut.ibuf_head.r.eq(b)
+            yield self.dut.ibuf_head.re.eq(1)
+            yield
+            yield self.dut.ibuf_head.re.eq(0)
+            yield
+
+    def run_sim(self, usb, cpu):
+        def padfront():
+            yield from self.dut.iobuf.recv("J")
+            for _ in range(20):
+                yield
+            yield from usb()
+        run_simulation(self.dut, {"usb_48": padfront(), "sys": cpu()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+
+    def test_receive(self):
+        done = []
+        def usb():
+            yield from self.host.send(token_packet(PID.OUT, 3, 2))
+            yield from self.host.send(data_packet(PID.DATA1, [1, 2, 3, 4, 5]))
+            yield from self.host.send(handshake_packet(PID.ACK))
+            yield from self.host.send(data_packet(PID.DATA0, list(range(8))))
+            for _ in range(100):
+                yield
+            done.append(True)
+        def cpu():
+            while not done:
+                yield
+            self.assertEqual((yield from self.read_packet()), ((0xe1, 3, 2, 1, 0), []))
+            self.assertEqual((yield from self.read_packet()), ((0x4b, 0, 0, 1, 0), [1, 2, 3, 4, 5]))
+            self.assertEqual((yield from self.read_packet()), ((0xd2, 0, 0, 1, 0), []))
+            self.assertEqual((yield from self.read_packet()), ((0xc3, 0, 0, 1, 0), list(range(8))))
+            self.assertTrue((yield self.dut.obuf_empty.status))
+        self.run_sim(usb, cpu)
+
+    def test_receive_bad_crc(self):
+        done = []
+        def usb():
+            data = data_packet(PID.DATA0, [1, 2, 3])
+            yield from self.host.send(data[:12] + ("1" if data[12] == "0" else "0") + data[13:])
+            token = token_packet(PID.IN, 5, 1)
+            yield from self.host.send(token[:-1] + ("1" if token[-1] == "0" else "0"))
+            for _ in range(100):
+                yield
+            done.append(True)
+        def cpu():
+            while not done:
+                yield
+            (pid, _, _, crc_ok, _), payload = yield from self.read_packet()
+            self.assertEqual((pid, crc_ok, len(payload)), (0xc3, 0, 3))
+            (pid, addr, ep, crc_ok, _), payload = yield from self.read_packet()
+            self.assertEqual((pid, addr, ep, crc_ok, payload), (0x69, 5, 1, 0, []))
+        self.run_sim(usb, cpu)
+
+    def test_overflow_payload(self):
+        done = []
+        def usb():
+            # Room for the payload of two of these, but not three
+            for i in range(3):
+                yield from self.host.send(data_packet(PID.DATA0, [i] * 64))
+            yield from self.host.send(handshake_packet(PID.ACK))
+            done.append(True)
+            # A bit at a time, so as not to start the next packet mid-bit
+            while len(done) < 2:
+                for _ in range(4):
+                    yield
+            yield from self.host.send(data_packet(PID.DATA1, [7] * 64))
+            for _ in range(100):
+                yield
+            done.append(True)
+        def cpu():
+            while not done:
+                yield
+            self.assertEqual((yield from self.read_packet()), ((0xc3, 0, 0, 1, 0), [0] * 64))
+            self.assertEqual((yield from self.read_packet()), ((0xc3, 0, 0, 1, 0), [1] * 64))
+            self.assertEqual((yield from self.read_packet()), ((0xd2, 0, 0, 1, 1), []))
+            self.assertTrue((yield self.dut.obuf_empty.status))
+            done.append(True)
+            while len(done) < 3:
+                yield
+            self.assertEqual((yield from self.read_packet()), ((0x4b, 0, 0, 1, 0), [7] * 64))
+            self.assertTrue((yield self.dut.obuf_empty.status))
+        self.run_sim(usb, cpu)
+
+    def test_overflow_headers(self):
+        done = []
+        def usb():
+            for _ in range(12):
+                yield from self.host.send(handshake_packet(PID.ACK))
+            yield from self.host.send(data_packet(PID.DATA0, [1, 2, 3]))
+            done.append(True)
+            # A bit at a time, so as not to start the next packet mid-bit
+            while len(done) < 2:
+                for _ in range(4):
+                    yield
+            yield from self.host.send(data_packet(PID.DATA1, [4, 5, 6]))
+            for _ in range(100):
+                yield
+            done.append(True)
+        def cpu():
+            while not done:
+                yield
+            packets = []
+            while not (yield self.dut.obuf_empty.status):
+                packets.append((yield from self.read_packet()))
+            self.assertEqual(packets, [((0xd2, 0, 0, 1, 0), [])] * len(packets))
+            done.append(True)
+            while len(done) < 3:
+                yield
+            self.assertEqual((yield from self.read_packet()), ((0x4b, 0, 0, 1, 1), [4, 5, 6]))
+            self.assertTrue((yield self.dut.obuf_empty.status))
+        self.run_sim(usb, cpu)
+
+    def test_transmit(self):
+        sent = []
+        def usb():
+            sent.append((yield from self.host.receive()))
+            sent.append((yield from self.host.receive()))
+            self.assertIsNone((yield from self.host.receive()))
+        def cpu():
+            data = [0xc3, 1, 2, 3] + crc16([1, 2, 3])
+            yield from self.write_bytes([len(data)] + data)
+            yield from self.write_bytes([1, 0xd2])
+            self.assertFalse((yield self.dut.ibuf_empty.status))
+            yield self.dut.arm.storage.eq(1)
+        self.run_sim(usb, cpu)
+        self.assertEqual(sent, [[0xc3, 1, 2, 3] + crc16([1, 2, 3]), [0xd2]])
+
+
 if __name__ == "__main__":
     import unittest
     unittest.main()
@@ -0,0 +1,326 @@
+from migen import *
+
+from migen.genlib.fifo import AsyncFIFOBuffered, SyncFIFOBuffered
+from migen.genlib.fsm import FSM, NextState
+
+from litex.soc.interconnect import wishbone
+
+from litex.soc.integration.doc import ModuleDoc, AutoDoc
+
+from ..pid import PID
+from .usbwishboneburstbridge import WishboneBurstMaster
+
+
+class USBWishboneBulkBridge(Module, AutoDoc):
+    """USB Wishbone Bridge over a pair of bulk endpoints
+
+    Parameters
+    ----------
+
+    usb_core : :obj:`sm.transfer.UsbTransfer`
+        The USB core to listen to.
+
+    endpoint : int, optional
+        The endpoint number to use, in both directions.
+
+    depth : int, optional
+        The number of words buffered on the USB side, in each direction.
+        It must hold at least two packets.
+
+    Attributes
+    ----------
+
+    wishbone : :obj:`wishbone.Interface`
+        The Wishbone master, in the ``sys`` domain.
+
+    selected : Signal
+        Set while the current transaction is to one of the bridge's
+        endpoints.  While it is, the wrapping module should drive the USB
+        core from ``arm``, ``dtb``, ``data_send_have`` and
+        ``data_send_payload``.
+
+    reset_toggles : Signal
+        Put both endpoints back to ``DATA0``, as ``SET_CONFIGURATION`` does.
+    """
+
+    OP_WRITE = 0x01
+    OP_READ = 0x02
+
+    def __init__(self, usb_core, endpoint=1, depth=32):
+        if depth < 32 or depth & (depth - 1):
+            raise ValueError("depth must be a power of two of at least 32")
+
+        self.wishbone = wishbone.Interface()
+
+        self.background = ModuleDoc(title="USB Wishbone Bulk Bridge", body="""
+            This bridge does the same job as the control transfer bridges, but over a bulk ``OUT``
+            and a bulk ``IN`` endpoint.  Bulk transfers get whatever bus time is left over in
+            each frame, rather than the small slice set aside for control transfers, and there is
+            no SETUP or status stage for each access.""")
+
+        self.protocol = ModuleDoc(title="USB Wishbone Bulk Protocol", body="""
+        The host writes a stream of commands to the ``OUT`` endpoint.  Commands may be split
+        across packets, and a packet may hold any number of them, so the host can queue up
+        as many as it likes without waiting for any of them to finish.  Each command starts
+        with an eight byte header, and all fields are little-endian:
+
+        ======  ======  ========================================================
+        Offset  Size    Field
+        ======  ======  ========================================================
+        0       1       Opcode: ``0x01`` to write, ``0x02`` to read
+        1       1       Reserved, send ``0x00``
+        2       2       Length in bytes, which must be a multiple of four
+        4       4       Wishbone byte address
+        ======  ======  ========================================================
+
+        A write is followed by `length` bytes of data.  A read sends `length` bytes back on
+        the ``IN`` endpoint, after those of any read before it, in packets of up to 64 bytes.
+        Commands are carried out in order.  Headers with any other opcode are skipped.
+        A packet the host sends again because it missed the ACK is dropped.
+        """)
+
+        # # #
+
+        self.selected = Signal()
+        self.arm = Signal()
+        self.dtb = Signal()
+        self.data_send_have = Signal()
+        self.data_send_payload = Signal(8)
+        self.reset_toggles = Signal()
+
+        is_out = Signal()
+        is_in = Signal()
+        self.comb += [
+            is_out.eq((usb_core.tok == PID.OUT) & (usb_core.endp == endpoint)),
+            is_in.eq((usb_core.tok == PID.IN) & (usb_core.endp == endpoint)),
+            self.selected.eq(is_out | is_in),
+        ]
+
+        in_dtb = Signal()
+        self.comb += self.dtb.eq(in_dtb)
+
+        # The USB core doesn't look at the toggle of OUT packets, so a packet
+        # the host sends again, with the same toggle as the last one, is
+        # spotted here.
+        out_toggle = Signal()
+        repeated = Signal()
+        self.comb += repeated.eq(usb_core.data_recv_pid[3] != out_toggle)
+        self.sync.usb_12 += [
+            If(is_out & usb_core.commit & ~usb_core.retry & ~repeated,
+                out_toggle.eq(~out_toggle),
+            ),
+            If(usb_core.usb_reset | self.reset_toggles,
+                out_toggle.eq(0),
+            ),
+        ]
+
+        # Commands, and the data for writes, are queued on the USB side,
+        # where an OUT packet is only taken when there is room for all of it.
+        cmd_layout = [("read", 1), ("length", 16), ("address", 32)]
+        cmd_depth = 16
+        self.submodules.cmd_queue = cmd_queue = ClockDomainsRenamer("usb_12")(
+            SyncFIFOBuffered(width=49, depth=cmd_depth))
+        self.submodules.write_queue = write_queue = ClockDomainsRenamer("usb_12")(
+            SyncFIFOBuffered(width=32, depth=depth))
+        self.submodules.cmd_fifo = cmd_fifo = ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(
+            AsyncFIFOBuffered(width=49, depth=4))
+        self.submodules.write_fifo = write_fifo = ClockDomainsRenamer({"write": "usb_12", "read": "sys"})(
+            AsyncFIFOBuffered(width=32, depth=64//4))
+        self.submodules.read_fifo = read_fifo = ClockDomainsRenamer({"write": "sys", "read": "usb_12"})(
+            AsyncFIFOBuffered(width=32, depth=64//4))
+
+        self.comb += [
+            cmd_fifo.din.eq(cmd_queue.dout),
+            cmd_fifo.we.eq(cmd_queue.readable & cmd_fifo.writable),
+            cmd_queue.re.eq(cmd_queue.readable & cmd_fifo.writable),
+            write_fifo.din.eq(write_queue.dout),
+            write_fifo.we.eq(write_queue.readable & write_fifo.writable),
+            write_queue.re.eq(write_queue.readable & write_fifo.writable),
+        ]
+
+        # ---------------------
+        # OUT endpoint
+        # ---------------------
+        # A packet holds at most 64 bytes: eight headers, or sixteen words.
+        out_room = Signal()
+        self.comb += out_room.eq((cmd_queue.level <= cmd_depth - 64//8) & (write_queue.level <= depth - 64//4))
+
+        # The last two bytes of each packet are its CRC16, so bytes are
+        # held back two at a time and only parsed once the next arrives.
+        last = [Signal(8) for _ in range(2)]
+        held = Signal(2)
+        byte = Signal(8)
+        parse = Signal()
+        self.comb += [
+            byte.eq(last[0]),
+            parse.eq(is_out & usb_core.data_recv_put & ~repeated & (held == 2)),
+        ]
+        self.sync.usb_12 += [
+            If(usb_core.start,
+                held.eq(0),
+            ).Elif(is_out & usb_core.data_recv_put,
+                last[0].eq(last[1]),
+                last[1].eq(usb_core.data_recv_payload),
+                If(held != 2,
+                    held.eq(held + 1),
+                ),
+            ),
+        ]
+
+        header = Signal(64)
+        header_next = Signal(64)
+        header_count = Signal(3)
+        in_data = Signal()
+        word = Signal(32)
+        lane = Signal(2)
+        words_left = Signal(14)
+        opcode = Signal(8)
+        length = Signal(16)
+        address = Signal(32)
+        cmd = Record(cmd_layout)
+        read_words = Signal(14)
+        self.comb += [
+            header_next.eq(Cat(header[8:], byte)),
+            opcode.eq(header_next[0:8]),
+            length.eq(header_next[16:32]),
+            address.eq(header_next[32:64]),
+            cmd.read.eq(opcode == self.OP_READ),
+            cmd.length.eq(length),
+            cmd.address.eq(address),
+            cmd_queue.din.eq(cmd.raw_bits()),
+            read_words.eq(Mux(opcode == self.OP_READ, length[2:], 0)),
+            write_queue.din.eq(Cat(word[:24], byte)),
+            If(parse,
+                If(~in_data & (header_count == 7),
+                    cmd_queue.we.eq(((opcode == self.OP_READ) | (opcode == self.OP_WRITE)) & (length[2:] != 0)),
+                ).Elif(in_data & (lane == 3),
+                    write_queue.we.eq(1),
+                ),
+            ),
+        ]
+        self.sync.usb_12 += [
+            If(usb_core.usb_reset,
+                header_count.eq(0),
+                in_data.eq(0),
+                lane.eq(0),
+            ).Elif(parse,
+                If(~in_data,
+                    header.eq(header_next),
+                    header_count.eq(header_count + 1),
+                    If((header_count == 7) & (opcode == self.OP_WRITE) & (length[2:] != 0),
+                        in_data.eq(1),
+                        words_left.eq(length[2:]),
+                    ),
+                ).Else(
+                    lane.eq(lane + 1),
+                    Case(lane, {i: word[8*i:8*(i+1)].eq(byte) for i in range(3)}),
+                    If(lane == 3,
+                        words_left.eq(words_left - 1),
+                        If(words_left == 1,
+                            in_data.eq(0),
+                        ),
+                    ),
+                ),
+            ),
+        ]
+
+        # ---------------------
+        # IN endpoint
+        # ---------------------
+        # Words read from the bus are kept until the host has ACKed the
+        # packet they went out in, so that they can be sent again.
+        self.specials.in_buffer = in_buffer = Memory(32, depth)
+        self.specials.in_wr = in_wr = in_buffer.get_port(write_capable=True, clock_domain="usb_12")
+        self.specials.in_rd = in_rd = in_buffer.get_port(clock_domain="usb_12")
+        ptr_bits = log2_int(depth) + 1
+        head = Signal(ptr_bits)     # The next word from the bus goes here
+        tail = Signal(ptr_bits)     # The oldest word not ACKed yet
+        rd = Signal(ptr_bits)       # The next word to send
+        level = Signal(ptr_bits)
+        self.comb += [
+            level.eq(head - tail),
+            in_wr.adr.eq(head[:-1]),
+            in_wr.dat_w.eq(read_fifo.dout),
+            in_wr.we.eq(read_fifo.readable & (level != depth)),
+            read_fifo.re.eq(read_fifo.readable & (level != depth)),
+        ]
+        self.sync.usb_12 += If(in_wr.we, head.eq(head + 1))
+
+        # Words asked for by reads and not sent yet
+        pending = Signal(17)
+        packet_words = Signal(5)
+        next_words = Signal(5)
+        sent = Signal(7)
+        rd_lane = Signal(2)
+        advance = Signal()
+        self.comb += [
+            next_words.eq(Mux(pending < 64//4, pending, 64//4)),
+            advance.eq(is_in & usb_core.data_send_get & (rd_lane == 3)),
+            in_rd.adr.eq(Mux(advance, rd + 1, rd)[:-1]),
+            self.data_send_payload.eq(in_rd.dat_r.part(rd_lane * 8, 8)),
+            self.data_send_have.eq(sent != Cat(C(0, 2), packet_words)),
+            self.arm.eq(Mux(is_in,
+                (pending != 0) & (level >= next_words),
+                out_room)),
+        ]
+        self.sync.usb_12 += [
+            If(parse & ~in_data & (header_count == 7),
+                pending.eq(pending + read_words),
+            ).Elif(is_in & usb_core.commit & ~usb_core.retry,
+                pending.eq(pending - packet_words),
+            ),
+            If(usb_core.poll | usb_core.retry,
+                rd.eq(tail),
+                rd_lane.eq(0),
+                sent.eq(0),
+            ).Elif(is_in & usb_core.data_send_get,
+                rd_lane.eq(rd_lane + 1),
+                sent.eq(sent + 1),
+                If(rd_lane == 3,
+                    rd.eq(rd + 1),
+                ),
+            ),
+            If(usb_core.poll,
+                packet_words.eq(next_words),
+            ),
+            If(is_in & usb_core.commit & ~usb_core.retry,
+                tail.eq(tail + packet_words),
+                in_dtb.eq(~in_dtb),
+            ),
+            If(usb_core.usb_reset | self.reset_toggles,
+                in_dtb.eq(0),
+            ),
+        ]
+
+        # ---------------------
+        # Wishbone side
+        # ---------------------
+        self.submodules.master = master = WishboneBurstMaster(self.wishbone, depth=64//4, flush=False)
+        sys_cmd = Record(cmd_layout)
+        self.comb += [
+            sys_cmd.raw_bits().eq(cmd_fifo.dout),
+            master.read_buffer.re.eq(master.read_buffer.readable & read_fifo.writable),
+            read_fifo.din.eq(master.read_buffer.dout),
+            read_fifo.we.eq(master.read_buffer.readable & read_fifo.writable),
+            master.write_buffer.din.eq(write_fifo.dout),
+            master.write_buffer.we.eq(write_fifo.readable & master.write_buffer.writable),
+            write_fifo.re.eq(write_fifo.readable & master.write_buffer.writable),
+        ]
+
+        sequencer = FSM(reset_state="IDLE")
+        self.submodules += sequencer
+        sequencer.act("IDLE",
+            If(cmd_fifo.readable,
+                NextValue(master.read, sys_cmd.read),
+                NextValue(master.length, sys_cmd.length),
+                NextValue(master.address, sys_cmd.address),
+                cmd_fifo.re.eq(1),
+                NextState("RUN"),
+            )
+        )
+        sequencer.act("RUN",
+            master.go.eq(1),
+            If(master.done,
+                NextState("IDLE"),
+            )
+        )
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import struct
+import unittest
+from unittest import TestCase
+
+from migen import *
+
+from litex.soc.interconnect import wishbone
+
+from ..io import FakeIoBuf
+from ..test.host import WireHost
+from ..utils.bridge import ControlTransfer
+
+from .dummyusb import DummyUsb
+from .usbwishbonebulkbridge import USBWishboneBulkBridge
+
+
+class BridgeTestBench(Module):
+    def __init__(self, bulk=True):
+        self.submodules.usb = DummyUsb(FakeIoBuf(), debug=True, burst=not bulk, bulk=bulk)
+        self.submodules.sram = wishbone.SRAM(1024,
+            init=[0x10203040 + i for i in range(256)],
+            bus=wishbone.Interface(bursting=True))
+        self.comb += self.usb.debug_bridge.wishbone.connect(self.sram.bus)
+
+        self.cycles = Signal(32)
+        self.sync.usb_48 += self.cycles.eq(self.cycles + 1)
+
+
+def command(op, address, length):
+    return list(struct.pack("<BBHI", op, 0, length, address))
+
+
+def words(data):
+    return list(struct.pack("<{}I".format(len(data)), *data))
+
+
+class TestUSBWishboneBulkBridge(TestCase):
+    def run_sim(self, dut, stim):
+        def padfront():
+            yield from dut.usb.iobuf.recv("J")
+            for _ in range(20):
+                yield
+            yield from stim()
+        run_simulation(dut, {"usb_48": padfront()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+
+    def test_read(self):
+        dut = BridgeTestBench()
+        host = WireHost(dut.usb.iobuf)
+        def stim():
+            yield from host.write_stream(1, command(USBWishboneBulkBridge.OP_READ, 0x10, 8))
+            data = yield from host.read_stream(1, 8)
+            self.assertEqual(data, words([0x10203044, 0x10203045]))
+        self.run_sim(dut, stim)
+
+    def test_write_read(self):
+        dut = BridgeTestBench()
+        host = WireHost(dut.usb.iobuf)
+        def stim():
+            # Several commands, one of them split across two packets
+            stream = (command(USBWishboneBulkBridge.OP_WRITE, 0x20, 12) + words([1, 2, 3]) +
+                command(0x7f, 0, 0) +
+                command(USBWishboneBulkBridge.OP_READ, 0x1c, 20) +
+                command(USBWishboneBulkBridge.OP_READ, 0x0, 4))
+            yield from host.out(1, stream[:30])
+            yield from host.out(1, stream[30:])
+            data = yield from host.read_stream(1, 24)
+            self.assertEqual(data, words([0x10203047, 1, 2, 3, 0x1020304b, 0x10203040]))
+        self.run_sim(dut, stim)
+
+    def test_long_read(self):
+        dut = BridgeTestBench()
+        host = WireHost(dut.usb.iobuf)
+        def stim():
+            yield from host.write_stream(1, command(USBWishboneBulkBridge.OP_READ, 0, 136))
+            sizes = []
+            data = []
+            while len(data) < 136:
+                packet = yield from host.in_(1)
+                if packet is not None:
+                    sizes.append(len(packet))
+                    data += packet
+            self.assertEqual(sizes, [64, 64, 8])
+            self.assertEqual(data, words([0x10203040 + i for i in range(34)]))
+        self.run_sim(dut, stim)
+
+    def test_repeated_out(self):
+        dut = BridgeTestBench()
+        host = WireHost(dut.usb.iobuf)
+        def stim():
+            read = command(USBWishboneBulkBridge.OP_READ, 0x10, 8)
+            yield from host.write_stream(1, read)
+            # Sent again with the same DATA PID, as if the ACK had been lost
+            host.toggle[1] = not host.toggle[1]
+            self.assertTrue((yield from host.out(1, read)))
+            data = yield from host.read_stream(1, 8)
+            self.assertEqual(data, words([0x10203044, 0x10203045]))
+            self.assertIsNone((yield from host.in_(1)))
+            # The next packet has the other toggle, and is taken
+            yield from host.write_stream(1, command(USBWishboneBulkBridge.OP_READ, 0x0, 4))
+            data = yield from host.read_stream(1, 4)
+            self.assertEqual(data, words([0x10203040]))
+        self.run_sim(dut, stim)
+
+    def test_in_naks_when_idle(self):
+        dut = BridgeTestBench()
+        host = WireHost(dut.usb.iobuf)
+        def stim():
+            self.assertIsNone((yield from host.in_(1)))
+        self.run_sim(dut, stim)
+
+
+class TestBridgeBenchmark(TestCase):
+    """Time reads over the bulk and the control transfer bridges.
+
+    The host here sends each packet as soon as the last one is done, so
+    this is the cost on the wire, before the host's scheduling of control
+    transfers is taken into account.
+    """
+    def measure(self, bulk, reads):
+        dut = BridgeTestBench(bulk=bulk)
+        host = WireHost(dut.usb.iobuf)
+        result = {}
+        def stim():
+            yield from dut.usb.iobuf.recv("J")
+            for _ in range(20):
+                yield
+            start = yield dut.cycles
+            data = []
+            if bulk:
+                stream = []
+                for address, length in reads:
+                    stream += command(USBWishboneBulkBridge.OP_READ, address, length)
+                yield from host.write_stream(1, stream)
+                data = yield from host.read_stream(1, sum(length for _, length in reads))
+            else:
+                for address, length in reads:
+                    data += yield from host.control(ControlTransfer(0xc3, 0,
+                        address & 0xffff, address >> 16, length))
+            result["cycles"] = (yield dut.cycles) - start
+            result["data"] = data
+        run_simulation(dut, {"usb_48": stim()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+        expected = []
+        for address, length in reads:
+            expected += words([0x10203040 + address // 4 + i for i in range(length // 4)])
+        self.assertEqual(result["data"], expected)
+        return result["cycles"]
+
+    def test_throughput(self):
+        reads = [(0, 64)]
+        control = self.measure(False, reads)
+        bulk = self.measure(True, reads)
+        print("64 byte read: control {} usb_48 cycles, bulk {}".format(control, bulk))
+        self.assertLess(bulk, control)
+
+    def test_latency(self):
+        reads = [(4 * i, 4) for i in range(4)]
+        control = self.measure(False, reads)
+        bulk = self.measure(True, reads)
+        print("4 word reads: control {} usb_48 cycles, bulk {}".format(control, bulk))
+        self.assertLess(bulk * 2, control)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,7 @@ from migen import *
 from migen.genlib.misc import chooser, WaitTimer
 from migen.genlib.record import Record
 from migen.genlib.fsm import FSM, NextState
-from migen.genlib.fifo import AsyncFIFOBuffered
+from migen.genlib.fifo import AsyncFIFOBuffered, SyncFIFOBuffered
 from migen.genlib.cdc import PulseSynchronizer, MultiReg, BusSynchronizer
 from litex.soc.interconnect import stream
 
@@ -14,6 +14,121 @@ from litex.soc.integration.doc import ModuleDoc, AutoDoc
 
 from ..pid import PID, PIDTypes
 
+
+class WishboneBurstMaster(Module):
+    """
+    The Wishbone side of a :obj:`USBWishboneBurstBridge`, in the ``sys`` domain.
+
+    While ``go`` is high, ``length`` bytes starting at ``address`` are read
+    into ``read_buffer`` if ``read`` is set, or written from
+    ``write_buffer`` if it isn't.  Words go over the bus in incrementing
+    bursts of up to `depth` beats.  A read burst only starts once
+    ``read_buffer`` is empty, and a write burst only covers the words
+    already in ``write_buffer``, so neither ever stalls the bus in the
+    middle.  A slave that doesn't do bursts sees a run of classic cycles.
+
+    Dropping ``go`` part way through stops at the end of the current burst.
+    ``done`` is set once the transfer is over, until ``go`` is dropped.
+    Anything left in ``read_buffer`` or ``write_buffer`` is thrown away
+    between transfers, unless `flush` is ``False``.
+    """
+    def __init__(self, bus, depth=16, flush=True):
+        self.go = Signal()
+        self.done = Signal()
+        self.read = Signal()
+        self.address = Signal(32)
+        self.length = Signal(16)
+
+        self.submodules.read_buffer = read_buffer = ResetInserter()(SyncFIFOBuffered(width=32, depth=depth))
+        self.submodules.write_buffer = write_buffer = ResetInserter()(SyncFIFOBuffered(width=32, depth=depth))
+
+        # Bytes done so far
+        self.burstcount = Signal(16)
+        adr = Signal(len(bus.adr))
+        beats = Signal(max=depth + 2)
+        words_left = Signal(15)
+        last = Signal()
+
+        self.comb += [
+            words_left.eq((self.length + 3 - self.burstcount) >> 2),
+            last.eq(beats == 1),
+            bus.adr.eq(adr),
+            bus.sel.eq(2 ** len(bus.sel) - 1),
+            bus.bte.eq(0b00),  # linear
+            bus.cti.eq(Mux(last, wishbone.CTI_BURST_END, wishbone.CTI_BURST_INCREMENTING)),
+            bus.dat_w.eq(write_buffer.dout),
+            read_buffer.din.eq(bus.dat_r),
+        ]
+
+        fsm = FSM(reset_state="IDLE")
+        self.submodules += fsm
+        fsm.act("IDLE",
+            NextValue(self.burstcount, 0),
+            NextValue(adr, self.address[2:]),
+            If(self.go & self.read,
+                NextState("READER")
+            ).Elif(self.go & ~self.read,
+                NextState("WRITER")
+            ),
+        )
+        if flush:
+            # clear both buffers in case of e.g. error condition or previous abort,
+            # all at once, as the next transfer may start on the very next cycle
+            fsm.act("IDLE",
+                read_buffer.reset.eq(1),
+                write_buffer.reset.eq(1),
+            )
+        fsm.act("READER",
+            If(~self.go | (self.burstcount >= self.length),
+                NextState("WAIT_DONE")
+            ).Elif(read_buffer.level == 0,
+                NextValue(beats, Mux(words_left < depth, words_left, depth)),
+                NextState("READER_BURST")
+            )
+        )
+        fsm.act("READER_BURST",
+            bus.cyc.eq(1),
+            bus.stb.eq(1),
+            If(bus.ack | bus.err,
+                read_buffer.we.eq(1),
+                NextValue(adr, adr + 1),
+                NextValue(self.burstcount, self.burstcount + 4),
+                NextValue(beats, beats - 1),
+                If(last,
+                    NextState("READER")
+                )
+            )
+        )
+        fsm.act("WRITER",
+            If(~self.go | (self.burstcount >= self.length),
+                NextState("WAIT_DONE")
+            ).Elif(write_buffer.level != 0,
+                NextValue(beats, Mux(words_left < write_buffer.level, words_left, write_buffer.level)),
+                NextState("WRITER_BURST")
+            )
+        )
+        fsm.act("WRITER_BURST",
+            bus.cyc.eq(1),
+            bus.stb.eq(1),
+            bus.we.eq(1),
+            If(bus.ack | bus.err,
+                write_buffer.re.eq(1),
+                NextValue(adr, adr + 1),
+                NextValue(self.burstcount, self.burstcount + 4),
+                NextValue(beats, beats - 1),
+                If(last,
+                    NextState("WRITER")
+                )
+            )
+        )
+        fsm.act("WAIT_DONE",
+            self.done.eq(1),
+            If(~self.go,
+                NextState("IDLE")
+            )
+        )
+
+
 class USBWishboneBurstBridge(Module, AutoDoc):
 
     def __init__(self, usb_core, magic_packet=0x43):
@@ -150,9 +265,6 @@ class USBWishboneBurstBridge(Module, AutoDoc):
             # clk12 domain
             self.write_fifo.din.eq(data),      # data coming from USB interface
             self.rd_data.eq(self.read_fifo.dout),  # data going to USB interface
-            # sys domain
-            self.read_fifo.din.eq(self.wishbone.dat_r),
-            self.wishbone.dat_w.eq(self.write_fifo.dout),
         ]
 
         self.submodules.address_synchronizer = BusSynchronizer(32, "usb_12", "sys")
@@ -161,83 +273,22 @@ class USBWishboneBurstBridge(Module, AutoDoc):
         self.length_sys = Signal(16)
         self.comb += [self.length_synchronizer.i.eq(self.length), self.length_sys.eq(self.length_synchronizer.o)]
 
-        self.burstcount = Signal(16)
-        addr_to_wb = Signal(32)
-        self.sync += addr_to_wb.eq(self.address_synchronizer.o + self.burstcount) # must register this to meet timing
-        self.comb += self.wishbone.adr.eq(addr_to_wb[2:])
-
-        self.comb += self.wishbone.cti.eq(0),  # classic cycle
-
-        wbmanager = FSM(reset_state="IDLE") # in sys domain
-        self.submodules += wbmanager
-        wbmanager.act("IDLE",
-            NextValue(self.burstcount, 0),
-            If(prefetch_go_sys & cmd_sys,  # 0xC3 (bit set) == read
-                NextState("READER")
-            ).Elif(prefetch_go_sys & ~cmd_sys,
-                NextState("WRITER")
-            ),
-            If(self.write_fifo.readable, # clear entries in write fifo in case of e.g. error condition or previous abort
-                self.write_fifo.re.eq(1),
-            )
-        )
-        wb_cyc = Signal()
-        self.comb += self.wishbone.cyc.eq(wb_cyc) # & ~(self.wishbone.ack | self.wishbone.err)) # not needed, but a reminder
-        wbmanager.act("READER",
-            If(self.burstcount < self.length_sys,
-                If(self.read_fifo.writable,
-                    NextValue(self.wishbone.stb, 1),
-                    NextValue(self.wishbone.we, 0),
-                    NextValue(wb_cyc, 1),
-                    NextState("READER_WAIT")
-                )
-            ).Else(
-                NextState("WAIT_DONE")
-            )
-        )
-        wbmanager.act("READER_WAIT",
-            If(self.wishbone.ack | self.wishbone.err,
-                NextValue(self.wishbone.stb, 0),
-                NextValue(wb_cyc, 0),
-                self.read_fifo.we.eq(1),
-                NextValue(self.burstcount, self.burstcount + 4),
-                NextState("READER_ADDR_WAIT"),
-            )
-        )
-        wbmanager.act("READER_ADDR_WAIT",
-                # one cycle dead state to allow the burst count address to propagate
-                NextState("READER")
-        )
-        wbmanager.act("WRITER",
-            If(self.burstcount < self.length_sys,
-                If(self.write_fifo.readable,
-                    NextValue(self.wishbone.stb, 1),
-                    NextValue(self.wishbone.we, 1),
-                    NextValue(wb_cyc, 1),
-                    NextState("WRITER_WAIT"),
-                )
-            ).Else(
-                NextState("WAIT_DONE")
-            )
-        )
-        wbmanager.act("WRITER_WAIT",
-            If(self.wishbone.ack | self.wishbone.err,
-                NextValue(self.wishbone.stb, 0),
-                NextValue(self.wishbone.we, 0),
-                NextValue(wb_cyc, 0),
-                self.write_fifo.re.eq(1),
-                NextValue(self.burstcount, self.burstcount + 4),
-                NextState("WRITER")
-            )
-        )
-        wbmanager.act("WAIT_DONE",
-            If(~prefetch_go_sys,
-                NextState("IDLE")
-            )
-        )
-        self.comb += self.wishbone.sel.eq(2 ** len(self.wishbone.sel) - 1)
-
-
+        self.submodules.master = master = WishboneBurstMaster(self.wishbone, depth=64//4)
+        self.comb += [
+            master.go.eq(prefetch_go_sys),
+            master.read.eq(cmd_sys),
+            master.address.eq(self.address_synchronizer.o),
+            master.length.eq(self.length_sys),
+
+            # Move words between the master and the clock domain crossing
+            # as soon as there is room for them.
+            self.read_fifo.din.eq(master.read_buffer.dout),
+            self.read_fifo.we.eq(master.read_buffer.readable & self.read_fifo.writable),
+            master.read_buffer.re.eq(master.read_buffer.readable & self.read_fifo.writable),
+            master.write_buffer.din.eq(self.write_fifo.dout),
+            master.write_buffer.we.eq(self.write_fifo.readable & master.write_buffer.writable),
+            self.write_fifo.re.eq(self.write_fifo.readable & master.write_buffer.writable),
+        ]
 
         not_first_byte=Signal()
         
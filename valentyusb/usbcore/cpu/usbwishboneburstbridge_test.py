@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest import TestCase
+
+from migen import *
+
+from litex.soc.interconnect import wishbone
+
+from .usbwishboneburstbridge import WishboneBurstMaster
+
+
+class MasterTestBench(Module):
+    def __init__(self, bursting=True):
+        self.bus = wishbone.Interface()
+        self.submodules.master = WishboneBurstMaster(self.bus, depth=16)
+        self.submodules.sram = wishbone.SRAM(256,
+            init=[0x1000 + i for i in range(64)],
+            bus=wishbone.Interface(bursting=bursting))
+        self.comb += self.bus.connect(self.sram.bus)
+
+        # Cycles with the bus held, and beats
+        self.cycles = Signal(16)
+        self.acks = Signal(16)
+        self.sync += [
+            If(self.bus.cyc, self.cycles.eq(self.cycles + 1)),
+            If(self.bus.cyc & self.bus.ack, self.acks.eq(self.acks + 1)),
+        ]
+
+
+class TestWishboneBurstMaster(TestCase):
+    def start(self, dut, read, address, length):
+        yield dut.master.read.eq(read)
+        yield dut.master.address.eq(address)
+        yield dut.master.length.eq(length)
+        yield dut.master.go.eq(1)
+        yield
+
+    def drain(self, dut, count):
+        data = []
+        for _ in range(200):
+            if len(data) == count:
+                break
+            if (yield dut.master.read_buffer.readable):
+                data.append((yield dut.master.read_buffer.dout))
+                yield dut.master.read_buffer.re.eq(1)
+                yield
+                yield dut.master.read_buffer.re.eq(0)
+            yield
+        return data
+
+    def read(self, bursting):
+        dut = MasterTestBench(bursting)
+        def stim():
+            yield from self.start(dut, 1, 8, 80)
+            for _ in range(40):
+                yield
+            # A whole packet is fetched ahead of anybody asking for it
+            self.assertEqual((yield dut.master.read_buffer.level), 16)
+            self.assertEqual((yield dut.acks), 16)
+            self.result = yield dut.cycles
+            # The next burst waits until that has been taken
+            self.assertEqual((yield from self.drain(dut, 16)), [0x1002 + i for i in range(16)])
+            self.assertEqual((yield from self.drain(dut, 4)), [0x1012 + i for i in range(4)])
+        run_simulation(dut, stim())
+        return self.result
+
+    def test_read_burst(self):
+        # One beat a cycle, after the first
+        self.assertLessEqual(self.read(bursting=True), 17)
+
+    def test_read_classic(self):
+        self.assertLessEqual(self.read(bursting=False), 32)
+
+    def test_read_odd_length(self):
+        dut = MasterTestBench()
+        def stim():
+            yield from self.start(dut, 1, 0, 6)
+            self.assertEqual((yield from self.drain(dut, 2)), [0x1000, 0x1001])
+            for _ in range(10):
+                yield
+            self.assertEqual((yield dut.acks), 2)
+        run_simulation(dut, stim())
+
+    def test_write(self):
+        dut = MasterTestBench()
+        def stim():
+            yield from self.start(dut, 0, 16, 24)
+            for i in range(6):
+                yield dut.master.write_buffer.din.eq(0xa0 + i)
+                yield dut.master.write_buffer.we.eq(1)
+                yield
+                yield dut.master.write_buffer.we.eq(0)
+                if i == 2:
+                    # Let the first burst go before the rest turns up
+                    for _ in range(10):
+                        yield
+            for _ in range(10):
+                yield
+            self.assertEqual((yield dut.acks), 6)
+            self.assertFalse((yield dut.master.write_buffer.readable))
+            data = []
+            for i in range(3, 11):
+                data.append((yield dut.sram.mem[i]))
+            self.assertEqual(data, [0x1003, 0xa0, 0xa1, 0xa2, 0xa3, 0xa4, 0xa5, 0x100a])
+        run_simulation(dut, stim())
+
+    def test_stop(self):
+        dut = MasterTestBench()
+        def stim():
+            yield from self.start(dut, 1, 0, 256)
+            for _ in range(30):
+                yield
+            yield dut.master.go.eq(0)
+            for _ in range(30):
+                yield
+            self.assertEqual((yield dut.acks), 16)
+            self.assertFalse((yield dut.bus.cyc))
+            # And it starts again from the top, with nothing left over from
+            # the read that was stopped
+            yield from self.start(dut, 1, 0, 4)
+            self.assertEqual((yield from self.drain(dut, 1)), [0x1000])
+            for _ in range(10):
+                yield
+            self.assertFalse((yield dut.master.read_buffer.readable))
+        run_simulation(dut, stim())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-import unittest
-
 from migen import *
 from migen.genlib.cdc import MultiReg
 
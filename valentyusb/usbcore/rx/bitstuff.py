@@ -3,9 +3,6 @@
 from migen import *
 from migen.fhdl.decorators import ResetInserter
 
-from ..test.common import BaseUsbTestCase
-import unittest
-
 
 @ResetInserter()
 class RxBitstuffRemover(Module):
@@ -3,9 +3,6 @@
 from migen import *
 from migen.genlib import cdc
 
-from ..test.common import BaseUsbTestCase
-import unittest
-
 
 class RxClockDataRecovery(Module):
     """RX Clock Data Recovery module.
@@ -5,9 +5,6 @@ from migen.genlib import cdc
 
 from migen.fhdl.decorators import ResetInserter
 
-from ..test.common import BaseUsbTestCase
-import unittest
-
 
 @ResetInserter()
 class RxPacketDetect(Module):
@@ -1,9 +1,6 @@
 #!/usr/bin/env python3
 
 from migen import *
-from ..test.common import BaseUsbTestCase
-
-import unittest
 
 
 class RxNRZIDecoder(Module):
@@ -3,15 +3,12 @@
 from migen import *
 from migen.genlib import cdc
 
-import unittest
-
 from .bitstuff import RxBitstuffRemover
 from .clock import RxClockDataRecovery
 from .detect import RxPacketDetect
 from .nrzi import RxNRZIDecoder
 from .shifter import RxShifter
 from ..utils.packet import b, nrzi
-from ..test.common import BaseUsbTestCase
 
 
 class RxPipeline(Module):
@@ -2,9 +2,7 @@
 
 from migen import *
 from migen.fhdl.decorators import ResetInserter
-from ..test.common import BaseUsbTestCase
 
-import unittest
 
 @ResetInserter()
 class RxShifter(Module):
@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-import unittest
-
 from migen import *
 
 from litex.soc.cores.gpio import GPIOOut
@@ -10,7 +8,6 @@ from ..pid import PIDTypes
 from ..rx.pipeline import RxPipeline
 from ..tx.pipeline import TxPipeline
 from ..utils.packet import *
-from ..test.common import BaseUsbTestCase
 
 
 class PacketHeaderDecode(Module):
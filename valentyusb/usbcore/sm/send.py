@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-import unittest
-
 from migen import *
 from migen.genlib import cdc
 
@@ -10,10 +8,7 @@ from litex.soc.cores.gpio import GPIOOut
 from ..pid import PIDTypes
 from ..tx.pipeline import TxPipeline
 from ..tx.crc import TxParallelCrcGenerator
-from ..utils.asserts import assertMultiLineEqualSideBySide
 from ..utils.packet import *
-from ..utils.pprint import pp_packet
-from ..test.common import BaseUsbTestCase
 
 
 class TxPacketSend(Module):
@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-import unittest
-
 from migen import *
 from migen.genlib.cdc import MultiReg
 
@@ -52,6 +50,7 @@ class UsbTransfer(Module):
         # ----------------------
         self.data_recv_put = Signal()
         self.data_recv_payload = Signal(8)
+        self.data_recv_pid = Signal(4)  # DATA0 or DATA1, for the last data packet
 
         self.data_send_get = Signal()
         self.data_send_have = Signal()
@@ -66,6 +65,7 @@ class UsbTransfer(Module):
         self.dtb  = Signal()
         self.arm  = Signal()
         self.sta  = Signal()
+        self.iso  = Signal()        # The endpoint is isochronous: there is no handshake
         self.addr = Signal(7)       # If the address doesn't match, we won't respond
 
         # ----------------------
@@ -93,6 +93,8 @@ class UsbTransfer(Module):
         self.end    = Signal()      # Asserted when transfer ends
         self.data_end=Signal()      # Asserted when a DATAx transfer finishes
         self.error  = Signal()      # Asserted when in the ERROR state
+        self.sof    = Signal()      # Asserted when a SOF packet is received
+        self.frame  = Signal(11)    # The frame number of the last SOF packet
         self.comb += [
             self.end.eq(self.commit | self.abort),
         ]
@@ -130,6 +132,12 @@ class UsbTransfer(Module):
         # <Data0[]
         # >Ack
         # ---------------------------
+        #
+        # Isochronous (no handshake)
+        # --------------------------
+        # >In         >Out
+        # <Data0[..]  >Data0[..]
+        # ---------------------------
         transfer = ResetInserter()(FSM(reset_state="WAIT_TOKEN"))
         self.submodules.transfer = transfer = ClockDomainsRenamer("usb_12")(transfer)
         self.comb += transfer.reset.eq(self.reset)
@@ -146,6 +154,12 @@ class UsbTransfer(Module):
 
         transfer.act("RECV_TOKEN",
             self.idle.eq(0),
+            # SOF packets go to every device, so don't check the address.
+            # The frame number is where the address and endpoint would be.
+            If(rxstate.o_decoded & (rxstate.o_pid == PID.SOF),
+                self.sof.eq(1),
+                NextValue(self.frame, Cat(rxstate.o_addr, rxstate.o_endp)),
+            ),
             If(rxstate.o_decoded,
                 # If the address doesn't match, go back and wait for
                 # a new token.
@@ -161,9 +175,12 @@ class UsbTransfer(Module):
         )
 
         response_pid = Signal(4)
+        iso = Signal()
         transfer.act("POLL_RESPONSE",
             self.poll.eq(1),
             If(self.rdy,
+                NextValue(iso, self.iso),
+
                 # Work out the response
                 If(self.tok == PID.SETUP,
                     NextValue(response_pid, PID.ACK),
@@ -188,7 +205,9 @@ class UsbTransfer(Module):
 
                 # In transfer
                 ).Elif(self.tok == PID.IN,
-                    If(~self.arm | self.sta,
+                    # An isochronous endpoint can't NAK, so it always
+                    # sends data, which is empty if there is none.
+                    If((~self.arm | self.sta) & ~self.iso,
                         NextState("SEND_HAND"),
                     ).Else(
                         NextState("SEND_DATA"),
@@ -203,6 +222,7 @@ class UsbTransfer(Module):
         transfer.act("WAIT_DATA",
             If(rxstate.o_decoded,
                 If((rxstate.o_pid & PIDTypes.TYPE_MASK) == PIDTypes.DATA,
+                    NextValue(self.data_recv_pid, rxstate.o_pid),
                     NextState("RECV_DATA"),
                 ).Elif(rxstate.o_pid == PID.SOF,
                     NextState("WAIT_DATA"),
@@ -220,7 +240,16 @@ class UsbTransfer(Module):
                 self.data_recv_put.eq(rx.o_data_strobe),
             ),
             If(rx.o_pkt_end,
-                NextState("SEND_HAND"),
+                If(iso,
+                    If(response_pid == PID.ACK,
+                        self.commit.eq(1),
+                    ).Else(
+                        self.abort.eq(1),
+                    ),
+                    NextState("WAIT_TOKEN"),
+                ).Else(
+                    NextState("SEND_HAND"),
+                ),
             ),
         )
         self.comb += [
@@ -236,7 +265,14 @@ class UsbTransfer(Module):
             ),
             self.data_send_get.eq(txstate.o_data_ack),
             self.data_end.eq(txstate.o_pkt_end),
-            If(txstate.o_pkt_end, NextState("WAIT_HAND")),
+            If(txstate.o_pkt_end,
+                If(iso,
+                    self.commit.eq(1),
+                    NextState("WAIT_TOKEN"),
+                ).Else(
+                    NextState("WAIT_HAND"),
+                ),
+            ),
         )
         self.comb += [
             txstate.i_data_payload.eq(self.data_send_payload),
@@ -8,7 +8,7 @@ from litex.soc.cores.gpio import GPIOOut
 
 from ..endpoint import *
 from ..io import FakeIoBuf
-from ..pid import PIDTypes
+from ..pid import PID, PIDTypes
 from ..rx.pipeline import RxPipeline
 from ..tx.pipeline import TxPipeline
 from .header import PacketHeaderDecode
@@ -17,6 +17,7 @@ from .send import TxPacketSend
 from ..utils.packet import *
 from ..test.common import BaseUsbTestCase, CommonUsbTestCase
 from ..test.clock import CommonTestMultiClockDomain
+from ..test.host import WireHost
 
 from .transfer import UsbTransfer
 
@@ -312,6 +313,105 @@ class TestUsbTransfer(
         return self.endpoints[epaddr].dtb
 
 
+class IsoTransferBench(Module):
+    """A `UsbTransfer` that sends [1, 2, 3] for every IN, and counts its pulses."""
+    def __init__(self):
+        self.submodules.usb = usb = UsbTransfer(FakeIoBuf())
+        self.commits = Signal(8)
+        self.aborts = Signal(8)
+        self.sofs = Signal(8)
+        sent = Signal(8)
+        self.comb += [
+            usb.data_send_have.eq(sent != 3),
+            usb.data_send_payload.eq(sent + 1),
+        ]
+        self.sync.usb_12 += [
+            If(usb.poll,
+                sent.eq(0),
+            ).Elif(usb.data_send_get,
+                sent.eq(sent + 1),
+            ),
+            If(usb.commit, self.commits.eq(self.commits + 1)),
+            If(usb.abort, self.aborts.eq(self.aborts + 1)),
+            If(usb.sof, self.sofs.eq(self.sofs + 1)),
+        ]
+
+
+class TestUsbTransferIso(unittest.TestCase):
+    def setUp(self):
+        self.dut = IsoTransferBench()
+        self.host = WireHost(self.dut.usb.iobuf)
+
+    def run_sim(self, stim):
+        def padfront():
+            for _ in range(20):
+                yield
+            yield from stim()
+        run_simulation(self.dut, {"usb_48": padfront()},
+            clocks={"usb_48": 4, "usb_12": 16, "sys": 16})
+
+    def test_sof(self):
+        def stim():
+            yield from self.host.send(sof_packet(0x123))
+            yield from self.host.send(sof_packet(0x7ff))
+            for _ in range(40):
+                yield
+            self.assertEqual((yield self.dut.sofs), 2)
+            self.assertEqual((yield self.dut.usb.frame), 0x7ff)
+        self.run_sim(stim)
+
+    def test_in(self):
+        def stim():
+            yield self.dut.usb.arm.eq(1)
+            yield self.dut.usb.iso.eq(1)
+            yield from self.host.send(token_packet(PID.IN, 0, 1))
+            packet = yield from self.host.receive()
+            self.assertEqual(packet, [0xc3, 1, 2, 3] + crc16([1, 2, 3]))
+            # There is no handshake to wait for
+            for _ in range(40):
+                yield
+            self.assertEqual((yield self.dut.commits), 1)
+            self.assertTrue((yield self.dut.usb.idle))
+        self.run_sim(stim)
+
+    def test_in_not_armed(self):
+        def stim():
+            yield self.dut.usb.iso.eq(1)
+            yield from self.host.send(token_packet(PID.IN, 0, 1))
+            # An isochronous endpoint never NAKs
+            packet = yield from self.host.receive()
+            self.assertEqual(packet[0], 0xc3)
+        self.run_sim(stim)
+
+    def test_in_bulk_waits(self):
+        def stim():
+            yield self.dut.usb.arm.eq(1)
+            yield from self.host.send(token_packet(PID.IN, 0, 1))
+            self.assertIsNotNone((yield from self.host.receive()))
+            for _ in range(40):
+                yield
+            self.assertEqual((yield self.dut.commits), 0)
+            self.assertFalse((yield self.dut.usb.idle))
+        self.run_sim(stim)
+
+    def test_out(self):
+        def stim():
+            yield self.dut.usb.arm.eq(1)
+            yield self.dut.usb.iso.eq(1)
+            yield from self.host.send(token_packet(PID.OUT, 0, 1))
+            yield from self.host.send(data_packet(PID.DATA0, [9, 8]))
+            self.assertIsNone((yield from self.host.receive()))
+            self.assertEqual((yield self.dut.commits), 1)
+            self.assertTrue((yield self.dut.usb.idle))
+
+            # Without `arm` the data is dropped, still without a handshake
+            yield self.dut.usb.arm.eq(0)
+            yield from self.host.send(token_packet(PID.OUT, 0, 1))
+            yield from self.host.send(data_packet(PID.DATA0, [7]))
+            self.assertIsNone((yield from self.host.receive()))
+            self.assertEqual((yield self.dut.aborts), 1)
+        self.run_sim(stim)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -2,26 +2,16 @@
 
 import unittest
 import inspect
+import sys
 
-from itertools import zip_longest
 from litex.soc.interconnect.csr import CSRStorage
 import migen
 
 from ..endpoint import *
 from ..pid import *
-from ..utils.asserts import assertMultiLineEqualSideBySide
 from ..utils.packet import *
-from ..utils.pprint import pp_packet
-
-
-def grouper(n, iterable, pad=None):
-    """Group iterable into multiples of n (with optional padding).
-
-    >>> list(grouper(3, 'abcdefg', 'x'))
-    [('a', 'b', 'c'), ('d', 'e', 'f'), ('g', 'x', 'x')]
-
-    """
-    return zip_longest(*[iter(iterable)]*n, fillvalue=pad)
+from ..utils.pcap import PcapWriter
+from . import scenario
 
 
 class BaseUsbTestCase(unittest.TestCase):
@@ -52,6 +42,17 @@ class BaseUsbTestCase(unittest.TestCase):
         else:
             return ("vcd/%s.vcd" % basename)
 
+    def make_pcap_name(self, vcd_name=None):
+        """
+        Create a name for the packet capture matching the vcd file
+        """
+        if not vcd_name:
+            # make_vcd_name() would guess this module as the caller's
+            main = sys.modules["__main__"]
+            modulename = main.__spec__.name if main.__spec__ else None
+            vcd_name = self.make_vcd_name(modulename=modulename)
+        return vcd_name[:-len(".vcd")] + ".pcap"
+
 
 class CommonUsbTestCase:
     """Base set of USB compliance tests.
@@ -118,6 +119,8 @@ class CommonUsbTestCase:
     ######################################################################
 
     def assertMultiLineEqualSideBySide(self, data1, data2, msg):
+        # sdiff is large, only load it once a test compares packets
+        from ..utils.asserts import assertMultiLineEqualSideBySide
         return assertMultiLineEqualSideBySide(data1, data2, msg)
 
     def ep_print(self, epaddr, msg, *args):
@@ -126,6 +129,18 @@ class CommonUsbTestCase:
             EndpointType.epdir(epaddr).name,
             msg) % args)
 
+    def sim_time(self):
+        """Simulation time in seconds, counted in usb_48 cycles."""
+        return getattr(self, "cycle_count", {}).get("usb_48", 0) / 48e6
+
+    def capture_packet(self, value, timestamp):
+        """Add a J/K encoded packet to this test's pcap file."""
+        pcap = getattr(self, "_pcap", None)
+        if pcap is None:
+            pcap = self._pcap = PcapWriter(self.make_pcap_name())
+            self.addCleanup(pcap.close)
+        pcap.write_jk(value, timestamp)
+
     def patch_csrs(self):
         for csr in self.dut.get_csrs():
             if isinstance(csr, CSRStorage) and hasattr(csr, "dat_w"):
@@ -158,6 +173,7 @@ class CommonUsbTestCase:
         # Wait for 4 idle clock cycles before sending the packet..
         yield from self.idle(4)
 
+        self.capture_packet(packet, self.sim_time())
         yield self.packet_h2d.eq(1)
         for v in packet:
             yield from self.update_internal_signals()
@@ -221,6 +237,7 @@ class CommonUsbTestCase:
             print("WARNING: Response came in {} bit times (> {})".format(bit_times / 4.0, bit_time_acceptable))
 
         # Read in the transmission data
+        start = self.sim_time()
         result = ""
         for i in range(0, 512):
             yield from self.update_internal_signals()
@@ -232,6 +249,7 @@ class CommonUsbTestCase:
                 break
         self.assertFalse(tx, "Packet didn't finish, "+msg)
         yield self.packet_d2h.eq(0)
+        self.capture_packet(result, start)
 
         # FIXME: Get the tx_en back into the USB12 clock domain...
         # 4 * 12MHz == Number of 48MHz ticks
@@ -239,6 +257,7 @@ class CommonUsbTestCase:
             yield from self.tick_usb12()
 
         # Check the packet received matches
+        from ..utils.pprint import pp_packet
         expected = pp_packet(wrap_packet(packet))
         actual = pp_packet(result)
         self.assertMultiLineEqualSideBySide(expected, actual, msg)
@@ -283,6 +302,10 @@ class CommonUsbTestCase:
     # ->token  ->token
     # <-data   ->data
     # ->ack    <-ack
+    #
+    # The packets come from the `scenario` builders, so that these run the
+    # same transactions as the cocotb test benches; the checks around them
+    # look at state only the Migen simulator can see.
 
     # Host to Device
     # ->setup
@@ -292,14 +315,11 @@ class CommonUsbTestCase:
         epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
         epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
 
-        yield from self.send_token_packet(PID.SETUP, addr, epaddr_out)
-        yield from self.send_data_packet(PID.DATA0, data)
-        yield from self.expect_ack()
-        yield from self.expect_setup(epaddr_out, data)
-        yield from self.clear_pending(epaddr_out)
-
-        # Check nothing pending at the end
-        self.assertFalse((yield from self.pending(epaddr_out)))
+        yield from self.run_scenario(scenario.setup(addr, data) + [
+            scenario.ClearPending(epaddr_out),
+            # Check nothing pending at the end
+            scenario.ExpectPending(epaddr_out, False),
+        ])
 
         # Check the token is set correctly
         yield from self.expect_last_tok(epaddr_out, 0b11)
@@ -317,22 +337,17 @@ class CommonUsbTestCase:
     # <-ack
     # ....
     def transaction_data_out(self, addr, epaddr, data, chunk_size=8):
+        assert EndpointType.epdir(epaddr) == EndpointType.OUT
         yield from self.check_no_pending_and_respond_ack(epaddr)
 
+        epnum = EndpointType.epnum(epaddr)
         datax = PID.DATA0
-        for i, chunk in enumerate(grouper(chunk_size, data, pad=0)):
-            self.assertFalse((yield from self.pending(epaddr)))
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(datax, chunk)
-            yield from self.expect_ack()
-            yield from self.expect_data(epaddr, chunk)
-            yield from self.clear_pending(epaddr)
-
+        for chunk in scenario.packets(data, chunk_size):
+            yield from self.run_scenario(
+                [scenario.ExpectPending(epaddr, False)] +
+                scenario.data_out(addr, epnum, chunk, chunk_size, pid=datax))
             yield from self.expect_last_tok(epaddr, 0b00)
-            if datax == PID.DATA0:
-                datax = PID.DATA1
-            else:
-                datax = PID.DATA0
+            datax = scenario.toggle(datax)
 
         # Check nothing pending at the end
         self.assertFalse((yield from self.pending(epaddr)))
@@ -345,11 +360,7 @@ class CommonUsbTestCase:
         assert EndpointType.epdir(epaddr) == EndpointType.OUT
         yield from self.check_no_pending_and_respond_ack(epaddr)
 
-        yield from self.send_token_packet(PID.OUT, addr, epaddr)
-        yield from self.send_data_packet(PID.DATA1, [])
-        yield from self.expect_ack()
-        yield from self.expect_data(epaddr, [])
-        yield from self.clear_pending(epaddr)
+        yield from self.run_scenario(scenario.status_out(addr, EndpointType.epnum(epaddr)))
 
         # Check nothing pending at the end
         self.assertFalse((yield from self.pending(epaddr)))
@@ -365,23 +376,14 @@ class CommonUsbTestCase:
     def transaction_data_in(self, addr, epaddr, data, chunk_size=8, dtb=PID.DATA1):
         assert EndpointType.epdir(epaddr) == EndpointType.IN
 
+        epnum = EndpointType.epnum(epaddr)
         datax = dtb
-        for i, chunk in enumerate(grouper(chunk_size, data, pad=0)):
+        for chunk in scenario.packets(data, chunk_size):
             yield from self.check_no_pending_and_respond_ack(epaddr)
             yield from self.set_response(epaddr, EndpointResponse.NAK)
-            yield from self.set_data(epaddr, chunk)
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_data_packet(datax, chunk)
-            yield from self.send_ack()
-            yield from self.clear_pending(epaddr)
-
+            yield from self.run_scenario(scenario.data_in(addr, epnum, chunk, chunk_size, pid=datax))
             yield from self.expect_last_tok(epaddr, 0b10)
-            if datax == PID.DATA0:
-                datax = PID.DATA1
-            else:
-                datax = PID.DATA0
+            datax = scenario.toggle(datax)
 
         # Check nothing pending at the end
         self.assertFalse((yield from self.pending(epaddr)))
@@ -394,55 +396,73 @@ class CommonUsbTestCase:
         assert EndpointType.epdir(epaddr) == EndpointType.IN
         yield from self.check_no_pending_and_respond_ack(epaddr)
 
-        yield from self.set_data(epaddr, [])
-        yield from self.send_token_packet(PID.IN, addr, epaddr)
-        yield from self.expect_data_packet(PID.DATA1, [])
-        yield from self.send_ack()
-        yield from self.clear_pending(epaddr)
+        yield from self.run_scenario(scenario.status_in(addr, EndpointType.epnum(epaddr)))
 
         # Check nothing pending at the end
         self.assertFalse((yield from self.pending(epaddr)))
 
     # Full control transfer
     ########################
-    def control_transfer_in(self, addr, setup_data, descriptor_data):
+    def control_transfer_in(self, addr, setup_data, descriptor_data, max_packet_size=8):
         epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
         epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
 
         yield from self.check_no_pending(epaddr_in)
         yield from self.check_no_pending(epaddr_out)
 
-        # Setup stage
-        yield from self.transaction_setup(addr, setup_data)
+        yield from self.run_scenario(scenario.control_in(addr, setup_data, descriptor_data, max_packet_size))
 
         yield from self.check_no_pending(epaddr_in)
         yield from self.check_no_pending(epaddr_out)
 
-        # Data stage
-        yield from self.set_response(epaddr_in, EndpointResponse.ACK)
-        yield from self.transaction_data_in(addr, epaddr_in, descriptor_data)
+    def control_transfer_out(self, addr, setup_data, descriptor_data, max_packet_size=8):
+        epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
+        epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
 
         yield from self.check_no_pending(epaddr_in)
         yield from self.check_no_pending(epaddr_out)
 
-        # Status stage
-        yield from self.set_response(epaddr_out, EndpointResponse.ACK)
-        yield from self.transaction_status_out(addr, epaddr_out)
+        yield from self.run_scenario(scenario.control_out(addr, setup_data, descriptor_data, max_packet_size))
 
         yield from self.check_no_pending(epaddr_in)
         yield from self.check_no_pending(epaddr_out)
 
-    def control_transfer_out(self, addr, setup_data, descriptor_data):
-        epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
-        epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
-        # Setup stage
-        yield from self.transaction_setup(addr, setup_data)
-        # Data stage
-        yield from self.set_response(epaddr_out, EndpointResponse.ACK)
-        yield from self.transaction_data_out(addr, epaddr_out, descriptor_data)
-        # Status stage
-        yield from self.set_response(epaddr_in, EndpointResponse.ACK)
-        yield from self.transaction_status_in(addr, epaddr_in)
+    # Scenarios
+    ########################
+    def run_scenario(self, steps):
+        """Run a list of `scenario` steps on the Migen simulator."""
+        for step in steps:
+            if isinstance(step, scenario.Token):
+                epdir = EndpointType.IN if step.pid == PID.IN else EndpointType.OUT
+                yield from self.send_token_packet(step.pid, step.addr, EndpointType.epaddr(step.epnum, epdir))
+            elif isinstance(step, scenario.Data):
+                yield from self.send_data_packet(step.pid, step.data)
+            elif isinstance(step, scenario.Handshake):
+                if step.pid == PID.ACK:
+                    yield from self.send_ack()
+                else:
+                    yield from self.send_handshake(step.pid)
+            elif isinstance(step, scenario.ExpectData):
+                yield from self.expect_data_packet(step.pid, step.data)
+            elif isinstance(step, scenario.ExpectHandshake):
+                yield self.packet_d2h.eq(1)
+                yield from self.expect_packet(handshake_packet(step.pid), "Expected %s packet." % step.pid.name)
+                yield self.packet_d2h.eq(0)
+            elif isinstance(step, scenario.SetResponse):
+                yield from self.set_response(step.epaddr, step.response)
+            elif isinstance(step, scenario.LoadData):
+                yield from self.set_data(step.epaddr, step.data)
+            elif isinstance(step, scenario.ExpectSetup):
+                yield from self.expect_setup(step.epaddr, step.data)
+            elif isinstance(step, scenario.ExpectReceived):
+                yield from self.expect_data(step.epaddr, step.data)
+            elif isinstance(step, scenario.ClearPending):
+                yield from self.clear_pending(step.epaddr)
+            elif isinstance(step, scenario.ExpectPending):
+                self.assertEqual(bool((yield from self.pending(step.epaddr))), step.pending,
+                    "Expected ep %d pending to be %s" % (step.epaddr, step.pending))
+            else:
+                raise TypeError("Unknown scenario step: %r" % (step,))
 
     ######################################################################
     # Actual test cases are after here.
@@ -596,29 +616,24 @@ class CommonUsbTestCase:
             yield from self.set_response(epaddr_out, EndpointResponse.ACK)
             yield from self.tick_usb12()
 
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA0, d[:4])
-            yield from self.expect_ack()
-            yield from self.expect_data(epaddr_out, d[:4])
-
-            yield from self.set_response(epaddr_out, EndpointResponse.STALL)
-
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA0, d[4:])
-            yield from self.expect_stall()
-
-            yield from self.send_token_packet(PID.SETUP, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA1, d)
-            yield from self.expect_ack()
+            yield from self.run_scenario([
+                scenario.Token(PID.OUT, addr, 0),
+                scenario.Data(PID.DATA0, d[:4]),
+                scenario.ExpectHandshake(PID.ACK),
+                scenario.ExpectReceived(epaddr_out, d[:4]),
+                scenario.SetResponse(epaddr_out, EndpointResponse.STALL),
+            ] + scenario.refused_out(addr, 0, d[4:], handshake=PID.STALL) + [
+                scenario.Token(PID.SETUP, addr, 0),
+                scenario.Data(PID.DATA1, d),
+                scenario.ExpectHandshake(PID.ACK),
+            ])
 
             # Now that we've transferred the data, the next response ought to be NAK
             respond = yield from self.response(epaddr_out)
             self.assertEqual(EndpointResponse.NAK, respond)
             yield from self.tick_usb12()
 
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA0, d[:4])
-            yield from self.expect_nak()
+            yield from self.run_scenario(scenario.refused_out(addr, 0, d[:4]))
 
         self.run_sim(stim)
 
@@ -630,8 +645,8 @@ class CommonUsbTestCase:
 
             yield from self.control_transfer_in(
                 20,
-                # Get descriptor, Index 0, Type 03, LangId 0000, wLength 10?
-                [0x80, 0x06, 0x00, 0x06, 0x00, 0x00, 0x0A, 0x00],
+                # Get descriptor, Index 0, Type 03, LangId 0000, wLength 12
+                [0x80, 0x06, 0x00, 0x03, 0x00, 0x00, 0x0C, 0x00],
                 # 12 byte descriptor, max packet size 8 bytes
                 [0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07,
                  0x08, 0x09, 0x0A, 0x0B],
@@ -654,16 +669,10 @@ class CommonUsbTestCase:
 
             # Data stage
             # -----------
-            yield from self.set_response(epaddr_in, EndpointResponse.NAK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr_in)
-            yield from self.expect_nak()
-
-            yield from self.set_data(epaddr_in, in_data)
-            yield from self.set_response(epaddr_in, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr_in)
-            yield from self.expect_data_packet(PID.DATA1, in_data)
-            yield from self.send_ack()
-            yield from self.clear_pending(epaddr_in)
+            yield from self.run_scenario(
+                [scenario.SetResponse(epaddr_in, EndpointResponse.NAK)] +
+                scenario.refused_in(addr, 0) +
+                scenario.data_in(addr, 0, in_data))
 
         self.run_sim(stim)
 
@@ -689,19 +698,11 @@ class CommonUsbTestCase:
 
             # Status stage
             # ----------
-            yield from self.set_response(epaddr_in, EndpointResponse.NAK)
-
-            yield from self.send_token_packet(PID.IN, addr, epaddr_in)
-            yield from self.expect_nak()
-
-            yield from self.send_token_packet(PID.IN, addr, epaddr_in)
-            yield from self.expect_nak()
-
-            yield from self.set_response(epaddr_in, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr_in)
-            yield from self.expect_data_packet(PID.DATA1, [])
-            yield from self.send_ack()
-            yield from self.clear_pending(epaddr_in)
+            yield from self.run_scenario(
+                [scenario.SetResponse(epaddr_in, EndpointResponse.NAK)] +
+                scenario.refused_in(addr, 0) +
+                scenario.refused_in(addr, 0) +
+                scenario.status_in(addr))
 
         self.run_sim(stim)
 
@@ -713,11 +714,9 @@ class CommonUsbTestCase:
 
             yield from self.control_transfer_out(
                 20,
-                # Get descriptor, Index 0, Type 03, LangId 0000, wLength 10?
-                [0x80, 0x06, 0x00, 0x06, 0x00, 0x00, 0x0A, 0x00],
-                # 12 byte descriptor, max packet size 8 bytes
-                [0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07,
-                 0x08, 0x09, 0x0A, 0x0B],
+                # Set descriptor, wLength 10
+                [0x00, 0x07, 0x00, 0x03, 0x00, 0x00, 0x0A, 0x00],
+                [0x30, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39],
             )
         self.run_sim(stim)
 
@@ -764,25 +763,11 @@ class CommonUsbTestCase:
 
             # Data stage
             # ----------
-            yield from self.set_response(epaddr_out, EndpointResponse.NAK)
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA1, out_data)
-            yield from self.expect_nak()
-
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA1, out_data)
-            yield from self.expect_nak()
-
-            #for i in range(200):
-            #    yield
-
-            yield from self.set_response(epaddr_out, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA1, out_data)
-            yield from self.expect_ack()
-            yield from self.expect_data(epaddr_out, out_data)
-            yield from self.clear_pending(epaddr_out)
-
+            yield from self.run_scenario(
+                [scenario.SetResponse(epaddr_out, EndpointResponse.NAK)] +
+                scenario.refused_out(addr, 0, out_data, PID.DATA1) +
+                scenario.refused_out(addr, 0, out_data, PID.DATA1) +
+                scenario.data_out(addr, 0, out_data, max_packet_size=64, pid=PID.DATA1))
 
         self.run_sim(stim)
 
@@ -812,21 +797,11 @@ class CommonUsbTestCase:
 
             # Status stage
             # ----------
-            yield from self.set_response(epaddr_out, EndpointResponse.NAK)
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA1, [])
-            yield from self.expect_nak()
-
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA1, [])
-            yield from self.expect_nak()
-
-            yield from self.set_response(epaddr_out, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA1, [])
-            yield from self.expect_ack()
-            yield from self.expect_data(epaddr_out, [])
-            yield from self.clear_pending(epaddr_out)
+            yield from self.run_scenario(
+                [scenario.SetResponse(epaddr_out, EndpointResponse.NAK)] +
+                scenario.refused_out(addr, 0, [], PID.DATA1) +
+                scenario.refused_out(addr, 0, [], PID.DATA1) +
+                scenario.status_out(addr))
 
         self.run_sim(stim)
 
@@ -841,19 +816,22 @@ class CommonUsbTestCase:
             yield from self.set_response(epaddr, EndpointResponse.NAK)
             yield from self.tick_usb12()
 
-            yield from self.set_data(epaddr, d[:4])
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_data_packet(PID.DATA1, d[:4])
-            yield from self.send_ack()
+            yield from self.run_scenario([
+                scenario.LoadData(epaddr, d[:4]),
+                scenario.SetResponse(epaddr, EndpointResponse.ACK),
+                scenario.Token(PID.IN, addr, 1),
+                scenario.ExpectData(PID.DATA1, d[:4]),
+                scenario.Handshake(PID.ACK),
 
-            self.assertTrue((yield from self.pending(epaddr)))
-            yield from self.set_data(epaddr, d[4:])
-            yield from self.clear_pending(epaddr)
+                # Queue the next packet before clearing pending
+                scenario.ExpectPending(epaddr, True),
+                scenario.LoadData(epaddr, d[4:]),
+                scenario.ClearPending(epaddr),
 
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_data_packet(PID.DATA0, d[4:])
-            yield from self.send_ack()
+                scenario.Token(PID.IN, addr, 1),
+                scenario.ExpectData(PID.DATA0, d[4:]),
+                scenario.Handshake(PID.ACK),
+            ])
 
         self.run_sim(stim)
 
@@ -869,11 +847,7 @@ class CommonUsbTestCase:
             yield from self.set_response(epaddr, EndpointResponse.NAK)
             yield from self.tick_usb12()
 
-            yield from self.set_data(epaddr, d)
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_data_packet(PID.DATA1, d)
-            yield from self.send_ack()
+            yield from self.run_scenario(scenario.data_in(addr, 1, d))
         self.run_sim(stim)
 
     def test_debug_in(self):
@@ -891,23 +865,24 @@ class CommonUsbTestCase:
             yield from self.clear_pending(EndpointType.epaddr(0, EndpointType.IN))
             yield from self.tick_usb12()
 
-            epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
-            epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
-
-            # Setup stage
-            yield from self.send_token_packet(PID.SETUP, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA0, setup_data)
-            yield from self.expect_ack()
-
-            # Data stage
-            yield from self.send_token_packet(PID.IN, addr, epaddr_in)
-            yield from self.expect_data_packet(PID.DATA1, [0x37, 0x75, 0x00, 0xe0])
-            yield from self.send_ack()
-
-            # Status stage
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_in)
-            yield from self.send_data_packet(PID.DATA1, [])
-            yield from self.expect_ack()
+            # The bridge answers these itself, so there is nothing for the
+            # firmware to do.
+            yield from self.run_scenario([
+                # Setup stage
+                scenario.Token(PID.SETUP, addr, 0),
+                scenario.Data(PID.DATA0, setup_data),
+                scenario.ExpectHandshake(PID.ACK),
+
+                # Data stage
+                scenario.Token(PID.IN, addr, 0),
+                scenario.ExpectData(PID.DATA1, [0x37, 0x75, 0x00, 0xe0]),
+                scenario.Handshake(PID.ACK),
+
+                # Status stage
+                scenario.Token(PID.OUT, addr, 0),
+                scenario.Data(PID.DATA1, []),
+                scenario.ExpectHandshake(PID.ACK),
+            ])
 
         self.run_sim(stim)
 
@@ -922,27 +897,26 @@ class CommonUsbTestCase:
             yield from self.clear_pending(EndpointType.epaddr(0, EndpointType.IN))
             yield from self.tick_usb12()
 
-            epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
-            epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
+            yield from self.run_scenario([
+                # Setup stage
+                scenario.Token(PID.SETUP, addr, 0),
+                scenario.Data(PID.DATA0, setup_data),
+                scenario.ExpectHandshake(PID.ACK),
 
-            # Setup stage
-            yield from self.send_token_packet(PID.SETUP, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA0, setup_data)
-            yield from self.expect_ack()
-
-            # Data stage (missing ACK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr_in)
-            yield from self.expect_data_packet(PID.DATA1, [0, 0, 0, 0])
+                # Data stage (missing ACK)
+                scenario.Token(PID.IN, addr, 0),
+                scenario.ExpectData(PID.DATA1, [0, 0, 0, 0]),
 
-            # Data stage
-            yield from self.send_token_packet(PID.IN, addr, epaddr_in)
-            yield from self.expect_data_packet(PID.DATA1, [0, 0, 0, 0])
-            yield from self.send_ack()
+                # Data stage
+                scenario.Token(PID.IN, addr, 0),
+                scenario.ExpectData(PID.DATA1, [0, 0, 0, 0]),
+                scenario.Handshake(PID.ACK),
 
-            # Status stage
-            yield from self.send_token_packet(PID.OUT, addr, epaddr_out)
-            yield from self.send_data_packet(PID.DATA1, [])
-            yield from self.expect_ack()
+                # Status stage
+                scenario.Token(PID.OUT, addr, 0),
+                scenario.Data(PID.DATA1, []),
+                scenario.ExpectHandshake(PID.ACK),
+            ])
 
         self.run_sim(stim)
 
@@ -962,25 +936,26 @@ class CommonUsbTestCase:
             yield from self.clear_pending(ep1in_addr)
             yield from self.tick_usb12()
 
-            # Setup stage
-            yield from self.send_token_packet(PID.SETUP, addr, ep0out_addr)
-            yield from self.send_data_packet(PID.DATA0, setup_data)
-            yield from self.expect_ack()
-
-            # Data stage
-            yield from self.send_token_packet(PID.OUT, addr, ep0out_addr)
-            yield from self.send_data_packet(PID.DATA1, [0, 0, 0, 0])
-            yield from self.expect_ack()
-
-            # Status stage (wrong endopint)
-            yield from self.send_token_packet(PID.IN, addr, ep1in_addr)
-            yield from self.expect_nak()
-            yield from self.send_nak()
-
-            # Status stage
-            yield from self.send_token_packet(PID.IN, addr, ep0in_addr)
-            yield from self.expect_data_packet(PID.DATA1, [])
-            yield from self.send_ack()
+            yield from self.run_scenario([
+                # Setup stage
+                scenario.Token(PID.SETUP, addr, 0),
+                scenario.Data(PID.DATA0, setup_data),
+                scenario.ExpectHandshake(PID.ACK),
+
+                # Data stage
+                scenario.Token(PID.OUT, addr, 0),
+                scenario.Data(PID.DATA1, [0, 0, 0, 0]),
+                scenario.ExpectHandshake(PID.ACK),
+            ] +
+                # Status stage (wrong endopint)
+                scenario.refused_in(addr, 1) + [
+                scenario.Handshake(PID.NAK),
+
+                # Status stage
+                scenario.Token(PID.IN, addr, 0),
+                scenario.ExpectData(PID.DATA1, []),
+                scenario.Handshake(PID.ACK),
+            ])
 
         self.run_sim(stim)
 
@@ -992,13 +967,7 @@ class CommonUsbTestCase:
             yield from self.clear_pending(ep1)
             yield from self.set_response(ep1, EndpointResponse.NAK)
 
-            d1 = [0x1]
-            yield from self.set_data(ep1, d1)
-            yield from self.set_response(ep1, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, ep1)
-            yield from self.expect_data_packet(PID.DATA1, d1)
-            yield from self.send_ack()
-            yield from self.clear_pending(ep1)
+            yield from self.run_scenario(scenario.data_in(addr, 1, [0x1]))
 
         self.run_sim(stim)
 
@@ -1010,13 +979,7 @@ class CommonUsbTestCase:
             yield from self.clear_pending(ep1)
             yield from self.set_response(ep1, EndpointResponse.NAK)
 
-            d1 = [0x2]
-            yield from self.set_data(ep1, d1)
-            yield from self.set_response(ep1, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, ep1)
-            yield from self.expect_data_packet(PID.DATA1, d1)
-            yield from self.send_ack()
-            yield from self.clear_pending(ep1)
+            yield from self.run_scenario(scenario.data_in(addr, 1, [0x2]))
 
         self.run_sim(stim)
 
@@ -1028,13 +991,7 @@ class CommonUsbTestCase:
             yield from self.clear_pending(ep1)
             yield from self.set_response(ep1, EndpointResponse.NAK)
 
-            d1 = [0xa]
-            yield from self.set_data(ep1, d1)
-            yield from self.set_response(ep1, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, ep1)
-            yield from self.expect_data_packet(PID.DATA1, d1)
-            yield from self.send_ack()
-            yield from self.clear_pending(ep1)
+            yield from self.run_scenario(scenario.data_in(addr, 1, [0xa]))
 
         self.run_sim(stim)
 
@@ -1123,37 +1080,11 @@ class CommonUsbTestCase:
             yield from self.set_response(ep2, EndpointResponse.NAK)
             yield from self.tick_usb12()
 
-            d1 = [0x1]
-            yield from self.set_data(ep1, d1)
-            yield from self.set_response(ep1, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, ep1)
-            yield from self.expect_data_packet(PID.DATA1, d1)
-            yield from self.send_ack()
-            yield from self.clear_pending(ep1)
-
-            d2 = [0x2]
-            yield from self.set_data(ep2, d2)
-            yield from self.set_response(ep2, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, ep2)
-            yield from self.expect_data_packet(PID.DATA1, d2)
-            yield from self.send_ack()
-            yield from self.clear_pending(ep2)
-
-            d3 = [0x3]
-            yield from self.set_data(ep2, d3)
-            yield from self.set_response(ep2, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, ep2)
-            yield from self.expect_data_packet(PID.DATA0, d3)
-            yield from self.send_ack()
-            yield from self.clear_pending(ep2)
-
-            d4 = [0x5]
-            yield from self.set_data(ep1, d4)
-            yield from self.set_response(ep1, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, ep1)
-            yield from self.expect_data_packet(PID.DATA0, d4)
-            yield from self.send_ack()
-            yield from self.clear_pending(ep1)
+            yield from self.run_scenario(
+                scenario.data_in(addr, 1, [0x1]) +
+                scenario.data_in(addr, 2, [0x2]) +
+                scenario.data_in(addr, 2, [0x3], pid=PID.DATA0) +
+                scenario.data_in(addr, 1, [0x5], pid=PID.DATA0))
 
         self.run_sim(stim)
 
@@ -1166,35 +1097,24 @@ class CommonUsbTestCase:
             yield from self.set_response(epaddr, EndpointResponse.NAK)
             yield from self.tick_usb12()
 
-            # Device NAK the PID.IN token packet
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_nak()
-
-            # Device NAK the PID.IN token packet a second time
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_nak()
-
             d1 = [0x1, 0x2, 0x3, 0x4]
-            yield from self.set_data(epaddr, d1)
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_data_packet(PID.DATA1, d1)
-            yield from self.send_ack()
-            yield from self.clear_pending(epaddr)
-
-            # Have data but was asked to NAK
             d2 = [0x5, 0x6, 0x7, 0x8]
-            yield from self.set_response(epaddr, EndpointResponse.NAK)
-            yield from self.set_data(epaddr, d2)
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_nak()
-
-            # Actually send the data now
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_data_packet(PID.DATA0, d2)
-            yield from self.send_ack()
-            yield from self.clear_pending(epaddr)
+            yield from self.run_scenario(
+                # Device NAK the PID.IN token packet, twice
+                scenario.refused_in(addr, 1) +
+                scenario.refused_in(addr, 1) +
+                scenario.data_in(addr, 1, d1) + [
+                # Have data but was asked to NAK
+                scenario.SetResponse(epaddr, EndpointResponse.NAK),
+                scenario.LoadData(epaddr, d2),
+            ] + scenario.refused_in(addr, 1) + [
+                # Actually send the data now
+                scenario.SetResponse(epaddr, EndpointResponse.ACK),
+                scenario.Token(PID.IN, addr, 1),
+                scenario.ExpectData(PID.DATA0, d2),
+                scenario.Handshake(PID.ACK),
+                scenario.ClearPending(epaddr),
+            ])
 
         self.run_sim(stim)
 
@@ -1205,35 +1125,32 @@ class CommonUsbTestCase:
 
             d = [0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0x8]
 
-            # While pending, set stall
-            self.assertTrue((yield from self.pending(epaddr)))
-            yield from self.set_response(epaddr, EndpointResponse.STALL)
-            yield from self.set_data(epaddr, d[:4])
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_stall()
-
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_nak()
-            yield from self.clear_pending(epaddr)
-
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_data_packet(PID.DATA1, d[:4])
-            yield from self.send_ack()
-            yield from self.set_data(epaddr, d[4:])
-            yield from self.clear_pending(epaddr)
-
-            # While not pending, set stall
-            self.assertFalse((yield from self.pending(epaddr)))
-            yield from self.set_response(epaddr, EndpointResponse.STALL)
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_stall()
-
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.IN, addr, epaddr)
-            yield from self.expect_data_packet(PID.DATA0, d[4:])
-            yield from self.send_ack()
-            yield from self.clear_pending(epaddr)
+            yield from self.run_scenario([
+                # While pending, set stall
+                scenario.ExpectPending(epaddr, True),
+                scenario.SetResponse(epaddr, EndpointResponse.STALL),
+                scenario.LoadData(epaddr, d[:4]),
+            ] + scenario.refused_in(addr, 1, PID.STALL) + [
+                scenario.SetResponse(epaddr, EndpointResponse.ACK),
+            ] + scenario.refused_in(addr, 1) + [
+                scenario.ClearPending(epaddr),
+
+                scenario.Token(PID.IN, addr, 1),
+                scenario.ExpectData(PID.DATA1, d[:4]),
+                scenario.Handshake(PID.ACK),
+                scenario.LoadData(epaddr, d[4:]),
+                scenario.ClearPending(epaddr),
+
+                # While not pending, set stall
+                scenario.ExpectPending(epaddr, False),
+                scenario.SetResponse(epaddr, EndpointResponse.STALL),
+            ] + scenario.refused_in(addr, 1, PID.STALL) + [
+                scenario.SetResponse(epaddr, EndpointResponse.ACK),
+                scenario.Token(PID.IN, addr, 1),
+                scenario.ExpectData(PID.DATA0, d[4:]),
+                scenario.Handshake(PID.ACK),
+                scenario.ClearPending(epaddr),
+            ])
 
         self.run_sim(stim)
 
@@ -1243,36 +1160,29 @@ class CommonUsbTestCase:
             epaddr = EndpointType.epaddr(2, EndpointType.OUT)
 
             d = [0x41, 0x01]
+            d2 = [0x41, 0x02]
 
             yield from self.clear_pending(epaddr)
             yield from self.set_response(epaddr, EndpointResponse.ACK)
             yield from self.tick_usb12()
 
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d)
-            yield from self.expect_ack()
-            yield from self.expect_data(epaddr, d)
-
-            # Should nak until pending is cleared
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d)
-            yield from self.expect_nak()
-
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d)
-            yield from self.expect_nak()
-
-            # Make sure no extra data turned up
-            #yield from self.expect_data(epaddr, [])
-
-            yield from self.clear_pending(epaddr)
-
-            d2 = [0x41, 0x02]
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d2)
-            yield from self.expect_ack()
-            yield from self.expect_data(epaddr, d2)
-            yield from self.clear_pending(epaddr)
+            yield from self.run_scenario([
+                scenario.Token(PID.OUT, addr, 2),
+                scenario.Data(PID.DATA1, d),
+                scenario.ExpectHandshake(PID.ACK),
+                scenario.ExpectReceived(epaddr, d),
+            ] +
+                # Should nak until pending is cleared
+                scenario.refused_out(addr, 2, d, PID.DATA1) +
+                scenario.refused_out(addr, 2, d, PID.DATA1) + [
+                scenario.ClearPending(epaddr),
+
+                scenario.Token(PID.OUT, addr, 2),
+                scenario.Data(PID.DATA1, d2),
+                scenario.ExpectHandshake(PID.ACK),
+                scenario.ExpectReceived(epaddr, d2),
+                scenario.ClearPending(epaddr),
+            ])
 
         self.run_sim(stim)
 
@@ -1287,27 +1197,15 @@ class CommonUsbTestCase:
             yield from self.set_response(epaddr, EndpointResponse.NAK)
             yield from self.tick_usb12()
 
-            # First nak
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d)
-            yield from self.expect_nak()
-            pending = yield from self.pending(epaddr)
-            self.assertFalse(pending)
-
-            # Second nak
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d)
-            yield from self.expect_nak()
-            pending = yield from self.pending(epaddr)
-            self.assertFalse(pending)
-
-            # Third attempt succeeds
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d)
-            yield from self.expect_ack()
-            yield from self.expect_data(epaddr, d)
-            yield from self.clear_pending(epaddr)
+            yield from self.run_scenario(
+                # First nak
+                scenario.refused_out(addr, 2, d, PID.DATA1) +
+                [scenario.ExpectPending(epaddr, False)] +
+                # Second nak
+                scenario.refused_out(addr, 2, d, PID.DATA1) +
+                [scenario.ExpectPending(epaddr, False)] +
+                # Third attempt succeeds
+                scenario.data_out(addr, 2, d, pid=PID.DATA1))
 
         self.run_sim(stim)
 
@@ -1318,38 +1216,25 @@ class CommonUsbTestCase:
 
             d = [0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0x8]
 
-            # While pending, set stall
-            self.assertTrue((yield from self.pending(epaddr)))
-            yield from self.set_response(epaddr, EndpointResponse.STALL)
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d[:4])
-            yield from self.expect_stall()
-
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d[:4])
-            yield from self.expect_nak()
-            yield from self.clear_pending(epaddr)
-
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA1, d[:4])
-            yield from self.expect_ack()
-            yield from self.expect_data(epaddr, d[:4])
-            yield from self.clear_pending(epaddr)
-
-            # While not pending, set stall
-            self.assertFalse((yield from self.pending(epaddr)))
-            yield from self.set_response(epaddr, EndpointResponse.STALL)
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA0, d[4:])
-            yield from self.expect_stall()
-
-            yield from self.set_response(epaddr, EndpointResponse.ACK)
-
-            yield from self.send_token_packet(PID.OUT, addr, epaddr)
-            yield from self.send_data_packet(PID.DATA0, d[4:])
-            yield from self.expect_ack()
-            yield from self.expect_data(epaddr, d[4:])
-            yield from self.clear_pending(epaddr)
+            yield from self.run_scenario([
+                # While pending, set stall
+                scenario.ExpectPending(epaddr, True),
+                scenario.SetResponse(epaddr, EndpointResponse.STALL),
+            ] + scenario.refused_out(addr, 2, d[:4], PID.DATA1, PID.STALL) + [
+                scenario.SetResponse(epaddr, EndpointResponse.ACK),
+            ] + scenario.refused_out(addr, 2, d[:4], PID.DATA1) + [
+                scenario.ClearPending(epaddr),
+
+                scenario.Token(PID.OUT, addr, 2),
+                scenario.Data(PID.DATA1, d[:4]),
+                scenario.ExpectHandshake(PID.ACK),
+                scenario.ExpectReceived(epaddr, d[:4]),
+                scenario.ClearPending(epaddr),
+
+                # While not pending, set stall
+                scenario.ExpectPending(epaddr, False),
+                scenario.SetResponse(epaddr, EndpointResponse.STALL),
+            ] + scenario.refused_out(addr, 2, d[4:], PID.DATA0, PID.STALL) +
+                scenario.data_out(addr, 2, d[4:]))
 
         self.run_sim(stim)
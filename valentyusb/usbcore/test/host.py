@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""A USB host on the wire, for driving simulated devices.
+
+:obj:`WireHost` drives a :obj:`io.FakeIoBuf` directly from the ``usb_48``
+domain, one line state per cycle, and :obj:`SimulationTransport` wraps it up
+as a :obj:`utils.bridge.Transport`.
+"""
+
+import queue
+import struct
+import threading
+
+from ..pid import PID
+from ..utils.bridge import Transport
+from ..utils.packet import data_packet, decode_packet, handshake_packet, token_packet, wrap_packet
+
+
+class WireHost:
+    """Just enough of a USB host to talk to a simulated device.
+
+    The methods are generators for the ``usb_48`` domain, with one line
+    state per cycle.  :meth:`send` and :meth:`receive` work on single
+    packets, for tests that want to see each step of a transaction; the
+    rest of the methods talk to the device at address 0 and keep track of
+    the data toggles.
+    """
+    def __init__(self, iobuf, max_packet_size=64):
+        self.iobuf = iobuf
+        self.max_packet_size = max_packet_size
+        self.toggle = {}
+
+    def send(self, packet):
+        """Send `packet`, as bits from :mod:`utils.packet`, after an idle gap."""
+        for v in "J" * 16 + wrap_packet(packet):
+            yield from self.iobuf.recv(v)
+            yield
+        yield from self.iobuf.recv("J")
+
+    def receive(self, timeout=10000):
+        """Return the bytes of the next packet from the device, or None.
+
+        None means nothing was sent for `timeout` cycles.
+        """
+        line = ""
+        for _ in range(timeout):
+            if (yield self.iobuf.usb_tx_en):
+                line += yield from self.iobuf.current()
+            elif line:
+                break
+            yield
+        return decode_packet(line) if line else None
+
+    def data_pid(self, ep):
+        return PID.DATA1 if self.toggle.get(ep, 0) else PID.DATA0
+
+    def out(self, ep, data):
+        """Send one OUT packet, and return True if it was ACKed."""
+        yield from self.send(token_packet(PID.OUT, 0, ep))
+        yield from self.send(data_packet(self.data_pid(ep), data))
+        handshake = yield from self.receive()
+        if handshake == [0xd2]:
+            self.toggle[ep] = not self.toggle.get(ep, 0)
+            return True
+        return False
+
+    def in_(self, ep):
+        """Ask for one IN packet, and return its payload, or None for a NAK."""
+        yield from self.send(token_packet(PID.IN, 0, ep))
+        packet = yield from self.receive()
+        if packet == [0x5a]:
+            return None
+        yield from self.send(handshake_packet(PID.ACK))
+        return packet[1:-2]
+
+    def setup(self, data):
+        yield from self.send(token_packet(PID.SETUP, 0, 0))
+        yield from self.send(data_packet(PID.DATA0, data))
+        handshake = yield from self.receive()
+        self.toggle[0] = 1
+        return handshake == [0xd2]
+
+    def write_stream(self, ep, data):
+        for i in range(0, len(data), self.max_packet_size):
+            while not (yield from self.out(ep, data[i:i+self.max_packet_size])):
+                pass
+
+    def read_stream(self, ep, length):
+        data = []
+        while len(data) < length:
+            packet = yield from self.in_(ep)
+            if packet is not None:
+                data += packet
+                if len(packet) < self.max_packet_size:
+                    break
+        return data
+
+    def control(self, t):
+        """Run a :obj:`ControlTransfer`, and return what it read."""
+        length = t.data if t.request_type & 0x80 else len(t.data)
+        yield from self.setup(list(struct.pack("<BBHHH",
+            t.request_type, t.request, t.value, t.index, length)))
+        if t.request_type & 0x80:
+            data = yield from self.read_stream(0, length)
+            while not (yield from self.out(0, [])):
+                pass
+            return bytes(data)
+        yield from self.write_stream(0, list(t.data))
+        while (yield from self.in_(0)) is None:
+            pass
+        return None
+
+
+class SimulationTransport(Transport):
+    """A :obj:`Transport` wired to a device in a Migen simulation.
+
+    The simulation runs in a thread of its own, and waits for the next
+    request between transfers, so it can be driven like a real device.
+    ``cycles`` counts the ``usb_48`` cycles spent so far, which makes it
+    easy to measure how long an access takes on the wire.
+
+    Parameters
+    ----------
+
+    dut : Module
+        The design to simulate.
+
+    iobuf : :obj:`io.FakeIoBuf`
+        The USB pins of the device in `dut`.
+
+    clocks : dict, optional
+        Passed to ``run_simulation``.
+    """
+    def __init__(self, dut, iobuf, clocks={"usb_48": 4, "usb_12": 16, "sys": 16}, **kwargs):
+        from migen.sim import run_simulation, passive
+
+        self.host = WireHost(iobuf)
+        self.cycles = 0
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+
+        def host():
+            yield from iobuf.recv("J")
+            for _ in range(20):
+                yield
+            while True:
+                request = self._requests.get()
+                if request is None:
+                    return
+                try:
+                    self._results.put((True, (yield from request())))
+                except Exception as e:
+                    self._results.put((False, e))
+
+        @passive
+        def count():
+            while True:
+                self.cycles += 1
+                yield
+
+        self._thread = threading.Thread(target=run_simulation,
+            args=(dut, {"usb_48": [host(), count()]}),
+            kwargs=dict(clocks=clocks, **kwargs), daemon=True)
+        self._thread.start()
+
+    def _run(self, request):
+        self._requests.put(request)
+        ok, result = self._results.get()
+        if not ok:
+            raise result
+        return result
+
+    def control(self, transfers):
+        def request():
+            results = []
+            for t in transfers:
+                results.append((yield from self.host.control(t)))
+            return results
+        return self._run(request)
+
+    def bulk_write(self, endpoint, data):
+        return self._run(lambda: self.host.write_stream(endpoint, list(data)))
+
+    def bulk_read(self, endpoint, length):
+        def request():
+            data = []
+            while len(data) < length:
+                data += yield from self.host.read_stream(endpoint, length - len(data))
+            return bytes(data)
+        return self._run(request)
+
+    def close(self):
+        """Let the simulation finish."""
+        self._requests.put(None)
+        self._thread.join()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""USB test scenarios described as data.
+
+A scenario is a list of steps.  Host steps put packets on the bus or check
+what the device answers; device steps are what the firmware does through
+the CSRs.  Scenarios are built once here and executed by a `run_scenario()`
+adapter in each test bench: `CommonUsbTestCase` for the Migen simulator and
+`UsbTest` in the cocotb test benches.  Another backend only needs its own
+`run_scenario()` that understands the steps below.
+
+>>> for step in control_in(0, [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x02, 0x00], [1, 2]):
+...     print(step)
+Token(pid=<PID.SETUP: 13>, addr=0, epnum=0)
+Data(pid=<PID.DATA0: 3>, data=[128, 6, 0, 1, 0, 0, 2, 0])
+ExpectHandshake(pid=<PID.ACK: 2>)
+ExpectSetup(epaddr=0, data=[128, 6, 0, 1, 0, 0, 2, 0])
+LoadData(epaddr=1, data=[1, 2])
+SetResponse(epaddr=1, response=<EndpointResponse.ACK: 0>)
+Token(pid=<PID.IN: 9>, addr=0, epnum=0)
+ExpectData(pid=<PID.DATA1: 11>, data=[1, 2])
+Handshake(pid=<PID.ACK: 2>)
+ClearPending(epaddr=1)
+SetResponse(epaddr=0, response=<EndpointResponse.ACK: 0>)
+Token(pid=<PID.OUT: 1>, addr=0, epnum=0)
+Data(pid=<PID.DATA1: 11>, data=[])
+ExpectHandshake(pid=<PID.ACK: 2>)
+ExpectReceived(epaddr=0, data=[])
+ClearPending(epaddr=0)
+"""
+
+from collections import namedtuple
+
+from ..endpoint import EndpointType, EndpointResponse
+from ..pid import PID
+
+# Host side ----------------------------------------------------------------
+Token = namedtuple("Token", ["pid", "addr", "epnum"])
+Data = namedtuple("Data", ["pid", "data"])
+Handshake = namedtuple("Handshake", ["pid"])
+ExpectData = namedtuple("ExpectData", ["pid", "data"])
+ExpectHandshake = namedtuple("ExpectHandshake", ["pid"])
+
+# Device side --------------------------------------------------------------
+SetResponse = namedtuple("SetResponse", ["epaddr", "response"])
+LoadData = namedtuple("LoadData", ["epaddr", "data"])
+ExpectSetup = namedtuple("ExpectSetup", ["epaddr", "data"])
+ExpectReceived = namedtuple("ExpectReceived", ["epaddr", "data"])
+ClearPending = namedtuple("ClearPending", ["epaddr"])
+ExpectPending = namedtuple("ExpectPending", ["epaddr", "pending"])
+
+
+def toggle(pid):
+    """
+    >>> toggle(PID.DATA0)
+    <PID.DATA1: 11>
+    >>> toggle(PID.DATA1)
+    <PID.DATA0: 3>
+    """
+    return PID.DATA1 if pid == PID.DATA0 else PID.DATA0
+
+
+def packets(data, max_packet_size, zlp=False):
+    """Split `data` into packets, adding a zero length packet if asked to.
+
+    An empty transfer is always a single zero length packet.
+
+    >>> packets([1, 2, 3], 2)
+    [[1, 2], [3]]
+    >>> packets([1, 2], 2)
+    [[1, 2]]
+    >>> packets([1, 2], 2, zlp=True)
+    [[1, 2], []]
+    >>> packets([], 2)
+    [[]]
+    """
+    data = list(data)
+    chunks = [data[i:i+max_packet_size] for i in range(0, len(data), max_packet_size)]
+    if not chunks or (zlp and len(chunks[-1]) == max_packet_size):
+        chunks.append([])
+    return chunks
+
+
+def setup(addr, data, epnum=0):
+    epaddr = EndpointType.epaddr(epnum, EndpointType.OUT)
+    return [
+        Token(PID.SETUP, addr, epnum),
+        Data(PID.DATA0, list(data)),
+        ExpectHandshake(PID.ACK),
+        ExpectSetup(epaddr, list(data)),
+    ]
+
+
+def data_out(addr, epnum, data, max_packet_size=8, pid=PID.DATA0, zlp=False):
+    """Host to device: OUT, DATAx, ACK for each packet of `data`."""
+    epaddr = EndpointType.epaddr(epnum, EndpointType.OUT)
+    steps = []
+    for chunk in packets(data, max_packet_size, zlp):
+        steps += [
+            SetResponse(epaddr, EndpointResponse.ACK),
+            Token(PID.OUT, addr, epnum),
+            Data(pid, chunk),
+            ExpectHandshake(PID.ACK),
+            ExpectReceived(epaddr, chunk),
+            ClearPending(epaddr),
+        ]
+        pid = toggle(pid)
+    return steps
+
+
+def data_in(addr, epnum, data, max_packet_size=8, pid=PID.DATA1, zlp=False):
+    """Device to host: IN, DATAx, ACK for each packet of `data`."""
+    epaddr = EndpointType.epaddr(epnum, EndpointType.IN)
+    steps = []
+    for chunk in packets(data, max_packet_size, zlp):
+        steps += [
+            LoadData(epaddr, chunk),
+            SetResponse(epaddr, EndpointResponse.ACK),
+            Token(PID.IN, addr, epnum),
+            ExpectData(pid, chunk),
+            Handshake(PID.ACK),
+            ClearPending(epaddr),
+        ]
+        pid = toggle(pid)
+    return steps
+
+
+def refused_out(addr, epnum, data, pid=PID.DATA0, handshake=PID.NAK):
+    """An OUT the device turns away with `handshake`, keeping none of the data.
+
+    >>> [type(step).__name__ for step in refused_out(0, 2, [1])]
+    ['Token', 'Data', 'ExpectHandshake']
+    """
+    return [
+        Token(PID.OUT, addr, epnum),
+        Data(pid, list(data)),
+        ExpectHandshake(handshake),
+    ]
+
+
+def refused_in(addr, epnum, handshake=PID.NAK):
+    """An IN the device answers with `handshake` instead of data."""
+    return [
+        Token(PID.IN, addr, epnum),
+        ExpectHandshake(handshake),
+    ]
+
+
+def status_out(addr, epnum=0):
+    return data_out(addr, epnum, [], pid=PID.DATA1)
+
+
+def status_in(addr, epnum=0):
+    return data_in(addr, epnum, [], pid=PID.DATA1)
+
+
+def _wlength(setup_data):
+    return setup_data[6] | (setup_data[7] << 8)
+
+
+def control_in(addr, setup_data, data, max_packet_size=8, epnum=0):
+    """A control read: SETUP, IN data stage, zero length OUT status stage.
+
+    A short transfer that ends on a packet boundary gets a zero length
+    packet so the host knows it is complete.
+    """
+    assert setup_data[0] & 0x80, "setup_data is not a device to host request"
+    zlp = len(data) < _wlength(setup_data)
+    steps = setup(addr, setup_data, epnum)
+    if data or _wlength(setup_data):
+        steps += data_in(addr, epnum, data, max_packet_size, zlp=zlp)
+    steps += status_out(addr, epnum)
+    return steps
+
+
+def control_out(addr, setup_data, data, max_packet_size=8, epnum=0):
+    """A control write: SETUP, OUT data stage, zero length IN status stage."""
+    assert not setup_data[0] & 0x80, "setup_data is not a host to device request"
+    steps = setup(addr, setup_data, epnum)
+    if data:
+        steps += data_out(addr, epnum, data, max_packet_size, pid=PID.DATA1)
+    steps += status_in(addr, epnum)
+    return steps
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from migen import Signal
+
+from ..endpoint import EndpointType, EndpointResponse
+from ..pid import PID
+
+from . import scenario
+from .common import CommonUsbTestCase
+
+
+class RecordingUsbTestCase(CommonUsbTestCase):
+    """Record the harness calls a scenario makes instead of simulating."""
+
+    def __init__(self):
+        self.calls = []
+        self.packet_d2h = Signal()
+
+    def assertEqual(self, first, second, msg=None):
+        assert first == second, msg
+
+    def run_sim(self, stim):
+        for _ in stim():
+            pass
+
+    def tick_usb12(self):
+        return self._record("tick")
+
+    def pending(self, epaddr):
+        self.calls.append(("pending", epaddr))
+        return False
+        yield
+
+    def _record(self, *args):
+        self.calls.append(args)
+        if False:
+            yield
+
+    def send_token_packet(self, pid, addr, epaddr):
+        return self._record("token", pid, addr, epaddr)
+
+    def send_data_packet(self, pid, data):
+        return self._record("data", pid, data)
+
+    def send_ack(self):
+        return self._record("ack")
+
+    def send_handshake(self, pid):
+        return self._record("handshake", pid)
+
+    def expect_data_packet(self, pid, data):
+        return self._record("expect_data", pid, data)
+
+    def expect_packet(self, packet, msg=None):
+        return self._record("expect", msg)
+
+    def set_response(self, epaddr, v):
+        return self._record("response", epaddr, v)
+
+    def set_data(self, epaddr, data):
+        return self._record("set_data", epaddr, data)
+
+    def expect_setup(self, epaddr, data):
+        return self._record("expect_setup", epaddr, data)
+
+    def expect_data(self, epaddr, data):
+        return self._record("expect_received", epaddr, data)
+
+    def clear_pending(self, epaddr):
+        return self._record("clear_pending", epaddr)
+
+
+def run(steps):
+    harness = RecordingUsbTestCase()
+    for _ in harness.run_scenario(steps):
+        pass
+    return harness.calls
+
+
+class TestScenario(unittest.TestCase):
+    ep0out = EndpointType.epaddr(0, EndpointType.OUT)
+    ep0in = EndpointType.epaddr(0, EndpointType.IN)
+
+    def test_control_in_packets(self):
+        data = list(range(20))
+        steps = scenario.control_in(5, [0x80, 6, 0, 1, 0, 0, 64, 0], data, max_packet_size=8)
+        sent = [s for s in steps if isinstance(s, scenario.ExpectData)]
+        self.assertEqual([s.pid for s in sent], [PID.DATA1, PID.DATA0, PID.DATA1])
+        self.assertEqual(sum((s.data for s in sent), []), data)
+
+    def test_control_in_zlp(self):
+        setup = [0x80, 6, 0, 1, 0, 0, 64, 0]
+        steps = scenario.control_in(0, setup, list(range(16)), max_packet_size=8)
+        sent = [s.data for s in steps if isinstance(s, scenario.ExpectData)]
+        self.assertEqual([len(d) for d in sent], [8, 8, 0])
+
+        # No zero length packet when the host gets all it asked for
+        setup = [0x80, 6, 0, 1, 0, 0, 16, 0]
+        steps = scenario.control_in(0, setup, list(range(16)), max_packet_size=8)
+        sent = [s.data for s in steps if isinstance(s, scenario.ExpectData)]
+        self.assertEqual([len(d) for d in sent], [8, 8])
+
+    def test_control_out_packets(self):
+        data = list(range(10))
+        steps = scenario.control_out(0, [0x00, 9, 1, 0, 0, 0, 10, 0], data, max_packet_size=64)
+        received = [s for s in steps if isinstance(s, scenario.Data)]
+        self.assertEqual([s.pid for s in received], [PID.DATA0, PID.DATA1])
+        self.assertEqual(received[1].data, data)
+        self.assertIsInstance(steps[-3], scenario.ExpectData)
+        self.assertEqual(steps[-3], scenario.ExpectData(PID.DATA1, []))
+
+    def test_migen_adapter(self):
+        calls = run(scenario.setup(3, [1, 2, 3, 4, 5, 6, 7, 8]) + scenario.status_in(3))
+        self.assertEqual(calls, [
+            ("token", PID.SETUP, 3, self.ep0out),
+            ("data", PID.DATA0, [1, 2, 3, 4, 5, 6, 7, 8]),
+            ("expect", "Expected ACK packet."),
+            ("expect_setup", self.ep0out, [1, 2, 3, 4, 5, 6, 7, 8]),
+            ("set_data", self.ep0in, []),
+            ("response", self.ep0in, EndpointResponse.ACK),
+            ("token", PID.IN, 3, self.ep0in),
+            ("expect_data", PID.DATA1, []),
+            ("ack",),
+            ("clear_pending", self.ep0in),
+        ])
+
+    def test_migen_tests_use_scenarios(self):
+        ep2out = EndpointType.epaddr(2, EndpointType.OUT)
+        harness = RecordingUsbTestCase()
+        harness.test_out_transfer_nak()
+        self.assertEqual(harness.calls[3:], [
+            ("token", PID.OUT, 28, ep2out),
+            ("data", PID.DATA1, [0x41, 0x01]),
+            ("expect", "Expected NAK packet."),
+            ("pending", ep2out),
+            ("token", PID.OUT, 28, ep2out),
+            ("data", PID.DATA1, [0x41, 0x01]),
+            ("expect", "Expected NAK packet."),
+            ("pending", ep2out),
+            ("response", ep2out, EndpointResponse.ACK),
+            ("token", PID.OUT, 28, ep2out),
+            ("data", PID.DATA1, [0x41, 0x01]),
+            ("expect", "Expected ACK packet."),
+            ("expect_received", ep2out, [0x41, 0x01]),
+            ("clear_pending", ep2out),
+        ])
+
+    def test_migen_adapter_unknown_step(self):
+        with self.assertRaises(TypeError):
+            run([("not", "a", "step")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,9 @@
 #!/usr/bin/env python3
 
-import unittest
-
 from migen import *
 
 from migen.fhdl.decorators import CEInserter, ResetInserter
 
-from .tester import module_tester
-from ..test.common import BaseUsbTestCase
-
 
 @ResetInserter()
 class TxBitstuffer(Module):
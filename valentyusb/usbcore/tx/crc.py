@@ -2,7 +2,6 @@
 
 import functools
 import operator
-import unittest
 
 from migen import *
 
@@ -11,8 +10,6 @@ from migen.fhdl.decorators import CEInserter, ResetInserter
 from ..utils.CrcMoose3 import CrcAlgorithm
 from ..utils.packet import crc16, encode_data, b
 from .shifter import TxShifter
-from .tester import module_tester
-from ..test.common import BaseUsbTestCase
 
 
 @CEInserter()
@@ -1,12 +1,7 @@
 #!/usr/bin/env python3
 
-import unittest
-
 from migen import *
 
-from .tester import module_tester
-from ..test.common import BaseUsbTestCase
-
 
 class TxNRZIEncoder(Module):
     """
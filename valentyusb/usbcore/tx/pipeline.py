@@ -4,13 +4,10 @@ from migen import *
 from migen.genlib import cdc
 from migen.genlib.fsm import FSM, NextState, NextValue
 
-import unittest
-
 from .bitstuff import TxBitstuffer
 from .nrzi import TxNRZIEncoder
 from .shifter import TxShifter
 from ..utils.packet import b, nrzi, diff
-from ..test.common import BaseUsbTestCase
 
 
 class TxPipeline(Module):
@@ -1,13 +1,10 @@
 #!/usr/bin/env python3
 
-import unittest
-
 from migen import *
 
 from migen.fhdl.decorators import CEInserter, ResetInserter
 
 from ..utils.packet import b
-from ..test.common import BaseUsbTestCase
 
 
 @ResetInserter()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Host side of the USB Wishbone debug bridges.
+
+:obj:`BridgeClient` speaks all three of the bridge protocols:
+
+``"word"``
+    :obj:`cpu.usbwishbonebridge.USBWishboneBridge`, one control transfer
+    for each 32-bit word.
+
+``"burst"``
+    :obj:`cpu.usbwishboneburstbridge.USBWishboneBurstBridge`, one control
+    transfer for a run of words.
+
+``"bulk"``
+    :obj:`cpu.usbwishbonebulkbridge.USBWishboneBulkBridge`, a stream of
+    commands over a pair of bulk endpoints.
+
+Accesses can be queued up and sent together with :meth:`BridgeClient.flush`,
+in which case accesses to adjacent addresses are merged into bursts and
+several requests are handed to the transport at once.  The USB side is a
+:obj:`Transport`: :obj:`PyUsbTransport` for real hardware, or
+:obj:`test.host.SimulationTransport` to run against the gateware in
+simulation.
+"""
+
+import abc
+import struct
+from collections import namedtuple
+
+
+ControlTransfer = namedtuple("ControlTransfer", ["request_type", "request", "value", "index", "data"])
+ControlTransfer.__doc__ = """One control transfer.
+
+For an ``IN`` transfer (bit 7 of `request_type` set) `data` is the number
+of bytes to read, and for an ``OUT`` transfer it is the bytes to write.
+"""
+
+
+class Transport(abc.ABC):
+    """What a :obj:`BridgeClient` needs from a USB device.
+
+    A transport has to implement all three methods, even if it is only used
+    with protocols that don't need the bulk ones.
+    """
+
+    @abc.abstractmethod
+    def control(self, transfers):
+        """Run a list of :obj:`ControlTransfer`, in order.
+
+        Returns a list with the bytes read by each ``IN`` transfer, and
+        ``None`` for each ``OUT`` transfer.  A transport is free to have
+        all of them in flight at the same time.
+        """
+
+    @abc.abstractmethod
+    def bulk_write(self, endpoint, data):
+        """Write `data` to the ``OUT`` endpoint, in as many packets as it takes."""
+
+    @abc.abstractmethod
+    def bulk_read(self, endpoint, length):
+        """Read exactly `length` bytes, over as many packets as it takes."""
+
+
+class PyUsbTransport(Transport):
+    """A :obj:`Transport` for a device opened with ``pyusb``.
+
+    ``pyusb`` has no way of queueing control transfers, so they are run
+    one at a time.  The bulk protocol has no need to.
+    """
+    def __init__(self, device, timeout=1000):
+        self.device = device
+        self.timeout = timeout
+
+    def control(self, transfers):
+        results = []
+        for t in transfers:
+            data = self.device.ctrl_transfer(t.request_type, t.request, t.value, t.index,
+                                             t.data, self.timeout)
+            results.append(bytes(data) if t.request_type & 0x80 else None)
+        return results
+
+    def bulk_write(self, endpoint, data):
+        self.device.write(endpoint, bytes(data), self.timeout)
+
+    def bulk_read(self, endpoint, length):
+        data = b""
+        while len(data) < length:
+            data += bytes(self.device.read(0x80 | endpoint, length - len(data), self.timeout))
+        return data
+
+
+class BridgeRead:
+    """The result of :meth:`BridgeClient.queue_read`, with ``data`` set once it has been flushed."""
+    def __init__(self, address, length):
+        self.address = address
+        self.length = length
+        self.data = None
+
+
+class _Access:
+    """A run of adjacent reads or writes, sent as one burst."""
+    def __init__(self, write, address, length, data=b""):
+        self.write = write
+        self.address = address
+        self.length = length
+        self.data = bytearray(data)
+        self.reads = []
+
+
+class BridgeClient:
+    """Read and write the Wishbone bus of a device through its debug bridge.
+
+    Parameters
+    ----------
+
+    transport : :obj:`Transport`
+        How to talk to the device.
+
+    protocol : str, optional
+        ``"word"``, ``"burst"`` or ``"bulk"``, as the bridge in the device.
+
+    max_burst : int, optional
+        The largest number of bytes to move in one request.
+
+    in_flight : int, optional
+        The number of requests handed to the transport at once.
+
+    endpoint : int, optional
+        The endpoint of the bulk bridge.
+
+    >>> client = BridgeClient(None, protocol="burst", max_burst=16)
+    >>> a = client.queue_read(0x100, 8)
+    >>> b = client.queue_read(0x108, 12)
+    >>> client.queue_write(0x200, bytes(4))
+    >>> [(x.write, hex(x.address), x.length) for x in client._pending]
+    [(False, '0x100', 16), (False, '0x110', 4), (True, '0x200', 4)]
+    """
+
+    MAGIC = 0x43
+    BULK_WRITE = 0x01
+    BULK_READ = 0x02
+
+    # Bytes of read data the bulk bridge can hold before it stops taking
+    # commands, so that it's safe to send more before reading it back.
+    BULK_READ_WINDOW = 256
+
+    def __init__(self, transport, protocol="burst", max_burst=None, in_flight=8, endpoint=1):
+        if protocol not in ("word", "burst", "bulk"):
+            raise ValueError("protocol must be \"word\", \"burst\" or \"bulk\", not {}".format(protocol))
+        if max_burst is None:
+            max_burst = {"word": 4, "burst": 1024, "bulk": 1024}[protocol]
+        if protocol == "word":
+            max_burst = 4
+        if max_burst < 4 or max_burst % 4 or max_burst > 0xfffc:
+            raise ValueError("max_burst must be a multiple of four, up to 0xfffc")
+        self.transport = transport
+        self.protocol = protocol
+        self.max_burst = max_burst
+        self.in_flight = in_flight
+        self.endpoint = endpoint
+        self._pending = []
+
+    def _queue(self, write, address, length, data=b"", read=None):
+        if address % 4 or length % 4:
+            raise ValueError("accesses must be to whole, aligned words")
+        while length:
+            last = self._pending[-1] if self._pending else None
+            if (last is not None and last.write == write
+                    and last.address + last.length == address
+                    and last.length < self.max_burst):
+                access = last
+            else:
+                access = _Access(write, address, 0)
+                self._pending.append(access)
+            n = min(length, self.max_burst - access.length)
+            if write:
+                access.data += data[:n]
+                data = data[n:]
+            elif read is not None:
+                access.reads.append((read, address - read.address, access.length, n))
+            access.length += n
+            address += n
+            length -= n
+
+    def queue_read(self, address, length=4):
+        """Queue up a read, and return a :obj:`BridgeRead` to find the result in."""
+        read = BridgeRead(address, length)
+        read.data = bytearray(length)
+        self._queue(False, address, length, read=read)
+        return read
+
+    def queue_write(self, address, data):
+        self._queue(True, address, len(data), data=bytes(data))
+
+    def flush(self):
+        """Send everything that has been queued up."""
+        pending, self._pending = self._pending, []
+        if self.protocol == "bulk":
+            self._flush_bulk(pending)
+        else:
+            self._flush_control(pending)
+        for access in pending:
+            for read, offset, start, n in access.reads:
+                read.data[offset:offset + n] = access.data[start:start + n]
+        for access in pending:
+            for read, _, _, _ in access.reads:
+                read.data = bytes(read.data)
+
+    def _flush_control(self, pending):
+        for i in range(0, len(pending), self.in_flight):
+            batch = pending[i:i + self.in_flight]
+            transfers = []
+            for access in batch:
+                request_type = self.MAGIC if access.write else 0x80 | self.MAGIC
+                transfers.append(ControlTransfer(request_type, 0,
+                    access.address & 0xffff, access.address >> 16,
+                    bytes(access.data) if access.write else access.length))
+            for access, data in zip(batch, self.transport.control(transfers)):
+                if not access.write:
+                    access.data = bytearray(data)
+
+    def _flush_bulk(self, pending):
+        pending = list(pending)
+        while pending:
+            # Send commands until there is as much read data on its way
+            # as the bridge can hold, then collect it.
+            stream = b""
+            batch = []
+            read_length = 0
+            while pending and len(batch) < self.in_flight and read_length < self.BULK_READ_WINDOW:
+                access = pending.pop(0)
+                batch.append(access)
+                op = self.BULK_WRITE if access.write else self.BULK_READ
+                stream += struct.pack("<BBHI", op, 0, access.length, access.address)
+                if access.write:
+                    stream += bytes(access.data)
+                else:
+                    read_length += access.length
+            self.transport.bulk_write(self.endpoint, stream)
+            if read_length:
+                data = self.transport.bulk_read(self.endpoint, read_length)
+                for access in batch:
+                    if not access.write:
+                        access.data, data = bytearray(data[:access.length]), data[access.length:]
+
+    def read(self, address, length=4):
+        """Read `length` bytes, along with anything already queued."""
+        read = self.queue_read(address, length)
+        self.flush()
+        return read.data
+
+    def write(self, address, data):
+        """Write `data`, along with anything already queued."""
+        self.queue_write(address, data)
+        self.flush()
+
+    def read32(self, address):
+        return struct.unpack("<I", self.read(address, 4))[0]
+
+    def write32(self, address, value):
+        self.write(address, struct.pack("<I", value))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
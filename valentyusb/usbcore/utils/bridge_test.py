@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import struct
+import unittest
+from unittest import TestCase
+
+from migen import *
+
+from litex.soc.interconnect import wishbone
+
+from ..io import FakeIoBuf
+from ..cpu.dummyusb import DummyUsb
+from ..test.host import SimulationTransport
+from .bridge import BridgeClient, Transport
+
+
+class MemoryTransport(Transport):
+    """Carries out bridge requests on a bytearray, and keeps a log of them."""
+    def __init__(self, size=1024):
+        self.memory = bytearray(size)
+        self.calls = []
+        self.stream = b""
+
+    def control(self, transfers):
+        self.calls.append(("control", list(transfers)))
+        results = []
+        for t in transfers:
+            address = t.value | (t.index << 16)
+            if t.request_type & 0x80:
+                results.append(bytes(self.memory[address:address + t.data]))
+            else:
+                self.memory[address:address + len(t.data)] = t.data
+                results.append(None)
+        return results
+
+    def bulk_write(self, endpoint, data):
+        self.calls.append(("bulk_write", endpoint, bytes(data)))
+        data = bytes(data)
+        while data:
+            op, _, length, address = struct.unpack("<BBHI", data[:8])
+            data = data[8:]
+            if op == BridgeClient.BULK_WRITE:
+                self.memory[address:address + length] = data[:length]
+                data = data[length:]
+            else:
+                self.stream += bytes(self.memory[address:address + length])
+
+    def bulk_read(self, endpoint, length):
+        self.calls.append(("bulk_read", endpoint, length))
+        data, self.stream = self.stream[:length], self.stream[length:]
+        return data
+
+
+class TestBridgeClient(TestCase):
+    def test_bad_options(self):
+        with self.assertRaises(ValueError):
+            BridgeClient(MemoryTransport(), protocol="serial")
+        with self.assertRaises(ValueError):
+            BridgeClient(MemoryTransport(), max_burst=6)
+        with self.assertRaises(ValueError):
+            BridgeClient(MemoryTransport()).queue_read(2, 4)
+
+    def test_incomplete_transport(self):
+        class ControlOnly(Transport):
+            def control(self, transfers):
+                return []
+        with self.assertRaises(TypeError):
+            ControlOnly()
+
+    def test_word(self):
+        transport = MemoryTransport()
+        client = BridgeClient(transport, protocol="word", in_flight=2)
+        client.write(0x10, bytes(range(12)))
+        self.assertEqual(client.read32(0x14), 0x07060504)
+        # One transfer for each word, two at a time
+        transfers = [len(call[1]) for call in transport.calls]
+        self.assertEqual(transfers, [2, 1, 1])
+        self.assertEqual(transport.calls[0][1][0].request_type, 0x43)
+        self.assertEqual(transport.calls[2][1][0].request_type, 0xc3)
+
+    def test_burst_coalesce(self):
+        transport = MemoryTransport(0x10100)
+        transport.memory[:256] = bytes(range(256))
+        client = BridgeClient(transport, protocol="burst", max_burst=64)
+        reads = [client.queue_read(0x20 + 4 * i) for i in range(20)]
+        client.queue_write(0x200, b"abcd")
+        client.queue_write(0x204, b"efgh")
+        far = client.queue_read(0x10000, 4)
+        client.flush()
+        self.assertEqual(b"".join(r.data for r in reads), bytes(range(0x20, 0x70)))
+        self.assertEqual(far.data, bytes(4))
+        self.assertEqual(transport.memory[0x200:0x208], b"abcdefgh")
+        # Reads merged up to max_burst, then the writes, then the far read
+        transfers = transport.calls[0][1]
+        self.assertEqual([(t.value, t.index) for t in transfers],
+            [(0x20, 0), (0x60, 0), (0x200, 0), (0, 1)])
+        self.assertEqual([t.data for t in transfers][:2], [64, 16])
+        self.assertEqual(transfers[2].data, b"abcdefgh")
+
+    def test_read_straddles_bursts(self):
+        transport = MemoryTransport()
+        transport.memory[:256] = bytes(range(256))
+        client = BridgeClient(transport, protocol="burst", max_burst=16)
+        a = client.queue_read(0, 8)
+        b = client.queue_read(8, 24)
+        client.flush()
+        self.assertEqual(a.data, bytes(range(8)))
+        self.assertEqual(b.data, bytes(range(8, 32)))
+
+    def test_bulk(self):
+        transport = MemoryTransport()
+        client = BridgeClient(transport, protocol="bulk")
+        client.queue_write(0, bytes(range(16)))
+        a = client.queue_read(4, 8)
+        b = client.queue_read(0x200, 400)
+        c = client.queue_read(12, 4)
+        client.flush()
+        self.assertEqual(a.data, bytes(range(4, 12)))
+        self.assertEqual(b.data, bytes(400))
+        self.assertEqual(c.data, bytes(range(12, 16)))
+        # The stream stops once the bridge might run out of room for read data
+        self.assertEqual([call[0] for call in transport.calls],
+            ["bulk_write", "bulk_read", "bulk_write", "bulk_read"])
+        self.assertEqual(transport.calls[1][2], 408)
+
+
+class SimulationTestBench(Module):
+    def __init__(self, protocol):
+        self.submodules.usb = DummyUsb(FakeIoBuf(), debug=True,
+            burst=protocol == "burst", bulk=protocol == "bulk")
+        self.submodules.sram = wishbone.SRAM(1024,
+            init=[0x10203040 + i for i in range(256)],
+            bus=wishbone.Interface(bursting=True))
+        self.comb += self.usb.debug_bridge.wishbone.connect(self.sram.bus)
+
+
+class TestSimulationTransport(TestCase):
+    def client(self, protocol):
+        dut = SimulationTestBench(protocol)
+        transport = SimulationTransport(dut, dut.usb.iobuf)
+        self.addCleanup(transport.close)
+        return BridgeClient(transport, protocol=protocol), transport
+
+    def test_bulk(self):
+        client, _ = self.client("bulk")
+        client.queue_write(0x10, struct.pack("<3I", 1, 2, 3))
+        client.write32(0x20, 0xcafe)
+        self.assertEqual(client.read(0xc, 24),
+            struct.pack("<6I", 0x10203043, 1, 2, 3, 0x10203047, 0xcafe))
+
+    def test_throughput(self):
+        # Eight word reads in a row, which the client turns into one burst
+        cycles = {}
+        for protocol in ("word", "burst", "bulk"):
+            client, transport = self.client(protocol)
+            reads = [client.queue_read(4 * i) for i in range(8)]
+            start = transport.cycles
+            client.flush()
+            cycles[protocol] = transport.cycles - start
+            self.assertEqual(b"".join(r.data for r in reads),
+                struct.pack("<8I", *[0x10203040 + i for i in range(8)]))
+        print("8 word reads, in usb_48 cycles: {}".format(cycles))
+        self.assertLess(cycles["bulk"], cycles["burst"])
+        self.assertLess(cycles["burst"], cycles["word"])
+
+
+if __name__ == '__main__':
+    unittest.main()
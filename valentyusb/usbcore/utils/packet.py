@@ -416,6 +416,73 @@ def undiff(usbp, usbn):
     return "".join(value)
 
 
+def decode_packet(value, cycles=4):
+    """Convert a J/K encoded packet back into the bytes on the wire.
+
+    This is the inverse of `wrap_packet`: the sync pattern is located, the
+    NRZI encoding and bit stuffing are removed, and decoding stops at the
+    SE0 of the end-of-packet.  The result starts with the PID byte and
+    includes the CRC bytes.  Returns None if no complete packet is found.
+
+    >>> ["%02x" % v for v in decode_packet(wrap_packet(handshake_packet(PID.ACK)))]
+    ['d2']
+    >>> ["%02x" % v for v in decode_packet(wrap_packet(token_packet(PID.SETUP, 0, 0), cycles=1), cycles=1)]
+    ['2d', '00', '10']
+    >>> decode_packet(wrap_packet(data_packet(PID.DATA0, [5, 6])))
+    [195, 5, 6, 125, 29]
+    >>> decode_packet("JJJJ" + wrap_packet(data_packet(PID.DATA1, [0xff]*8)), cycles=4)[1:9]
+    [255, 255, 255, 255, 255, 255, 255, 255]
+    >>> decode_packet("JJJJKKKKJJJJ") is None
+    True
+    """
+    # Collapse the oversampled line states into one symbol per bit.
+    symbols = ""
+    run_state = None
+    run_length = 0
+    for v in value + "?":
+        if v == ' ':
+            continue
+        if v == run_state:
+            run_length += 1
+            continue
+        if run_state is not None:
+            symbols += run_state * max(1, int(round(run_length / cycles)))
+        run_state = v
+        run_length = 1
+
+    start = symbols.find("KJKJKJKK")
+    if start < 0:
+        return None
+
+    # Undo the NRZI encoding and the bit stuffing.
+    bits = []
+    state = "K"
+    ones = 0
+    for v in symbols[start + 8:]:
+        if v == "_":
+            break
+        if v not in "JK":
+            return None
+        bit = 1 if v == state else 0
+        state = v
+        if ones == 6:
+            ones = 0
+            if bit:
+                return None
+            continue
+        ones = ones + 1 if bit else 0
+        bits.append(bit)
+    else:
+        return None
+
+    if not bits or len(bits) % 8:
+        return None
+    return [
+        sum(bit << i for i, bit in enumerate(bits[n:n+8]))
+        for n in range(0, len(bits), 8)
+    ]
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
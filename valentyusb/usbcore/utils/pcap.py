@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import struct
+import threading
+
+from .packet import decode_packet
+
+# Link types from http://www.tcpdump.org/linktypes.html -- each record is a
+# single USB packet as seen on the wire: PID, payload and CRC, without the
+# sync pattern or EOP.
+LINKTYPE_USB_2_0 = 288
+LINKTYPE_USB_2_0_LOW_SPEED = 293
+LINKTYPE_USB_2_0_FULL_SPEED = 294
+LINKTYPE_USB_2_0_HIGH_SPEED = 295
+
+# Classic pcap with nanosecond resolution timestamps.
+PCAP_MAGIC_NS = 0xa1b23c4d
+
+
+def pcap_header(linktype=LINKTYPE_USB_2_0_FULL_SPEED, snaplen=65535):
+    """The pcap global header.
+
+    >>> pcap_header().hex()
+    '4d3cb2a1020004000000000000000000ffff000026010000'
+    """
+    return struct.pack("<IHHiIII", PCAP_MAGIC_NS, 2, 4, 0, 0, snaplen, linktype)
+
+
+def pcap_record(data, timestamp):
+    """A pcap record for `data` captured `timestamp` seconds into the simulation.
+
+    >>> pcap_record([0xd2], 1.5e-6).hex()
+    '00000000dc0500000100000001000000d2'
+    """
+    ns = int(round(timestamp * 1e9))
+    data = bytes(data)
+    return struct.pack("<IIII", ns // 10**9, ns % 10**9, len(data), len(data)) + data
+
+
+class PcapWriter:
+    """Stream USB packets from a simulation into a pcap file.
+
+    Packets are handed to a background thread which does the file I/O, so
+    capturing costs the simulation no more than putting them on a queue.
+    The file is flushed whenever the queue runs dry, so it can be opened in
+    Wireshark while a long simulation is still running.
+
+    Args
+    ----
+
+    filename (str): The pcap file to write.  Missing directories are created.
+
+    linktype (int): The pcap link type, full-speed USB 2.0 by default.
+    """
+
+    def __init__(self, filename, linktype=LINKTYPE_USB_2_0_FULL_SPEED):
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.filename = filename
+        self._file = open(filename, "wb")
+        self._file.write(pcap_header(linktype))
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="pcap-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._file.write(pcap_record(*item))
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def write(self, data, timestamp):
+        """Queue the bytes of a packet (PID to CRC) seen at `timestamp` seconds."""
+        self._queue.put((bytes(data), timestamp))
+
+    def write_jk(self, value, timestamp, cycles=4):
+        """Queue a packet given as J/K line states, as used by the test benches.
+
+        Line states that do not decode to a packet are dropped.
+        """
+        data = decode_packet(value, cycles)
+        if data is not None:
+            self.write(data, timestamp)
+
+    def close(self):
+        """Write out all queued packets and close the file."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import tempfile
+import unittest
+
+from ..pid import PID
+from .packet import wrap_packet, data_packet, handshake_packet
+from .pcap import PcapWriter, LINKTYPE_USB_2_0_FULL_SPEED
+
+
+def read_pcap(filename):
+    with open(filename, "rb") as f:
+        data = f.read()
+    linktype = struct.unpack("<I", data[20:24])[0]
+    records = []
+    offset = 24
+    while offset < len(data):
+        sec, nsec, incl, orig = struct.unpack("<IIII", data[offset:offset+16])
+        offset += 16
+        records.append((sec * 10**9 + nsec, list(data[offset:offset+incl])))
+        offset += incl
+    return linktype, records
+
+
+class TestPcapWriter(unittest.TestCase):
+    def test_write_jk(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "capture", "test.pcap")
+            with PcapWriter(filename) as pcap:
+                pcap.write_jk(wrap_packet(data_packet(PID.DATA0, [5, 6])), 1e-6)
+                pcap.write_jk(wrap_packet(handshake_packet(PID.ACK)), 2.5e-6)
+                # Garbage on the line is not captured
+                pcap.write_jk("JJJJ____JJJJ", 3e-6)
+
+            linktype, records = read_pcap(filename)
+            self.assertEqual(linktype, LINKTYPE_USB_2_0_FULL_SPEED)
+            self.assertEqual(records, [
+                (1000, [0xc3, 5, 6, 125, 29]),
+                (2500, [0xd2]),
+            ])
+
+    def test_close_twice(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pcap = PcapWriter(os.path.join(tmpdir, "test.pcap"))
+            pcap.write([0xd2], 0)
+            pcap.close()
+            pcap.close()
+            self.assertEqual(read_pcap(pcap.filename)[1], [(0, [0xd2])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import os
+import re
+import shutil
 import tempfile
 
 def write_gtkwave_file(vcd_filename):
@@ -61,10 +64,90 @@ i_usbn
 """.format(**locals()))
 
 
-def add_vcd_timescale(filename, timescale=435):
-    tempfile = tempfile.SpooledTemporaryFile()
-    with open(filename) as f:
-        data = f.read()
-    with open(filename, 'w') as f:
-        f.write("$timescale %ips $end\n" % timescale)
-        f.write(data)
+# Copy large VCD files in chunks this size, so memory use stays bounded.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# A header comment that VCD writers can emit so the timescale can later be
+# patched in place instead of rewriting the whole file.
+VCD_HEADER_RESERVE = "$comment" + " " * 48 + "$end\n"
+
+# Give up looking for the end of the declarations after this much.
+MAX_HEADER_SIZE = 64 * 1024 * 1024
+
+_RESERVED_RE = re.compile(rb"\$comment\s*\$end")
+
+
+def _read_vcd_header(f, chunk_size=CHUNK_SIZE):
+    """Read from `f` up to the end of the VCD declarations."""
+    header = b""
+    while True:
+        chunk = f.read(chunk_size)
+        header += chunk
+        end = header.find(b"$enddefinitions")
+        if end >= 0:
+            return header[:end]
+        if not chunk or len(header) >= MAX_HEADER_SIZE:
+            return header
+
+
+def add_vcd_timescale(filename, timescale=435, chunk_size=CHUNK_SIZE):
+    """Add a `$timescale` declaration to the top of a VCD file.
+
+    Files that already declare a timescale are left untouched.  If the header
+    has a blank `$comment` block big enough (see `VCD_HEADER_RESERVE`) it is
+    overwritten in place, otherwise the file is rewritten through a temporary
+    file in `chunk_size` pieces.
+
+    Returns True if the file was changed.
+    """
+    line = ("$timescale %ips $end" % timescale).encode("ascii")
+
+    with open(filename, "rb") as f:
+        header = _read_vcd_header(f, chunk_size)
+    if b"$timescale" in header:
+        return False
+
+    for m in _RESERVED_RE.finditer(header):
+        size = m.end() - m.start()
+        if size >= len(line):
+            with open(filename, "r+b") as f:
+                f.seek(m.start())
+                f.write(line.ljust(size))
+            return True
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".vcd")
+    try:
+        with os.fdopen(fd, "wb") as dst, open(filename, "rb") as src:
+            dst.write(line + b"\n")
+            shutil.copyfileobj(src, dst, chunk_size)
+        shutil.copymode(filename, tmpname)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+    return True
+
+
+def main(argv=None):
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser(description="Add a $timescale to VCD files")
+    parser.add_argument("files", nargs="+", help="VCD files to patch")
+    parser.add_argument("-t", "--timescale", type=int, default=435,
+                        help="Timescale in ps (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of files to process at once (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        results = executor.map(add_vcd_timescale, args.files, [args.timescale] * len(args.files))
+        for filename, changed in zip(args.files, results):
+            print("%s: %s" % (filename, "patched" if changed else "already has a timescale"))
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from .vcd import add_vcd_timescale, VCD_HEADER_RESERVE
+
+HEADER = "$scope module top $end\n$var wire 1 ! clk $end\n$upscope $end\n$enddefinitions $end\n"
+BODY = "".join("#%d\n%d!\n" % (t, t & 1) for t in range(2000))
+
+
+class TestAddVcdTimescale(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "test.vcd")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, data):
+        with open(self.filename, "w") as f:
+            f.write(data)
+
+    def read(self):
+        with open(self.filename) as f:
+            return f.read()
+
+    def test_rewrite(self):
+        self.write(HEADER + BODY)
+        self.assertTrue(add_vcd_timescale(self.filename, chunk_size=100))
+        self.assertEqual(self.read(), "$timescale 435ps $end\n" + HEADER + BODY)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["test.vcd"])
+
+    def test_already_present(self):
+        data = "$timescale 1ps $end\n" + HEADER + BODY
+        self.write(data)
+        self.assertFalse(add_vcd_timescale(self.filename, chunk_size=100))
+        self.assertEqual(self.read(), data)
+
+    def test_in_place(self):
+        self.write(VCD_HEADER_RESERVE + HEADER + BODY)
+        self.assertTrue(add_vcd_timescale(self.filename, timescale=100))
+        data = self.read()
+        self.assertEqual(len(data), len(VCD_HEADER_RESERVE + HEADER + BODY))
+        self.assertTrue(data.startswith("$timescale 100ps $end "))
+        self.assertTrue(data.endswith(HEADER + BODY))
+
+    def test_reserve_too_small(self):
+        self.write("$comment $end\n" + HEADER + BODY)
+        self.assertTrue(add_vcd_timescale(self.filename))
+        self.assertEqual(self.read(), "$timescale 435ps $end\n$comment $end\n" + HEADER + BODY)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+import array
+import bisect
+import json
+import mmap
+import os
+import re
+from collections import namedtuple
+
+from ..pid import PID
+from .packet import decode_packet
+
+# Signals from `sim/tb.v` that get indexed.  The first scope that declares
+# each name wins, which is the testbench itself when dumping from `tb`.
+USB_SIGNALS = ("usb_d_p", "usb_d_n", "usb_tx_en")
+TEST_NAME_SIGNAL = "test_name"
+
+INDEX_MAGIC = b"VLNTYIDX1\n"
+
+_TIMESCALE_UNITS = {
+    "s": 10**12, "ms": 10**9, "us": 10**6, "ns": 10**3, "ps": 1, "fs": 10**-3,
+}
+
+Packet = namedtuple("Packet", ["start", "end", "direction", "data"])
+Packet.__doc__ = """A decoded USB packet.
+
+start, end : int
+    Times in VCD units of the first sync symbol and of the end-of-packet.
+
+direction : str
+    ``"device"`` if the device was driving the bus (``usb_tx_en`` high),
+    otherwise ``"host"``.
+
+data : list of int
+    The bytes on the wire, starting with the PID and including the CRC.
+"""
+
+
+def _packet_pid(self):
+    return PID(self.data[0] & 0xf)
+Packet.pid = property(_packet_pid)
+
+
+def _decode_test_name(value):
+    """Decode a `test_name` vector value back into its ASCII name.
+
+    >>> _decode_test_name(b"0110000101100010")
+    'ab'
+    >>> _decode_test_name(b"x")
+    ''
+    """
+    if not value or not set(value) <= set(b"01"):
+        return ""
+    n = int(value, 2)
+    return n.to_bytes((n.bit_length() + 7) // 8, "big").decode("ascii", "replace").strip("\x00")
+
+
+class VcdIndex:
+    """Index the USB signals of a (large) VCD file for fast packet queries.
+
+    Building the index makes a single pass over the memory-mapped VCD and
+    records the time, file offset and value of every change of the USB
+    signals, as well as the offset of every `test_name` change.  The index
+    is saved next to the VCD (``dump.vcd.idx``) and reused as long as the
+    VCD has not changed, so later queries never touch the bulk of the VCD.
+
+    Packets are decoded on demand from the recorded line states.
+
+    Args
+    ----
+
+    vcd_filename (str): The VCD file to index.
+
+    index_filename (str, optional): Where to keep the index.  Defaults to the
+        VCD name with ``.idx`` appended.
+
+    bit_time (float, optional): Duration of one USB bit in VCD time units.
+        By default this is derived from the ``$timescale`` of the VCD,
+        assuming a full-speed (12 Mbit/s) bus.
+    """
+
+    def __init__(self, vcd_filename, index_filename=None, bit_time=None, rebuild=False):
+        self.vcd_filename = vcd_filename
+        self.index_filename = index_filename or (vcd_filename + ".idx")
+        self.changes = {}
+        self.meta = {}
+
+        if rebuild or not self._load():
+            self._build()
+            self._save()
+
+        if bit_time is None:
+            bit_time = 10**12 / 12e6 / self.meta["timescale_ps"]
+        self.bit_time = bit_time
+
+    # Index creation ---------------------------------------------------
+    def _stat(self):
+        st = os.stat(self.vcd_filename)
+        return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+    def _parse_header(self, mm):
+        end = mm.find(b"$enddefinitions")
+        if end < 0:
+            raise ValueError("%s: no $enddefinitions found" % self.vcd_filename)
+        header = mm[:end].decode("ascii", "replace")
+
+        timescale_ps = 1
+        m = re.search(r"\$timescale\s+(\d+)\s*([munpf]?s)\s+\$end", header)
+        if m:
+            timescale_ps = int(m.group(1)) * _TIMESCALE_UNITS[m.group(2)]
+
+        ids = {}
+        for m in re.finditer(r"\$var\s+\S+\s+(\d+)\s+(\S+)\s+(\S+)(?:\s+\[[^\]]*\])?\s+\$end", header):
+            _, code, name = m.groups()
+            if name in USB_SIGNALS + (TEST_NAME_SIGNAL,) and name not in ids.values():
+                ids[code] = name
+        missing = set(USB_SIGNALS) - set(ids.values())
+        if missing:
+            raise ValueError("%s: missing signals %s" % (self.vcd_filename, ", ".join(sorted(missing))))
+
+        body = mm.find(b"\n", end) + 1
+        return timescale_ps, ids, body
+
+    def _build(self):
+        self.changes = {}
+        with open(self.vcd_filename, "rb") as f, \
+             mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            timescale_ps, ids, body = self._parse_header(mm)
+
+            for name in ids.values():
+                self.changes[name] = (array.array("Q"), array.array("Q"), array.array("B"))
+
+            codes = b"|".join(re.escape(c.encode()) for c in ids)
+            pattern = re.compile(
+                rb"^(?:#(\d+)|([01xzXZ])(" + codes + rb")|b(\S+) (" + codes + rb"))\s*$",
+                re.M)
+
+            now = 0
+            for m in pattern.finditer(mm, body):
+                if m.group(1) is not None:
+                    now = int(m.group(1))
+                    continue
+                if m.group(2) is not None:
+                    name = ids[m.group(3).decode()]
+                    value = m.group(2)
+                else:
+                    name = ids[m.group(5).decode()]
+                    value = m.group(4)[-1:]
+                times, offsets, values = self.changes[name]
+                times.append(now)
+                offsets.append(m.start())
+                values.append(value[0])
+
+        self.meta = dict(self._stat(), timescale_ps=timescale_ps, signals=sorted(self.changes))
+
+    def _save(self):
+        with open(self.index_filename, "wb") as f:
+            f.write(INDEX_MAGIC)
+            f.write(json.dumps(self.meta).encode() + b"\n")
+            for name in self.meta["signals"]:
+                times, offsets, values = self.changes[name]
+                f.write(("%d\n" % len(times)).encode())
+                times.tofile(f)
+                offsets.tofile(f)
+                values.tofile(f)
+
+    def _load(self):
+        try:
+            with open(self.index_filename, "rb") as f:
+                if f.readline() != INDEX_MAGIC:
+                    return False
+                meta = json.loads(f.readline().decode())
+                if {k: meta.get(k) for k in ("size", "mtime")} != self._stat():
+                    return False
+                changes = {}
+                for name in meta["signals"]:
+                    count = int(f.readline())
+                    arrays = (array.array("Q"), array.array("Q"), array.array("B"))
+                    for a in arrays:
+                        a.fromfile(f, count)
+                    changes[name] = arrays
+        except (OSError, ValueError, EOFError):
+            return False
+        self.meta = meta
+        self.changes = changes
+        return True
+
+    # Queries ----------------------------------------------------------
+    def value_at(self, name, t):
+        """Return the value (as a character) of `name` at time `t`."""
+        times, _, values = self.changes[name]
+        i = bisect.bisect_right(times, t) - 1
+        if i < 0:
+            return "x"
+        return chr(values[i])
+
+    def tests(self):
+        """Return a list of ``(name, start, end)`` for every `test_name` value.
+
+        `end` is None for the test that is still running at the end of the dump.
+        """
+        if TEST_NAME_SIGNAL not in self.changes:
+            return []
+        times, offsets, _ = self.changes[TEST_NAME_SIGNAL]
+        result = []
+        with open(self.vcd_filename, "rb") as f, \
+             mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for t, offset in zip(times, offsets):
+                line = mm[offset:mm.find(b"\n", offset)]
+                if not line.startswith(b"b"):
+                    continue
+                name = _decode_test_name(line[1:].split()[0])
+                if not name:
+                    continue
+                if result and result[-1][2] is None:
+                    result[-1] = result[-1][:2] + (t,)
+                result.append((name, t, None))
+        return result
+
+    def _line_states(self, start, end):
+        """Merge the D+/D- changes in ``[start, end)`` into J/K/SE0 runs."""
+        events = []
+        for name in ("usb_d_p", "usb_d_n"):
+            times, _, _ = self.changes[name]
+            lo = bisect.bisect_left(times, start)
+            hi = len(times) if end is None else bisect.bisect_left(times, end)
+            events.extend(times[lo:hi])
+        events = sorted(set(events))
+
+        runs = []
+        t = start
+        for t_next in events + [end]:
+            if t_next is not None and t_next <= t:
+                continue
+            dp = self.value_at("usb_d_p", t)
+            dn = self.value_at("usb_d_n", t)
+            state = {("1", "0"): "J", ("0", "1"): "K", ("0", "0"): "_"}.get((dp, dn), "?")
+            if runs and runs[-1][0] == state:
+                runs[-1][2] = t_next
+            else:
+                runs.append([state, t, t_next])
+            t = t_next
+            if t is None:
+                break
+        return runs
+
+    def packets(self, start=0, end=None):
+        """Decode all packets that start within ``[start, end)``."""
+        result = []
+        runs = self._line_states(start, end)
+        i = 0
+        while i < len(runs):
+            state, t0, _ = runs[i]
+            if state != "K":
+                i += 1
+                continue
+            # Collect runs up to and including the SE0 of the end-of-packet.
+            j = i
+            while j < len(runs) and runs[j][0] in "JK":
+                j += 1
+            if j >= len(runs) or runs[j][0] != "_" or runs[j][2] is None:
+                break
+            symbols = ""
+            for state, r0, r1 in runs[i:j+1]:
+                symbols += state * max(1, int(round((r1 - r0) / self.bit_time)))
+            data = decode_packet(symbols, cycles=1)
+            if data:
+                direction = "device" if self.value_at("usb_tx_en", t0) == "1" else "host"
+                result.append(Packet(t0, runs[j][2], direction, data))
+            i = j + 1
+        return result
+
+    def packets_in_test(self, name):
+        """Decode all packets sent while `test_name` was set to `name`."""
+        result = []
+        for test, start, end in self.tests():
+            if test == name:
+                result.extend(self.packets(start, end))
+        return result
+
+
+def format_packet(packet):
+    """Format a `Packet` as a single line of text.
+
+    >>> format_packet(Packet(10, 20, "host", [0xd2]))
+    '10-20 host   ACK'
+    >>> format_packet(Packet(10, 20, "device", [0xc3, 0x01, 0x02, 0x9b, 0x7a]))
+    '10-20 device DATA0 01 02 (crc 9b 7a)'
+    """
+    pid = packet.pid
+    text = "%d-%d %-6s %s" % (packet.start, packet.end, packet.direction, pid.name)
+    payload = packet.data[1:]
+    if pid in (PID.DATA0, PID.DATA1, PID.DATA2, PID.MDATA) and len(payload) >= 2:
+        body, crc = payload[:-2], payload[-2:]
+        if body:
+            text += " " + " ".join("%02x" % v for v in body)
+        text += " (crc %02x %02x)" % tuple(crc)
+    elif pid in (PID.SETUP, PID.OUT, PID.IN) and len(payload) == 2:
+        token = payload[0] | payload[1] << 8
+        text += " addr %d ep %d" % (token & 0x7f, (token >> 7) & 0xf)
+    elif pid == PID.SOF and len(payload) == 2:
+        text += " frame %d" % ((payload[0] | payload[1] << 8) & 0x7ff)
+    elif payload:
+        text += " " + " ".join("%02x" % v for v in payload)
+    return text
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Query USB packets in a simulation VCD dump")
+    parser.add_argument("vcd", help="VCD file to query, e.g. sim/dump.vcd")
+    parser.add_argument("--index", help="Index file (default: VCD name + .idx)")
+    parser.add_argument("--reindex", action="store_true", help="Rebuild the index even if it is up to date")
+    parser.add_argument("--list-tests", action="store_true", help="List the tests recorded in `test_name`")
+    parser.add_argument("--test", help="Show the packets of a single test")
+    parser.add_argument("--start", type=int, default=0, help="Start time, in VCD units")
+    parser.add_argument("--end", type=int, default=None, help="End time, in VCD units")
+    parser.add_argument("--bit-time", type=float, default=None,
+                        help="Duration of one USB bit, in VCD units (default: from $timescale)")
+    args = parser.parse_args(argv)
+
+    index = VcdIndex(args.vcd, index_filename=args.index, bit_time=args.bit_time, rebuild=args.reindex)
+    if args.list_tests:
+        for name, start, end in index.tests():
+            print("%s %d-%s" % (name, start, "" if end is None else end))
+        return 0
+
+    if args.test:
+        packets = index.packets_in_test(args.test)
+    else:
+        packets = index.packets(args.start, args.end)
+    for packet in packets:
+        print(format_packet(packet))
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
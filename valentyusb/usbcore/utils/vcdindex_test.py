@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from ..pid import PID
+from .packet import wrap_packet, token_packet, data_packet, handshake_packet
+from .vcdindex import VcdIndex
+
+
+def _write_vcd(f, tests, bit_time=833):
+    """Write a VCD laid out like the one `sim/tb.v` dumps.
+
+    `tests` is a list of (name, [(direction, packet), ...]).
+    """
+    f.write("$timescale\n\t100ps\n$end\n")
+    f.write("$scope module tb $end\n")
+    f.write("$var wire 1 ! usb_d_p $end\n")
+    f.write("$var wire 1 \" usb_d_n $end\n")
+    f.write("$var wire 1 # usb_tx_en $end\n")
+    f.write("$var reg 4096 $ test_name [4095:0] $end\n")
+    f.write("$upscope $end\n$enddefinitions $end\n")
+    f.write("#0\n$dumpvars\n1!\n0\"\n0#\nbx $\n$end\n")
+
+    t = 10 * bit_time
+    for name, packets in tests:
+        f.write("#%d\nb%s $\n" % (t, "".join("{:08b}".format(ord(c)) for c in name)))
+        t += 10 * bit_time
+        for direction, packet in packets:
+            f.write("#%d\n%s#\n" % (t - bit_time, "1" if direction == "device" else "0"))
+            for symbol in wrap_packet(packet, cycles=1):
+                dp, dn = {"J": "10", "K": "01", "_": "00"}[symbol]
+                f.write("#%d\n%s!\n%s\"\n" % (t, dp, dn))
+                t += bit_time
+            f.write("#%d\n0#\n" % t)
+            t += 20 * bit_time
+    f.write("#%d\n" % t)
+
+
+class TestVcdIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.vcd = os.path.join(self.tmpdir.name, "dump.vcd")
+        with open(self.vcd, "w") as f:
+            _write_vcd(f, [
+                ("test_setup", [
+                    ("host", token_packet(PID.SETUP, 0, 0)),
+                    ("host", data_packet(PID.DATA0, [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00])),
+                    ("device", handshake_packet(PID.ACK)),
+                ]),
+                ("test_in", [
+                    ("host", token_packet(PID.IN, 3, 1)),
+                    ("device", data_packet(PID.DATA1, [0xff] * 8)),
+                    ("host", handshake_packet(PID.ACK)),
+                ]),
+            ])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_tests(self):
+        index = VcdIndex(self.vcd)
+        names = [name for name, _, _ in index.tests()]
+        self.assertEqual(names, ["test_setup", "test_in"])
+
+    def test_packets_in_test(self):
+        index = VcdIndex(self.vcd)
+        packets = index.packets_in_test("test_in")
+        self.assertEqual([p.pid for p in packets], [PID.IN, PID.DATA1, PID.ACK])
+        self.assertEqual([p.direction for p in packets], ["host", "device", "host"])
+        self.assertEqual(packets[1].data[1:9], [0xff] * 8)
+
+        packets = index.packets_in_test("test_setup")
+        self.assertEqual([p.pid for p in packets], [PID.SETUP, PID.DATA0, PID.ACK])
+        self.assertEqual(packets[1].data[1:9], [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x40, 0x00])
+
+    def test_packets_time_range(self):
+        index = VcdIndex(self.vcd)
+        everything = index.packets()
+        self.assertEqual(len(everything), 6)
+        middle = index.packets(everything[1].start, everything[4].start)
+        self.assertEqual(middle, everything[1:4])
+
+    def test_index_reused(self):
+        VcdIndex(self.vcd)
+        self.assertTrue(os.path.exists(self.vcd + ".idx"))
+        index = VcdIndex(self.vcd)
+        self.assertEqual(len(index.packets()), 6)
+
+    def test_index_rebuilt_on_change(self):
+        VcdIndex(self.vcd)
+        with open(self.vcd, "w") as f:
+            _write_vcd(f, [("test_ack", [("device", handshake_packet(PID.ACK))])])
+        index = VcdIndex(self.vcd)
+        self.assertEqual([name for name, _, _ in index.tests()], ["test_ack"])
+        self.assertEqual([p.pid for p in index.packets()], [PID.ACK])
+
+
+if __name__ == "__main__":
+    unittest.main()